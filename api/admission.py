@@ -0,0 +1,112 @@
+"""
+Admission control for device requests that lead to upstream calls.
+
+Uploads and AI-process requests are checked before any work is done for
+them:
+
+- with ADMISSION_DEVICE_RATE set, each device that sends an X-Device-Id
+  has a token bucket of ADMISSION_DEVICE_BURST requests, refilled at
+  ADMISSION_DEVICE_RATE per second; beyond it the request gets a 429.
+  Requests without an id aren't rate limited, since the client address
+  is shared by every device behind a NAT or proxy;
+- if the upstream calls the request needs would queue for a concurrency
+  slot (see upstream.Limiter) for longer than UPSTREAM_DEADLINE allows, it
+  gets a 503 straight away, instead of holding a worker until the
+  deadline runs out.
+
+Both come with a Retry-After. Admitted requests still queue for their
+upstream's slots, where they go before batch work.
+"""
+import math
+import time
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from . import upstream
+
+
+class RateLimited(Exception):
+    """A device sent more requests than its token bucket allows"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+# What admit() raises, for the views to catch
+REJECTIONS = (upstream.Overloaded, RateLimited)
+
+
+class TokenBuckets:
+    """A token bucket per key, for the ``max_keys`` most recently seen keys"""
+
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """Take a token from ``key``'s bucket; return 0 if it had one, else the seconds until it will"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+device_buckets = TokenBuckets()
+
+_rejected = {'overloaded': 0, 'rate_limited': 0}
+_rejected_lock = threading.Lock()
+
+
+def rejected_counts():
+    """Requests turned away so far, by reason"""
+    with _rejected_lock:
+        return dict(_rejected)
+
+
+def _reject(reason, error):
+    with _rejected_lock:
+        _rejected[reason] += 1
+    return error
+
+
+def admit(device_id, upstreams=()):
+    """
+    Raise upstream.Overloaded or RateLimited if a request from ``device_id``
+    (None when the device sent no X-Device-Id) that calls ``upstreams`` (names in upstream.UPSTREAMS, one after the
+    other) should be turned away. Only an admitted request takes a token.
+    """
+    wait = 0.0
+    expected = 0.0
+    for name in upstreams:
+        limiter = upstream.UPSTREAMS[name].limiter
+        queued = limiter.estimated_wait()
+        wait += queued
+        expected += queued + (limiter.hold or 0.0)
+    if wait and expected > settings.UPSTREAM_DEADLINE:
+        raise _reject('overloaded', upstream.Overloaded(
+            f"Server busy: {', '.join(upstreams)} would not answer within {settings.UPSTREAM_DEADLINE:.0f}s", wait
+        ))
+
+    rate = settings.ADMISSION_DEVICE_RATE
+    if device_id and rate:
+        retry_after = device_buckets.take(device_id, rate, settings.ADMISSION_DEVICE_BURST)
+        if retry_after:
+            raise _reject('rate_limited', RateLimited("Too many requests from this device", retry_after))
+
+
+def rejection(error):
+    """Body, status code and headers of the response for an error from admit()"""
+    retry_after = max(1, math.ceil(error.retry_after))
+    code = 429 if isinstance(error, RateLimited) else 503
+    return {"error": str(error), "retry_after": retry_after}, code, {"Retry-After": str(retry_after)}
@@ -1,5 +1,26 @@
+import threading
 from django.apps import AppConfig
+from django.core import checks
+from django.conf import settings
 
 
 class ApiConfig(AppConfig):
     name = 'api'
+
+    def ready(self):
+        from .tts_formats import check_transcoder
+        checks.register(check_transcoder)
+        if settings.API_WARMUP:
+            # Pay for model loading and SDK imports at startup instead of on the first request
+            from .recognizers import get_recognizer
+            from .speech_generator import warm_up
+            from .intents import prerender
+            get_recognizer().load()
+            warm_up()
+            # Needs gTTS on the first boot only, so it doesn't hold up startup
+            threading.Thread(target=prerender, name="intent-prerender", daemon=True).start()
+        if settings.TRANSCRIPTION_AUTOSTART:
+            # Queued jobs would otherwise wait for the next upload after a restart.
+            # In a thread, since it touches the database.
+            from .jobs import start_queue
+            threading.Thread(target=start_queue, name="transcription-autostart", daemon=True).start()
@@ -0,0 +1,101 @@
+"""
+Non-blocking clients for the remote speech APIs, used by the async views.
+
+Requests go through one pooled httpx.AsyncClient per event loop, so a
+worker keeps a bounded set of keep-alive connections to Google instead of
+a thread per in-flight call. Request building and response parsing reuse
+SpeechRecognition's and gTTS's own code; only the transport is replaced.
+That code is private to both libraries, so requirements.txt pins them and
+api/tests.py checks these clients against the libraries' public calls.
+"""
+import io
+import asyncio
+import weakref
+import httpx
+import speech_recognition as sr
+from django.conf import settings
+from .upstream import gtts_audio, parse_google
+
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_http_client():
+    """Return the pooled AsyncClient of the running event loop and its request semaphore"""
+    loop = asyncio.get_running_loop()
+    entry = _clients.get(loop)
+    if entry is None:
+        limit = settings.ASYNC_HTTP_MAX_CONNECTIONS
+        client = httpx.AsyncClient(
+            timeout=settings.ASYNC_HTTP_TIMEOUT,
+            limits=httpx.Limits(max_connections=limit, max_keepalive_connections=limit),
+        )
+        entry = _clients[loop] = (client, asyncio.Semaphore(limit))
+    return entry
+
+
+async def post(url, timeout=None, **kwargs):
+    """
+    POST through the pooled client. Callers past the connection limit wait
+    on the semaphore: httpcore rescans its whole queue on every assignment,
+    which costs more CPU than the requests themselves once hundreds wait.
+    """
+    if timeout is not None:
+        # httpx reads an explicit None as "no timeout"
+        kwargs['timeout'] = timeout
+    client, semaphore = get_http_client()
+    async with semaphore:
+        return await client.post(url, **kwargs)
+
+
+async def recognize_google(audio_data, language, endpoint=None, timeout=None):
+    """
+    Async counterpart of sr.Recognizer.recognize_google(with_confidence=True).
+
+    Returns (text, confidence), see upstream.parse_google, and raises
+    sr.UnknownValueError or sr.RequestError like the synchronous call.
+    """
+    from speech_recognition.recognizers.google import ENDPOINT, create_request_builder
+
+    builder = create_request_builder(endpoint=endpoint or ENDPOINT, language=language, filter_level=0)
+    # FLAC encoding runs the flac binary, keep it off the event loop
+    request = await asyncio.to_thread(builder.build, audio_data)
+    try:
+        response = await post(
+            request.full_url, content=request.data, headers=dict(request.header_items()), timeout=timeout
+        )
+        response.raise_for_status()
+    except httpx.HTTPStatusError as e:
+        raise sr.RequestError(f"recognition request failed: {e.response.reason_phrase}")
+    except httpx.HTTPError as e:
+        # As in upstream.recognize_google: the message can carry the URL, API key included
+        raise sr.RequestError(f"recognition connection failed: {type(e).__name__}")
+    return parse_google(response.text)
+
+
+async def synthesize(tts, timeout=None):
+    """
+    Return the MP3 bytes for a gTTS-like object without blocking the loop.
+
+    Real gTTS objects are sent over the pooled client. Objects with an
+    ``aread()`` coroutine (the benchmark stand-ins) are awaited directly;
+    anything else falls back to write_to_fp() in a worker thread.
+    """
+    if hasattr(tts, 'aread'):
+        return await tts.aread()
+
+    import gtts
+    # gtts.tts.gTTS is the real class even when gtts.gTTS was swapped for a stand-in
+    if not isinstance(tts, gtts.tts.gTTS):
+        buffer = io.BytesIO()
+        await asyncio.to_thread(tts.write_to_fp, buffer)
+        return buffer.getvalue()
+
+    audio = b''
+    for prepared in tts._prepare_requests():
+        try:
+            response = await post(prepared.url, content=prepared.body, headers=dict(prepared.headers), timeout=timeout)
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            raise gtts.gTTSError(f"TTS request failed: {e}")
+        audio += gtts_audio(response.text)
+    return audio
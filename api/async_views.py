@@ -0,0 +1,162 @@
+"""
+Async versions of the upload and AI-process endpoints, for ASGI servers.
+
+They answer like RawAudioUploadViewSet.create and AIProcessViewSet.retrieve,
+but await the remote APIs (api/async_clients.py) and the async ORM instead
+of blocking a thread, so one worker can keep hundreds of device requests
+in flight. DRF has no async views, so these are plain Django views.
+"""
+import time
+import uuid
+import asyncio
+import logging
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse, HttpResponseNotAllowed
+from .models import AudioFile
+from .serializers import AIProcessSerializer
+from .services import VoicePipeline, VoicePipelineError
+from .audio_processor import AudioProcessor
+from .jobs import get_queue
+from .storage import UPLOADS, media_storage, get_sweeper
+from .metrics import StageTimer, observe_stages
+from .audio_codecs import EXTENSIONS, negotiate, probe
+from .tts_formats import UnsupportedFormatError, requested_format, variant
+from .views import (
+    device_id_from, format_fields, generation_failed, inline_job_fields, unsupported_format, unsupported_upload,
+)
+from . import admission, upstream
+
+logger = logging.getLogger(__name__)
+
+
+def rejected(error):
+    body, code, headers = admission.rejection(error)
+    return JsonResponse(body, status=code, headers=headers)
+
+
+def _write_file(name, data):
+    path = media_storage.create_path(name)
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+
+async def upload_audio(request):
+    """
+    POST raw audio in any format RawAudioUploadViewSet accepts. Queued with
+    a 202 by default; with ?stream=1 it is transcribed before responding
+    and returned with a 201.
+    """
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+    content_type = request.META.get("CONTENT_TYPE")
+    container = negotiate(content_type)
+    if container is None:
+        logger.error(f"Unsupported Content-Type: {content_type}")
+        body, headers = unsupported_upload(content_type)
+        return JsonResponse(body, status=415, headers=headers)
+
+    streaming = request.GET.get("stream") in ("1", "true")
+    try:
+        admission.admit(device_id_from(request), ("stt",) if streaming else ())
+    except admission.REJECTIONS as e:
+        return rejected(e)
+
+    try:
+        filename = f"recording_{int(time.time())}_{uuid.uuid4().hex[:8]}{EXTENSIONS[container]}"
+        name = media_storage.shard(f"{UPLOADS}/{filename}")
+
+        timer = StageTimer()
+        with timer.stage("upload"):
+            # The ASGI handler has already spooled the body by the time the view runs
+            body = request.body
+            file_path = await asyncio.to_thread(_write_file, name, body)
+        logger.info(f"Saved file: {filename}, Size: {len(body)} bytes")
+        audio_format = probe(body)
+
+        audio_file = await AudioFile.objects.acreate(
+            audio_file=name,
+            original_filename=filename,
+            device_id=device_id_from(request),
+            stage_timings=timer.stages,
+            **format_fields(audio_format),
+            # A streamed upload is transcribed right here rather than by the queue
+            **(inline_job_fields() if streaming else {}),
+        )
+        file_url = f"http://{request.get_host()}{settings.MEDIA_URL}{name}"
+        get_sweeper().start()
+        data = {
+            "id": str(audio_file.id), "filename": filename, "url": file_url,
+            "format": audio_format._asdict() if audio_format else None,
+        }
+
+        if streaming:
+            result = await AudioProcessor().aconvert_wav_bytes_to_text(body, source=file_path)
+            result["timings"] = {**timer.stages, **result.get("timings", {})}
+            observe_stages(result["timings"])
+            await sync_to_async(audio_file.save_transcription)(result)
+            if result.get("retry_after"):
+                return rejected(upstream.Overloaded(result["error"], result["retry_after"]))
+            return JsonResponse({
+                **data,
+                "status": audio_file.status,
+                "transcription": result.get("text") if result.get("success") else None,
+                "transcription_error": result.get("error") if not result.get("success") else None,
+            }, status=201)
+
+        observe_stages(timer.stages)
+        await sync_to_async(get_queue().enqueue)(audio_file)
+        return JsonResponse({**data, "status": audio_file.status}, status=202)
+
+    except Exception as e:
+        logger.error(f"Error processing upload: {str(e)}")
+        return JsonResponse({"error": f"Upload failed: {str(e)}"}, status=500)
+
+
+async def ai_process(request, pk):
+    """GET the spoken AI response for a transcribed upload, in the audio format asked for"""
+    if request.method != "GET":
+        return HttpResponseNotAllowed(["GET"])
+    try:
+        audio_format = requested_format(request)
+    except UnsupportedFormatError as e:
+        return JsonResponse(unsupported_format(e), status=406)
+    try:
+        pipeline = VoicePipeline()
+        audio_file = await pipeline.aget_transcription(pk)
+        admission.admit(device_id_from(request), pipeline.upstreams(audio_file))
+        handler = await pipeline.arespond(audio_file)
+        if not handler.processed:
+            return JsonResponse(generation_failed(audio_file, handler), status=502)
+        audio_path = handler.audio_file.name if handler.audio_file else None
+        if audio_path:
+            audio_path = await asyncio.to_thread(variant, audio_path, audio_format)
+    except VoicePipelineError as e:
+        return JsonResponse({"error": e.message, **e.details}, status=400)
+    except admission.REJECTIONS as e:
+        return rejected(e)
+    except UnsupportedFormatError as e:
+        return JsonResponse(unsupported_format(e), status=406)
+    except Exception as e:
+        return JsonResponse({"error": f"Processing error: {str(e)}"}, status=500)
+
+    serializer = AIProcessSerializer(data={
+        "response_id": pk,
+        "request_text": audio_file.transcription,
+        "response_text": handler.response_text,
+        "audio_link": request.build_absolute_uri(f"{settings.MEDIA_URL}{audio_path}") if audio_path else None,
+        "audio_format": audio_format,
+        "intent": handler.intent,
+        "action": handler.action,
+        "is_successful": bool(audio_path),
+        "created_at": audio_file.created_at,
+    })
+    if serializer.is_valid():
+        return JsonResponse(serializer.data)
+    return JsonResponse(serializer.errors, status=400)
+
+
+# Devices post without a CSRF token. csrf_exempt() is not async-aware before
+# Django 5.0, so the flag is set directly.
+upload_audio.csrf_exempt = True
@@ -0,0 +1,625 @@
+"""
+Decoders for the compressed formats devices can upload instead of PCM WAV
+(and the IMA-ADPCM encoder api/tts_formats.py uses for playback).
+
+- IMA-ADPCM in a WAV container (format tag 0x0011): 4 bits per sample, so
+  a quarter of the bytes of 16-bit PCM, and cheap enough for an ESP32 to
+  encode as it records. Decoded block by block with audioop.
+- FLAC: lossless, roughly half of PCM for speech. Decoded by the flac
+  binary SpeechRecognition ships with (or the system one).
+- Ogg Opus: the smallest, but it needs the optional opuslib package and
+  libopus; it is only offered when both are installed.
+
+Every decoder is incremental: feed() takes the upload's bytes as they
+arrive and returns the 16-bit PCM decoded so far, finish() returns the
+rest. ``format`` is set once the stream header has been read, and
+``frames`` counts what was decoded, so durations come from the stream
+itself rather than the byte count.
+"""
+import os
+import mmap
+import struct
+import logging
+import audioop
+import threading
+import subprocess
+from functools import lru_cache
+from collections import namedtuple
+import numpy as np
+from django.conf import settings
+from django.utils.http import parse_header_parameters
+from .audio_processor import (
+    parse_wav_header, WavFormatError, WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT, WAVE_FORMAT_IMA_ADPCM,
+)
+
+logger = logging.getLogger(__name__)
+
+# Upload containers, by the Content-Type devices send
+CONTENT_TYPES = {
+    'audio/wav': 'wav',
+    'audio/x-wav': 'wav',
+    'audio/wave': 'wav',
+    'audio/vnd.wave': 'wav',
+    'audio/flac': 'flac',
+    'audio/x-flac': 'flac',
+    'audio/ogg': 'ogg',
+    'audio/opus': 'ogg',
+}
+# File extension an upload is stored under, per container
+EXTENSIONS = {'wav': '.wav', 'flac': '.flac', 'ogg': '.opus'}
+
+WAV_CODECS = {
+    WAVE_FORMAT_PCM: 'pcm',
+    WAVE_FORMAT_IEEE_FLOAT: 'float',
+    0x0006: 'alaw',
+    0x0007: 'ulaw',
+    WAVE_FORMAT_IMA_ADPCM: 'ima-adpcm',
+}
+
+# Opus always counts granule positions and pre-skip at 48 kHz, but libopus
+# can decode straight to any of these rates
+OPUS_GRANULE_RATE = 48000
+OPUS_RATES = (8000, 12000, 16000, 24000, 48000)
+# Longest Opus packet: 120 ms
+OPUS_MAX_PACKET_MS = 120
+
+AudioFormat = namedtuple('AudioFormat', ['codec', 'sample_rate', 'channels', 'duration_ms'])
+
+
+class DecodeError(ValueError):
+    """Raised when an upload can't be decoded"""
+
+
+def sniff(buffer):
+    """Container of an upload by its magic bytes: 'wav', 'flac', 'ogg' or None"""
+    magic = bytes(buffer[:4])
+    if magic == b'RIFF':
+        return 'wav'
+    if magic == b'fLaC':
+        return 'flac'
+    if magic == b'OggS':
+        return 'ogg'
+    return None
+
+
+def flac_available():
+    try:
+        from speech_recognition.audio import get_flac_converter
+        get_flac_converter()
+    except OSError:
+        return False
+    return True
+
+
+def opus_available():
+    try:
+        import opuslib  # noqa: F401
+    except Exception:
+        # opuslib raises a bare Exception when libopus itself is missing
+        return False
+    return True
+
+
+@lru_cache(maxsize=None)
+def available_containers():
+    """Containers this server can decode, checked once per process (Python retries failed imports)"""
+    containers = ['wav']
+    if flac_available():
+        containers.append('flac')
+    if opus_available():
+        containers.append('ogg')
+    return containers
+
+
+def supported_content_types():
+    """Content-Types the upload endpoints accept on this server"""
+    containers = available_containers()
+    return [content_type for content_type, container in CONTENT_TYPES.items() if container in containers]
+
+
+def negotiate(content_type):
+    """
+    Container for the Content-Type header of an upload, or None if this
+    server can't decode it. audio/ogg must be Opus if a codecs= is given.
+    """
+    media_type, params = parse_header_parameters(content_type or '')
+    container = CONTENT_TYPES.get(media_type.lower())
+    if container is None or container not in available_containers():
+        return None
+    if container == 'ogg' and params.get('codecs', 'opus').lower() != 'opus':
+        return None
+    return container
+
+
+def needs_decoding(buffer):
+    """True if the buffer holds a format AudioProcessor reads through this module"""
+    container = sniff(buffer)
+    if container != 'wav':
+        return container is not None
+    try:
+        return parse_wav_header(buffer).format_tag == WAVE_FORMAT_IMA_ADPCM
+    except WavFormatError:
+        return False
+
+
+def downmix(pcm16, channels):
+    """Average interleaved 16-bit PCM down to mono"""
+    if channels == 1:
+        return pcm16
+    samples = np.frombuffer(pcm16, dtype='<i2')
+    samples = samples[:len(samples) - len(samples) % channels].reshape(-1, channels)
+    return samples.mean(axis=1).astype('<i2').tobytes()
+
+
+# audioop reads the high nibble of each byte first, WAV IMA-ADPCM the low one
+_SWAP_NIBBLES = bytes(((b & 0x0F) << 4) | (b >> 4) for b in range(256))
+
+
+def adpcm_samples_per_block(block_align, channels):
+    """Samples per channel in a WAV IMA-ADPCM block: the header sample plus two per data byte"""
+    return (block_align - 4 * channels) * 2 // channels + 1
+
+
+def adpcm_frames(data_size, block_align, channels):
+    """Samples per channel in ``data_size`` bytes of WAV IMA-ADPCM blocks"""
+    blocks, tail = divmod(data_size, block_align)
+    frames = blocks * adpcm_samples_per_block(block_align, channels)
+    if tail > 4 * channels:
+        frames += adpcm_samples_per_block(tail, channels)
+    return frames
+
+
+def encode_ima_adpcm_wav(pcm16, sample_rate, block_align=512):
+    """
+    Encode mono 16-bit PCM as a WAV IMA-ADPCM file. Every block restarts
+    from a verbatim sample, so a player can start decoding at any block.
+    """
+    samples_per_block = adpcm_samples_per_block(block_align, 1)
+    block_bytes = samples_per_block * 2
+    index = 0
+    blocks = []
+    for offset in range(0, len(pcm16) - len(pcm16) % 2, block_bytes):
+        block = pcm16[offset:offset + block_bytes]
+        first, = struct.unpack_from('<h', block)
+        # The header carries the first sample and the step index the block starts from
+        header = struct.pack('<hBx', first, index)
+        data, (_, index) = audioop.lin2adpcm(block[2:], 2, (first, index))
+        blocks.append(header + data.translate(_SWAP_NIBBLES))
+    data = b''.join(blocks)
+    fmt = struct.pack('<HHIIHHHH', WAVE_FORMAT_IMA_ADPCM, 1, sample_rate,
+                      sample_rate * block_align // samples_per_block, block_align, 4, 2, samples_per_block)
+    chunks = (b'fmt ' + struct.pack('<I', len(fmt)) + fmt
+              + b'fact' + struct.pack('<II', 4, len(pcm16) // 2)
+              + b'data' + struct.pack('<I', len(data)) + data + b'\0' * (len(data) & 1))
+    return b'RIFF' + struct.pack('<I', 4 + len(chunks)) + b'WAVE' + chunks
+
+
+def decode_ima_block(block, channels):
+    """Decode one WAV IMA-ADPCM block (or the short last one) to interleaved 16-bit PCM"""
+    header = 4 * channels
+    if len(block) < header:
+        return b''
+    if channels == 1:
+        predictor, index = struct.unpack_from('<hB', block, 0)
+        pcm, _ = audioop.adpcm2lin(bytes(block[4:]).translate(_SWAP_NIBBLES), 2, (predictor, min(index, 88)))
+        return struct.pack('<h', predictor) + pcm
+
+    # After the headers, each channel's nibbles come in interleaved 4-byte groups
+    data = np.frombuffer(block, dtype=np.uint8, offset=header)
+    groups = data[:len(data) - len(data) % header].reshape(-1, channels, 4)
+    out = np.empty((1 + 8 * len(groups), channels), dtype='<i2')
+    for channel in range(channels):
+        predictor, index = struct.unpack_from('<hB', block, 4 * channel)
+        nibbles = groups[:, channel].tobytes().translate(_SWAP_NIBBLES)
+        pcm, _ = audioop.adpcm2lin(nibbles, 2, (predictor, min(index, 88)))
+        out[0, channel] = predictor
+        out[1:, channel] = np.frombuffer(pcm, dtype='<i2')
+    return out.tobytes()
+
+
+class Decoder:
+    """Incremental decoder of one upload to interleaved 16-bit PCM"""
+    codec = None
+
+    def __init__(self):
+        self.format = None
+        self.frames = 0
+
+    def feed(self, data):
+        """Add upload bytes; return the PCM they completed"""
+        raise NotImplementedError
+
+    def finish(self):
+        """Return the PCM left once the upload has ended"""
+        return b''
+
+    def close(self):
+        """Release the decoder without finishing it"""
+
+    @property
+    def duration_ms(self):
+        return None if self.format is None else int(self.frames * 1000 / self.format.sample_rate)
+
+    def _start(self, sample_rate, channels, duration_ms=None):
+        self.format = AudioFormat(self.codec, sample_rate, channels, duration_ms)
+
+    def _emit(self, pcm):
+        self.frames += len(pcm) // (2 * self.format.channels)
+        return pcm
+
+
+class ImaAdpcmDecoder(Decoder):
+    """WAV IMA-ADPCM, decoded a block at a time"""
+    codec = 'ima-adpcm'
+
+    def __init__(self):
+        super().__init__()
+        self._buffer = bytearray()
+        self._block_align = None
+        # Bytes of the data chunk still to come, or None if its size is a placeholder
+        self._remaining = None
+
+    def feed(self, data):
+        self._buffer += data
+        if self.format is None and not self._read_header():
+            return b''
+        if self._remaining is not None:
+            del self._buffer[self._remaining:]
+        usable = len(self._buffer) - len(self._buffer) % self._block_align
+        pcm = b''.join(
+            decode_ima_block(self._buffer[offset:offset + self._block_align], self.format.channels)
+            for offset in range(0, usable, self._block_align)
+        )
+        del self._buffer[:usable]
+        if self._remaining is not None:
+            self._remaining -= usable
+        return self._emit(pcm)
+
+    def finish(self):
+        if self.format is None:
+            raise DecodeError("Upload ended inside the WAV header")
+        pcm = decode_ima_block(self._buffer, self.format.channels)
+        self._buffer.clear()
+        return self._emit(pcm)
+
+    def _read_header(self):
+        try:
+            info = parse_wav_header(self._buffer)
+        except WavFormatError as e:
+            if bytes(self._buffer[:4]) != b'RIFF'[:len(self._buffer)] or len(self._buffer) > 4096:
+                raise DecodeError(str(e))
+            return False
+        if info.format_tag != WAVE_FORMAT_IMA_ADPCM:
+            raise DecodeError(f"Not an IMA-ADPCM WAV (format {info.format_tag:#06x})")
+        if info.block_align <= 4 * info.channels:
+            raise DecodeError(f"Invalid IMA-ADPCM block size {info.block_align}")
+
+        declared, = struct.unpack_from('<I', self._buffer, info.data_offset - 4)
+        self._remaining = None if declared in (0, 0xFFFFFFFF) else declared
+        self._block_align = info.block_align
+        duration_ms = None
+        if self._remaining is not None:
+            frames = adpcm_frames(self._remaining, info.block_align, info.channels)
+            duration_ms = int(frames * 1000 / info.sample_rate)
+        self._start(info.sample_rate, info.channels, duration_ms)
+        del self._buffer[:info.data_offset]
+        return True
+
+
+def parse_streaminfo(buffer):
+    """(sample_rate, channels, bits_per_sample, total_samples) from the FLAC STREAMINFO block"""
+    if len(buffer) < 42:
+        return None
+    if bytes(buffer[:4]) != b'fLaC' or buffer[4] & 0x7F != 0:
+        raise DecodeError("Not a FLAC stream")
+    # 20 bits sample rate, 3 bits channels - 1, 5 bits bits per sample - 1, 36 bits total samples
+    packed, = struct.unpack_from('>Q', buffer, 18)
+    sample_rate = packed >> 44
+    channels = ((packed >> 41) & 0x7) + 1
+    bits = ((packed >> 36) & 0x1F) + 1
+    total_samples = packed & 0xFFFFFFFFF
+    if not sample_rate:
+        raise DecodeError("FLAC stream has no sample rate")
+    return sample_rate, channels, bits, total_samples
+
+
+def flac_command():
+    from speech_recognition.audio import get_flac_converter
+    # --decode-through-errors: an upload cut off mid-frame still yields the
+    # audio that arrived, as a truncated WAV does
+    return [get_flac_converter(), '--decode', '--silent', '--stdout', '--decode-through-errors',
+            '--force-raw-format', '--endian=little', '--sign=signed', '-']
+
+
+class FlacDecoder(Decoder):
+    """
+    FLAC, piped through the flac binary as it arrives.
+
+    A reader thread drains flac's output so writing the upload into it
+    never blocks on a full pipe.
+    """
+    codec = 'flac'
+
+    def __init__(self):
+        super().__init__()
+        self._header = bytearray()
+        self._process = None
+        self._reader = None
+        self._output = bytearray()
+        self._output_lock = threading.Lock()
+        self._width = None
+
+    def feed(self, data):
+        if self._process is None:
+            self._header += data
+            info = parse_streaminfo(self._header)
+            if info is None:
+                return b''
+            self._spawn(info)
+            data, self._header = bytes(self._header), None
+        try:
+            self._process.stdin.write(data)
+        except BrokenPipeError:
+            raise DecodeError(self._failure())
+        return self._drain()
+
+    def finish(self):
+        if self._process is None:
+            raise DecodeError("Upload ended inside the FLAC header")
+        try:
+            self._process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self._reader.join()
+        if self._process.wait() != 0:
+            raise DecodeError(self._failure())
+        return self._drain(final=True)
+
+    def close(self):
+        if self._process is not None and self._process.poll() is None:
+            self._process.kill()
+            self._process.wait()
+
+    def _spawn(self, info):
+        sample_rate, channels, bits, total_samples = info
+        self._width = (bits + 7) // 8
+        self._start(sample_rate, channels, int(total_samples * 1000 / sample_rate) if total_samples else None)
+        self._process = subprocess.Popen(
+            flac_command(), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+        self._reader = threading.Thread(target=self._read, name="flac-reader", daemon=True)
+        self._reader.start()
+
+    def _read(self):
+        while True:
+            chunk = self._process.stdout.read1(65536)
+            if not chunk:
+                return
+            with self._output_lock:
+                self._output += chunk
+
+    def _drain(self, final=False):
+        frame = self._width * self.format.channels
+        with self._output_lock:
+            usable = len(self._output) if final else len(self._output) - len(self._output) % frame
+            pcm = bytes(self._output[:usable - usable % frame])
+            del self._output[:usable]
+        if self._width != 2:
+            pcm = audioop.lin2lin(pcm, self._width, 2)
+        return self._emit(pcm)
+
+    def _failure(self):
+        self.close()
+        message = self._process.stderr.read().decode(errors='replace').strip()
+        return f"FLAC decoding failed: {message.splitlines()[-1] if message else 'flac exited early'}"
+
+
+class OggReader:
+    """Split an Ogg stream into packets as its pages arrive"""
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._packet = bytearray()
+        # Granule position of the last complete page
+        self.granule = None
+
+    def feed(self, data):
+        """Add bytes and return the packets they completed"""
+        self._buffer += data
+        view = self._buffer
+        packets = []
+        offset = 0
+        while len(view) - offset >= 27:
+            if view[offset:offset + 4] != b'OggS':
+                raise DecodeError("Lost Ogg page sync")
+            header_size = 27 + view[offset + 26]
+            if len(view) - offset < header_size:
+                break
+            lacing = view[offset + 27:offset + header_size]
+            if len(view) - offset < header_size + sum(lacing):
+                break
+            position = offset + header_size
+            for size in lacing:
+                self._packet += view[position:position + size]
+                position += size
+                # A lacing value under 255 ends the packet; 255 continues it on
+                if size < 255:
+                    packets.append(bytes(self._packet))
+                    self._packet.clear()
+            granule, = struct.unpack_from('<q', view, offset + 6)
+            if granule != -1:
+                self.granule = granule
+            offset = position
+        del self._buffer[:offset]
+        return packets
+
+
+def parse_opus_head(packet):
+    """(channels, pre_skip, mapping_family) from an OpusHead packet"""
+    if len(packet) < 19 or packet[:8] != b'OpusHead':
+        raise DecodeError("Not an Ogg Opus stream")
+    channels, pre_skip = struct.unpack_from('<BH', packet, 9)
+    return channels, pre_skip, packet[18]
+
+
+class OpusDecoder(Decoder):
+    """Ogg Opus through opuslib, decoded straight to PREPROCESS_SAMPLE_RATE when libopus supports it"""
+    codec = 'opus'
+
+    def __init__(self):
+        super().__init__()
+        try:
+            import opuslib
+        except Exception as e:
+            raise DecodeError(f"missing opuslib module: pip install opuslib ({e})")
+        self._opuslib = opuslib
+        self._reader = OggReader()
+        self._decoder = None
+        self._packets = 0
+        self._skip = 0
+        rate = settings.PREPROCESS_SAMPLE_RATE
+        self._rate = rate if rate in OPUS_RATES else OPUS_GRANULE_RATE
+
+    def feed(self, data):
+        out = []
+        for packet in self._reader.feed(data):
+            self._packets += 1
+            if self._packets == 1:
+                channels, pre_skip, mapping = parse_opus_head(packet)
+                if mapping != 0 and channels > 2:
+                    raise DecodeError("Multistream Opus is not supported")
+                self._decoder = self._opuslib.Decoder(self._rate, channels)
+                self._skip = pre_skip * self._rate // OPUS_GRANULE_RATE * 2 * channels
+                self._start(self._rate, channels)
+            elif self._packets == 2:
+                continue  # OpusTags
+            else:
+                out.append(self._decode(packet))
+        if self.format is None:
+            # The OpusHead page hasn't arrived in full yet
+            return b''
+        return self._emit(b''.join(out))
+
+    def finish(self):
+        if self.format is None:
+            raise DecodeError("Upload ended inside the Opus header")
+        return b''
+
+    def _decode(self, packet):
+        try:
+            pcm = self._decoder.decode(packet, self._rate * OPUS_MAX_PACKET_MS // 1000)
+        except self._opuslib.OpusError as e:
+            raise DecodeError(f"Opus decoding failed: {e}")
+        if self._skip:
+            # Pre-skip: encoder delay at the start of the stream
+            skipped = min(self._skip, len(pcm))
+            self._skip -= skipped
+            pcm = pcm[skipped:]
+        return pcm
+
+
+DECODERS = {'flac': FlacDecoder, 'ogg': OpusDecoder}
+
+
+def open_decoder(container):
+    """Decoder for an upload in ``container``, picked by the WAV header for 'wav'"""
+    if container == 'wav':
+        return ImaAdpcmDecoder()
+    try:
+        return DECODERS[container]()
+    except KeyError:
+        raise DecodeError(f"Unsupported container: {container}")
+
+
+def decode(buffer):
+    """
+    Decode a whole IMA-ADPCM, FLAC or Opus upload.
+
+    Returns (AudioFormat, interleaved 16-bit PCM); the format's duration is
+    the length of the decoded audio.
+    """
+    container = sniff(buffer)
+    if container is None:
+        raise DecodeError("Unknown audio format")
+    if container == 'flac':
+        # One run of flac, without the reader thread of the streaming decoder
+        sample_rate, channels, bits, _ = parse_streaminfo(buffer) or (None,) * 4
+        if sample_rate is None:
+            raise DecodeError("Truncated FLAC header")
+        result = subprocess.run(flac_command(), input=buffer, capture_output=True)
+        if result.returncode != 0:
+            message = result.stderr.decode(errors='replace').strip()
+            raise DecodeError(f"FLAC decoding failed: {message.splitlines()[-1] if message else result.returncode}")
+        pcm = result.stdout
+        width = (bits + 7) // 8
+        pcm = pcm[:len(pcm) - len(pcm) % (width * channels)]
+        if width != 2:
+            pcm = audioop.lin2lin(pcm, width, 2)
+        frames = len(pcm) // (2 * channels)
+        return AudioFormat('flac', sample_rate, channels, int(frames * 1000 / sample_rate)), pcm
+
+    decoder = open_decoder(container)
+    try:
+        pcm = decoder.feed(buffer) + decoder.finish()
+    finally:
+        decoder.close()
+    return decoder.format._replace(duration_ms=decoder.duration_ms), pcm
+
+
+def probe(buffer):
+    """
+    AudioFormat of an upload from its headers alone, without decoding it.
+
+    Duration comes from the WAV data size, the IMA-ADPCM block count, the
+    FLAC STREAMINFO sample count or the last Ogg granule position, and is
+    None when the stream doesn't record it. Returns None for unknown data.
+    """
+    container = sniff(buffer)
+    try:
+        if container == 'wav':
+            info = parse_wav_header(buffer)
+            if info.format_tag == WAVE_FORMAT_IMA_ADPCM:
+                frames = adpcm_frames(info.data_size, info.block_align, info.channels)
+            else:
+                frames = info.data_size // max(info.channels * info.sample_width, 1)
+            codec = WAV_CODECS.get(info.format_tag, f"wav-{info.format_tag:#06x}")
+            return AudioFormat(codec, info.sample_rate, info.channels,
+                               int(frames * 1000 / info.sample_rate) if info.sample_rate else None)
+        if container == 'flac':
+            info = parse_streaminfo(buffer)
+            if info is None:
+                return None
+            sample_rate, channels, _, total_samples = info
+            return AudioFormat('flac', sample_rate, channels,
+                               int(total_samples * 1000 / sample_rate) if total_samples else None)
+        if container == 'ogg':
+            return _probe_ogg(buffer)
+    except (WavFormatError, DecodeError, struct.error) as e:
+        logger.warning(f"Could not read the audio header: {e}")
+    return None
+
+
+def _probe_ogg(buffer):
+    packets = OggReader().feed(buffer[:4096])
+    if not packets:
+        return None
+    channels, pre_skip, _ = parse_opus_head(packets[0])
+    input_rate, = struct.unpack_from('<I', packets[0], 12)
+    # The granule position of the last page (at most 65307 bytes) is the stream length at 48 kHz
+    tail = bytes(buffer[-65307:])
+    last = tail.rfind(b'OggS')
+    duration_ms = None
+    if last != -1 and len(tail) - last >= 14:
+        granule, = struct.unpack_from('<q', tail, last + 6)
+        if granule > pre_skip:
+            duration_ms = int((granule - pre_skip) * 1000 / OPUS_GRANULE_RATE)
+    return AudioFormat('opus', input_rate or OPUS_GRANULE_RATE, channels, duration_ms)
+
+
+def probe_file(path):
+    """probe() of a stored upload; the file is mapped, so only the pages probe() touches are read"""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return probe(mapped)
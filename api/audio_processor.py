@@ -1,33 +1,117 @@
 
+import io
 import os
-import speech_recognition as sr
-from pydub import AudioSegment
-import pydub
-import tempfile
+import asyncio
+import mmap
+import struct
+import hashlib
 import logging
-import shutil
+from collections import namedtuple
+from urllib.parse import urlparse
+import speech_recognition as sr
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from .cache import transcription_cache
+from .metrics import StageTimer
+from . import upstream
+from .storage import UPLOADS, media_storage
+from .recognizers import get_recognizer
+from .preprocessing import preprocess, SilentAudioError
 
 logger = logging.getLogger(__name__)
 
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_IMA_ADPCM = 0x0011
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# Error reported when the recognizer heard no words, as opposed to failing
+UNRECOGNIZED_ERROR = "Could not understand audio"
+# Error reported when preprocessing found nothing above the silence threshold
+SILENT_ERROR = "No speech detected"
+
+WavInfo = namedtuple('WavInfo', [
+    'format_tag', 'channels', 'sample_rate', 'sample_width', 'block_align', 'data_offset', 'data_size'
+])
+
+
+class WavFormatError(ValueError):
+    """Raised when a buffer is not a RIFF/WAVE file we can read"""
+
+
+def parse_wav_header(buffer):
+    """
+    Walk the RIFF chunks of a WAV buffer once and return a WavInfo with the
+    sample format and the location of the PCM data. No sample bytes are copied.
+    """
+    view = memoryview(buffer)
+    if len(view) < 12 or bytes(view[0:4]) != b'RIFF' or bytes(view[8:12]) != b'WAVE':
+        raise WavFormatError("Not a RIFF/WAVE file")
+
+    fmt = None
+    offset = 12
+    while offset + 8 <= len(view):
+        chunk_id = bytes(view[offset:offset + 4])
+        chunk_size, = struct.unpack_from('<I', view, offset + 4)
+        body = offset + 8
+
+        if chunk_id == b'fmt ':
+            if chunk_size < 16 or body + min(chunk_size, 26) > len(view):
+                raise WavFormatError("Truncated fmt chunk")
+            format_tag, channels, sample_rate, _, block_align, bits = struct.unpack_from('<HHIIHH', view, body)
+            if format_tag == WAVE_FORMAT_EXTENSIBLE and chunk_size >= 26:
+                # The sub-format GUID starts with the real format tag
+                format_tag, = struct.unpack_from('<H', view, body + 24)
+            fmt = (format_tag, channels, sample_rate, (bits + 7) // 8, block_align)
+
+        elif chunk_id == b'data':
+            if fmt is None:
+                raise WavFormatError("data chunk before fmt chunk")
+            # Streamed recordings often carry a placeholder size; trust the buffer instead
+            available = len(view) - body
+            if chunk_size == 0 or chunk_size > available:
+                chunk_size = available
+            frame_size = max(fmt[1] * fmt[3], 1)
+            return WavInfo(*fmt, data_offset=body, data_size=chunk_size - chunk_size % frame_size)
+
+        offset = body + chunk_size + (chunk_size & 1)
+
+    raise WavFormatError("No data chunk found")
+
+
+def pcm_view(buffer):
+    """Return (WavInfo, memoryview over the PCM samples) for a WAV buffer"""
+    info = parse_wav_header(buffer)
+    return info, memoryview(buffer)[info.data_offset:info.data_offset + info.data_size]
+
+
+def pcm_digest(audio_data):
+    """SHA-256 of the normalized PCM handed to the recognizer, including its format"""
+    digest = hashlib.sha256(f"{audio_data.sample_rate}:{audio_data.sample_width}:".encode())
+    digest.update(audio_data.frame_data)
+    return digest.hexdigest()
+
+
 class AudioProcessor:
     """
     Class for processing audio files and converting them to text.
     """
-    
-    def __init__(self):
-        self.recognizer = sr.Recognizer()
-    
+
+    def __init__(self, recognizer=None):
+        # Backends and their models are shared by every processor in the worker
+        self.recognizer = recognizer or get_recognizer()
+
     def convert_wav_to_text(self, audio_file_path):
         try:
-            from urllib.parse import urlparse
-            from django.conf import settings
-
             # Handle URL if provided
             if audio_file_path.startswith("http"):
                 parsed = urlparse(audio_file_path)
-                file_name = os.path.basename(parsed.path)
-                audio_file_path = os.path.join(settings.MEDIA_ROOT, "audio_files", file_name)
+                # Media URLs mirror the storage layout, shard directories included
+                if parsed.path.startswith(settings.MEDIA_URL):
+                    name = parsed.path[len(settings.MEDIA_URL):]
+                else:
+                    name = f"{UPLOADS}/{os.path.basename(parsed.path)}"
+                audio_file_path = media_storage.path(name)
                 logger.info(f"Converted URL to local path: {audio_file_path}")
 
             # Check file existence and permissions
@@ -40,42 +124,181 @@ class AudioProcessor:
                 return {"success": False, "error": "No read permission", "text": None}
 
             # Log file size
-            logger.info(f"File size: {os.path.getsize(audio_file_path)} bytes")
+            file_size = os.path.getsize(audio_file_path)
+            logger.info(f"File size: {file_size} bytes")
+            if file_size == 0:
+                return {"success": False, "error": "Audio loading failed: empty file", "text": None}
 
-            # Load audio
-            try:
-                audio = AudioSegment.from_wav(audio_file_path)
-                logger.info(f"Audio details: duration={len(audio)/1000}s, sample_rate={audio.frame_rate}, channels={audio.channels}")
-            except Exception as e:
-                logger.error(f"Failed to load WAV file with pydub: {e}")
-                return {"success": False, "error": f"Audio loading failed: {e}", "text": None}
-
-            # Use a simple temporary file
-            temp_path = os.path.join(tempfile.gettempdir(), "temp_audio.wav")
-            logger.info(f"Exporting to temp file: {temp_path}")
+            # Map the file instead of reading it so the samples are never copied
+            with open(audio_file_path, "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
             try:
-                audio.export(temp_path, format="wav")
-                if not os.path.exists(temp_path):
-                    logger.error(f"Temporary file not created: {temp_path}")
-                    return {"success": False, "error": "Failed to create temp file", "text": None}
-                with sr.AudioFile(temp_path) as source:
-                    audio_data = self.recognizer.record(source)
-                    text = self.recognizer.recognize_google(audio_data, language="en-US")
-                    return {"success": True, "error": None, "text": text}
+                return self.convert_wav_bytes_to_text(mapped, source=audio_file_path)
             finally:
-                if os.path.exists(temp_path):
-                    try:
-                        os.remove(temp_path)
-                        logger.info(f"Removed temp file: {temp_path}")
-                    except Exception as e:
-                        logger.warning(f"Failed to remove temp file {temp_path}: {e}")
-
-        except sr.UnknownValueError:
-            logger.warning(f"Speech Recognition could not understand audio: {audio_file_path}")
-            return {"success": False, "error": "Could not understand audio", "text": None}
-        except sr.RequestError as e:
-            logger.error(f"Could not request results from Google Speech Recognition service: {e}")
-            return {"success": False, "error": f"API unavailable: {e}", "text": None}
+                try:
+                    mapped.close()
+                except BufferError:
+                    # Unpreprocessed PCM reaches the recognizer as a view of the mapping, and an
+                    # attempt cut off at the deadline may still hold it; the mapping goes with it
+                    pass
+
         except Exception as e:
             logger.error(f"Error processing audio file {audio_file_path}: {e}")
-            return {"success": False, "error": str(e), "text": None}
\ No newline at end of file
+            return {"success": False, "error": str(e), "text": None}
+
+    def convert_wav_bytes_to_text(self, buffer, source="<buffer>"):
+        """
+        Transcribe a WAV file held in memory (uploaded bytes, bytearray or mmap).
+
+        The result carries the decode and recognize durations under "timings",
+        and "retry_after" when recognition was shed under load (see api/admission.py).
+        """
+        timer = StageTimer()
+        try:
+            with timer.stage("decode"):
+                audio_data, stats = self.load_audio_data(buffer)
+        except Exception as e:
+            return self._load_error(e, source, timer)
+
+        # Devices repeat the same commands; identical audio reuses the earlier text
+        digest = pcm_digest(audio_data)
+        cached = self._cache_hit(transcription_cache.get(digest), digest, stats, source, timer)
+        if cached:
+            return cached
+
+        with timer.stage("recognize"), upstream.deadline(settings.UPSTREAM_DEADLINE):
+            result = self.recognize(audio_data, source)
+        return self._recognized(result, digest, stats, timer)
+
+    def load_audio_data(self, buffer):
+        """
+        Build sr.AudioData for a WAV buffer and return it with its ClipStats.
+
+        With AUDIO_PREPROCESS the samples go through preprocessing.preprocess
+        (downmix, resample, trim, normalize) and SilentAudioError is raised for
+        clips without speech. Otherwise mono PCM is wrapped as a view of the
+        original bytes and the stats are None. IMA-ADPCM, FLAC and Opus are
+        decoded by audio_codecs; pydub is only used for formats none of these
+        paths can decode, such as A-law.
+        """
+        # Imported here: audio_codecs builds on parse_wav_header
+        from .audio_codecs import needs_decoding
+        if needs_decoding(buffer):
+            return self._load_compressed(buffer)
+
+        info, pcm = pcm_view(buffer)
+        duration = info.data_size / (info.sample_rate * info.channels * info.sample_width)
+        logger.info(f"Audio details: duration={duration}s, sample_rate={info.sample_rate}, channels={info.channels}")
+
+        is_float = info.format_tag == WAVE_FORMAT_IEEE_FLOAT and info.sample_width in (4, 8)
+        is_pcm = info.format_tag == WAVE_FORMAT_PCM and 1 <= info.sample_width <= 4
+        if settings.AUDIO_PREPROCESS and (is_pcm or is_float):
+            pcm16, stats = preprocess(pcm, info.sample_rate, info.sample_width, info.channels, is_float)
+            return sr.AudioData(pcm16, settings.PREPROCESS_SAMPLE_RATE, 2), stats
+
+        if is_pcm and info.channels == 1:
+            return sr.AudioData(pcm, info.sample_rate, info.sample_width), None
+
+        # Companded audio (or anything when preprocessing is off) needs a real conversion
+        from pydub import AudioSegment
+        logger.info(f"Converting format {info.format_tag:#06x} with {info.channels} channels via pydub")
+        segment = AudioSegment.from_file(io.BytesIO(buffer), format="wav").set_channels(1)
+        if settings.AUDIO_PREPROCESS:
+            pcm16, stats = preprocess(segment.raw_data, segment.frame_rate, segment.sample_width, 1)
+            return sr.AudioData(pcm16, settings.PREPROCESS_SAMPLE_RATE, 2), stats
+        return sr.AudioData(segment.raw_data, segment.frame_rate, segment.sample_width), None
+
+    def _load_compressed(self, buffer):
+        """load_audio_data for uploads audio_codecs has to decode first"""
+        from .audio_codecs import decode, downmix
+        audio_format, pcm16 = decode(buffer)
+        logger.info(f"Audio details: codec={audio_format.codec}, duration={audio_format.duration_ms / 1000}s, "
+                    f"sample_rate={audio_format.sample_rate}, channels={audio_format.channels}")
+        if settings.AUDIO_PREPROCESS:
+            pcm16, stats = preprocess(pcm16, audio_format.sample_rate, 2, audio_format.channels)
+            return sr.AudioData(pcm16, settings.PREPROCESS_SAMPLE_RATE, 2), stats
+        return sr.AudioData(downmix(pcm16, audio_format.channels), audio_format.sample_rate, 2), None
+
+    async def aconvert_wav_bytes_to_text(self, buffer, source="<buffer>"):
+        """Async convert_wav_bytes_to_text: decoding runs in a thread, recognition on the event loop"""
+        timer = StageTimer()
+        try:
+            with timer.stage("decode"):
+                audio_data, stats = await asyncio.to_thread(self.load_audio_data, buffer)
+        except Exception as e:
+            return self._load_error(e, source, timer)
+
+        digest = pcm_digest(audio_data)
+        cached = self._cache_hit(await sync_to_async(transcription_cache.get)(digest), digest, stats, source, timer)
+        if cached:
+            return cached
+
+        with timer.stage("recognize"), upstream.deadline(settings.UPSTREAM_DEADLINE):
+            result = await self.arecognize(audio_data, source)
+        return self._recognized(result, digest, stats, timer)
+
+    @staticmethod
+    def _load_error(error, source, timer):
+        """The failure result for a buffer load_audio_data() couldn't turn into speech"""
+        if isinstance(error, SilentAudioError):
+            logger.info(f"Rejected silent clip {source}")
+            return {"success": False, "error": SILENT_ERROR, "text": None, "stats": error.stats._asdict(),
+                    "timings": timer.stages}
+        logger.error(f"Failed to load WAV data from {source}: {error}")
+        return {"success": False, "error": f"Audio loading failed: {error}", "text": None, "timings": timer.stages}
+
+    @staticmethod
+    def _cache_hit(text, digest, stats, source, timer):
+        """The result for a transcription cache lookup that returned ``text``, or None on a miss"""
+        if text is None:
+            return None
+        logger.info(f"Transcription cache hit for {source}")
+        return {"success": True, "error": None, "text": text, "pcm_digest": digest,
+                "stats": stats._asdict() if stats else None, "timings": timer.stages}
+
+    @staticmethod
+    def _recognized(result, digest, stats, timer):
+        """Complete a recognize() result and cache its text"""
+        result["pcm_digest"] = digest
+        result["stats"] = stats._asdict() if stats else None
+        result["timings"] = timer.stages
+        if result["success"]:
+            transcription_cache.set(digest, result["text"])
+        return result
+
+    def recognize(self, audio_data, source="<buffer>"):
+        """Run speech recognition on sr.AudioData and return the result dict"""
+        try:
+            result = self.recognizer.recognize(audio_data)
+        except Exception as e:
+            return self._recognition_error(e, source)
+        return self._recognition_result(result, source)
+
+    async def arecognize(self, audio_data, source="<buffer>"):
+        """Async recognize() through the backends' arecognize"""
+        try:
+            result = await self.recognizer.arecognize(audio_data)
+        except Exception as e:
+            return self._recognition_error(e, source)
+        return self._recognition_result(result, source)
+
+    @staticmethod
+    def _recognition_result(result, source):
+        """Map a RecognitionResult to the success result dict"""
+        logger.info(f"Recognized {source} with {result.backend} (confidence={result.confidence})")
+        return {"success": True, "error": None, "text": result.text}
+
+    def _recognition_error(self, error, source):
+        """Map a recognizer exception to the failure result dict"""
+        if isinstance(error, sr.UnknownValueError):
+            logger.warning(f"Speech Recognition could not understand audio: {source}")
+            return {"success": False, "error": UNRECOGNIZED_ERROR, "text": None}
+        if isinstance(error, sr.RequestError):
+            logger.error(f"Could not request results from speech recognition service: {error}")
+            result = {"success": False, "error": f"API unavailable: {error}", "text": None}
+            if isinstance(error.__cause__, upstream.Overloaded):
+                # Shed rather than failed: the caller can try again later
+                result["retry_after"] = error.__cause__.retry_after
+            return result
+        logger.error(f"Error processing audio file {source}: {error}")
+        return {"success": False, "error": str(error), "text": None}
@@ -0,0 +1,265 @@
+import re
+import json
+import asyncio
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from .models import AudioFile, LLMResponse
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    """
+    Small thread-safe LRU map with hit/miss counters and optional expiry.
+    ``ttl`` is the seconds an entry stays valid (0 expires it at once);
+    None keeps entries until they are evicted.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        if self.maxsize <= 0:
+            return
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TranscriptionCache:
+    """
+    Reuse earlier transcriptions of byte-identical audio.
+
+    Keys are PCM digests (see audio_processor.pcm_digest). Lookups go to an
+    in-process LRU first and then to the indexed AudioFile.pcm_digest column,
+    so every worker benefits from transcriptions made by the others.
+    """
+
+    def __init__(self, maxsize=None):
+        self.memory = LRUCache(settings.TRANSCRIPTION_CACHE_SIZE if maxsize is None else maxsize)
+        self.db_hits = 0
+        self.misses = 0
+
+    def get(self, digest):
+        """Return the cached transcription text for a digest, or None"""
+        text = self.memory.get(digest)
+        if text is not None:
+            return text
+
+        text = (
+            AudioFile.objects.filter(pcm_digest=digest, is_successful=True)
+            .values_list('transcription', flat=True)
+            .first()
+        )
+        if text:
+            self.db_hits += 1
+            self.memory.set(digest, text)
+            return text
+        self.misses += 1
+        return None
+
+    def set(self, digest, text):
+        self.memory.set(digest, text)
+
+    def stats(self):
+        return {
+            'memory_hits': self.memory.hits,
+            'db_hits': self.db_hits,
+            'misses': self.misses,
+            'size': len(self.memory),
+        }
+
+
+def normalize_request_text(text):
+    """Case-fold and strip punctuation so trivially different utterances share a key"""
+    text = re.sub(r"[^\w\s']", " ", text.lower())
+    return " ".join(text.split())
+
+
+class LLMResponseCache:
+    """
+    Cache LLM answers by normalized request text, model and generation config.
+
+    Entries live in an in-process LRU with a TTL and in the LLMResponse
+    table, which survives restarts and is shared by every worker. The prompt
+    template is hashed into ``prompt_version`` and into every key, so
+    editing the template stops old answers from being served; purge_stale()
+    then deletes them.
+    """
+
+    def __init__(self, model_name, generation_config, prompt_template, maxsize=None, ttl=None):
+        self.model_name = model_name
+        self.generation_config = generation_config
+        self.prompt_version = hashlib.sha256(prompt_template.encode()).hexdigest()[:16]
+        self.ttl = settings.LLM_CACHE_TTL if ttl is None else ttl
+        self.memory = LRUCache(settings.LLM_CACHE_SIZE if maxsize is None else maxsize, ttl=self.ttl)
+        self.db_hits = 0
+        self.misses = 0
+
+    def key(self, text):
+        payload = json.dumps({
+            'text': normalize_request_text(text),
+            'model': self.model_name,
+            'config': self.generation_config,
+            'prompt': self.prompt_version,
+        }, sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, text):
+        """Return a cached response for the request text, or None"""
+        key = self.key(text)
+        response = self.memory.get(key)
+        if response is not None:
+            return response
+
+        now = timezone.now()
+        row = (
+            LLMResponse.objects.filter(key=key, expires_at__gt=now)
+            .values_list('response_text', 'expires_at')
+            .first()
+        )
+        if row is not None:
+            response, expires_at = row
+            self.db_hits += 1
+            # Don't let the memory copy outlive the database entry
+            self.memory.set(key, response, ttl=(expires_at - now).total_seconds())
+            return response
+        self.misses += 1
+        return None
+
+    def set(self, text, response):
+        key = self.key(text)
+        self.memory.set(key, response)
+        # One INSERT ... ON CONFLICT statement: update_or_create's read-then-write
+        # transaction fails at once with "database is locked" when SQLite writers overlap
+        LLMResponse.objects.bulk_create(
+            [LLMResponse(
+                key=key,
+                request_text=normalize_request_text(text),
+                response_text=response,
+                model_name=self.model_name,
+                prompt_version=self.prompt_version,
+                expires_at=timezone.now() + timedelta(seconds=self.ttl),
+            )],
+            update_conflicts=True,
+            unique_fields=['key'],
+            update_fields=['request_text', 'response_text', 'model_name', 'prompt_version', 'expires_at'],
+        )
+
+    def purge_stale(self, everything=False):
+        """Delete expired entries and those made with another prompt template"""
+        self.memory.clear()
+        rows = LLMResponse.objects.all()
+        if not everything:
+            rows = rows.filter(~Q(prompt_version=self.prompt_version) | Q(expires_at__lte=timezone.now()))
+        deleted, _ = rows.delete()
+        return deleted
+
+    def stats(self):
+        return {
+            'memory_hits': self.memory.hits,
+            'db_hits': self.db_hits,
+            'misses': self.misses,
+            'size': len(self.memory),
+        }
+
+
+class SingleFlight:
+    """
+    Collapse concurrent calls for the same key into one.
+
+    The first caller runs the function; callers arriving while it is in
+    flight wait for it and get the same result (or exception).
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': threading.Event(), 'result': None, 'error': None}
+
+        if not leader:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = fn(*args, **kwargs)
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+
+
+class AsyncSingleFlight:
+    """
+    SingleFlight for coroutine functions.
+
+    Callers on the same event loop await one shared task. Calls are keyed
+    per loop because a task can only be awaited from the loop running it.
+    """
+
+    def __init__(self):
+        self._tasks = {}
+
+    async def do(self, key, fn, *args, **kwargs):
+        flight_key = (asyncio.get_running_loop(), key)
+        task = self._tasks.get(flight_key)
+        if task is None:
+            task = self._tasks[flight_key] = asyncio.ensure_future(fn(*args, **kwargs))
+            task.add_done_callback(lambda _: self._tasks.pop(flight_key, None))
+        # A cancelled caller must not cancel the call the others are waiting on
+        return await asyncio.shield(task)
+
+
+transcription_cache = TranscriptionCache()
@@ -0,0 +1,106 @@
+"""
+Local answers for known device commands.
+
+Most requests are a handful of home-control phrases ("OK Google turn on the
+AC"). LOCAL_INTENTS maps phrase patterns to a fixed response and an action
+payload for the device; a transcription that matches one is answered
+without Gemini, and its speech was rendered at startup, so the answer is a
+stored clip. Only what doesn't match goes to the LLM.
+
+Patterns are regular expressions matched against the whole transcription
+after normalize_request_text and with a leading wake word removed. All of
+them are compiled into one alternation, so matching is a single regex
+call whatever the size of the table.
+"""
+import re
+import logging
+import threading
+from collections import namedtuple
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from .cache import normalize_request_text
+from . import upstream
+
+logger = logging.getLogger(__name__)
+
+Intent = namedtuple('Intent', ['name', 'response', 'action'])
+
+
+class IntentMatcher:
+    """Match transcriptions against a table of intents (see LOCAL_INTENTS for the format)"""
+
+    def __init__(self, table, wake_words=()):
+        self.intents = []
+        alternatives = []
+        for index, entry in enumerate(table):
+            self.intents.append(Intent(entry['name'], entry['response'], entry.get('action')))
+            patterns = '|'.join(f"(?:{pattern})" for pattern in entry['patterns'])
+            alternatives.append(f"(?P<i{index}>{patterns})")
+        wake_words = '|'.join(re.escape(normalize_request_text(word)) for word in wake_words)
+        try:
+            self._pattern = re.compile('|'.join(alternatives)) if alternatives else None
+            self._wake_word = re.compile(rf"^(?:{wake_words})\b\s*") if wake_words else None
+        except re.error as e:
+            raise ImproperlyConfigured(f"Invalid LOCAL_INTENTS pattern: {e}")
+        if self._pattern is not None:
+            # Each intent is an outer group, so lastindex names the one that matched
+            self._by_group = {self._pattern.groupindex[f"i{index}"]: intent for index, intent in enumerate(self.intents)}
+
+    def normalize(self, text):
+        text = normalize_request_text(text or '')
+        if self._wake_word is not None:
+            text = self._wake_word.sub('', text)
+        return text
+
+    def match(self, text):
+        """The Intent for a transcription, or None if it should go to the LLM"""
+        if self._pattern is None:
+            return None
+        match = self._pattern.fullmatch(self.normalize(text))
+        if match is None:
+            return None
+        return self._by_group.get(match.lastindex)
+
+    def responses(self):
+        """Texts whose speech should be ready before the first request"""
+        from .speech_generator import iter_sentences
+        texts = []
+        for intent in self.intents:
+            texts.append(intent.response)
+            # Streamed answers are synthesized sentence by sentence
+            sentences = list(iter_sentences([intent.response]))
+            if len(sentences) > 1:
+                texts += sentences
+        return list(dict.fromkeys(texts))
+
+
+def prerender(speech_processor=None):
+    """
+    Synthesize every canned response in LOCAL_INTENT_LANGUAGES and
+    TTS_DEFAULT_FORMAT. Clips are content-addressed, so after the first
+    boot this only checks that the files exist.
+    """
+    from .speech_generator import SpeechProcessor
+    speech_processor = speech_processor or SpeechProcessor()
+    texts = get_intents().responses()
+    failed = 0
+    with upstream.priority(upstream.BATCH):
+        for language in settings.LOCAL_INTENT_LANGUAGES:
+            for text in texts:
+                if speech_processor.generate_speech(text, language, settings.TTS_DEFAULT_FORMAT) is None:
+                    failed += 1
+    logger.info(f"Pre-rendered {len(texts) * len(settings.LOCAL_INTENT_LANGUAGES) - failed} intent responses"
+                f" ({failed} failed, rendered on first use instead)")
+
+
+_intents = None
+_intents_lock = threading.Lock()
+
+
+def get_intents():
+    """Return the process-wide matcher built from LOCAL_INTENTS"""
+    global _intents
+    with _intents_lock:
+        if _intents is None:
+            _intents = IntentMatcher(settings.LOCAL_INTENTS, settings.LOCAL_INTENT_WAKE_WORDS)
+        return _intents
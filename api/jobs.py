@@ -0,0 +1,212 @@
+import os
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, connections
+from django.utils import timezone
+from .models import AudioFile
+from .audio_processor import AudioProcessor, SILENT_ERROR
+from .preprocessing import SilentAudioError
+from .recognizers import get_recognizer
+from .metrics import observe_stages
+from . import upstream
+
+logger = logging.getLogger(__name__)
+
+
+def _init_worker_process():
+    """Drop database connections inherited from the parent over fork and load recognizers"""
+    connections.close_all()
+    get_recognizer().load()
+
+
+def _init_inspect_process():
+    """Like _init_worker_process, but for workers that never recognize"""
+    connections.close_all()
+
+
+def transcribe_file(file_path):
+    """Transcribe one file; module level so process workers can pickle it"""
+    # Queued and backlog jobs give way to uploads a device is waiting on
+    with upstream.priority(upstream.BATCH):
+        return AudioProcessor().convert_wav_to_text(file_path)
+
+
+def inspect_file(file_path):
+    """Decode and preprocess one file without recognizing it, for dry runs"""
+    if not file_path or not os.path.exists(file_path):
+        return {"success": False, "error": "File not found", "stats": None}
+    try:
+        with open(file_path, "rb") as f:
+            _, stats = AudioProcessor().load_audio_data(f.read())
+    except SilentAudioError as e:
+        return {"success": False, "error": SILENT_ERROR, "stats": e.stats._asdict()}
+    except Exception as e:
+        return {"success": False, "error": f"Audio loading failed: {e}", "stats": None}
+    return {"success": True, "error": None, "stats": stats._asdict() if stats else None}
+
+
+class TranscriptionQueue:
+    """
+    Database-backed transcription queue drained by a pool of workers.
+
+    Jobs are AudioFile rows in the ``queued`` state, so pending work lives in
+    the same SQLite database as everything else and survives a restart
+    without an external broker. Each worker thread claims the oldest queued
+    row with a conditional UPDATE, which keeps two workers (or two server
+    processes) from picking up the same job.
+    """
+
+    def __init__(self, workers=None, mode=None, poll_interval=None):
+        self.workers = workers or settings.TRANSCRIPTION_WORKERS
+        self.mode = mode or settings.TRANSCRIPTION_WORKER_MODE
+        self.poll_interval = poll_interval or settings.TRANSCRIPTION_POLL_INTERVAL
+        self._threads = []
+        self._pid = None
+        self._executor = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        self._stopping = threading.Event()
+
+    @property
+    def running(self):
+        return bool(self._threads)
+
+    def start(self):
+        """Start the worker pool, requeueing jobs abandoned by a previous run"""
+        with self._lock:
+            if self._threads and self._pid == os.getpid():
+                return
+            # Threads started before a fork (e.g. gunicorn --preload) don't exist in the child
+            self._threads = []
+            self._pid = os.getpid()
+            self._stopping.clear()
+            self.recover()
+            if self.mode == 'process':
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker_process)
+            for i in range(self.workers):
+                thread = threading.Thread(
+                    target=self._work, name=f"transcription-worker-{i}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+            logger.info(f"Started {self.workers} transcription workers ({self.mode} mode)")
+
+    def stop(self, wait=True):
+        """Stop the workers after their current job"""
+        with self._lock:
+            self._stopping.set()
+            with self._wakeup:
+                self._wakeup.notify_all()
+            if wait:
+                for thread in self._threads:
+                    thread.join()
+            if self._executor:
+                self._executor.shutdown(wait=wait)
+                self._executor = None
+            self._threads = []
+
+    def enqueue(self, audio_file):
+        """Mark an AudioFile as queued and wake an idle worker"""
+        if audio_file.status != AudioFile.STATUS_QUEUED:
+            audio_file.status = AudioFile.STATUS_QUEUED
+            audio_file.save(update_fields=['status'])
+        self.start()
+        with self._wakeup:
+            self._wakeup.notify()
+
+    def recover(self):
+        """Requeue jobs whose worker died before finishing them"""
+        cutoff = timezone.now() - timedelta(seconds=settings.TRANSCRIPTION_JOB_TIMEOUT)
+        count = AudioFile.objects.filter(
+            status=AudioFile.STATUS_RUNNING, claimed_at__lt=cutoff
+        ).update(status=AudioFile.STATUS_QUEUED, claimed_at=None)
+        if count:
+            logger.warning(f"Requeued {count} abandoned transcription jobs")
+        return count
+
+    def claim_next(self):
+        """Atomically move the oldest queued job to running and return it"""
+        while True:
+            pk = (
+                AudioFile.objects.filter(status=AudioFile.STATUS_QUEUED)
+                .order_by('created_at')
+                .values_list('pk', flat=True)
+                .first()
+            )
+            if pk is None:
+                return None
+            claimed = AudioFile.objects.filter(pk=pk, status=AudioFile.STATUS_QUEUED).update(
+                status=AudioFile.STATUS_RUNNING, claimed_at=timezone.now()
+            )
+            if claimed:
+                return AudioFile.objects.get(pk=pk)
+            # Another worker won the race for this row, try the next one
+
+    def process(self, job):
+        """Transcribe a claimed job and store the result on it"""
+        file_path = job.get_file_path()
+        try:
+            if not file_path or not os.path.exists(file_path):
+                result = {"success": False, "error": "File not found", "text": None}
+            elif self._executor:
+                result = self._executor.submit(transcribe_file, file_path).result()
+            else:
+                result = transcribe_file(file_path)
+        except Exception as e:
+            logger.error(f"Transcription job {job.pk} crashed: {e}")
+            result = {"success": False, "error": str(e), "text": None}
+        if result.get("retry_after"):
+            # Shed in favour of interactive requests; back off, then try again
+            logger.info(f"Transcription job {job.pk} shed, retrying in {result['retry_after']:.1f}s")
+            job.status = AudioFile.STATUS_QUEUED
+            job.claimed_at = None
+            job.save(update_fields=['status', 'claimed_at'])
+            self._stopping.wait(result["retry_after"])
+            return result
+        timings = result.setdefault("timings", {})
+        if job.claimed_at:
+            timings["queue_wait"] = (job.claimed_at - job.created_at).total_seconds()
+        # Observed here rather than in the worker, so process mode reports too
+        observe_stages(timings)
+        job.save_transcription(result)
+        logger.info(f"Transcription job {job.pk} finished, success={job.is_successful}")
+        return result
+
+    def _work(self):
+        while not self._stopping.is_set():
+            try:
+                job = self.claim_next()
+                if job is None:
+                    with self._wakeup:
+                        self._wakeup.wait(self.poll_interval)
+                    continue
+                self.process(job)
+            except Exception as e:
+                logger.error(f"Transcription worker error: {e}")
+            finally:
+                close_old_connections()
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    """Return the process-wide transcription queue"""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = TranscriptionQueue()
+        return _queue
+
+
+def start_queue():
+    """Start the process-wide queue at server startup, so jobs left from a previous run are picked up"""
+    try:
+        get_queue().start()
+    except DatabaseError as e:
+        # e.g. migrations not applied yet; the first upload starts it again
+        logger.error(f"Transcription queue not started: {e}")
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from api.speech_generator import llm_cache
+
+
+class Command(BaseCommand):
+    help = "Delete cached LLM answers that are expired or were made with an older prompt template"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help="Delete every cached answer")
+
+    def handle(self, *args, **options):
+        deleted = llm_cache.purge_stale(everything=options['all'])
+        self.stdout.write(f"Deleted {deleted} cached LLM responses")
@@ -0,0 +1,23 @@
+import time
+from django.core.management.base import BaseCommand
+from api.jobs import TranscriptionQueue
+
+
+class Command(BaseCommand):
+    help = "Run a dedicated pool of workers draining the transcription queue"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None, help="Number of worker threads")
+        parser.add_argument('--mode', choices=['thread', 'process'], default=None,
+                            help="Run recognition in threads or in a process pool")
+
+    def handle(self, *args, **options):
+        queue = TranscriptionQueue(workers=options['workers'], mode=options['mode'])
+        queue.start()
+        self.stdout.write(f"Draining transcription queue with {queue.workers} {queue.mode} workers")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping workers after their current job")
+            queue.stop()
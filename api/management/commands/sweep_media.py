@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError
+from api.storage import MediaSweeper, sweep_lock
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete uploads and generated clips past their retention or quota, orphaned uploads "
+        "and abandoned partial files (see MEDIA_RETENTION_DAYS and MEDIA_QUOTA_BYTES)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None, help="Files deleted per batch")
+        parser.add_argument('--pause', type=float, default=None, help="Seconds to sleep between batches")
+        parser.add_argument('--dry-run', action='store_true', help="Report what would be deleted without deleting")
+
+    def handle(self, *args, **options):
+        sweeper = MediaSweeper(batch_size=options['batch_size'], pause=options['pause'], dry_run=options['dry_run'])
+        with sweep_lock() as acquired:
+            if not acquired:
+                raise CommandError("Another process is sweeping the media directory")
+            stats = sweeper.sweep()
+        verb = "Would delete" if options['dry_run'] else "Deleted"
+        deleted = stats['expired'] + stats['over_quota'] + stats['orphans'] + stats['partial']
+        self.stdout.write(
+            f"Scanned {stats['scanned']} files. {verb} {deleted} ({stats['bytes_freed'] / 1024 ** 2:.1f} MB): "
+            f"{stats['expired']} expired, {stats['over_quota']} over quota, "
+            f"{stats['orphans']} orphaned, {stats['partial']} partial"
+        )
@@ -0,0 +1,220 @@
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from django.utils import timezone
+from api.jobs import _init_worker_process, _init_inspect_process, transcribe_file, inspect_file
+from api.models import AudioFile
+
+DEFAULT_CHECKPOINT = os.path.join(settings.BASE_DIR, '.transcribe_backlog.checkpoint')
+
+
+class RateLimiter:
+    """Space calls evenly so at most ``rate`` start per second"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_at = time.monotonic()
+
+    def wait(self):
+        if not self.interval:
+            return
+        now = time.monotonic()
+        if now < self.next_at:
+            time.sleep(self.next_at - now)
+        self.next_at = max(now, self.next_at) + self.interval
+
+
+class Command(BaseCommand):
+    help = (
+        "Transcribe AudioFile rows that were never processed or whose transcription failed, "
+        "in a process pool, writing results back in batches"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--only', choices=['unprocessed', 'failed', 'all'], default='all',
+                            help="Which rows to pick up (default: both unprocessed and failed)")
+        parser.add_argument('--workers', type=int, default=None, help="Size of the process pool")
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help="Rows fetched per query and written per bulk_update")
+        parser.add_argument('--rate', type=float, default=0,
+                            help="Maximum files sent to the recognizer per second (0 = unlimited)")
+        parser.add_argument('--limit', type=int, default=None, help="Stop after this many rows")
+        parser.add_argument('--resume', action='store_true',
+                            help="Continue after the last row written by a previous run")
+        parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT,
+                            help="File recording the last row written")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Only decode and preprocess the files and report throughput; nothing is written")
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be at least 1")
+        self.options = options
+        self.dry_run = options['dry_run']
+        workers = options['workers'] or settings.TRANSCRIPTION_WORKERS
+
+        queryset = self.backlog()
+        total = queryset.count()
+        if options['limit'] is not None:
+            total = min(total, options['limit'])
+            queryset = queryset[:options['limit']]
+        self.stdout.write(f"{total} rows in the backlog, {workers} workers"
+                          + (" (dry run)" if self.dry_run else ""))
+        if not total:
+            return
+
+        self.counts = {'done': 0, 'succeeded': 0, 'silent': 0, 'missing': 0, 'shed': 0, 'taken': 0, 'audio_ms': 0}
+        # Set once a row is shed, so --resume doesn't skip past it
+        self.checkpoint_held = False
+        self.started = time.perf_counter()
+        limiter = RateLimiter(0 if self.dry_run else options['rate'])
+        batch_size = options['batch_size']
+        pending = deque()
+
+        executor = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_inspect_process if self.dry_run else _init_worker_process,
+        )
+        try:
+            for row in queryset.iterator(chunk_size=batch_size):
+                limiter.wait()
+                if not self.dry_run and not self.claim(row):
+                    self.counts['taken'] += 1
+                    continue
+                fn = inspect_file if self.dry_run else transcribe_file
+                pending.append((row, executor.submit(fn, row.get_file_path())))
+                # Keep one batch in flight while the previous one is written
+                if len(pending) >= 2 * batch_size:
+                    self.flush([pending.popleft() for _ in range(batch_size)], total)
+            while pending:
+                self.flush([pending.popleft() for _ in range(min(batch_size, len(pending)))], total)
+        except KeyboardInterrupt:
+            self.stdout.write("Interrupted; rerun with --resume to continue after the last written batch")
+            executor.shutdown(wait=False, cancel_futures=True)
+            if not self.dry_run:
+                self.release([row for row, _ in pending])
+            raise
+        executor.shutdown()
+        self.report()
+
+    def backlog(self):
+        """Rows needing (re)transcription, in primary key order so runs can resume"""
+        unprocessed = Q(is_processed=False)
+        failed = Q(is_processed=True, is_successful=False)
+        condition = {'unprocessed': unprocessed, 'failed': failed, 'all': unprocessed | failed}[self.options['only']]
+        # Rows a queue worker is transcribing right now are left alone; the
+        # rest are claimed one by one as they are submitted (see claim())
+        queryset = AudioFile.objects.filter(condition).exclude(status=AudioFile.STATUS_RUNNING).order_by('pk')
+
+        if self.options['resume']:
+            last_pk = self.read_checkpoint()
+            if last_pk:
+                self.stdout.write(f"Resuming after {last_pk}")
+                queryset = queryset.filter(pk__gt=last_pk)
+        return queryset
+
+    def claim(self, row):
+        """
+        Mark a row running, as a queue worker does, so the workers leave it
+        alone until its result is written. False if a worker got there first.
+        """
+        claimed_at = timezone.now()
+        claimed = AudioFile.objects.filter(pk=row.pk, status=row.status).update(
+            status=AudioFile.STATUS_RUNNING, claimed_at=claimed_at
+        )
+        if claimed:
+            row.status, row.claimed_at = AudioFile.STATUS_RUNNING, claimed_at
+        return bool(claimed)
+
+    def release(self, rows):
+        """Hand claimed rows back unchanged: failed ones stay done, unprocessed ones are queued again"""
+        for is_processed, status in ((True, AudioFile.STATUS_DONE), (False, AudioFile.STATUS_QUEUED)):
+            AudioFile.objects.filter(
+                pk__in=[row.pk for row in rows if row.is_processed == is_processed],
+                status=AudioFile.STATUS_RUNNING,
+            ).update(status=status, claimed_at=None)
+
+    def flush(self, batch, total):
+        """Collect results for a batch in submission order and write them back"""
+        rows = []
+        shed = []
+        checkpoint = None
+        for row, future in batch:
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"success": False, "error": str(e), "text": None}
+            self.count(result)
+            if self.dry_run:
+                continue
+            if result.get('retry_after'):
+                # Shed in favour of interactive requests: not a transcription failure
+                shed.append(row)
+                self.checkpoint_held = True
+                continue
+            row.apply_transcription(result)
+            rows.append(row)
+            if not self.checkpoint_held:
+                checkpoint = row.pk
+
+        if not self.dry_run:
+            AudioFile.objects.bulk_update(rows, AudioFile.TRANSCRIPTION_FIELDS)
+            self.release(shed)
+            if checkpoint is not None:
+                self.write_checkpoint(checkpoint)
+
+        elapsed = time.perf_counter() - self.started
+        self.stdout.write(
+            f"{self.counts['done']}/{total} rows, {self.counts['succeeded']} ok, "
+            f"{self.counts['done'] / elapsed:.1f} files/s"
+        )
+
+    def count(self, result):
+        self.counts['done'] += 1
+        if result.get('retry_after'):
+            self.counts['shed'] += 1
+        elif result.get('success'):
+            self.counts['succeeded'] += 1
+        elif result.get('error') == "File not found":
+            self.counts['missing'] += 1
+        stats = result.get('stats')
+        if stats:
+            self.counts['audio_ms'] += stats['duration_ms']
+            if stats['trimmed_ms'] == stats['duration_ms']:
+                self.counts['silent'] += 1
+
+    def report(self):
+        elapsed = time.perf_counter() - self.started
+        counts = self.counts
+        audio_seconds = counts['audio_ms'] / 1000
+        label = "decodable" if self.dry_run else "transcribed"
+        self.stdout.write(self.style.SUCCESS(
+            f"{counts['done']} rows in {elapsed:.1f}s: {counts['succeeded']} {label}, "
+            f"{counts['silent']} silent, {counts['missing']} missing files"
+        ))
+        if counts['shed'] or counts['taken']:
+            self.stdout.write(
+                f"{counts['shed']} rows shed under load and left for a later run, "
+                f"{counts['taken']} taken by queue workers"
+            )
+        self.stdout.write(
+            f"Throughput: {counts['done'] / elapsed:.1f} files/s, "
+            f"{audio_seconds / elapsed:.1f} audio seconds/s ({audio_seconds:.0f}s of audio)"
+        )
+
+    def read_checkpoint(self):
+        try:
+            with open(self.options['checkpoint']) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def write_checkpoint(self, pk):
+        path = self.options['checkpoint']
+        with open(f"{path}.tmp", 'w') as f:
+            f.write(str(pk))
+        os.replace(f"{path}.tmp", path)
@@ -0,0 +1,188 @@
+"""
+Serving stored media: uploads (audio_files/) and generated speech
+(generated_audio/) at MEDIA_URL, the links the API hands out.
+
+Responses carry an ETag and honour If-None-Match, and a single byte range
+(Range, with If-Range) is answered with 206 so a device can resume a
+download or start playback in the middle of a clip. With MEDIA_OFFLOAD set
+the body is left to the front-end server (X-Sendfile for Apache/lighttpd,
+X-Accel-Redirect for nginx); otherwise it is a FileResponse, which WSGI
+servers with a sendfile-capable wsgi.file_wrapper (gunicorn, uWSGI) send
+with os.sendfile without copying it through Python.
+"""
+import os
+import mimetypes
+import posixpath
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured, SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified
+from django.utils.cache import parse_etags
+from django.views.decorators.http import require_safe
+from .storage import UPLOADS, GENERATED, PARTIAL_SUFFIX, media_storage
+from .tts_formats import content_type as variant_content_type, format_of
+
+SERVED_DIRECTORIES = (UPLOADS, GENERATED)
+
+# Uploads are stored under the container's extension (audio_codecs.EXTENSIONS)
+UPLOAD_CONTENT_TYPES = {'.wav': 'audio/wav', '.flac': 'audio/flac', '.opus': 'audio/ogg; codecs=opus'}
+
+
+class RangeNotSatisfiable(ValueError):
+    """Raised for a Range header none of whose bytes are in the file"""
+
+
+def media_content_type(name):
+    """Content-Type of a stored file; generated variants get their tts_formats type"""
+    if name.startswith(GENERATED + '/'):
+        audio_format = format_of(name)
+        if audio_format is not None:
+            return variant_content_type(audio_format)
+    extension = posixpath.splitext(name)[1].lower()
+    return UPLOAD_CONTENT_TYPES.get(extension) or mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+
+def etag_for(stat):
+    """
+    Stored files are never rewritten in place (write_atomic replaces them
+    with a new inode), so inode and size identify the content. The mtime
+    is left out: reuse of a generated clip refreshes it for the sweeper.
+    """
+    return f'"{stat.st_ino:x}-{stat.st_size:x}"'
+
+
+def etag_matches(header, etag):
+    """If-None-Match comparison, which is weak: W/"x" matches "x" """
+    etags = parse_etags(header)
+    return '*' in etags or any(candidate.removeprefix('W/') == etag for candidate in etags)
+
+
+def parse_range(header, size):
+    """
+    (start, end) of a single ``bytes=`` range, end inclusive, or None when
+    the header should be ignored (malformed, another unit, or several ranges,
+    which are answered with the whole file). Raises RangeNotSatisfiable.
+    """
+    unit, _, ranges = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in ranges:
+        return None
+    first, dash, last = ranges.strip().partition('-')
+    try:
+        start = int(first) if first else None
+        end = int(last) if last else None
+    except ValueError:
+        return None
+    if not dash or (start is None and end is None):
+        return None
+    if start is None:
+        # bytes=-N: the last N bytes
+        if end == 0:
+            raise RangeNotSatisfiable(header)
+        start, end = max(0, size - end), size - 1
+    elif end is None:
+        end = size - 1
+    elif start > end:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable(header)
+    return start, min(end, size - 1)
+
+
+class FileRange:
+    """
+    ``length`` bytes of an open file from its current position. Keeps
+    fileno() so wsgi.file_wrapper can still sendfile the range (gunicorn
+    sends Content-Length bytes from the file offset); without tell() or
+    seek(), FileResponse leaves the Content-Length set here alone.
+    """
+
+    def __init__(self, file, length):
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+def resolve(path):
+    """Storage name and absolute path of a served file, or Http404"""
+    name = posixpath.normpath(path)
+    if name.split('/', 1)[0] not in SERVED_DIRECTORIES or name.endswith(PARTIAL_SUFFIX):
+        raise Http404
+    try:
+        return name, media_storage.path(name)
+    except SuspiciousFileOperation:
+        raise Http404
+
+
+def offloaded(name, absolute_path, content_type, headers):
+    """Empty response that has the front-end server named by MEDIA_OFFLOAD send the file"""
+    response = HttpResponse(content_type=content_type, headers=headers)
+    if settings.MEDIA_OFFLOAD == 'x-sendfile':
+        response['X-Sendfile'] = absolute_path
+    elif settings.MEDIA_OFFLOAD == 'x-accel-redirect':
+        response['X-Accel-Redirect'] = settings.MEDIA_ACCEL_REDIRECT_PREFIX + name
+    else:
+        raise ImproperlyConfigured(f"Unknown MEDIA_OFFLOAD: {settings.MEDIA_OFFLOAD}")
+    return response
+
+
+@require_safe
+def serve_media(request, path):
+    """GET/HEAD a stored upload or generated clip"""
+    name, absolute_path = resolve(path)
+    try:
+        file = open(absolute_path, 'rb')
+    except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+        raise Http404
+    try:
+        stat = os.fstat(file.fileno())
+        etag = etag_for(stat)
+        headers = {
+            'ETag': etag,
+            'Accept-Ranges': 'bytes',
+            'Cache-Control': f"max-age={settings.MEDIA_CACHE_MAX_AGE[name.split('/', 1)[0]]}",
+        }
+        if etag_matches(request.headers.get('If-None-Match', ''), etag):
+            file.close()
+            return HttpResponseNotModified(headers=headers)
+
+        content_type = media_content_type(name)
+        if settings.MEDIA_OFFLOAD:
+            # The front-end server answers Range itself
+            file.close()
+            return offloaded(name, absolute_path, content_type, headers)
+
+        size = stat.st_size
+        byte_range = None
+        range_header = request.headers.get('Range')
+        if range_header and request.headers.get('If-Range', etag) == etag:
+            try:
+                byte_range = parse_range(range_header, size)
+            except RangeNotSatisfiable:
+                file.close()
+                headers['Content-Range'] = f"bytes */{size}"
+                return HttpResponse(status=416, headers=headers)
+
+        if byte_range is None:
+            response = FileResponse(file, content_type=content_type, headers=headers)
+            response['Content-Length'] = size
+            return response
+        start, end = byte_range
+        file.seek(start)
+        response = FileResponse(FileRange(file, end - start + 1), status=206, content_type=content_type, headers=headers)
+        response['Content-Range'] = f"bytes {start}-{end}/{size}"
+        response['Content-Length'] = end - start + 1
+        return response
+    except BaseException:
+        file.close()
+        raise
@@ -0,0 +1,136 @@
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+# Upper bounds in seconds, from a cache hit to a slow remote call
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class StageTimer:
+    """
+    Collect the duration of each named stage of one request.
+
+    ``stages`` is a plain dict of seconds so it can travel in result dicts
+    (including back from process workers) and be stored in a JSONField.
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+
+class Histogram:
+    """Prometheus-style histogram with one label, kept in process memory"""
+
+    def __init__(self, name, help_text, label, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, seconds):
+        index = bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                # Per-bucket counts (last slot is +Inf), then sum and count
+                series = self._series[label_value] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += seconds
+            series[2] += 1
+
+    def render(self):
+        with self._lock:
+            snapshot = {key: (list(counts), total, count) for key, (counts, total, count) in self._series.items()}
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_value, (counts, total, count) in sorted(snapshot.items()):
+            label = f'{self.label}="{label_value}"'
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{label}}} {total}")
+            lines.append(f"{self.name}_count{{{label}}} {count}")
+        return lines
+
+
+stage_seconds = Histogram(
+    'voice_pipeline_stage_seconds',
+    "Time spent in each stage of the voice pipeline",
+    'stage',
+)
+
+queue_wait_seconds = Histogram(
+    'voice_pipeline_upstream_queue_wait_seconds',
+    "Time calls waited for a concurrency slot of an upstream",
+    'upstream',
+)
+
+
+def observe_stages(stages):
+    """Feed the durations of a StageTimer (or a stored stage_timings dict) into the histogram"""
+    for name, seconds in (stages or {}).items():
+        stage_seconds.observe(name, seconds)
+
+
+def render_metrics():
+    """Prometheus text exposition of the pipeline histograms, cache and upstream counters"""
+    from .cache import transcription_cache
+    from .speech_generator import llm_cache
+
+    lines = stage_seconds.render() + queue_wait_seconds.render()
+    for cache_name, cache in (('transcription', transcription_cache), ('llm', llm_cache)):
+        stats = cache.stats()
+        for key in ('memory_hits', 'db_hits', 'misses'):
+            metric = f"voice_pipeline_{cache_name}_cache_{key}_total"
+            lines += [f"# TYPE {metric} counter", f"{metric} {stats[key]}"]
+        metric = f"voice_pipeline_{cache_name}_cache_size"
+        lines += [f"# TYPE {metric} gauge", f"{metric} {stats['size']}"]
+    lines += render_upstreams()
+    lines += render_admission()
+    return "\n".join(lines) + "\n"
+
+
+def render_upstreams():
+    """Counters and circuit state of each upstream API (see api/upstream.py)"""
+    from .upstream import Upstream, UPSTREAMS, INTERACTIVE, BATCH
+    priorities = {INTERACTIVE: 'interactive', BATCH: 'batch'}
+
+    stats = {name: upstream.stats() for name, upstream in sorted(UPSTREAMS.items())}
+    lines = []
+    for counter in Upstream.COUNTERS:
+        metric = f"voice_pipeline_upstream_{counter}_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines += [f'{metric}{{upstream="{name}"}} {values[counter]}' for name, values in stats.items()]
+    metric = "voice_pipeline_upstream_circuit_open"
+    lines.append(f"# TYPE {metric} gauge")
+    lines += [f'{metric}{{upstream="{name}"}} {int(values["state"] != "closed")}' for name, values in stats.items()]
+    metric = "voice_pipeline_upstream_in_flight"
+    lines.append(f"# TYPE {metric} gauge")
+    lines += [f'{metric}{{upstream="{name}"}} {values["in_flight"]}' for name, values in stats.items()]
+    metric = "voice_pipeline_upstream_queued"
+    lines.append(f"# TYPE {metric} gauge")
+    for name, values in stats.items():
+        lines += [f'{metric}{{upstream="{name}",priority="{priorities[level]}"}} {count}'
+                  for level, count in sorted(values["queued"].items())]
+    return lines
+
+
+def render_admission():
+    """Requests turned away at the entry points (see api/admission.py)"""
+    from .admission import rejected_counts
+
+    metric = "voice_pipeline_admission_rejected_total"
+    lines = [f"# TYPE {metric} counter"]
+    lines += [f'{metric}{{reason="{reason}"}} {count}' for reason, count in sorted(rejected_counts().items())]
+    return lines
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:05
+
+from django.db import migrations, models
+
+
+def mark_processed_done(apps, schema_editor):
+    """Rows transcribed before the queue existed are already finished"""
+    AudioFile = apps.get_model('api', 'AudioFile')
+    AudioFile.objects.filter(is_processed=True).update(status='done')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_aihandler'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='audiofile',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='audiofile',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done')], db_index=True, default='queued', max_length=16),
+        ),
+        migrations.RunPython(mark_processed_done, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_audiofile_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='audiofile',
+            name='pcm_digest',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+    ]
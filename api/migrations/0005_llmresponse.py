@@ -0,0 +1,25 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_audiofile_pcm_digest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LLMResponse',
+            fields=[
+                ('key', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('request_text', models.TextField()),
+                ('response_text', models.TextField()),
+                ('model_name', models.CharField(max_length=100)),
+                ('prompt_version', models.CharField(db_index=True, max_length=16)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_llmresponse'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aihandler',
+            name='audio_source',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='responses', to='api.audiofile'),
+        ),
+        migrations.AddField(
+            model_name='aihandler',
+            name='error_message',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='aihandler',
+            name='response_text',
+            field=models.TextField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_aihandler_response'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='audiofile',
+            name='duration_ms',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='audiofile',
+            name='rms_dbfs',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='audiofile',
+            name='trimmed_ms',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_audiofile_clip_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aihandler',
+            name='stage_timings',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='audiofile',
+            name='stage_timings',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_stage_timings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='audiofile',
+            name='device_id',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='aihandler',
+            index=models.Index(fields=['-created_at', '-id'], name='aihandler_history_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='aihandler',
+            index=models.Index(fields=['processed', '-created_at', '-id'], name='aihandler_processed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='audiofile',
+            index=models.Index(fields=['-created_at', '-id'], name='audiofile_history_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='audiofile',
+            index=models.Index(fields=['device_id', '-created_at', '-id'], name='audiofile_device_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='audiofile',
+            index=models.Index(fields=['is_processed', '-created_at', '-id'], name='audiofile_processed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='audiofile',
+            index=models.Index(fields=['is_successful', '-created_at', '-id'], name='audiofile_successful_idx'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:47
+
+import api.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_history_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='aihandler',
+            name='audio_file',
+            field=models.FileField(blank=True, null=True, storage=api.storage.ShardedStorage(), upload_to='generated_audio/'),
+        ),
+        migrations.AlterField(
+            model_name='audiofile',
+            name='audio_file',
+            field=models.FileField(storage=api.storage.ShardedStorage(), upload_to='audio_files/'),
+        ),
+    ]
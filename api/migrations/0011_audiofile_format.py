@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_media_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='audiofile',
+            name='channels',
+            field=models.SmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='audiofile',
+            name='codec',
+            field=models.CharField(blank=True, max_length=16, null=True),
+        ),
+        migrations.AddField(
+            model_name='audiofile',
+            name='sample_rate',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
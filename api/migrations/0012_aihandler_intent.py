@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-18 12:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_audiofile_format'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aihandler',
+            name='action',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='aihandler',
+            name='intent',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+    ]
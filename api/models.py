@@ -1,20 +1,40 @@
 from django.db import models
 from django.conf import settings
+from django.utils import timezone
 import os
 import uuid
+from .storage import media_storage
 
 # Create your models here.
 class AudioFile(models.Model):
     """Model for storing audio files and their transcription results"""
     
+    # Transcription job states (see api/jobs.py)
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+    ]
+    
     # Unique identifier for each audio file
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     
     # Original filename of the uploaded file
     original_filename = models.CharField(max_length=255, blank=True)
     
+    # Device that uploaded the file, from the X-Device-Id header
+    device_id = models.CharField(max_length=64, blank=True, null=True)
+    
     # The actual audio file
-    audio_file = models.FileField(upload_to='audio_files/')
+    audio_file = models.FileField(upload_to='audio_files/', storage=media_storage)
+    
+    # Format of the upload as sent, read from its header (see api/audio_codecs.py)
+    codec = models.CharField(max_length=16, blank=True, null=True)
+    sample_rate = models.IntegerField(null=True, blank=True)
+    channels = models.SmallIntegerField(null=True, blank=True)
     
     # Text transcription of the audio
     transcription = models.TextField(blank=True, null=True)
@@ -26,35 +46,94 @@ class AudioFile(models.Model):
     is_processed = models.BooleanField(default=False)
     is_successful = models.BooleanField(default=False)
     
+    # Position in the transcription queue, polled by clients after a 202
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_QUEUED, db_index=True)
+    
+    # SHA-256 of the normalized PCM, used to reuse transcriptions of identical audio
+    pcm_digest = models.CharField(max_length=64, blank=True, null=True, db_index=True)
+    
+    # Preprocessing stats: clip length, silence trimmed off and speech level.
+    # Uploads through /api/audio/ get duration_ms from their header on arrival.
+    duration_ms = models.IntegerField(null=True, blank=True)
+    trimmed_ms = models.IntegerField(null=True, blank=True)
+    rms_dbfs = models.FloatField(null=True, blank=True)
+    
+    # When a worker picked the job up, used to requeue jobs of dead workers
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    
+    # Seconds spent per pipeline stage (upload, queue_wait, decode, recognize)
+    stage_timings = models.JSONField(null=True, blank=True)
+    
     # Timestamps
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    class Meta:
+        # Newest-first history listings, alone or narrowed by one filter (see views.HistoryFilterMixin)
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='audiofile_history_idx'),
+            models.Index(fields=['device_id', '-created_at', '-id'], name='audiofile_device_idx'),
+            models.Index(fields=['is_processed', '-created_at', '-id'], name='audiofile_processed_idx'),
+            models.Index(fields=['is_successful', '-created_at', '-id'], name='audiofile_successful_idx'),
+        ]
+    
     def __str__(self):
         return f"{self.original_filename or self.id} - {'Processed' if self.is_processed else 'Pending'}"
     
     def get_file_path(self):
         """Get the absolute path to the audio file"""
         if self.audio_file:
-            return os.path.join(settings.MEDIA_ROOT, self.audio_file.name)
+            return self.audio_file.path
         return None
     
-    def save_transcription(self, transcription_result):
+    # Fields written by apply_transcription, for bulk_update
+    TRANSCRIPTION_FIELDS = [
+        'is_processed', 'status', 'is_successful', 'pcm_digest', 'duration_ms',
+        'trimmed_ms', 'rms_dbfs', 'transcription', 'error_message', 'claimed_at', 'stage_timings',
+        'updated_at',
+    ]
+    
+    def save_transcription(self, transcription_result, eager=True):
         """
         Save transcription results to the model
         
         Args:
             transcription_result (dict): Dictionary with keys 'success', 'error', 'text'
+                and optionally 'pcm_digest' and 'stats'
+            eager (bool): Start the AI response right away if EAGER_RESPONSES is on
         """
+        self.apply_transcription(transcription_result)
+        self.save()
+        if eager and self.is_successful:
+            # Imported here: services builds on the models
+            from .services import get_eager_responses
+            get_eager_responses().start(self)
+    
+    def apply_transcription(self, transcription_result):
+        """Set the fields for a transcription result without saving"""
         self.is_processed = True
+        self.status = self.STATUS_DONE
         self.is_successful = transcription_result.get('success', False)
+        self.pcm_digest = transcription_result.get('pcm_digest') or self.pcm_digest
+        
+        stats = transcription_result.get('stats')
+        if stats:
+            self.duration_ms = stats['duration_ms']
+            self.trimmed_ms = stats['trimmed_ms']
+            self.rms_dbfs = stats['rms_dbfs']
+        
+        timings = transcription_result.get('timings')
+        if timings:
+            self.stage_timings = {**(self.stage_timings or {}), **timings}
         
         if self.is_successful:
             self.transcription = transcription_result.get('text', '')
+            self.error_message = None
         else:
             self.error_message = transcription_result.get('error', 'Unknown error')
         
-        self.save()
+        self.claimed_at = None
+        self.updated_at = timezone.now()
 
 class AIHandler(models.Model):
     """Model for handle transcription and send back results with wav file"""
@@ -63,8 +142,30 @@ class AIHandler(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     processed = models.BooleanField(default=False)
     
-    audio_file = models.FileField(upload_to='generated_audio/', null=True, blank=True)
+    audio_file = models.FileField(upload_to='generated_audio/', storage=media_storage, null=True, blank=True)
     original_request = models.JSONField(null=True, blank=True)
+    
+    # The transcribed upload this is a response to
+    audio_source = models.ForeignKey(
+        AudioFile, null=True, blank=True, on_delete=models.SET_NULL, related_name='responses'
+    )
+    
+    # LLM answer and the error if generating the response failed
+    response_text = models.TextField(blank=True, null=True)
+    error_message = models.TextField(blank=True, null=True)
+    
+    # Seconds spent per pipeline stage (llm, tts, or first_audio/respond when streamed)
+    stage_timings = models.JSONField(null=True, blank=True)
+    
+    # The LOCAL_INTENTS entry that answered instead of the LLM, and its device action
+    intent = models.CharField(max_length=64, null=True, blank=True)
+    action = models.JSONField(null=True, blank=True)
+    
+    class Meta:
+        indexes = [
+            models.Index(fields=['-created_at', '-id'], name='aihandler_history_idx'),
+            models.Index(fields=['processed', '-created_at', '-id'], name='aihandler_processed_idx'),
+        ]
 
     def get_audio_path(self):
         """Return the path to the generated audio file"""
@@ -73,4 +174,18 @@ class AIHandler(models.Model):
         return None
 
     def __str__(self):
-        return f"TTS Request {self.id} - {self.created_at.strftime('%Y-%m-%d %H:%M')}"
\ No newline at end of file
+        return f"TTS Request {self.id} - {self.created_at.strftime('%Y-%m-%d %H:%M')}"
+
+class LLMResponse(models.Model):
+    """Cached LLM answer, shared by all workers (see cache.LLMResponseCache)"""
+    key = models.CharField(max_length=64, primary_key=True)
+    request_text = models.TextField()
+    response_text = models.TextField()
+    model_name = models.CharField(max_length=100)
+    # Hash of the prompt template the answer was generated with
+    prompt_version = models.CharField(max_length=16, db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"LLM response for '{self.request_text[:40]}' ({self.model_name})"
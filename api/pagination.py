@@ -0,0 +1,17 @@
+from rest_framework.pagination import CursorPagination
+
+
+class HistoryPagination(CursorPagination):
+    """
+    Keyset pagination for history listings, newest first.
+
+    The cursor carries the created_at of the last row served, so each page
+    is a range scan on the (created_at, id) indexes rather than an OFFSET that
+    gets slower the deeper a client pages. Rows created in the same
+    microsecond as that position are skipped with a small offset that DRF
+    keeps in the cursor; -id only fixes their order within a page.
+    """
+    ordering = ('-created_at', '-id')
+    page_size = 50
+    page_size_query_param = 'page_size'
+    max_page_size = 200
@@ -0,0 +1,113 @@
+import math
+from collections import namedtuple
+import numpy as np
+from django.conf import settings
+
+ClipStats = namedtuple('ClipStats', ['duration_ms', 'trimmed_ms', 'rms_dbfs'])
+
+# Quietest level reported, so silent clips don't produce -inf
+MIN_DBFS = -120.0
+
+
+class SilentAudioError(ValueError):
+    """Raised when a clip contains no frame above the silence threshold"""
+
+    def __init__(self, stats):
+        super().__init__("No speech detected")
+        self.stats = stats
+
+
+def to_dbfs(rms):
+    return max(20 * math.log10(rms), MIN_DBFS) if rms > 0 else MIN_DBFS
+
+
+def decode(pcm, sample_width, channels, is_float=False):
+    """Decode interleaved PCM bytes into mono float32 samples in [-1, 1]"""
+    pcm = memoryview(pcm).cast('B')
+    pcm = pcm[:len(pcm) - len(pcm) % sample_width]
+    raw = np.frombuffer(pcm, dtype=np.uint8)
+    if is_float:
+        samples = np.frombuffer(pcm, dtype='<f4' if sample_width == 4 else '<f8').astype(np.float32)
+    elif sample_width == 1:
+        # 8-bit WAV is unsigned around 128
+        samples = (raw.astype(np.float32) - 128) / 128
+    elif sample_width == 2:
+        samples = np.frombuffer(pcm, dtype='<i2').astype(np.float32) / 32768
+    elif sample_width == 3:
+        # Widen 24-bit samples into the top of an int32 to keep the sign
+        triples = raw[:len(raw) - len(raw) % 3].reshape(-1, 3).astype(np.int32)
+        samples = ((triples[:, 0] << 8) | (triples[:, 1] << 16) | (triples[:, 2] << 24)).astype(np.float32) / 2 ** 31
+    elif sample_width == 4:
+        samples = np.frombuffer(pcm, dtype='<i4').astype(np.float32) / 2 ** 31
+    else:
+        raise ValueError(f"Unsupported sample width: {sample_width}")
+
+    if channels > 1:
+        samples = samples[:len(samples) - len(samples) % channels].reshape(-1, channels).mean(axis=1)
+    return samples
+
+
+def resample(samples, src_rate, dst_rate):
+    """Linear-interpolation resampler with a box filter against aliasing when downsampling"""
+    if src_rate == dst_rate or len(samples) == 0:
+        return samples
+    if src_rate > dst_rate:
+        width = int(round(src_rate / dst_rate))
+        if width > 1:
+            samples = np.convolve(samples, np.full(width, 1.0 / width, dtype=np.float32), mode='same')
+    count = int(len(samples) * dst_rate / src_rate)
+    positions = np.arange(count, dtype=np.float64) * (src_rate / dst_rate)
+    return np.interp(positions, np.arange(len(samples)), samples).astype(np.float32)
+
+
+def speech_bounds(samples, sample_rate, threshold, pad_ms, frame_ms=20):
+    """Return (start, end) sample indexes around the frames above threshold, or None"""
+    frame = max(int(sample_rate * frame_ms / 1000), 1)
+    count = len(samples) // frame
+    if count == 0:
+        return None
+    energy = np.sqrt(np.mean(samples[:count * frame].reshape(count, frame) ** 2, axis=1))
+    voiced = np.flatnonzero(energy >= threshold)
+    if len(voiced) == 0:
+        return None
+    pad = int(sample_rate * pad_ms / 1000)
+    start = max(voiced[0] * frame - pad, 0)
+    end = min((voiced[-1] + 1) * frame + pad, len(samples))
+    return start, end
+
+
+def normalize(samples, target_dbfs, max_gain_db):
+    """Scale to the target RMS level, limited by max gain and by clipping"""
+    rms = float(np.sqrt(np.mean(samples ** 2))) if len(samples) else 0.0
+    peak = float(np.max(np.abs(samples))) if len(samples) else 0.0
+    if rms == 0 or peak == 0:
+        return samples
+    gain = min(10 ** ((target_dbfs - to_dbfs(rms)) / 20), 10 ** (max_gain_db / 20), 0.99 / peak)
+    return samples * np.float32(gain)
+
+
+def preprocess(pcm, sample_rate, sample_width, channels, is_float=False):
+    """
+    Downmix, resample, trim and normalize a clip for the recognizer.
+
+    Returns (16-bit mono PCM bytes at PREPROCESS_SAMPLE_RATE, ClipStats).
+    Raises SilentAudioError if nothing in the clip rises above the silence
+    threshold, so silent clips never reach a remote recognizer.
+    """
+    target_rate = settings.PREPROCESS_SAMPLE_RATE
+    samples = resample(decode(pcm, sample_width, channels, is_float), sample_rate, target_rate)
+    duration_ms = int(len(samples) * 1000 / target_rate)
+
+    bounds = speech_bounds(samples, target_rate, settings.PREPROCESS_SILENCE_THRESHOLD, settings.PREPROCESS_PAD_MS)
+    if bounds is None:
+        rms = float(np.sqrt(np.mean(samples ** 2))) if len(samples) else 0.0
+        raise SilentAudioError(ClipStats(duration_ms, duration_ms, to_dbfs(rms)))
+
+    start, end = bounds
+    samples = samples[start:end]
+    rms = float(np.sqrt(np.mean(samples ** 2)))
+    stats = ClipStats(duration_ms, duration_ms - int(len(samples) * 1000 / target_rate), round(to_dbfs(rms), 2))
+
+    samples = normalize(samples, settings.PREPROCESS_TARGET_DBFS, settings.PREPROCESS_MAX_GAIN_DB)
+    pcm16 = np.clip(np.round(samples * 32767), -32768, 32767).astype('<i2')
+    return pcm16.tobytes(), stats
@@ -0,0 +1,249 @@
+import os
+import asyncio
+import logging
+import threading
+from collections import namedtuple
+import speech_recognition as sr
+from django.conf import settings
+from . import upstream
+
+logger = logging.getLogger(__name__)
+
+# confidence is a probability in [0, 1], or None when the engine didn't report one
+RecognitionResult = namedtuple('RecognitionResult', ['text', 'confidence', 'backend'])
+
+
+class RecognizerBackend:
+    """
+    Base class for speech recognition engines.
+
+    recognize() takes sr.AudioData and returns a RecognitionResult. Like
+    SpeechRecognition itself it raises sr.UnknownValueError when nothing
+    was understood and sr.RequestError when the engine is unavailable.
+    """
+    name = None
+
+    def load(self):
+        """Load models up front; called once per worker"""
+
+    def recognize(self, audio_data):
+        raise NotImplementedError
+
+    async def arecognize(self, audio_data):
+        """Async recognize(); local engines run in a worker thread by default"""
+        return await asyncio.to_thread(self.recognize, audio_data)
+
+
+class GoogleBackend(RecognizerBackend):
+    """
+    Google Web Speech API, the original remote engine. Calls go through
+    upstream.stt, so they are pooled, hedged, bounded by the request
+    deadline and short-circuited while the API is failing.
+    """
+    name = 'google'
+
+    def __init__(self, language=None, endpoint=None):
+        self.language = language or settings.RECOGNIZER_LANGUAGE
+        self.endpoint = endpoint or settings.GOOGLE_SPEECH_ENDPOINT
+
+    def recognize(self, audio_data):
+        try:
+            text, confidence = upstream.stt.call(
+                upstream.recognize_google, audio_data, self.language, self.endpoint, ignore=(sr.UnknownValueError,)
+            )
+        except upstream.UpstreamError as e:
+            raise sr.RequestError(str(e)) from e
+        return RecognitionResult(text, confidence, self.name)
+
+    async def arecognize(self, audio_data):
+        from .async_clients import recognize_google
+        try:
+            text, confidence = await upstream.stt.acall(
+                recognize_google, audio_data, self.language, self.endpoint, ignore=(sr.UnknownValueError,)
+            )
+        except upstream.UpstreamError as e:
+            raise sr.RequestError(str(e)) from e
+        return RecognitionResult(text, confidence, self.name)
+
+
+class SphinxBackend(RecognizerBackend):
+    """
+    Offline CMU Sphinx engine (requires the pocketsphinx package).
+
+    sr.Recognizer.recognize_sphinx builds a new decoder on every call, which
+    means reloading the acoustic and language models each time. Here the
+    decoder is built once and reused; a lock serializes utterances because
+    a decoder can only decode one at a time.
+    """
+    name = 'sphinx'
+
+    def __init__(self, language=None):
+        self.language = language or settings.RECOGNIZER_LANGUAGE
+        self.decoder = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            if self.decoder is not None:
+                return
+            try:
+                from pocketsphinx import Decoder
+            except ImportError:
+                raise sr.RequestError("missing PocketSphinx module: pip install pocketsphinx")
+
+            data_dir = os.path.join(os.path.dirname(sr.__file__), 'pocketsphinx-data', self.language)
+            if not os.path.isdir(data_dir):
+                raise sr.RequestError(f"missing PocketSphinx language data directory: {data_dir}")
+            self.decoder = Decoder(
+                hmm=os.path.join(data_dir, 'acoustic-model'),
+                lm=os.path.join(data_dir, 'language-model.lm.bin'),
+                dict=os.path.join(data_dir, 'pronounciation-dictionary.dict'),
+                logfn=os.devnull,
+            )
+            logger.info(f"Loaded PocketSphinx models for {self.language}")
+
+    def recognize(self, audio_data):
+        self.load()
+        # The bundled models expect 16 kHz 16-bit mono
+        raw_data = audio_data.get_raw_data(convert_rate=16000, convert_width=2)
+        with self._lock:
+            self.decoder.start_utt()
+            self.decoder.process_raw(raw_data, False, True)
+            self.decoder.end_utt()
+            hypothesis = self.decoder.hyp()
+        if hypothesis is None or not hypothesis.hypstr:
+            raise sr.UnknownValueError()
+        return RecognitionResult(hypothesis.hypstr, self.confidence(hypothesis.prob), self.name)
+
+    def confidence(self, prob):
+        """
+        The posterior probability of the best path, in [0, 1]. pocketsphinx 5
+        reports it as a probability; older releases as its logarithm in the
+        decoder's log base, which is never positive.
+        """
+        if prob < 0:
+            prob = self.decoder.get_logmath().exp(prob)
+        return min(max(float(prob), 0.0), 1.0)
+
+
+BACKENDS = {
+    GoogleBackend.name: GoogleBackend,
+    SphinxBackend.name: SphinxBackend,
+}
+
+
+class RecognizerChain:
+    """
+    Try backends in order and stop at the first confident result.
+
+    With ["sphinx", "google"] the local engine answers whenever it is sure
+    enough and the remote one is only called for low-confidence or
+    unintelligible audio. A result without a confidence (Google leaves it
+    out for some answers) counts as confident. If no backend is confident,
+    the most confident result wins; if none produced text, the last error
+    is raised.
+
+    When that error is sr.RequestError (every backend was unavailable, e.g.
+    the Google circuit is open) the ``fallback`` backends are tried instead.
+    """
+
+    def __init__(self, backends, min_confidence=None, fallback=()):
+        self.backends = backends
+        self.fallback = list(fallback)
+        self.min_confidence = settings.RECOGNIZER_MIN_CONFIDENCE if min_confidence is None else min_confidence
+
+    def load(self):
+        for backend in self.backends + self.fallback:
+            try:
+                backend.load()
+            except sr.RequestError as e:
+                logger.error(f"Could not load recognizer backend {backend.name}: {e}")
+
+    def recognize(self, audio_data):
+        try:
+            return self._recognize(self.backends, audio_data)
+        except sr.RequestError as e:
+            if not self.fallback:
+                raise
+            self._falling_back(e)
+            return self._recognize(self.fallback, audio_data)
+
+    async def arecognize(self, audio_data):
+        """Same fallback order as recognize(), awaiting each backend"""
+        try:
+            return await self._arecognize(self.backends, audio_data)
+        except sr.RequestError as e:
+            if not self.fallback:
+                raise
+            self._falling_back(e)
+            return await self._arecognize(self.fallback, audio_data)
+
+    def _recognize(self, backends, audio_data):
+        best = None
+        last_error = None
+        for backend in backends:
+            try:
+                result = backend.recognize(audio_data)
+            except (sr.UnknownValueError, sr.RequestError) as e:
+                logger.info(f"Recognizer backend {backend.name} failed: {e!r}")
+                last_error = e
+                continue
+            if self._is_confident(backend, result):
+                return result
+            best = self._better(best, result)
+
+        if best is not None:
+            return best
+        raise last_error or sr.UnknownValueError()
+
+    async def _arecognize(self, backends, audio_data):
+        best = None
+        last_error = None
+        for backend in backends:
+            try:
+                result = await backend.arecognize(audio_data)
+            except (sr.UnknownValueError, sr.RequestError) as e:
+                logger.info(f"Recognizer backend {backend.name} failed: {e!r}")
+                last_error = e
+                continue
+            if self._is_confident(backend, result):
+                return result
+            best = self._better(best, result)
+
+        if best is not None:
+            return best
+        raise last_error or sr.UnknownValueError()
+
+    def _falling_back(self, error):
+        names = ', '.join(backend.name for backend in self.fallback)
+        logger.warning(f"Remote recognizers unavailable ({error}), falling back to {names}")
+        upstream.stt.count('fallbacks')
+
+    def _is_confident(self, backend, result):
+        if result.confidence is None:
+            # Nothing to compare; asking the next backend wouldn't be any better informed
+            return True
+        if result.confidence >= self.min_confidence:
+            return True
+        logger.info(f"Recognizer backend {backend.name} below confidence threshold ({result.confidence:.2f})")
+        return False
+
+    @staticmethod
+    def _better(best, result):
+        return result if best is None or result.confidence > best.confidence else best
+
+
+_chain = None
+_chain_lock = threading.Lock()
+
+
+def get_recognizer():
+    """Return the worker-wide recognizer chain configured by RECOGNIZER_BACKENDS"""
+    global _chain
+    with _chain_lock:
+        if _chain is None:
+            _chain = RecognizerChain(
+                [BACKENDS[name]() for name in settings.RECOGNIZER_BACKENDS],
+                fallback=[BACKENDS[name]() for name in settings.RECOGNIZER_FALLBACK],
+            )
+        return _chain
@@ -1,6 +1,5 @@
 from rest_framework import serializers
 from .models import AudioFile, AIHandler
-from .speech_generator import SpeechProcessor
 
 class AudioFileSerializer(serializers.ModelSerializer):
     """Serializer for the AudioFile model"""
@@ -8,26 +7,42 @@ class AudioFileSerializer(serializers.ModelSerializer):
     class Meta:
         model = AudioFile
         fields = [
-            'id', 'original_filename', 'audio_file', 
+            'id', 'original_filename', 'device_id', 'audio_file', 
+            'codec', 'sample_rate', 'channels',
             'transcription', 'error_message', 
-            'is_processed', 'is_successful',
+            'is_processed', 'is_successful', 'status',
+            'duration_ms', 'trimmed_ms', 'rms_dbfs',
             'created_at', 'updated_at'
         ]
         read_only_fields = [
-            'id', 'transcription', 'error_message', 
-            'is_processed', 'is_successful',
+            'id', 'device_id', 'codec', 'sample_rate', 'channels',
+            'transcription', 'error_message', 
+            'is_processed', 'is_successful', 'status',
+            'duration_ms', 'trimmed_ms', 'rms_dbfs',
             'created_at', 'updated_at'
         ]
 
+class AudioFileListSerializer(serializers.ModelSerializer):
+    """Columns shown in the upload history; the list view loads only these"""
+    
+    class Meta:
+        model = AudioFile
+        fields = [
+            'id', 'device_id', 'status', 'is_processed', 'is_successful',
+            'transcription', 'created_at'
+        ]
+        read_only_fields = fields
+
 class AudioTranscriptionResultSerializer(serializers.ModelSerializer):
     """Serializer for transcription results"""
     
     class Meta:
         model = AudioFile
         fields = [
-            'id', 'original_filename', 
+            'id', 'original_filename', 'codec', 'sample_rate', 'channels',
             'transcription', 'error_message', 
-            'is_processed', 'is_successful',
+            'is_processed', 'is_successful', 'status',
+            'duration_ms', 'trimmed_ms', 'rms_dbfs', 'stage_timings',
             'created_at', 'updated_at'
         ]
         read_only_fields = fields
@@ -37,5 +52,20 @@ class AIProcessSerializer(serializers.Serializer):
     request_text = serializers.CharField()
     response_text = serializers.CharField()
     audio_link = serializers.URLField(allow_null=True)
+    audio_format = serializers.CharField(required=False)
+    # Set when a LOCAL_INTENTS entry answered; ``action`` is for the device to carry out
+    intent = serializers.CharField(required=False, allow_null=True)
+    action = serializers.JSONField(required=False, allow_null=True)
     is_successful = serializers.BooleanField()
     created_at = serializers.DateTimeField()
+
+class AIHandlerListSerializer(serializers.ModelSerializer):
+    """Columns shown in the response history; the list view loads only these"""
+    
+    class Meta:
+        model = AIHandler
+        fields = [
+            'id', 'audio_source', 'text_content', 'response_text',
+            'audio_file', 'processed', 'created_at'
+        ]
+        read_only_fields = fields
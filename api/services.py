@@ -0,0 +1,306 @@
+import time
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+from .models import AudioFile, AIHandler
+from .speech_generator import SpeechProcessor
+from .tts_formats import SOURCE_FORMAT
+from .metrics import observe_stages
+from .cache import LRUCache
+from . import admission, upstream
+
+logger = logging.getLogger(__name__)
+
+
+class VoicePipelineError(Exception):
+    """Raised when no response can be produced for an upload"""
+
+    def __init__(self, message, details=None):
+        super().__init__(message)
+        self.message = message
+        self.details = details or {}
+
+
+class VoicePipeline:
+    """
+    Turn a transcribed upload into a spoken AI response.
+
+    Everything runs in-process on the ORM and SpeechProcessor: look up the
+    transcription, ask the LLM, synthesize the answer and persist it as an
+    AIHandler. Views and batch jobs both go through this class.
+    """
+
+    def __init__(self, speech_processor=None):
+        self.speech_processor = speech_processor or SpeechProcessor()
+
+    def get_transcription(self, audio_file_id):
+        """Return the AudioFile if it has a usable transcription, else raise VoicePipelineError"""
+        try:
+            audio_file = AudioFile.objects.get(pk=audio_file_id)
+        except AudioFile.DoesNotExist:
+            raise VoicePipelineError('Audio file not found')
+        return self._check_transcription(audio_file)
+
+    async def aget_transcription(self, audio_file_id):
+        """Async get_transcription"""
+        try:
+            audio_file = await AudioFile.objects.aget(pk=audio_file_id)
+        except AudioFile.DoesNotExist:
+            raise VoicePipelineError('Audio file not found')
+        return self._check_transcription(audio_file)
+
+    def _check_transcription(self, audio_file):
+        if audio_file.status != AudioFile.STATUS_DONE:
+            raise VoicePipelineError('Transcription not finished yet', {
+                'status': audio_file.status,
+                'response_id': str(audio_file.pk),
+                'created_at': audio_file.created_at,
+            })
+        if not audio_file.is_successful or audio_file.transcription is None:
+            raise VoicePipelineError('Transcription failed or unavailable', {
+                'error_message': audio_file.error_message or 'No transcription provided',
+                'response_id': str(audio_file.pk),
+                'created_at': audio_file.created_at,
+            })
+        return audio_file
+
+    def upstreams(self, audio_file):
+        """Names of the upstreams answering ``audio_file`` calls, for admission.admit()"""
+        if self.speech_processor.intents.match(audio_file.transcription) is not None:
+            # Canned responses were rendered at startup
+            return ()
+        if get_eager_responses().started(audio_file):
+            return ()
+        return ('llm', 'tts')
+
+    def respond(self, audio_file, language='en'):
+        """
+        The AI response for a transcribed AudioFile. With EAGER_RESPONSES
+        this is the one started when the transcription was saved, waited
+        for if it is still being generated; otherwise a new one is generated
+        and persisted. Raises upstream.Overloaded if the LLM or TTS had no
+        capacity left for it.
+        """
+        handler = get_eager_responses().result(audio_file, language)
+        if handler is not None:
+            return handler
+        return self.generate(audio_file, language)
+
+    async def arespond(self, audio_file, language='en'):
+        """Async respond, for the async views"""
+        handler = await get_eager_responses().aresult(audio_file, language)
+        if handler is not None:
+            return handler
+        return await self.agenerate(audio_file, language)
+
+    def generate(self, audio_file, language='en', eager=False):
+        """Generate and persist a new AI response for a transcribed AudioFile"""
+        handler = AIHandler.objects.create(
+            text_content=audio_file.transcription,
+            audio_source=audio_file,
+            original_request={'audio_file_id': str(audio_file.pk), 'language': language, 'eager': eager},
+        )
+        result = self.speech_processor.process_and_convert(handler, language)
+        if not result['success']:
+            logger.error(f"Response generation failed for {audio_file.pk}: {result['error']}")
+        return handler
+
+    async def agenerate(self, audio_file, language='en'):
+        """Async generate"""
+        handler = await AIHandler.objects.acreate(
+            text_content=audio_file.transcription,
+            audio_source=audio_file,
+            original_request={'audio_file_id': str(audio_file.pk), 'language': language, 'eager': False},
+        )
+        result = await self.speech_processor.aprocess_and_convert(handler, language)
+        if not result['success']:
+            logger.error(f"Response generation failed for {audio_file.pk}: {result['error']}")
+        return handler
+
+    def stream_respond(self, audio_file, language='en', audio_format=SOURCE_FORMAT):
+        """
+        Generate the response sentence by sentence.
+
+        Yields one event per sentence ({'index', 'text', 'audio_path'}, the
+        audio in ``audio_format``) as soon as its audio is ready, then a final {'done': True, ...} event.
+        The AIHandler is saved once the answer is complete.
+        """
+        handler = AIHandler.objects.create(
+            text_content=audio_file.transcription,
+            audio_source=audio_file,
+            original_request={
+                'audio_file_id': str(audio_file.pk), 'language': language, 'streamed': True, 'audio_format': audio_format,
+            },
+        )
+        # stream_response answers matching requests from the same table
+        intent = self.speech_processor.intents.match(audio_file.transcription)
+        if intent is not None:
+            handler.intent, handler.action = intent.name, intent.action
+        sentences = []
+        timings = handler.stage_timings = {}
+        start = time.perf_counter()
+        try:
+            for index, (sentence, audio_path) in enumerate(
+                self.speech_processor.stream_response(audio_file.transcription, language, audio_format)
+            ):
+                if not audio_path:
+                    raise VoicePipelineError('Failed to generate audio file')
+                sentences.append(sentence)
+                timings.setdefault('first_audio', time.perf_counter() - start)
+                yield {'index': index, 'text': sentence, 'audio_path': audio_path}
+            handler.processed = True
+        except Exception as e:
+            logger.error(f"Streamed response failed for {audio_file.pk}: {e}")
+            handler.error_message = str(e)
+        finally:
+            timings['respond'] = time.perf_counter() - start
+            observe_stages(timings)
+            handler.response_text = ' '.join(sentences)
+            handler.save()
+
+        yield {
+            'done': True,
+            'response_id': str(handler.pk),
+            'response_text': handler.response_text,
+            'is_successful': handler.processed,
+            'error': handler.error_message,
+            'intent': handler.intent,
+            'action': handler.action,
+        }
+
+    def respond_to(self, audio_file_id, language='en'):
+        """Look up an upload by id and respond to it"""
+        return self.respond(self.get_transcription(audio_file_id), language)
+
+
+class EagerResponses:
+    """
+    Speculative AI responses (EAGER_RESPONSES).
+
+    start() is called when a transcription is saved and generates the
+    response in a worker thread, stored as an AIHandler flagged "eager" in
+    its original_request. respond() then returns that handler instead of
+    starting over: right away if it is done, after waiting for it if it is
+    in flight, in this process or (polling the table) in another one. A
+    failed speculative response is ignored and the request generates its own.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers or settings.EAGER_RESPONSE_WORKERS
+        self._executor = None
+        self._futures = {}
+        # Uploads answered in this process, so upstreams() can skip admission for them
+        self._answered = LRUCache(maxsize=1024)
+        self._lock = threading.Lock()
+
+    def start(self, audio_file, language='en'):
+        """Start generating the response to a transcribed AudioFile in the background"""
+        if not settings.EAGER_RESPONSES or not audio_file.is_successful:
+            return
+        # Speculative work gives way when the upstreams are already saturated
+        try:
+            admission.admit(None, VoicePipeline().upstreams(audio_file))
+        except upstream.Overloaded as e:
+            logger.info(f"Not answering {audio_file.pk} ahead of time: {e}")
+            return
+        with self._lock:
+            if audio_file.pk in self._futures:
+                return
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="eager-response")
+            future = self._executor.submit(self._generate, audio_file, language)
+            self._futures[audio_file.pk] = future
+        future.add_done_callback(lambda _: self._finished(audio_file.pk))
+
+    def started(self, audio_file):
+        """Whether this process is generating or has generated the response to ``audio_file``"""
+        if not settings.EAGER_RESPONSES:
+            return False
+        with self._lock:
+            if audio_file.pk in self._futures:
+                return True
+        return self._answered.get(audio_file.pk) is not None
+
+    def result(self, audio_file, language='en'):
+        """The speculative response to ``audio_file``, or None if there is no usable one"""
+        if not settings.EAGER_RESPONSES:
+            return None
+        with self._lock:
+            future = self._futures.get(audio_file.pk)
+        if future is not None:
+            try:
+                future.result(timeout=settings.UPSTREAM_DEADLINE)
+            except Exception:
+                return None
+        end = time.monotonic() + settings.UPSTREAM_DEADLINE
+        while True:
+            handler = self._latest(audio_file, language).first()
+            if not self._in_flight(handler) or time.monotonic() >= end:
+                return handler if handler is not None and handler.processed else None
+            time.sleep(settings.EAGER_POLL_INTERVAL)
+
+    async def aresult(self, audio_file, language='en'):
+        """Async result(); waits on the event loop"""
+        if not settings.EAGER_RESPONSES:
+            return None
+        with self._lock:
+            future = self._futures.get(audio_file.pk)
+        if future is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), settings.UPSTREAM_DEADLINE)
+            except Exception:
+                return None
+        end = time.monotonic() + settings.UPSTREAM_DEADLINE
+        while True:
+            handler = await self._latest(audio_file, language).afirst()
+            if not self._in_flight(handler) or time.monotonic() >= end:
+                return handler if handler is not None and handler.processed else None
+            await asyncio.sleep(settings.EAGER_POLL_INTERVAL)
+
+    def _generate(self, audio_file, language):
+        try:
+            handler = VoicePipeline().generate(audio_file, language, eager=True)
+            if handler.processed:
+                self._answered.set(audio_file.pk, handler.pk)
+            return handler
+        except Exception as e:
+            logger.warning(f"Speculative response to {audio_file.pk} failed: {e}")
+            raise
+        finally:
+            close_old_connections()
+
+    def _finished(self, pk):
+        with self._lock:
+            self._futures.pop(pk, None)
+
+    @staticmethod
+    def _latest(audio_file, language):
+        return AIHandler.objects.filter(
+            audio_source=audio_file, original_request__eager=True, original_request__language=language,
+        ).order_by('-created_at')
+
+    @staticmethod
+    def _in_flight(handler):
+        """Whether ``handler`` is a speculative response still being generated, possibly by another process"""
+        if handler is None or handler.processed or handler.error_message:
+            return False
+        # One that outlived its deadline belonged to a process that died
+        return timezone.now() - handler.created_at < timedelta(seconds=settings.UPSTREAM_DEADLINE)
+
+
+_eager = None
+_eager_lock = threading.Lock()
+
+
+def get_eager_responses():
+    """Return the process-wide EagerResponses"""
+    global _eager
+    with _eager_lock:
+        if _eager is None:
+            _eager = EagerResponses()
+        return _eager
@@ -1,83 +1,366 @@
 import os
+import re
+import asyncio
+import json
+import hashlib
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import sync_to_async
 from django.conf import settings
-import uuid
-import gtts
-import google.generativeai as genai
+from .cache import LLMResponseCache, SingleFlight, AsyncSingleFlight
+from .metrics import StageTimer, observe_stages
+from . import upstream
+from .storage import GENERATED, media_storage, write_atomic
+from .tts_formats import SOURCE_FORMAT, variant, pretranscode
+from .intents import get_intents
 
-genai.configure(api_key=settings.GOOGLE_API_KEY)
-model = genai.GenerativeModel("gemini-2.0-flash-lite")
+logger = logging.getLogger(__name__)
+
+MODEL_NAME = "gemini-2.0-flash-lite"
+GENERATION_CONFIG = {
+    'temperature': 0.3,
+    'max_output_tokens': 100,
+}
 
 base_promt = " in 50 words or less. Format the answer for text-to-speech: Avoid symbols, and use natural language that sounds good when spoken."
 
+# Changing base_promt, the model or the config automatically misses old entries
+llm_cache = LLMResponseCache(MODEL_NAME, GENERATION_CONFIG, base_promt)
+
+# The Gemini SDK and gTTS are slow to import, so they are only loaded on first use
+_model = None
+_model_lock = threading.Lock()
+
+
+def get_model():
+    """Configure the Gemini SDK and build the model on first use"""
+    global _model
+    with _model_lock:
+        if _model is None:
+            import google.generativeai as genai
+            genai.configure(api_key=settings.GOOGLE_API_KEY)
+            _model = genai.GenerativeModel(MODEL_NAME)
+        return _model
+
+
+def warm_up():
+    """Build the LLM client and import gTTS ahead of the first request"""
+    get_model()
+    import gtts  # noqa: F401
+
+
+# gTTS voice options, part of the key of every stored clip
+TTS_VOICE = {
+    'tld': 'com',
+    'slow': False,
+}
+
+# Concurrent requests for the same clip share a single gTTS call
+tts_flight = SingleFlight()
+async_tts_flight = AsyncSingleFlight()
+
+
+def speech_key(text, language, voice):
+    """Content address of a TTS clip"""
+    payload = json.dumps({'text': text.strip(), 'lang': language, 'voice': voice}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def clip_name(text, language):
+    """Storage name of the clip for ``text``, relative to MEDIA_ROOT"""
+    return media_storage.shard(f"{GENERATED}/{speech_key(text, language, TTS_VOICE)}.mp3")
+
+
+def touch(path):
+    """Mark a stored clip as used, so retention counts from its last use; False if it doesn't exist"""
+    try:
+        os.utime(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def reraise_shed(error):
+    """Re-raise upstream.Overloaded: shed, not failed, so the view answers 503 and the device retries"""
+    if isinstance(error, upstream.Overloaded):
+        raise error
+
+
+# A sentence ends at . ! or ? followed by whitespace, so "3.5" is not split
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
+
+
+def iter_sentences(chunks):
+    """Regroup streamed text chunks into whole sentences as soon as each one ends"""
+    buffer = ''
+    for chunk in chunks:
+        buffer += chunk
+        parts = SENTENCE_END.split(buffer)
+        for sentence in parts[:-1]:
+            if sentence.strip():
+                yield sentence.strip()
+        buffer = parts[-1]
+    if buffer.strip():
+        yield buffer.strip()
+
+
 class SpeechProcessor:
-    """Class for processing text and handling text-to-speech conversion"""
+    """
+    Class for processing text and handling text-to-speech conversion.
+
+    ``llm`` and ``tts_class`` default to the Gemini model and gTTS; anything
+    with the same generate_content() / write_to_fp() interface can be
+    passed instead, e.g. the fakes in benchmarks/fakes.py. Both are called
+    through upstream.llm and upstream.tts. Requests matching one of
+    ``intents`` (default: LOCAL_INTENTS) get its canned response instead
+    of an LLM answer.
+    """
     
-    def __init__(self):
-        self.output_dir = os.path.join(settings.MEDIA_ROOT, 'generated_audio')
-        # Create the directory if it doesn't exist
-        os.makedirs(self.output_dir, exist_ok=True)
+    def __init__(self, llm=None, tts_class=None, intents=None):
+        self._llm = llm
+        self._tts_class = tts_class
+        self._intents = intents
+
+    @property
+    def llm(self):
+        return self._llm or get_model()
+
+    @property
+    def intents(self):
+        return self._intents or get_intents()
+
+    @property
+    def tts_class(self):
+        if self._tts_class is None:
+            import gtts
+            self._tts_class = gtts.gTTS
+        return self._tts_class
 
     def process_text(self, text):
+        cached = llm_cache.get(text)
+        if cached is not None:
+            return cached
+
         prompt = text + base_promt
         
-        ai_response = model.generate_content(
+        ai_response = upstream.llm.call(self._generate, prompt)
+
+        llm_cache.set(text, ai_response.text)
+        return ai_response.text
+
+    def _generate(self, prompt, timeout, stream=False):
+        return self.llm.generate_content(
             prompt,
-            generation_config=genai.types.GenerationConfig(
-                temperature=0.3, 
-                max_output_tokens=100
-            )
+            generation_config=dict(GENERATION_CONFIG),
+            stream=stream,
+            request_options={'timeout': timeout}
         )
 
+    async def _agenerate(self, prompt, timeout):
+        llm = self.llm
+        if hasattr(llm, 'generate_content_async'):
+            return await llm.generate_content_async(
+                prompt, generation_config=dict(GENERATION_CONFIG), request_options={'timeout': timeout}
+            )
+        return await asyncio.to_thread(self._generate, prompt, timeout)
+
+    async def aprocess_text(self, text):
+        """Async process_text, using the model's generate_content_async when it has one"""
+        cached = await sync_to_async(llm_cache.get)(text)
+        if cached is not None:
+            return cached
+
+        prompt = text + base_promt
+        ai_response = await upstream.llm.acall(self._agenerate, prompt)
+
+        await sync_to_async(llm_cache.set)(text, ai_response.text)
         return ai_response.text
+
+    def stream_text(self, text):
+        """Yield the LLM answer in pieces as the model produces them"""
+        cached = llm_cache.get(text)
+        if cached is not None:
+            yield cached
+            return
+
+        prompt = text + base_promt
+        
+        # A stream can't be hedged once it started, so only the breaker and timeout apply
+        ai_response = upstream.llm.call(self._generate, prompt, stream=True, hedge=False)
+
+        parts = []
+        for chunk in ai_response:
+            parts.append(chunk.text)
+            yield chunk.text
+        llm_cache.set(text, ''.join(parts))
+
+    def stream_response(self, text, language='en', audio_format=SOURCE_FORMAT):
+        """
+        Yield (sentence, audio_path) for each sentence of the answer.
+
+        Each sentence is sent to TTS as soon as the LLM finishes it, while
+        the rest of the answer keeps streaming in, and is yielded once its
+        audio exists, in order.
+        """
+        intent = self.intents.match(text)
+        answer = [intent.response] if intent is not None else self.stream_text(text)
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=settings.TTS_STREAM_WORKERS) as pool:
+            for sentence in iter_sentences(answer):
+                pending.append((sentence, pool.submit(self.generate_speech, sentence, language, audio_format)))
+                while pending and pending[0][1].done():
+                    sentence, future = pending.popleft()
+                    yield sentence, future.result()
+            while pending:
+                sentence, future = pending.popleft()
+                yield sentence, future.result()
     
-    def generate_speech(self, text, language='en'):
-        """Convert text to speech and save as a WAV file"""
+    def generate_speech(self, text, language='en', audio_format=SOURCE_FORMAT):
+        """
+        Convert text to speech and save it as an MP3 file, plus its variant
+        in ``audio_format`` (see api/tts_formats.py).
+
+        Clips are stored under the hash of (text, language, voice), so a
+        repeated request returns the existing file without calling gTTS.
+        """
         try:
-            # Generate a unique filename
-            filename = f"{uuid.uuid4()}.wav"
-            output_path = os.path.join(self.output_dir, filename)
-            
-            # Use gTTS to convert text to speech
-            tts = gtts.gTTS(text=text, lang=language)
-            
-            # Save the audio file
-            tts.save(output_path)
+            name = clip_name(text, language)
+            if not touch(media_storage.path(name)):
+                tts_flight.do(name, self._synthesize, text, language, name)
             
             # Return the relative path from MEDIA_ROOT
-            return os.path.join('generated_audio', filename)
+            return variant(name, audio_format)
         
         except Exception as e:
-            print(f"Error generating speech: {str(e)}")
+            reraise_shed(e)
+            logger.error(f"Error generating speech: {e}")
             return None
+
+    def _voice(self, text, language):
+        """The gTTS object for ``text``"""
+        return self.tts_class(text=text, lang=language, **TTS_VOICE)
+
+    def _synthesize(self, text, language, name):
+        # Another request may have finished the clip while we waited for the flight
+        output_path = media_storage.path(name)
+        if os.path.exists(output_path):
+            return
         
-    def process_and_convert(self, ai_handler, language='en'):
-        """Process text from AIHandler instance and convert to speech"""
+        audio = upstream.tts.call(upstream.synthesize, self._voice(text, language))
+        write_atomic(output_path, audio)
+        pretranscode(name)
+
+    async def agenerate_speech(self, text, language='en', audio_format=SOURCE_FORMAT):
+        """Async generate_speech: gTTS goes over the pooled async client, files are written in a thread"""
         try:
-            request_text = ai_handler.text_content
+            name = clip_name(text, language)
+            if not await asyncio.to_thread(touch, media_storage.path(name)):
+                await async_tts_flight.do(name, self._asynthesize, text, language, name)
             
-            response_text = self.process_text(request_text)
+            if audio_format == SOURCE_FORMAT:
+                return name
+            return await asyncio.to_thread(variant, name, audio_format)
+        
+        except Exception as e:
+            reraise_shed(e)
+            logger.error(f"Error generating speech: {e}")
+            return None
+
+    async def _asynthesize(self, text, language, name):
+        output_path = media_storage.path(name)
+        if os.path.exists(output_path):
+            return
+        from .async_clients import synthesize
+        audio = await upstream.tts.acall(synthesize, self._voice(text, language))
+        await asyncio.to_thread(write_atomic, output_path, audio)
+        await asyncio.to_thread(pretranscode, name)
+
+    def process_and_convert(self, ai_handler, language='en'):
+        """Process text from AIHandler instance, convert to speech and store both on it"""
+        timer = StageTimer()
+        # Saved with the handler in every branch below
+        ai_handler.stage_timings = timer.stages
+        try:
+            response_text = self._answer_locally(ai_handler)
             
-            audio_path = self.generate_speech(response_text, language)
+            with upstream.deadline(settings.UPSTREAM_DEADLINE):
+                if response_text is None:
+                    with timer.stage('llm'):
+                        response_text = self.process_text(ai_handler.text_content)
+                ai_handler.response_text = response_text
+                
+                with timer.stage('tts'):
+                    audio_path = self.generate_speech(response_text, language)
             
-            if audio_path:
-                ai_handler.audio_file = audio_path
-                ai_handler.processed = True
-                ai_handler.save()
+            result = self._apply_response(ai_handler, response_text, audio_path)
+            ai_handler.save()
+            return result
                 
-                return {
-                    'success': True,
-                    'audio_path': audio_path,
-                    'request_text': request_text,
-                    'response_text': response_text
-                }
-            else:
-                return {
-                    'success': False,
-                    'error': 'Failed to generate audio file'
-                }
+        except Exception as e:
+            ai_handler.error_message = str(e)
+            ai_handler.save()
+            reraise_shed(e)
+            return {'success': False, 'error': str(e)}
+        finally:
+            observe_stages(timer.stages)
+
+    async def aprocess_and_convert(self, ai_handler, language='en'):
+        """Async process_and_convert; the event loop is free while the LLM and TTS answer"""
+        timer = StageTimer()
+        ai_handler.stage_timings = timer.stages
+        try:
+            response_text = self._answer_locally(ai_handler)
+            
+            with upstream.deadline(settings.UPSTREAM_DEADLINE):
+                if response_text is None:
+                    with timer.stage('llm'):
+                        response_text = await self.aprocess_text(ai_handler.text_content)
+                ai_handler.response_text = response_text
                 
+                with timer.stage('tts'):
+                    audio_path = await self.agenerate_speech(response_text, language)
+            
+            result = self._apply_response(ai_handler, response_text, audio_path)
+            await ai_handler.asave()
+            return result
+        
         except Exception as e:
+            ai_handler.error_message = str(e)
+            await ai_handler.asave()
+            reraise_shed(e)
+            return {'success': False, 'error': str(e)}
+        finally:
+            observe_stages(timer.stages)
+
+    def _answer_locally(self, ai_handler):
+        """The canned response if the request matches an intent (recorded on the handler), else None"""
+        intent = self.intents.match(ai_handler.text_content)
+        if intent is None:
+            return None
+        ai_handler.intent = intent.name
+        ai_handler.action = intent.action
+        return intent.response
+
+    @staticmethod
+    def _apply_response(ai_handler, response_text, audio_path):
+        """Set the outcome on the handler (without saving) and return the result dict"""
+        request_text = ai_handler.text_content
+        if audio_path:
+            ai_handler.audio_file = audio_path
+            ai_handler.processed = True
+            ai_handler.error_message = None
             return {
-                'success': False,
-                'error': str(e)
-            }
\ No newline at end of file
+                'success': True,
+                'audio_path': audio_path,
+                'request_text': request_text,
+                'response_text': response_text
+            }
+        ai_handler.error_message = 'Failed to generate audio file'
+        return {
+            'success': False,
+            'error': 'Failed to generate audio file',
+            'request_text': request_text,
+            'response_text': response_text
+        }
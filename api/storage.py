@@ -0,0 +1,256 @@
+"""
+Media storage for uploads and generated clips.
+
+Files are spread over hashed subdirectories (audio_files/3f/recording_1.wav)
+so no single directory holds every file, and MediaSweeper enforces
+the retention and size quotas of MEDIA_RETENTION_DAYS and MEDIA_QUOTA_BYTES.
+Paths stored before sharding (audio_files/recording_1.wav) keep working.
+"""
+import os
+import time
+import hashlib
+import logging
+import posixpath
+import tempfile
+import threading
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.db import close_old_connections
+from django.utils.deconstruct import deconstructible
+
+logger = logging.getLogger(__name__)
+
+UPLOADS = 'audio_files'
+GENERATED = 'generated_audio'
+# Suffix of files still being written (see write_atomic)
+PARTIAL_SUFFIX = '.part'
+
+
+@deconstructible
+class ShardedStorage(FileSystemStorage):
+    """FileSystemStorage that files every name under MEDIA_SHARD_DEPTH levels of hashed directories"""
+
+    def shard(self, name):
+        """audio_files/x.wav -> audio_files/ab/x.wav (one level per MEDIA_SHARD_DEPTH), by the hash of the file name"""
+        directory, filename = posixpath.split(name)
+        digest = hashlib.sha1(filename.encode()).hexdigest()
+        levels = [digest[2 * i:2 * i + 2] for i in range(settings.MEDIA_SHARD_DEPTH)]
+        return posixpath.join(directory, *levels, filename)
+
+    def generate_filename(self, filename):
+        return super().generate_filename(self.shard(filename))
+
+    def create_path(self, name):
+        """Absolute path to write ``name`` to, with its directories created"""
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+
+media_storage = ShardedStorage()
+
+
+def write_atomic(path, data):
+    """Write next to the target and rename, so readers never see a partial file"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=PARTIAL_SUFFIX)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+
+class MediaSweeper:
+    """
+    Delete media past its retention, over its quota, or left behind.
+
+    Per directory (uploads and generated clips) a sweep deletes files older
+    than the retention, then the oldest files until the directory fits its
+    quota. Uploads no AudioFile points at and stale .part files are removed
+    once they are older than MEDIA_ORPHAN_GRACE. Generated clips are a
+    content-addressed cache shared by many responses, so they are never
+    treated as orphans; generate_speech refreshes their mtime on reuse, and
+    their transcoded variants (api/tts_formats.py) age the same way.
+
+    Rows whose file was deleted keep their transcription and response text;
+    their file field is cleared. Deletes happen in batches of
+    MEDIA_SWEEP_BATCH with MEDIA_SWEEP_PAUSE seconds in between, and the
+    background thread runs at low CPU and I/O priority.
+    """
+
+    def __init__(self, storage=None, batch_size=None, pause=None, dry_run=False):
+        self.storage = storage or media_storage
+        self.batch_size = batch_size or settings.MEDIA_SWEEP_BATCH
+        self.pause = settings.MEDIA_SWEEP_PAUSE if pause is None else pause
+        self.dry_run = dry_run
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def sweep(self):
+        """Run one sweep over every media directory and return what was deleted"""
+        stats = {'scanned': 0, 'expired': 0, 'over_quota': 0, 'orphans': 0, 'partial': 0, 'bytes_freed': 0}
+        for directory in (UPLOADS, GENERATED):
+            self._sweep_directory(directory, stats)
+        logger.info(f"Media sweep finished: {stats}")
+        return stats
+
+    def _sweep_directory(self, directory, stats):
+        now = time.time()
+        grace_cutoff = now - settings.MEDIA_ORPHAN_GRACE
+        days = settings.MEDIA_RETENTION_DAYS.get(directory)
+        expire_cutoff = now - days * 86400 if days is not None else None
+
+        files = []
+        partial = []
+        for name, size, mtime in self._scan(directory):
+            stats['scanned'] += 1
+            if name.endswith(PARTIAL_SUFFIX):
+                if mtime < grace_cutoff:
+                    partial.append((name, size))
+            else:
+                files.append((mtime, size, name))
+        self._delete(partial, directory, stats, 'partial')
+
+        expired = [(name, size) for mtime, size, name in files if expire_cutoff is not None and mtime < expire_cutoff]
+        self._delete(expired, directory, stats, 'expired')
+        files = [entry for entry in files if expire_cutoff is None or entry[0] >= expire_cutoff]
+
+        if directory == UPLOADS:
+            candidates = [(name, size) for mtime, size, name in files if mtime < grace_cutoff]
+            orphans = self._unreferenced(candidates)
+            self._delete(orphans, directory, stats, 'orphans')
+            orphaned = {name for name, _ in orphans}
+            files = [entry for entry in files if entry[2] not in orphaned]
+
+        quota = settings.MEDIA_QUOTA_BYTES.get(directory)
+        total = sum(size for _, size, _ in files)
+        if quota is not None and total > quota:
+            over = []
+            for mtime, size, name in sorted(files):
+                if total <= quota:
+                    break
+                over.append((name, size))
+                total -= size
+            self._delete(over, directory, stats, 'over_quota')
+
+    def _scan(self, directory):
+        """Yield (name, size, mtime) for every file under a media directory"""
+        root = self.storage.path(directory)
+        stack = [root]
+        while stack:
+            try:
+                entries = list(os.scandir(stack.pop()))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    try:
+                        info = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    name = posixpath.join(directory, *os.path.relpath(entry.path, root).split(os.sep))
+                    yield name, info.st_size, info.st_mtime
+
+    def _unreferenced(self, candidates):
+        """The (name, size) pairs no AudioFile row points at"""
+        from .models import AudioFile
+        orphans = []
+        for start in range(0, len(candidates), self.batch_size):
+            batch = candidates[start:start + self.batch_size]
+            known = set(AudioFile.objects.filter(audio_file__in=[name for name, _ in batch])
+                        .values_list('audio_file', flat=True))
+            orphans += [(name, size) for name, size in batch if name not in known]
+        return orphans
+
+    def _delete(self, files, directory, stats, reason):
+        from .models import AudioFile, AIHandler
+        for start in range(0, len(files), self.batch_size):
+            if start:
+                self._stopping.wait(self.pause)
+            batch = files[start:start + self.batch_size]
+            names = [name for name, _ in batch]
+            if not self.dry_run:
+                for name, size in batch:
+                    try:
+                        os.remove(self.storage.path(name))
+                    except FileNotFoundError:
+                        continue
+                if directory == UPLOADS:
+                    AudioFile.objects.filter(audio_file__in=names).update(audio_file='')
+                else:
+                    AIHandler.objects.filter(audio_file__in=names).update(audio_file=None)
+            stats[reason] += len(batch)
+            stats['bytes_freed'] += sum(size for _, size in batch)
+
+    def start(self):
+        """Sweep every MEDIA_SWEEP_INTERVAL seconds in a background thread (no-op if the interval is 0)"""
+        with self._lock:
+            if self._thread is not None or not settings.MEDIA_SWEEP_INTERVAL:
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="media-sweeper", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            self._stopping.set()
+            if self._thread is not None:
+                self._thread.join()
+                self._thread = None
+
+    def _run(self):
+        try:
+            # Linux applies nice to the calling thread only, and derives its I/O priority from it
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except (AttributeError, OSError):
+            pass
+        while not self._stopping.wait(settings.MEDIA_SWEEP_INTERVAL):
+            try:
+                with sweep_lock() as acquired:
+                    if acquired:
+                        self.sweep()
+            except Exception as e:
+                logger.error(f"Media sweep failed: {e}")
+            finally:
+                close_old_connections()
+
+
+@contextmanager
+def sweep_lock():
+    """
+    Non-blocking lock file under MEDIA_ROOT, so only one process sweeps at
+    a time. Yields False when another process holds it.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        yield True
+        return
+    os.makedirs(settings.MEDIA_ROOT, exist_ok=True)
+    with open(os.path.join(settings.MEDIA_ROOT, '.sweep.lock'), 'w') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            yield False
+            return
+        yield True
+
+
+_sweeper = None
+_sweeper_lock = threading.Lock()
+
+
+def get_sweeper():
+    """Return the process-wide media sweeper"""
+    global _sweeper
+    with _sweeper_lock:
+        if _sweeper is None:
+            _sweeper = MediaSweeper()
+        return _sweeper
@@ -0,0 +1,286 @@
+import math
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import speech_recognition as sr
+from django.conf import settings
+from .audio_processor import (
+    AudioProcessor, WavFormatError, parse_wav_header, pcm_digest, WAVE_FORMAT_PCM, WAVE_FORMAT_IMA_ADPCM,
+    UNRECOGNIZED_ERROR, SILENT_ERROR,
+)
+from .audio_codecs import DecodeError, open_decoder
+from .cache import transcription_cache
+from .preprocessing import preprocess, SilentAudioError
+
+logger = logging.getLogger(__name__)
+
+# numpy dtypes of the sample widths the segmenter can measure
+_SAMPLE_DTYPES = {1: np.uint8, 2: '<i2', 4: '<i4'}
+
+
+class SilenceSegmenter:
+    """
+    Split a stream of mono PCM bytes into speech segments at pauses.
+
+    Audio is measured in short frames; a segment is closed once it contains
+    speech followed by ``min_silence_ms`` of frames below the RMS threshold,
+    or when it reaches ``max_segment_ms``. Leading silence is dropped except
+    for a short pre-roll so word onsets are not clipped.
+    """
+
+    def __init__(self, sample_rate, sample_width, frame_ms=30, silence_threshold=None,
+                 min_silence_ms=None, max_segment_ms=None, preroll_ms=300):
+        if sample_width not in _SAMPLE_DTYPES:
+            raise ValueError(f"Unsupported sample width for segmentation: {sample_width}")
+        self.sample_rate = sample_rate
+        self.sample_width = sample_width
+        self.frame_bytes = int(sample_rate * frame_ms / 1000) * sample_width
+        self.frame_ms = frame_ms
+
+        # Threshold is a fraction of full scale so it works for any sample width
+        if silence_threshold is None:
+            silence_threshold = settings.STREAMING_SILENCE_THRESHOLD
+        full_scale = (1 << (8 * sample_width - 1)) - 1
+        self.threshold = silence_threshold * full_scale
+        self.min_silence_frames = math.ceil((min_silence_ms or settings.STREAMING_MIN_SILENCE_MS) / frame_ms)
+        self.max_segment_bytes = int(sample_rate * (max_segment_ms or settings.STREAMING_MAX_SEGMENT_MS) / 1000) * sample_width
+        self.preroll_bytes = int(sample_rate * preroll_ms / 1000) * sample_width
+
+        self._pending = bytearray()
+        self._current = bytearray()
+        self._has_speech = False
+        self._silent_frames = 0
+
+    def frame_rms(self, frame):
+        return float(np.sqrt(np.mean(np.square(self._samples(frame)))))
+
+    def frames_rms(self, pcm):
+        """RMS of each frame of ``pcm``, a whole number of frames, as an array"""
+        frames = self._samples(pcm).reshape(-1, self.frame_bytes // self.sample_width)
+        return np.sqrt(np.mean(np.square(frames), axis=1))
+
+    def _samples(self, pcm):
+        samples = np.frombuffer(pcm, dtype=_SAMPLE_DTYPES[self.sample_width]).astype(np.float64)
+        if self.sample_width == 1:
+            # 8-bit WAV is unsigned around 128
+            samples -= 128
+        return samples
+
+    def feed(self, data):
+        """Add PCM bytes and return the list of segments completed by them"""
+        self._pending += data
+        completed = []
+        usable = len(self._pending) - len(self._pending) % self.frame_bytes
+        if not usable:
+            return completed
+        levels = self.frames_rms(self._pending[:usable])
+        for index, offset in enumerate(range(0, usable, self.frame_bytes)):
+            segment = self._add_frame(self._pending[offset:offset + self.frame_bytes], levels[index])
+            if segment:
+                completed.append(segment)
+        del self._pending[:usable]
+        return completed
+
+    def flush(self):
+        """Return the last segment once the stream has ended, if it holds speech"""
+        self._current += self._pending
+        self._pending.clear()
+        segment = bytes(self._current) if self._has_speech else None
+        self._reset()
+        return segment
+
+    def _add_frame(self, frame, rms):
+        self._current += frame
+        if rms >= self.threshold:
+            self._has_speech = True
+            self._silent_frames = 0
+        else:
+            self._silent_frames += 1
+
+        if not self._has_speech:
+            # Keep only a short pre-roll of silence before speech starts
+            if len(self._current) > self.preroll_bytes:
+                del self._current[:len(self._current) - self.preroll_bytes]
+            return None
+
+        if self._silent_frames >= self.min_silence_frames or len(self._current) >= self.max_segment_bytes:
+            segment = bytes(self._current)
+            self._reset()
+            return segment
+        return None
+
+    def _reset(self):
+        self._current = bytearray()
+        self._has_speech = False
+        self._silent_frames = 0
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Shared pool that recognizes segments while uploads are still arriving"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.STREAMING_RECOGNITION_WORKERS,
+                thread_name_prefix="stream-recognizer",
+            )
+        return _executor
+
+
+class StreamingTranscriber:
+    """
+    Transcribe an upload incrementally while it is still arriving.
+
+    Feed it the raw request chunks. Once the header has been read, PCM
+    (decoded by audio_codecs for IMA-ADPCM, FLAC and Opus) is segmented on
+    silence and every completed segment is submitted for recognition
+    straight away, so after the last byte only the final segment is left
+    to recognize. ``streaming`` is False if the upload is not mono, in
+    which case the caller should fall back to the queue.
+    """
+
+    def __init__(self, processor=None, executor=None, container='wav'):
+        self.processor = processor or AudioProcessor()
+        self.executor = executor or get_executor()
+        self.active = True
+        self._error = None
+        self.sample_rate = None
+        self.sample_width = None
+        self._header = bytearray()
+        # WAV is read here unless its header says IMA-ADPCM; other containers always need a decoder
+        self._decoder = None if container == 'wav' else open_decoder(container)
+        self._segmenter = None
+        self._futures = []
+        # The whole clip is kept so digest and stats match the non-streaming path
+        self._pcm = bytearray()
+
+    @property
+    def streaming(self):
+        """True once a usable header was read and segments are being recognized"""
+        return self.active and self._segmenter is not None
+
+    def feed(self, chunk):
+        if not self.active:
+            return
+        if self._segmenter is None:
+            chunk = self._read_header(chunk)
+            if chunk is None:
+                return
+        elif self._decoder is not None:
+            chunk = self._decode(self._decoder.feed, chunk)
+        self._pcm += chunk
+        for segment in self._segmenter.feed(chunk):
+            self._submit(segment)
+
+    def finish(self):
+        """Recognize the tail of the stream and stitch all segments together"""
+        if self._decoder is not None and self.active:
+            tail = self._decode(self._decoder.finish)
+            if not self.active:
+                return {"success": False, "error": f"Audio loading failed: {self._error}", "text": None}
+            self._pcm += tail
+            for segment in self._segmenter.feed(tail):
+                self._submit(segment)
+        if self._segmenter is not None:
+            segment = self._segmenter.flush()
+            if segment:
+                self._submit(segment)
+
+        results = [future.result() for future in self._futures]
+        logger.info(f"Streaming transcription finished with {len(results)} segments")
+        digest, stats = self._summarize()
+        if not results and stats and digest is None:
+            return {"success": False, "error": SILENT_ERROR, "text": None, "stats": stats}
+        failures = [r for r in results if not r.get("success") and r.get("error") != UNRECOGNIZED_ERROR]
+        if failures:
+            return {**failures[0], "pcm_digest": digest, "stats": stats}
+        texts = [r["text"] for r in results if r.get("success") and r.get("text")]
+        if not texts:
+            return {"success": False, "error": UNRECOGNIZED_ERROR, "text": None, "pcm_digest": digest, "stats": stats}
+
+        text = " ".join(texts)
+        if digest:
+            transcription_cache.set(digest, text)
+        return {"success": True, "error": None, "text": text, "pcm_digest": digest, "stats": stats}
+
+    def _summarize(self):
+        """Digest and ClipStats of the whole clip, computed as AudioProcessor would"""
+        if self._segmenter is None:
+            return None, None
+        pcm = self._pcm[:len(self._pcm) - len(self._pcm) % self.sample_width]
+        if not settings.AUDIO_PREPROCESS:
+            return pcm_digest(sr.AudioData(bytes(pcm), self.sample_rate, self.sample_width)), None
+        try:
+            pcm16, stats = preprocess(pcm, self.sample_rate, self.sample_width, 1)
+        except SilentAudioError as e:
+            return None, e.stats._asdict()
+        return pcm_digest(sr.AudioData(pcm16, settings.PREPROCESS_SAMPLE_RATE, 2)), stats._asdict()
+
+    def _read_header(self, chunk):
+        """Buffer bytes until the header is complete; return the PCM after it"""
+        if self._decoder is not None:
+            pcm = self._decode(self._decoder.feed, chunk)
+            if self._decoder.format is None:
+                return None
+            return self._start(self._decoder.format.sample_rate, 2, self._decoder.format.channels, pcm)
+
+        self._header += chunk
+        try:
+            info = parse_wav_header(self._header)
+        except WavFormatError as e:
+            # Wait for more bytes unless the header is clearly not a WAV
+            if (len(self._header) >= 4 and bytes(self._header[:4]) != b'RIFF') or len(self._header) > 4096:
+                self._disable(e)
+            return None
+
+        if info.format_tag == WAVE_FORMAT_IMA_ADPCM:
+            self._decoder = open_decoder('wav')
+            header, self._header = bytes(self._header), bytearray()
+            return self._read_header(header)
+        if info.format_tag != WAVE_FORMAT_PCM or info.sample_width not in _SAMPLE_DTYPES:
+            self._disable(f"unsupported WAV format {info.format_tag:#06x}")
+            return None
+        pcm = bytes(self._header[info.data_offset:])
+        self._header = bytearray()
+        return self._start(info.sample_rate, info.sample_width, info.channels, pcm)
+
+    def _start(self, sample_rate, sample_width, channels, pcm):
+        if channels != 1:
+            self._disable("upload is not mono")
+            return None
+        self.sample_rate = sample_rate
+        self.sample_width = sample_width
+        self._segmenter = SilenceSegmenter(sample_rate, sample_width)
+        return pcm
+
+    def _decode(self, step, *args):
+        """Run a decoder step; a decoding error turns streaming off"""
+        try:
+            return step(*args)
+        except DecodeError as e:
+            self._disable(e)
+            return b''
+
+    def _disable(self, reason):
+        logger.info(f"Streaming transcription disabled: {reason}")
+        self.active = False
+        self._error = str(reason)
+        if self._decoder is not None:
+            self._decoder.close()
+
+    def _submit(self, segment):
+        index = len(self._futures)
+        if settings.AUDIO_PREPROCESS:
+            try:
+                pcm16, _ = preprocess(segment, self.sample_rate, self.sample_width, 1)
+            except SilentAudioError:
+                return
+            audio_data = sr.AudioData(pcm16, settings.PREPROCESS_SAMPLE_RATE, 2)
+        else:
+            audio_data = sr.AudioData(segment, self.sample_rate, self.sample_width)
+        self._futures.append(self.executor.submit(self.processor.recognize, audio_data, f"<stream segment {index}>"))
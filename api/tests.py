@@ -1,3 +1,1907 @@
-from django.test import TestCase
+import io
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import wave
+import base64
+import struct
+import shutil
+import asyncio
+import audioop
+import tempfile
+import threading
+import subprocess
+from contextlib import contextmanager
+from datetime import timedelta
+from urllib.parse import urlencode
+from concurrent.futures import Future
+from unittest import mock, skipUnless
+import httpx
+import numpy as np
+import requests
+import speech_recognition as sr
+from asgiref.sync import sync_to_async
+from django.apps import apps
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from . import admission, async_clients, audio_codecs, services, tts_formats, upstream
+from .audio_processor import (
+    AudioProcessor, parse_wav_header, SILENT_ERROR, WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT, WAVE_FORMAT_IMA_ADPCM,
+)
+from .cache import LRUCache, LLMResponseCache, SingleFlight, AsyncSingleFlight, TranscriptionCache
+from .intents import IntentMatcher
+from .jobs import TranscriptionQueue, start_queue
+from .metrics import DEFAULT_BUCKETS, Histogram
+from .management.commands import transcribe_backlog
+from .models import AudioFile, AIHandler, LLMResponse
+from .preprocessing import SilentAudioError, normalize, preprocess
+from .recognizers import RecognitionResult, RecognizerChain, SphinxBackend
+from .speech_generator import clip_name
+from .storage import GENERATED, PARTIAL_SUFFIX, UPLOADS, MediaSweeper, media_storage, sweep_lock
+from .streaming import SilenceSegmenter, StreamingTranscriber
+from .websocket import DeviceSession
 
-# Create your tests here.
+
+def make_audio_data(seconds=0.1, sample_rate=16000):
+    """sr.AudioData holding silence"""
+    return sr.AudioData(b'\0\0' * int(seconds * sample_rate), sample_rate, 2)
+
+
+# Response bodies in the wire format of the Google Speech v2 API and of the
+# batchexecute endpoint gTTS calls, as SpeechRecognition 3.17 and gTTS 2.5
+# parse them
+GOOGLE_STT_BODY = (
+    '{"result":[]}\n'
+    '{"result":[{"alternative":[{"transcript":"OK Google turn on the AC","confidence":0.92},'
+    '{"transcript":"ok google turn on the AC"}],"final":true}],"result_index":0}\n'
+)
+GOOGLE_STT_EMPTY_BODY = '{"result":[]}\n'
+GOOGLE_STT_NO_CONFIDENCE_BODY = (
+    '{"result":[]}\n'
+    '{"result":[{"alternative":[{"transcript":"OK Google turn on the AC"}],"final":true}],"result_index":0}\n'
+)
+MP3_PART = b'ID3\x04\x00\x00\x00\x00\x00\x00\xff\xf3\x44\xc4' + bytes(range(64))
+
+
+def gtts_body(audio=MP3_PART):
+    payload = base64.b64encode(audio).decode('ascii')
+    return (
+        ")]}'\n\n"
+        "412\n"
+        f'[["wrb.fr","jQ1olc","[\\"{payload}\\"]",null,null,null,"generic"],["di",57],'
+        '["af.httprm",56,"-4370413218335340452",7]]\n'
+        "25\n"
+        '[["e",4,null,null,548]]\n'
+    )
+
+
+def requests_response(body, request=None, status=200):
+    response = requests.Response()
+    response.status_code = status
+    response.reason = 'OK' if status == 200 else 'Error'
+    response._content = body.encode()
+    response._content_consumed = True
+    response.encoding = 'utf-8'
+    response.request = request
+    return response
+
+
+class RecordingSession:
+    """Stand-in for the pooled requests session that answers every call with ``body``"""
+
+    def __init__(self, body):
+        self.body = body
+        self.posts = []
+        self.sent = []
+
+    def post(self, url, data=None, headers=None, timeout=None):
+        self.posts.append((url, data, headers))
+        return requests_response(self.body)
+
+    def send(self, prepared, **kwargs):
+        self.sent.append((prepared.url, prepared.body))
+        return requests_response(self.body, prepared)
+
+
+class GoogleRecognitionClientTests(SimpleTestCase):
+    """upstream.recognize_google and its async counterpart send what sr.Recognizer.recognize_google sends"""
+
+    def recognize_with_library(self, audio, body):
+        requests_made = []
+
+        def obtain_transcription(request, timeout):
+            requests_made.append((request.full_url, request.data, dict(request.header_items())))
+            return body
+
+        with mock.patch('speech_recognition.recognizers.google.obtain_transcription', obtain_transcription):
+            result = sr.Recognizer().recognize_google(audio, language='en-US', with_confidence=True)
+        return result, requests_made[0]
+
+    def test_matches_library_request_and_result(self):
+        audio = make_audio_data()
+        expected, expected_request = self.recognize_with_library(audio, GOOGLE_STT_BODY)
+        session = RecordingSession(GOOGLE_STT_BODY)
+        with mock.patch.object(upstream, 'get_session', return_value=session):
+            result = upstream.recognize_google(audio, 'en-US', timeout=5)
+        self.assertEqual(result, ('OK Google turn on the AC', 0.92))
+        self.assertEqual(result, expected)
+        self.assertEqual(session.posts, [expected_request])
+
+    def test_missing_confidence_is_none(self):
+        # SpeechRecognition would report 0.5, below RECOGNIZER_MIN_CONFIDENCE
+        session = RecordingSession(GOOGLE_STT_NO_CONFIDENCE_BODY)
+        with mock.patch.object(upstream, 'get_session', return_value=session):
+            self.assertEqual(upstream.recognize_google(make_audio_data(), 'en-US'), ('OK Google turn on the AC', None))
+
+    def test_empty_result_is_unknown_value(self):
+        session = RecordingSession(GOOGLE_STT_EMPTY_BODY)
+        with mock.patch.object(upstream, 'get_session', return_value=session):
+            with self.assertRaises(sr.UnknownValueError):
+                upstream.recognize_google(make_audio_data(), 'en-US')
+
+    def test_http_error_is_request_error(self):
+        session = RecordingSession(GOOGLE_STT_BODY)
+        session.post = lambda *args, **kwargs: requests_response('', status=403)
+        with mock.patch.object(upstream, 'get_session', return_value=session):
+            with self.assertRaises(sr.RequestError):
+                upstream.recognize_google(make_audio_data(), 'en-US')
+
+    def test_connection_error_hides_the_url(self):
+        # The URL carries the API key and the message ends up in AudioFile.error_message
+        def post(url, **kwargs):
+            raise requests.ConnectionError(f"Max retries exceeded with url: {url}")
+
+        async def apost(url, **kwargs):
+            raise httpx.ConnectError(f"All connection attempts failed: {url}")
+
+        session = RecordingSession(GOOGLE_STT_BODY)
+        session.post = post
+        with mock.patch.object(upstream, 'get_session', return_value=session), self.assertRaises(sr.RequestError) as raised:
+            upstream.recognize_google(make_audio_data(), 'en-US')
+        self.assertEqual(str(raised.exception), 'recognition connection failed: ConnectionError')
+        with mock.patch.object(async_clients, 'post', apost), self.assertRaises(sr.RequestError) as raised:
+            asyncio.run(async_clients.recognize_google(make_audio_data(), 'en-US'))
+        self.assertEqual(str(raised.exception), 'recognition connection failed: ConnectError')
+
+    def test_async_matches_library(self):
+        audio = make_audio_data()
+        expected, expected_request = self.recognize_with_library(audio, GOOGLE_STT_BODY)
+        posts = []
+
+        async def post(url, timeout=None, content=None, headers=None):
+            posts.append((url, content, headers))
+            return httpx.Response(200, text=GOOGLE_STT_BODY, request=httpx.Request('POST', url))
+
+        with mock.patch.object(async_clients, 'post', post):
+            result = asyncio.run(async_clients.recognize_google(audio, 'en-US', timeout=5))
+        self.assertEqual(result, expected)
+        self.assertEqual(posts, [expected_request])
+
+
+class GTTSClientTests(SimpleTestCase):
+    """upstream.synthesize and its async counterpart return what gTTS.write_to_fp writes"""
+
+    # Long enough for gTTS to split it into several requests
+    TEXT = "Turning on the air conditioner in the living room now. " * 3
+
+    def synthesize_with_library(self, tts):
+        sent = []
+
+        def send(session, request, **kwargs):
+            sent.append((request.url, request.body))
+            return requests_response(gtts_body(), request)
+
+        buffer = io.BytesIO()
+        with mock.patch('requests.Session.send', send):
+            tts.write_to_fp(buffer)
+        return buffer.getvalue(), sent
+
+    def make_tts(self):
+        import gtts
+        return gtts.tts.gTTS(text=self.TEXT, lang='en')
+
+    def test_matches_library_requests_and_audio(self):
+        expected, expected_sent = self.synthesize_with_library(self.make_tts())
+        self.assertGreater(len(expected_sent), 1)
+        session = RecordingSession(gtts_body())
+        with mock.patch.object(upstream, 'get_session', return_value=session):
+            audio = upstream.synthesize(self.make_tts(), timeout=5)
+        self.assertEqual(audio, MP3_PART * len(expected_sent))
+        self.assertEqual(audio, expected)
+        self.assertEqual(session.sent, expected_sent)
+
+    def test_response_without_audio_is_gtts_error(self):
+        import gtts
+        body = gtts_body().replace('jQ1olc","[', 'jQ1olc",null,"[')
+        with mock.patch.object(upstream, 'get_session', return_value=RecordingSession(body)):
+            with self.assertRaises(gtts.gTTSError):
+                upstream.synthesize(self.make_tts())
+
+    def test_async_matches_library(self):
+        expected, expected_sent = self.synthesize_with_library(self.make_tts())
+        posts = []
+
+        async def post(url, timeout=None, content=None, headers=None):
+            posts.append((url, content))
+            return httpx.Response(200, text=gtts_body(), request=httpx.Request('POST', url))
+
+        with mock.patch.object(async_clients, 'post', post):
+            audio = asyncio.run(async_clients.synthesize(self.make_tts(), timeout=5))
+        self.assertEqual(audio, expected)
+        self.assertEqual(posts, expected_sent)
+
+
+class StubBackend:
+    """Recognizer backend that answers with a fixed result or error"""
+
+    def __init__(self, name, text=None, confidence=None, error=None):
+        self.name = name
+        self.text = text
+        self.confidence = confidence
+        self.error = error
+        self.calls = 0
+
+    def load(self):
+        pass
+
+    def recognize(self, audio_data):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        return RecognitionResult(self.text, self.confidence, self.name)
+
+    async def arecognize(self, audio_data):
+        return self.recognize(audio_data)
+
+
+class RecognizerChainTests(SimpleTestCase):
+    audio = make_audio_data()
+
+    def recognize(self, backends, fallback=()):
+        chain = RecognizerChain(backends, min_confidence=0.6, fallback=fallback)
+        result = chain.recognize(self.audio)
+        # The async path has to agree
+        self.assertEqual(asyncio.run(chain.arecognize(self.audio)), result)
+        return result
+
+    def test_confident_result_skips_later_backends(self):
+        local = StubBackend('local', 'turn on the light', 0.9)
+        remote = StubBackend('remote', 'turn on the lights', 0.95)
+        self.assertEqual(self.recognize([local, remote]).backend, 'local')
+        self.assertEqual(remote.calls, 0)
+
+    def test_unsure_result_falls_through(self):
+        local = StubBackend('local', 'turn on the light', 0.3)
+        remote = StubBackend('remote', 'turn on the lights', 0.95)
+        self.assertEqual(self.recognize([local, remote]).backend, 'remote')
+
+    def test_missing_confidence_is_accepted(self):
+        remote = StubBackend('remote', 'turn on the lights', None)
+        later = StubBackend('later', 'turn on the light', 0.99)
+        self.assertEqual(self.recognize([remote, later]).backend, 'remote')
+        self.assertEqual(later.calls, 0)
+
+    def test_most_confident_wins_when_none_is_sure(self):
+        first = StubBackend('first', 'turn on', 0.4)
+        second = StubBackend('second', 'turn off', 0.5)
+        third = StubBackend('third', None, error=sr.UnknownValueError())
+        self.assertEqual(self.recognize([first, second, third]).backend, 'second')
+
+    def test_last_error_is_raised(self):
+        backends = [StubBackend('a', error=sr.UnknownValueError()), StubBackend('b', error=sr.RequestError('down'))]
+        with self.assertRaises(sr.RequestError):
+            RecognizerChain(backends, min_confidence=0.6).recognize(self.audio)
+
+    def test_fallback_only_when_unavailable(self):
+        fallback = StubBackend('sphinx', 'turn on the light', 0.2)
+        self.assertEqual(self.recognize([StubBackend('google', error=sr.RequestError('open'))], [fallback]).backend,
+                         'sphinx')
+        with self.assertRaises(sr.UnknownValueError):
+            RecognizerChain([StubBackend('google', error=sr.UnknownValueError())], fallback=[fallback]).recognize(self.audio)
+
+
+class SphinxConfidenceTests(SimpleTestCase):
+    """SphinxBackend turns the decoder's posterior into a probability the chain can compare"""
+
+    def recognize(self, prob):
+        hypothesis = mock.Mock(hypstr='turn on the light', prob=prob)
+        backend = SphinxBackend(language='en-US')
+        backend.decoder = mock.Mock(**{'hyp.return_value': hypothesis})
+        backend.decoder.get_logmath.return_value.exp.side_effect = lambda value: 1.0001 ** value
+        return backend.recognize(make_audio_data()).confidence
+
+    def test_probability_is_kept(self):
+        self.assertEqual(self.recognize(0.42), 0.42)
+
+    def test_log_probability_is_converted(self):
+        # What pocketsphinx before 5 reports: the log posterior in base 1.0001
+        self.assertAlmostEqual(self.recognize(-6932), 0.5, places=3)
+        self.assertLess(self.recognize(-200000), 0.01)
+
+
+def make_pcm(seconds, tone_hz=None, sample_rate=16000, amplitude=0.3):
+    """Mono 16-bit PCM: a sine tone, or silence without ``tone_hz``"""
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    samples = amplitude * np.sin(2 * np.pi * tone_hz * t) if tone_hz else np.zeros_like(t)
+    return (samples * 32767).astype('<i2').tobytes()
+
+
+def make_wav(pcm, sample_rate=16000, channels=1):
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as w:
+        w.setnchannels(channels)
+        w.setsampwidth(2)
+        w.setframerate(sample_rate)
+        w.writeframes(pcm)
+    return buffer.getvalue()
+
+
+def riff_chunk(chunk_id, payload):
+    """A RIFF chunk, padded to an even length"""
+    return chunk_id + struct.pack('<I', len(payload)) + payload + b'\0' * (len(payload) & 1)
+
+
+def build_wav(data, format_tag=WAVE_FORMAT_PCM, channels=1, sample_rate=16000, bits=16, chunks=b'', data_size=None):
+    """
+    A WAV file put together by hand, for sample formats and layouts the wave
+    module won't write: ``chunks`` go between fmt and data, and ``data_size``
+    overrides the size the data chunk declares
+    """
+    block_align = channels * ((bits + 7) // 8)
+    fmt = struct.pack('<HHIIHH', format_tag, channels, sample_rate, sample_rate * block_align, block_align, bits)
+    declared = len(data) if data_size is None else data_size
+    body = b'WAVE' + riff_chunk(b'fmt ', fmt) + chunks + b'data' + struct.pack('<I', declared) + data
+    return b'RIFF' + struct.pack('<I', len(body)) + body
+
+
+def write_media(name, data):
+    path = media_storage.create_path(name)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return path
+
+
+def dbfs(samples):
+    return 20 * np.log10(np.sqrt(np.mean(np.square(samples, dtype=float))))
+
+
+@override_settings(AUDIO_PREPROCESS=True, PREPROCESS_SAMPLE_RATE=16000, PREPROCESS_SILENCE_THRESHOLD=0.01,
+                   PREPROCESS_PAD_MS=150, PREPROCESS_TARGET_DBFS=-20.0, PREPROCESS_MAX_GAIN_DB=20.0)
+class PreprocessingTests(SimpleTestCase):
+    TONE = make_pcm(0.5, tone_hz=440)
+
+    def samples(self, pcm):
+        return np.frombuffer(pcm, dtype='<i2').astype(int)
+
+    def test_downmix(self):
+        mono, _ = preprocess(self.TONE, 16000, 2, 1)
+        # The tone on the left channel only: the mix is the tone at half the level
+        left = np.frombuffer(self.TONE, dtype='<i2')
+        stereo = np.column_stack([left, np.zeros_like(left)]).astype('<i2').tobytes()
+        pcm, stats = preprocess(stereo, 16000, 2, 2)
+        self.assertAlmostEqual(stats.rms_dbfs, dbfs(left / 32768) - 6.02, places=1)
+        self.assertLessEqual(np.abs(self.samples(pcm) - self.samples(mono)).max(), 1)
+
+        cancelling = np.column_stack([left, -left]).astype('<i2').tobytes()
+        with self.assertRaises(SilentAudioError):
+            preprocess(cancelling, 16000, 2, 2)
+
+    def test_resampled_to_16khz(self):
+        for rate in (8000, 22050, 48000):
+            pcm, stats = preprocess(make_pcm(1.0, tone_hz=440, sample_rate=rate), rate, 2, 1)
+            samples = self.samples(pcm)
+            self.assertEqual((len(samples), stats.duration_ms), (16000, 1000))
+            # One second at 16 kHz: FFT bin n is n Hz
+            self.assertEqual(np.argmax(np.abs(np.fft.rfft(samples))), 440)
+
+    def test_silence_is_trimmed_to_the_padding(self):
+        # 25 silent 20 ms frames either side of 25 voiced ones
+        pcm, stats = preprocess(make_pcm(0.5) + self.TONE + make_pcm(0.5), 16000, 2, 1)
+        self.assertEqual((stats.duration_ms, stats.trimmed_ms), (1500, 700))
+        samples = self.samples(pcm)
+        self.assertEqual(len(samples), 16 * (500 + 2 * 150))
+        self.assertFalse(samples[:16 * 150].any())
+        self.assertTrue(samples[16 * 150:16 * 650].any())
+
+    def test_normalized_to_the_target_level(self):
+        for amplitude in (0.05, 0.9):
+            pcm, stats = preprocess(make_pcm(0.5, tone_hz=440, amplitude=amplitude), 16000, 2, 1)
+            self.assertAlmostEqual(stats.rms_dbfs, 20 * np.log10(amplitude / np.sqrt(2)), places=1)
+            self.assertAlmostEqual(dbfs(self.samples(pcm) / 32768), -20.0, places=1)
+
+        quiet = np.sin(np.linspace(0, 100, 1000)).astype(np.float32) * 0.001
+        self.assertAlmostEqual(dbfs(normalize(quiet, -20.0, 20.0)), dbfs(quiet) + 20, places=3)
+        # A click in a quiet clip limits the gain before it clips
+        clicked = quiet.copy()
+        clicked[500] = 0.5
+        self.assertAlmostEqual(float(np.abs(normalize(clicked, -20.0, 20.0)).max()), 0.99, places=5)
+
+    def test_sample_formats(self):
+        tone = 0.3 * np.sin(2 * np.pi * 440 * np.arange(8000) / 16000)
+        scaled = {bits: np.round(tone * (2 ** (bits - 1) - 1)).astype(np.int64) for bits in (8, 24, 32)}
+        wavs = {
+            '8-bit': build_wav((scaled[8] + 128).astype(np.uint8).tobytes(), bits=8),
+            '16-bit': make_wav(np.round(tone * 32767).astype('<i2').tobytes()),
+            '24-bit': build_wav(scaled[24].astype('<i4').view(np.uint8).reshape(-1, 4)[:, :3].tobytes(), bits=24),
+            '32-bit': build_wav(scaled[32].astype('<i4').tobytes(), bits=32),
+            'float': build_wav(tone.astype('<f4').tobytes(), WAVE_FORMAT_IEEE_FLOAT, bits=32),
+            'double': build_wav(tone.astype('<f8').tobytes(), WAVE_FORMAT_IEEE_FLOAT, bits=64),
+        }
+        processor = AudioProcessor(recognizer=mock.Mock())
+        reference, _ = processor.load_audio_data(wavs.pop('double'))
+        for name, wav in wavs.items():
+            with self.subTest(name):
+                audio_data, stats = processor.load_audio_data(wav)
+                self.assertEqual((audio_data.sample_rate, audio_data.sample_width), (16000, 2))
+                self.assertEqual((stats.duration_ms, stats.trimmed_ms), (500, 0))
+                difference = self.samples(audio_data.frame_data) - self.samples(reference.frame_data)
+                # 8-bit keeps 1/128 of full scale; the others round to the same 16-bit samples
+                self.assertLessEqual(np.abs(difference).max(), 100 if name == '8-bit' else 1)
+
+    def test_silent_clip_is_rejected(self):
+        with self.assertRaises(SilentAudioError) as caught:
+            preprocess(make_pcm(0.5, tone_hz=440, amplitude=0.005), 16000, 2, 1)
+        self.assertEqual(str(caught.exception), "No speech detected")
+        self.assertEqual(caught.exception.stats[:2], (500, 500))
+
+        recognizer = mock.Mock()
+        result = AudioProcessor(recognizer=recognizer).convert_wav_bytes_to_text(make_wav(make_pcm(0.5)))
+        self.assertEqual((result['success'], result['error']), (False, SILENT_ERROR))
+        self.assertEqual(result['stats'], {'duration_ms': 500, 'trimmed_ms': 500, 'rms_dbfs': -120.0})
+        recognizer.recognize.assert_not_called()
+
+
+class TemporaryMediaRoot:
+    """Test case mixin that points MEDIA_ROOT at a fresh directory and keeps the sweeper off"""
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, True)
+        override = override_settings(MEDIA_ROOT=media_root, MEDIA_SWEEP_INTERVAL=0)
+        override.enable()
+        self.addCleanup(override.disable)
+
+
+@override_settings(AUDIO_PREPROCESS=False)
+class WavLoadingTests(TemporaryMediaRoot, SimpleTestCase):
+    PCM = make_pcm(0.5, tone_hz=440)
+    # Metadata chunks with odd sizes, each followed by its pad byte
+    CHUNKS = riff_chunk(b'LIST', b'INFOISFT\x03\x00\x00\x00ab\x00') + riff_chunk(b'junk', b'odd')
+
+    def setUp(self):
+        super().setUp()
+        self.recognizer = mock.Mock()
+        self.recognizer.recognize.return_value = RecognitionResult("lights on", 0.9, 'stub')
+        self.processor = AudioProcessor(recognizer=self.recognizer)
+        # Every test reuses the same tone; the recognizer has to see each of them
+        patcher = mock.patch('api.audio_processor.transcription_cache', mock.Mock(**{'get.return_value': None}))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def recognized(self):
+        """The sr.AudioData the recognizer was called with"""
+        audio_data, = self.recognizer.recognize.call_args.args
+        return audio_data
+
+    def test_chunks_before_data(self):
+        wav = build_wav(self.PCM, chunks=self.CHUNKS)
+        info = parse_wav_header(wav)
+        self.assertEqual((info.data_offset, info.data_size), (len(wav) - len(self.PCM), len(self.PCM)))
+
+        result = self.processor.convert_wav_bytes_to_text(wav)
+        self.assertEqual((result['success'], result['text']), (True, "lights on"))
+        audio_data = self.recognized()
+        self.assertEqual((audio_data.sample_rate, audio_data.sample_width), (16000, 2))
+        self.assertEqual(bytes(audio_data.frame_data), self.PCM)
+
+    def test_truncated_data_size(self):
+        # Cut off mid-sample, with the size the full recording would have had or a streaming placeholder
+        cut = self.PCM[:len(self.PCM) // 2 + 1]
+        for declared in (len(self.PCM), 0, 0xFFFFFFFF):
+            with self.subTest(declared=declared):
+                wav = build_wav(cut, chunks=self.CHUNKS, data_size=declared)
+                result = self.processor.convert_wav_bytes_to_text(wav)
+                self.assertTrue(result['success'])
+                self.assertEqual(bytes(self.recognized().frame_data), cut[:-1])
+
+    def test_mapped_file(self):
+        name = media_storage.shard(f'{UPLOADS}/chunks.wav')
+        path = write_media(name, build_wav(self.PCM, chunks=self.CHUNKS))
+        for location in (path, f'http://127.0.0.1:8000{settings.MEDIA_URL}{name}'):
+            with self.subTest(location=location):
+                self.assertEqual(self.processor.convert_wav_to_text(location)['text'], "lights on")
+                self.assertEqual(bytes(self.recognized().frame_data), self.PCM)
+
+        self.assertEqual(self.processor.convert_wav_to_text(path + '.missing')['error'], "File not found")
+        empty = write_media(f'{UPLOADS}/empty.wav', b'')
+        self.assertEqual(self.processor.convert_wav_to_text(empty)['error'], "Audio loading failed: empty file")
+
+    def test_not_a_wav(self):
+        result = self.processor.convert_wav_bytes_to_text(b'ID3\x04' + b'\0' * 64)
+        self.assertEqual((result['success'], result['error']), (False, "Audio loading failed: Not a RIFF/WAVE file"))
+        result = self.processor.convert_wav_bytes_to_text(build_wav(self.PCM)[:36] + riff_chunk(b'LIST', b'x'))
+        self.assertEqual(result['error'], "Audio loading failed: No data chunk found")
+        self.recognizer.recognize.assert_not_called()
+
+    @override_settings(AUDIO_PREPROCESS=True)
+    def test_alaw_goes_through_pydub(self):
+        from pydub import AudioSegment
+        decoded = AudioSegment(data=self.PCM, sample_width=2, frame_rate=8000, channels=1)
+        alaw = build_wav(audioop.lin2alaw(self.PCM, 2), format_tag=0x0006, sample_rate=8000, bits=8)
+        with mock.patch.object(AudioSegment, 'from_file', return_value=decoded) as from_file:
+            result = self.processor.convert_wav_bytes_to_text(alaw, source='alaw.wav')
+        self.assertTrue(result['success'])
+        self.assertEqual(from_file.call_args.args[0].getvalue(), alaw)
+        # Then preprocessed like any other upload: one second at 8 kHz becomes one at 16 kHz
+        self.assertEqual(result['stats']['duration_ms'], 1000)
+        self.assertEqual(len(self.recognized().frame_data), 32000)
+
+    @skipUnless(shutil.which('ffmpeg'), "pydub needs ffmpeg to decode A-law")
+    def test_alaw_decoded_by_ffmpeg(self):
+        alaw = build_wav(audioop.lin2alaw(self.PCM, 2), format_tag=0x0006, bits=8)
+        self.assertTrue(self.processor.convert_wav_bytes_to_text(alaw)['success'])
+        samples = np.frombuffer(self.recognized().frame_data, dtype='<i2').astype(int)
+        self.assertLess(np.abs(samples - np.frombuffer(self.PCM, dtype='<i2')).max(), 400)
+
+    def test_stereo_is_mixed_by_pydub_without_preprocessing(self):
+        left = np.frombuffer(self.PCM, dtype='<i2')
+        stereo = np.column_stack([left, left // 2]).astype('<i2').tobytes()
+        self.assertTrue(self.processor.convert_wav_bytes_to_text(build_wav(stereo, channels=2))['success'])
+        samples = np.frombuffer(self.recognized().frame_data, dtype='<i2').astype(int)
+        self.assertEqual(len(samples), len(left))
+        self.assertLessEqual(np.abs(samples - (left * 3 // 4)).max(), 1)
+
+
+class TranscriptionQueueTests(TestCase):
+
+    def make_job(self, age, status=AudioFile.STATUS_QUEUED, claimed_age=None):
+        job = AudioFile.objects.create(audio_file='audio_files/job.wav', status=status)
+        now = timezone.now()
+        AudioFile.objects.filter(pk=job.pk).update(
+            created_at=now - timedelta(seconds=age),
+            claimed_at=None if claimed_age is None else now - timedelta(seconds=claimed_age),
+        )
+        return job
+
+    def test_claims_oldest_queued_job(self):
+        newer = self.make_job(10)
+        oldest = self.make_job(30)
+        self.make_job(60, status=AudioFile.STATUS_DONE)
+        queue = TranscriptionQueue(workers=1)
+
+        job = queue.claim_next()
+        self.assertEqual(job.pk, oldest.pk)
+        self.assertEqual(job.status, AudioFile.STATUS_RUNNING)
+        self.assertIsNotNone(job.claimed_at)
+        self.assertEqual(queue.claim_next().pk, newer.pk)
+        self.assertIsNone(queue.claim_next())
+
+    @override_settings(TRANSCRIPTION_JOB_TIMEOUT=300)
+    def test_recover_requeues_only_abandoned_jobs(self):
+        abandoned = self.make_job(900, status=AudioFile.STATUS_RUNNING, claimed_age=600)
+        working = self.make_job(900, status=AudioFile.STATUS_RUNNING, claimed_age=60)
+
+        self.assertEqual(TranscriptionQueue(workers=1).recover(), 1)
+        abandoned.refresh_from_db()
+        working.refresh_from_db()
+        self.assertEqual(abandoned.status, AudioFile.STATUS_QUEUED)
+        self.assertIsNone(abandoned.claimed_at)
+        self.assertEqual(working.status, AudioFile.STATUS_RUNNING)
+
+    @override_settings(API_WARMUP=False)
+    def test_autostart_only_when_enabled(self):
+        config = apps.get_app_config('api')
+        with mock.patch('api.apps.threading') as app_threading:
+            with override_settings(TRANSCRIPTION_AUTOSTART=False):
+                config.ready()
+            app_threading.Thread.assert_not_called()
+            with override_settings(TRANSCRIPTION_AUTOSTART=True):
+                config.ready()
+        app_threading.Thread.assert_called_once_with(target=start_queue, name="transcription-autostart", daemon=True)
+
+
+class TranscribeBacklogTests(TemporaryMediaRoot, TestCase):
+    SHED = {"success": False, "error": "shed", "text": None, "retry_after": 1.0}
+
+    def setUp(self):
+        super().setUp()
+        self.checkpoint = os.path.join(settings.MEDIA_ROOT, 'backlog.checkpoint')
+        now = timezone.now()
+
+        def row(n, name, **fields):
+            # Primary keys in the order the command walks them; larger n is older
+            audio_file = AudioFile.objects.create(id=uuid.UUID(int=n), audio_file=f'audio_files/{name}.wav', **fields)
+            AudioFile.objects.filter(pk=audio_file.pk).update(created_at=now - timedelta(seconds=n))
+            return audio_file
+
+        self.failed = row(1, 'failed', is_processed=True, status=AudioFile.STATUS_DONE, error_message='no speech')
+        self.first = row(2, 'first')
+        self.second = row(3, 'second')
+        row(4, 'done', is_processed=True, is_successful=True, status=AudioFile.STATUS_DONE, transcription='old')
+        row(5, 'running', status=AudioFile.STATUS_RUNNING, claimed_at=now)
+        executor = mock.patch.object(transcribe_backlog, 'ProcessPoolExecutor', return_value=ImmediateExecutor())
+        executor.start()
+        self.addCleanup(executor.stop)
+
+    def run_backlog(self, *args, results=None):
+        """Run the command with a fake recognizer; returns the files it transcribed and its output"""
+        results = results or {}
+
+        def transcribe(file_path):
+            name = os.path.splitext(os.path.basename(file_path))[0]
+            return results.get(name, {"success": True, "error": None, "text": f"{name} text"})
+
+        out = io.StringIO()
+        with mock.patch.object(transcribe_backlog, 'transcribe_file', side_effect=transcribe) as transcribe_file:
+            call_command('transcribe_backlog', '--checkpoint', self.checkpoint, *args, stdout=out)
+        names = [os.path.basename(call.args[0]) for call in transcribe_file.call_args_list]
+        return names, out.getvalue()
+
+    def read_checkpoint(self):
+        with open(self.checkpoint) as f:
+            return f.read()
+
+    def test_only(self):
+        self.assertEqual(self.run_backlog('--only', 'failed')[0], ['failed.wav'])
+        self.failed.refresh_from_db()
+        self.first.refresh_from_db()
+        self.assertEqual((self.failed.is_successful, self.failed.transcription), (True, 'failed text'))
+        self.assertEqual((self.first.is_processed, self.first.status), (False, AudioFile.STATUS_QUEUED))
+
+        self.assertEqual(self.run_backlog('--only', 'unprocessed')[0], ['first.wav', 'second.wav'])
+        failed = AudioFile.objects.filter(is_successful=False).exclude(status=AudioFile.STATUS_RUNNING)
+        self.assertFalse(failed.exists())
+
+    def test_limit_and_resume(self):
+        self.assertEqual(self.run_backlog('--limit', '2', '--batch-size', '1')[0], ['failed.wav', 'first.wav'])
+        self.assertEqual(self.read_checkpoint(), str(self.first.pk))
+        self.assertEqual(self.run_backlog('--resume')[0], ['second.wav'])
+        self.assertEqual(self.read_checkpoint(), str(self.second.pk))
+
+    @mock.patch.object(transcribe_backlog, 'inspect_file', return_value={"success": True, "error": None, "stats": None})
+    def test_dry_run_writes_nothing(self, inspect_file):
+        names, output = self.run_backlog('--dry-run')
+        self.assertEqual(names, [])
+        self.assertEqual(inspect_file.call_count, 3)
+        self.assertIn("3 rows in the backlog, ", output)
+        self.assertIn("3 decodable", output)
+        self.failed.refresh_from_db()
+        self.first.refresh_from_db()
+        self.assertEqual((self.failed.is_successful, self.failed.error_message), (False, 'no speech'))
+        self.assertEqual((self.first.status, self.first.claimed_at), (AudioFile.STATUS_QUEUED, None))
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_shed_rows_are_left_for_a_later_run(self):
+        names, output = self.run_backlog(results={'failed': self.SHED, 'second': self.SHED})
+        self.assertEqual(names, ['failed.wav', 'first.wav', 'second.wav'])
+        self.assertIn("2 rows shed under load", output)
+        self.failed.refresh_from_db()
+        self.first.refresh_from_db()
+        self.second.refresh_from_db()
+        # Unchanged, rather than recorded as a failed transcription
+        self.assertEqual((self.failed.status, self.failed.error_message, self.failed.claimed_at),
+                         (AudioFile.STATUS_DONE, 'no speech', None))
+        self.assertEqual((self.second.is_processed, self.second.status, self.second.claimed_at),
+                         (False, AudioFile.STATUS_QUEUED, None))
+        self.assertEqual(self.first.transcription, 'first text')
+        # A resumed run starts over before the first shed row
+        self.assertFalse(os.path.exists(self.checkpoint))
+        self.assertEqual(self.run_backlog('--resume')[0], ['failed.wav', 'second.wav'])
+
+    def test_rows_claimed_by_a_worker_are_skipped(self):
+        with racing_worker(transcribe_backlog.Command, 'claim') as claimed:
+            names, output = self.run_backlog('--only', 'unprocessed')
+        # The worker took the oldest queued row before the command reached it
+        self.assertEqual([job and job.pk for job in claimed], [self.second.pk, None])
+        self.assertEqual(names, ['first.wav'])
+        self.assertIn("1 taken by queue workers", output)
+        self.second.refresh_from_db()
+        self.assertEqual((self.second.status, self.second.transcription), (AudioFile.STATUS_RUNNING, None))
+
+
+class TranscriptionCacheTests(TestCase):
+
+    def test_database_then_memory(self):
+        cache = TranscriptionCache(maxsize=10)
+        self.assertIsNone(cache.get('digest'))
+        AudioFile.objects.create(audio_file='audio_files/a.wav', pcm_digest='digest', is_successful=False,
+                                 transcription='wrong')
+        self.assertIsNone(cache.get('digest'))
+        AudioFile.objects.create(audio_file='audio_files/b.wav', pcm_digest='digest', is_successful=True,
+                                 transcription='turn on the lights')
+
+        self.assertEqual(cache.get('digest'), 'turn on the lights')
+        with self.assertNumQueries(0):
+            self.assertEqual(cache.get('digest'), 'turn on the lights')
+        self.assertEqual(cache.stats(), {'memory_hits': 1, 'db_hits': 1, 'misses': 2, 'size': 1})
+
+
+class LRUCacheTests(SimpleTestCase):
+
+    def test_expiry(self):
+        cache = LRUCache(maxsize=10, ttl=60)
+        cache.set('kept', 1)
+        cache.set('expired', 2, ttl=0)
+        self.assertEqual(cache.get('kept'), 1)
+        self.assertIsNone(cache.get('expired'))
+        with mock.patch('api.cache.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertIsNone(cache.get('kept'))
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+
+
+class LLMResponseCacheTests(TestCase):
+    CONFIG = {'temperature': 0.2}
+
+    def make_cache(self, template='Answer briefly: {text}'):
+        return LLMResponseCache('gemini-test', self.CONFIG, template, maxsize=10, ttl=60)
+
+    def test_shared_through_database_by_normalized_text(self):
+        self.make_cache().set('Turn on the AC!', 'Okay.')
+        other_worker = self.make_cache()
+        self.assertEqual(other_worker.get('turn on the  ac'), 'Okay.')
+        self.assertEqual(other_worker.db_hits, 1)
+        self.assertIsNone(other_worker.get('turn off the ac'))
+
+    def test_set_replaces_existing_answer(self):
+        cache = self.make_cache()
+        cache.set('what time is it', 'Noon.')
+        cache.set('What time is it?', 'One o\'clock.')
+        self.assertEqual(LLMResponse.objects.get().response_text, 'One o\'clock.')
+
+    def test_expired_and_other_template_are_misses(self):
+        self.make_cache().set('turn on the ac', 'Okay.')
+        self.assertIsNone(self.make_cache('New template: {text}').get('turn on the ac'))
+        LLMResponse.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertIsNone(self.make_cache().get('turn on the ac'))
+
+    def test_purge_stale(self):
+        old = self.make_cache('Old template: {text}')
+        old.set('turn on the ac', 'Okay.')
+        current = self.make_cache()
+        current.set('turn off the ac', 'Done.')
+        self.assertEqual(current.purge_stale(), 1)
+        self.assertEqual(current.get('turn off the ac'), 'Done.')
+        self.assertEqual(current.purge_stale(everything=True), 1)
+        self.assertFalse(LLMResponse.objects.exists())
+
+
+class SingleFlightTests(SimpleTestCase):
+
+    def run_concurrently(self, flight, fn, callers=4):
+        """Call flight.do from ``callers`` threads while the first call is in flight"""
+        results = [None] * callers
+
+        def call(index):
+            try:
+                results[index] = flight.do('key', fn)
+            except Exception as e:
+                results[index] = e
+
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(callers)]
+        threads[0].start()
+        self.started.wait(1)
+        for thread in threads[1:]:
+            thread.start()
+        # Let the others reach the in-flight call before it finishes
+        time.sleep(0.1)
+        self.release.set()
+        for thread in threads:
+            thread.join(1)
+        return results
+
+    def setUp(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.calls = 0
+
+    def test_concurrent_calls_share_one_result(self):
+        def fn():
+            self.calls += 1
+            self.started.set()
+            self.release.wait(1)
+            return object()
+
+        results = self.run_concurrently(SingleFlight(), fn)
+        self.assertEqual(self.calls, 1)
+        self.assertTrue(all(result is results[0] for result in results))
+
+    def test_error_reaches_every_caller(self):
+        error = ValueError('transcode failed')
+
+        def fn():
+            self.calls += 1
+            self.started.set()
+            self.release.wait(1)
+            raise error
+
+        results = self.run_concurrently(SingleFlight(), fn)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(results, [error] * 4)
+
+    def test_later_call_runs_again(self):
+        flight = SingleFlight()
+        self.assertEqual(flight.do('key', lambda: 1), 1)
+        self.assertEqual(flight.do('key', lambda: 2), 2)
+
+    def test_async_callers_share_one_task(self):
+        flight = AsyncSingleFlight()
+
+        async def fn():
+            self.calls += 1
+            await asyncio.sleep(0.01)
+            return 'audio'
+
+        async def run():
+            first = asyncio.ensure_future(flight.do('key', fn))
+            others = [asyncio.ensure_future(flight.do('key', fn)) for _ in range(3)]
+            await asyncio.sleep(0)
+            # A cancelled caller leaves the call to the others
+            first.cancel()
+            return await asyncio.gather(*others)
+
+        self.assertEqual(asyncio.run(run()), ['audio'] * 3)
+        self.assertEqual(self.calls, 1)
+
+
+@override_settings(
+    UPSTREAM_BREAKER_FAILURES=2, UPSTREAM_BREAKER_RESET=30.0, UPSTREAM_HEDGE_PERCENTILE=None,
+    UPSTREAM_TIMEOUTS={'stt': 5.0}, ADMISSION_CONCURRENCY={'stt': 4},
+)
+class UpstreamTests(SimpleTestCase):
+
+    def setUp(self):
+        self.upstream = upstream.Upstream('stt')
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def failing(self, timeout):
+        raise ConnectionError('connection reset')
+
+    def test_breaker_opens_after_consecutive_failures(self):
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                self.upstream.call(self.failing)
+        fn = mock.Mock()
+        with self.assertRaises(upstream.CircuitOpenError):
+            self.upstream.call(fn)
+        fn.assert_not_called()
+        self.assertEqual(self.upstream.stats()['short_circuits'], 1)
+
+        # After UPSTREAM_BREAKER_RESET one trial call goes through and closes it again
+        self.upstream.breaker.opened_at -= 30
+        self.assertEqual(self.upstream.call(lambda timeout: 'ok'), 'ok')
+        self.assertEqual(self.upstream.breaker.state, upstream.CircuitBreaker.CLOSED)
+
+    def test_ignored_errors_are_answers(self):
+        def unknown(timeout):
+            raise sr.UnknownValueError()
+
+        for _ in range(3):
+            with self.assertRaises(sr.UnknownValueError):
+                self.upstream.call(unknown, ignore=sr.UnknownValueError)
+        self.assertEqual(self.upstream.breaker.state, upstream.CircuitBreaker.CLOSED)
+
+    def test_attempt_is_cut_at_the_deadline(self):
+        def hang(timeout):
+            # Well past the timeout it was given, like a hung connection
+            self.release.wait(5)
+
+        start = time.monotonic()
+        with upstream.deadline(0.2), self.assertRaises(upstream.DeadlineExceeded):
+            self.upstream.call(hang)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(self.upstream.stats()['timeouts'], 1)
+
+    def test_spent_deadline_fails_without_calling(self):
+        fn = mock.Mock()
+        with upstream.deadline(0), self.assertRaises(upstream.DeadlineExceeded):
+            self.upstream.call(fn)
+        fn.assert_not_called()
+
+    def test_nested_deadline_cannot_extend(self):
+        with upstream.deadline(1):
+            with upstream.deadline(60):
+                self.assertLessEqual(upstream.remaining(), 1)
+        self.assertIsNone(upstream.remaining())
+
+    @override_settings(UPSTREAM_HEDGE_PERCENTILE=50, UPSTREAM_HEDGE_MIN_SAMPLES=1, UPSTREAM_HEDGE_MAX_RATIO=1.0)
+    def test_slow_attempt_is_hedged(self):
+        for _ in range(5):
+            self.upstream.latency.add(0.05)
+        attempts = []
+
+        def answer(timeout):
+            attempts.append(timeout)
+            if len(attempts) == 1:
+                self.release.wait(timeout)
+                return 'slow'
+            return 'hedge'
+
+        self.assertEqual(self.upstream.call(answer), 'hedge')
+        stats = self.upstream.stats()
+        self.assertEqual((stats['hedges'], stats['hedge_wins']), (1, 1))
+        self.assertEqual(self.upstream.call(lambda timeout: 'fast', hedge=False), 'fast')
+
+
+@override_settings(ADMISSION_CONCURRENCY={'stt': 1})
+class LimiterTests(SimpleTestCase):
+
+    def test_waiter_gets_released_slot(self):
+        limiter = upstream.Limiter('stt')
+        self.assertEqual(limiter.acquire(1), 0.0)
+        waited = []
+        waiter = threading.Thread(target=lambda: waited.append(limiter.acquire(2)))
+        waiter.start()
+        while not sum(limiter.queued().values()):
+            time.sleep(0.01)
+        limiter.release(0.5)
+        waiter.join(1)
+        self.assertEqual(len(waited), 1)
+        self.assertEqual(limiter.active, 1)
+        self.assertEqual(limiter.hold, 0.5)
+
+    def test_overloaded_when_wait_exceeds_budget(self):
+        limiter = upstream.Limiter('stt')
+        limiter.acquire(1)
+        limiter.hold = 5.0
+        with self.assertRaises(upstream.Overloaded) as raised:
+            limiter.acquire(1)
+        self.assertEqual(raised.exception.retry_after, 5.0)
+        self.assertEqual(limiter.queued(), {upstream.INTERACTIVE: 0, upstream.BATCH: 0})
+
+
+def busy_limiter(wait, hold=1.0):
+    return mock.Mock(limiter=mock.Mock(**{'estimated_wait.return_value': wait, 'hold': hold}))
+
+
+@override_settings(ADMISSION_DEVICE_RATE=1.0, ADMISSION_DEVICE_BURST=2, UPSTREAM_DEADLINE=20.0)
+class AdmissionTests(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(admission, 'device_buckets', admission.TokenBuckets())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_device_rate_limit(self):
+        admission.admit('esp32-1')
+        admission.admit('esp32-1')
+        with self.assertRaises(admission.RateLimited) as raised:
+            admission.admit('esp32-1')
+        self.assertGreater(raised.exception.retry_after, 0)
+        # Other devices and requests without an id have their own budget
+        admission.admit('esp32-2')
+        for _ in range(5):
+            admission.admit(None)
+
+    @override_settings(ADMISSION_DEVICE_RATE=0)
+    def test_no_rate_limit_by_default(self):
+        for _ in range(5):
+            admission.admit('esp32-1')
+
+    def test_overloaded_when_queues_exceed_deadline(self):
+        with mock.patch.dict(upstream.UPSTREAMS, {'llm': busy_limiter(15.0), 'tts': busy_limiter(6.0)}):
+            admission.admit('esp32-1', ('llm',))
+            with self.assertRaises(upstream.Overloaded) as raised:
+                admission.admit('esp32-1', ('llm', 'tts'))
+        self.assertEqual(raised.exception.retry_after, 21.0)
+
+    def test_rejection_responses(self):
+        body, code, headers = admission.rejection(admission.RateLimited('slow down', 0.2))
+        self.assertEqual((code, headers, body['retry_after']), (429, {'Retry-After': '1'}, 1))
+        _, code, headers = admission.rejection(upstream.Overloaded('busy', 7.5))
+        self.assertEqual((code, headers), (503, {'Retry-After': '8'}))
+
+    def test_views_reject_with_retry_after(self):
+        admission.device_buckets.take('esp32-1', 1.0, 1)
+        response = self.client.post('/api/audio/multipart/', {}, HTTP_X_DEVICE_ID='esp32-1')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertFalse(AudioFile.objects.exists())
+
+        with mock.patch.dict(upstream.UPSTREAMS, {'stt': busy_limiter(30.0)}):
+            response = self.client.post('/api/audio/?stream=1', make_wav(make_pcm(0.1)), content_type='audio/wav')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()['retry_after'], 30)
+
+
+class HistoryListTests(TestCase):
+
+    def setUp(self):
+        now = timezone.now()
+        self.uploads = []
+        for i in range(5):
+            upload = AudioFile.objects.create(
+                audio_file=f'audio_files/{i}.wav', device_id='esp32-1' if i % 2 else 'esp32-2',
+                is_successful=i < 3, status=AudioFile.STATUS_DONE,
+            )
+            AudioFile.objects.filter(pk=upload.pk).update(created_at=now - timedelta(days=5 - i))
+            self.uploads.append(upload)
+            AIHandler.objects.create(text_content=f'request {i}', audio_source=upload, processed=i == 4)
+
+    def ids(self, url):
+        """Ids of every row listed at ``url``, following the next links"""
+        ids = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            ids += [row['id'] for row in response.json()['results']]
+            url = response.json()['next']
+        return ids
+
+    def expected(self, indexes):
+        return [str(self.uploads[i].pk) for i in indexes]
+
+    def test_pages_newest_first(self):
+        self.assertEqual(self.ids('/api/audio/multipart/?page_size=2'), self.expected([4, 3, 2, 1, 0]))
+
+    def test_filters(self):
+        self.assertEqual(self.ids('/api/audio/multipart/?device=esp32-1&page_size=1'), self.expected([3, 1]))
+        self.assertEqual(self.ids('/api/audio/multipart/?is_successful=false'), self.expected([4, 3]))
+        now = timezone.now()
+        window = urlencode({'created_after': (now - timedelta(days=3, hours=12)).isoformat(),
+                            'created_before': (now - timedelta(days=2, hours=12)).isoformat()})
+        self.assertEqual(self.ids(f'/api/audio/multipart/?{window}'), self.expected([2]))
+        # A date is midnight in the server time zone
+        tomorrow = (timezone.localdate() + timedelta(days=1)).isoformat()
+        self.assertEqual(len(self.ids(f'/api/audio/multipart/?created_before={tomorrow}')), 5)
+
+    def test_response_history_filters(self):
+        responses = self.ids('/api/audio/ai-process/?device=esp32-2&page_size=1')
+        self.assertEqual(len(responses), 3)
+        self.assertEqual(len(self.ids('/api/audio/ai-process/?is_successful=true')), 1)
+
+    def test_invalid_filters_are_rejected(self):
+        self.assertEqual(self.client.get('/api/audio/multipart/?created_after=yesterday').status_code, 400)
+        self.assertEqual(self.client.get('/api/audio/ai-process/?is_successful=maybe').status_code, 400)
+
+
+@override_settings(MEDIA_OFFLOAD='')
+class ServeMediaTests(TemporaryMediaRoot, SimpleTestCase):
+    NAME = 'generated_audio/3f/clip.mp3'
+    DATA = bytes(range(256)) * 4
+
+    def setUp(self):
+        super().setUp()
+        write_media(self.NAME, self.DATA)
+        self.url = settings.MEDIA_URL + self.NAME
+
+    def get(self, **headers):
+        return self.client.get(self.url, **{f"HTTP_{name.upper().replace('-', '_')}": value
+                                            for name, value in headers.items()})
+
+    def test_whole_file(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.DATA)
+        self.assertEqual(response['Content-Type'], 'audio/mpeg')
+        self.assertEqual(response['Content-Length'], str(len(self.DATA)))
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+    def test_etag_revalidation(self):
+        etag = self.get()['ETag']
+        response = self.get(if_none_match=f'W/{etag}')
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(self.get(if_none_match='"other"').status_code, 200)
+
+    def test_byte_ranges(self):
+        response = self.get(range='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), self.DATA[10:20])
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{len(self.DATA)}')
+        self.assertEqual(response['Content-Length'], '10')
+
+        response = self.get(range='bytes=-5')
+        self.assertEqual(b''.join(response.streaming_content), self.DATA[-5:])
+        response = self.get(range='bytes=1000-')
+        self.assertEqual(response['Content-Range'], f'bytes 1000-1023/{len(self.DATA)}')
+
+    def test_ignored_ranges(self):
+        for header in ('bytes=0-1,5-6', 'items=0-1', 'bytes=9-2'):
+            self.assertEqual(self.get(range=header).status_code, 200, header)
+        # A Range for another version of the file gets all of this one
+        self.assertEqual(self.get(range='bytes=0-9', if_range='"stale"').status_code, 200)
+
+    def test_unsatisfiable_range(self):
+        response = self.get(range='bytes=2048-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(self.DATA)}')
+
+    def test_only_media_directories_are_served(self):
+        write_media('generated_audio/3f/clip.mp3.part', b'partial')
+        for path in ('generated_audio/3f/clip.mp3.part', 'generated_audio/3f/missing.mp3', '../settings.py',
+                     'other/clip.mp3'):
+            self.assertEqual(self.client.get(settings.MEDIA_URL + path).status_code, 404, path)
+
+
+class IntentMatcherTests(SimpleTestCase):
+    matcher = IntentMatcher(settings.LOCAL_INTENTS, settings.LOCAL_INTENT_WAKE_WORDS)
+
+    def test_matches_after_wake_word_and_normalization(self):
+        for text, name in (('OK Google, turn on the AC.', 'ac_on'), ('Hey Google lights off', 'lights_off'),
+                           ('please turn off the air conditioning', 'ac_off'), ('Light on!', 'lights_on')):
+            self.assertEqual(self.matcher.match(text).name, name, text)
+        self.assertEqual(self.matcher.match('turn on the lights').action, {'device': 'lights', 'command': 'on'})
+
+    def test_only_whole_transcriptions_match(self):
+        for text in ('turn on the lights in ten minutes', 'what is the weather', 'turn on the ok google lights',
+                     '', None):
+            self.assertIsNone(self.matcher.match(text), text)
+
+    def test_empty_table_matches_nothing(self):
+        self.assertIsNone(IntentMatcher([]).match('turn on the ac'))
+
+    def test_invalid_pattern(self):
+        with self.assertRaises(ImproperlyConfigured):
+            IntentMatcher([{'name': 'broken', 'patterns': ['(turn on'], 'response': 'Okay.'}])
+
+    def test_responses_include_sentences(self):
+        matcher = IntentMatcher([{'name': 'two', 'patterns': ['hello'], 'response': 'Hi there. How can I help?'}])
+        self.assertEqual(matcher.responses(), ['Hi there. How can I help?', 'Hi there.', 'How can I help?'])
+
+
+DAY = 86400
+
+
+@override_settings(MEDIA_RETENTION_DAYS={UPLOADS: 30, GENERATED: 90}, MEDIA_QUOTA_BYTES={UPLOADS: None, GENERATED: None},
+                   MEDIA_ORPHAN_GRACE=3600, MEDIA_SWEEP_BATCH=2, MEDIA_SWEEP_PAUSE=0)
+class MediaSweeperTests(TemporaryMediaRoot, TestCase):
+
+    def media(self, name, age, size=10, upload=True, generated=False):
+        """
+        Write a file ``age`` seconds old; an upload gets an AudioFile row
+        and a generated clip an AIHandler unless told otherwise
+        """
+        name = media_storage.shard(name)
+        path = write_media(name, b'x' * size)
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        if name.startswith(UPLOADS) and upload:
+            AudioFile.objects.create(audio_file=name, transcription=f"text of {name}")
+        if generated:
+            AIHandler.objects.create(text_content=name, audio_file=name, response_text=f"answer to {name}")
+        return name
+
+    def remaining(self):
+        names = set()
+        for directory in (UPLOADS, GENERATED):
+            for dirpath, _, filenames in os.walk(media_storage.path(directory)):
+                relative = os.path.relpath(dirpath, settings.MEDIA_ROOT).split(os.sep)
+                names.update('/'.join([*relative, filename]) for filename in filenames)
+        return names
+
+    def test_retention(self):
+        expired_upload = self.media(f'{UPLOADS}/old.wav', 31 * DAY)
+        kept_upload = self.media(f'{UPLOADS}/recent.wav', 29 * DAY)
+        expired_clip = self.media(f'{GENERATED}/old.mp3', 91 * DAY, generated=True)
+        kept_clip = self.media(f'{GENERATED}/recent.mp3', 60 * DAY, generated=True)
+
+        stats = MediaSweeper().sweep()
+        self.assertEqual(self.remaining(), {kept_upload, kept_clip})
+        self.assertEqual((stats['scanned'], stats['expired'], stats['bytes_freed']), (4, 2, 20))
+
+        # The rows stay, with their text, but no longer point at a file
+        upload = AudioFile.objects.get(transcription=f"text of {expired_upload}")
+        self.assertEqual(upload.audio_file.name, '')
+        self.assertEqual(AudioFile.objects.get(transcription=f"text of {kept_upload}").audio_file.name, kept_upload)
+        handler = AIHandler.objects.get(response_text=f"answer to {expired_clip}")
+        self.assertFalse(handler.audio_file)
+        self.assertEqual(AIHandler.objects.get(response_text=f"answer to {kept_clip}").audio_file.name, kept_clip)
+
+    @override_settings(MEDIA_QUOTA_BYTES={UPLOADS: 250, GENERATED: 100})
+    def test_quota_evicts_the_oldest_first(self):
+        uploads = [self.media(f'{UPLOADS}/{hours}h.wav', hours * 3600, size=100) for hours in (5, 4, 3, 2, 1)]
+        clips = [self.media(f'{GENERATED}/{hours}h.mp3', hours * 3600, size=60) for hours in (2, 1)]
+
+        stats = MediaSweeper().sweep()
+        self.assertEqual(self.remaining(), {uploads[3], uploads[4], clips[1]})
+        self.assertEqual((stats['over_quota'], stats['bytes_freed']), (4, 360))
+        self.assertEqual(AudioFile.objects.filter(audio_file='').count(), 3)
+
+    def test_orphans_after_the_grace_period(self):
+        self.media(f'{UPLOADS}/orphan.wav', 2 * 3600, upload=False)
+        arriving = self.media(f'{UPLOADS}/arriving.wav', 600, upload=False)
+        referenced = self.media(f'{UPLOADS}/referenced.wav', 2 * 3600)
+        # Clips are a shared cache: no row needs to point at them
+        clip = self.media(f'{GENERATED}/cached.mp3', 2 * 3600)
+        self.media(f'{GENERATED}/abandoned.mp3{PARTIAL_SUFFIX}', 2 * 3600)
+        writing = self.media(f'{GENERATED}/writing.mp3{PARTIAL_SUFFIX}', 600)
+
+        stats = MediaSweeper().sweep()
+        self.assertEqual(self.remaining(), {arriving, referenced, clip, writing})
+        self.assertEqual((stats['orphans'], stats['partial'], stats['expired'], stats['over_quota']), (1, 1, 0, 0))
+
+    def test_dry_run_deletes_nothing(self):
+        names = {self.media(f'{UPLOADS}/old.wav', 31 * DAY), self.media(f'{UPLOADS}/orphan.wav', DAY, upload=False)}
+        stats = MediaSweeper(dry_run=True).sweep()
+        self.assertEqual((stats['expired'], stats['orphans']), (1, 1))
+        self.assertEqual(self.remaining(), names)
+        self.assertFalse(AudioFile.objects.filter(audio_file='').exists())
+
+    def test_lock_file(self):
+        old = self.media(f'{UPLOADS}/old.wav', 31 * DAY)
+        with sweep_lock() as acquired:
+            self.assertTrue(acquired)
+            self.assertTrue(os.path.exists(os.path.join(settings.MEDIA_ROOT, '.sweep.lock')))
+            # Another sweeper, here or in another process, backs off
+            with sweep_lock() as second:
+                self.assertFalse(second)
+            with self.assertRaisesMessage(CommandError, "Another process is sweeping"):
+                call_command('sweep_media', stdout=io.StringIO())
+            self.assertIn(old, self.remaining())
+        out = io.StringIO()
+        call_command('sweep_media', stdout=out)
+        self.assertIn("1 expired", out.getvalue())
+        self.assertEqual(self.remaining(), set())
+
+
+class OutputFormatTests(TemporaryMediaRoot, SimpleTestCase):
+    PCM = make_pcm(0.5, tone_hz=440)
+
+    def test_encoders(self):
+        rate = 16000
+        self.assertEqual(tts_formats.encode(self.PCM, rate, 'pcm'), self.PCM)
+        self.assertEqual(len(tts_formats.encode(self.PCM, rate, 'ulaw')), len(self.PCM) // 2)
+        with wave.open(io.BytesIO(tts_formats.encode(self.PCM, rate, 'wav'))) as w:
+            self.assertEqual((w.getnchannels(), w.getsampwidth(), w.getframerate()), (1, 2, rate))
+            self.assertEqual(w.readframes(w.getnframes()), self.PCM)
+        info = parse_wav_header(tts_formats.encode(self.PCM, rate, 'adpcm'))
+        self.assertEqual((info.format_tag, info.sample_rate), (WAVE_FORMAT_IMA_ADPCM, rate))
+        with self.assertRaises(tts_formats.UnsupportedFormatError):
+            tts_formats.encode(self.PCM, rate, 'mp3')
+
+    def test_variant_names(self):
+        source = 'generated_audio/3f/key.mp3'
+        names = {name: tts_formats.variant_name(source, name) for name in tts_formats.OUTPUT_FORMATS}
+        self.assertEqual(names, {
+            'mp3': source,
+            'wav': 'generated_audio/3f/key.wav',
+            'pcm': 'generated_audio/3f/key.pcm.raw',
+            'ulaw': 'generated_audio/3f/key.ulaw.raw',
+            'adpcm': 'generated_audio/3f/key.adpcm.wav',
+        })
+        for name, stored_name in names.items():
+            self.assertEqual(tts_formats.format_of(stored_name), name)
+        self.assertIsNone(tts_formats.format_of('audio_files/3f/recording.flac'))
+
+    @override_settings(TTS_OUTPUT_SAMPLE_RATE=16000)
+    def test_variant_is_transcoded_once(self):
+        source = 'generated_audio/3f/key.src'
+        write_media(source, make_wav(self.PCM))
+        name = tts_formats.variant(source, 'pcm')
+        self.assertEqual(name, 'generated_audio/3f/key.pcm.raw')
+        with open(media_storage.path(name), 'rb') as f:
+            pcm = np.frombuffer(f.read(), dtype='<i2')
+        self.assertEqual(len(pcm), len(self.PCM) // 2)
+        self.assertLessEqual(np.abs(pcm.astype(int) - np.frombuffer(self.PCM, dtype='<i2')).max(), 1)
+
+        with mock.patch.object(tts_formats, 'transcode') as transcode:
+            self.assertEqual(tts_formats.variant(source, 'pcm'), name)
+        transcode.assert_not_called()
+
+    def test_formats_need_ffmpeg(self):
+        with mock.patch.object(tts_formats, 'transcoder_available', return_value=False):
+            self.assertEqual(tts_formats.check_format('mp3'), 'mp3')
+            self.assertEqual(tts_formats.available_formats(), ['mp3'])
+            with self.assertRaises(tts_formats.TranscoderUnavailable):
+                tts_formats.check_format('pcm')
+        with self.assertRaises(tts_formats.UnsupportedFormatError):
+            tts_formats.check_format('ogg')
+
+
+def ogg_page(*packets, granule=0):
+    """One Ogg page holding ``packets``, with the CRC left at zero (the reader doesn't check it)"""
+    lacing = bytearray()
+    for packet in packets:
+        lacing += bytes([255] * (len(packet) // 255) + [len(packet) % 255])
+    return (b'OggS' + struct.pack('<BBqIIIB', 0, 0, granule, 1, 0, 0, len(lacing))
+            + bytes(lacing) + b''.join(packets))
+
+
+def opus_head(channels=1, pre_skip=0, input_rate=16000):
+    return b'OpusHead' + struct.pack('<BBHIhB', 1, channels, pre_skip, input_rate, 0, 0)
+
+
+def flac_streaminfo(sample_rate, channels, bits, total_samples):
+    """A FLAC stream header, without any audio frames"""
+    packed = (sample_rate << 44) | ((channels - 1) << 41) | ((bits - 1) << 36) | total_samples
+    streaminfo = struct.pack('>HH', 4096, 4096) + b'\0' * 6 + struct.pack('>Q', packed) + b'\0' * 16
+    return b'fLaC' + bytes([0x80, 0, 0, len(streaminfo)]) + streaminfo
+
+
+class AudioCodecTests(TemporaryMediaRoot, TestCase):
+    PCM = make_pcm(0.5, tone_hz=440)
+
+    def test_ima_adpcm_round_trip(self):
+        encoded = audio_codecs.encode_ima_adpcm_wav(self.PCM, 16000)
+        self.assertLess(len(encoded), len(self.PCM) // 3)
+        audio_format, pcm = audio_codecs.decode(encoded)
+        self.assertEqual(audio_format, audio_codecs.AudioFormat('ima-adpcm', 16000, 1, 500))
+        self.assertEqual(len(pcm), len(self.PCM))
+        original = np.frombuffer(self.PCM, dtype='<i2').astype(float)
+        error = np.frombuffer(pcm, dtype='<i2') - original
+        # Lossy, but well under the signal once the step size has adapted
+        self.assertLess(np.sqrt(np.mean(error ** 2)), 0.05 * np.sqrt(np.mean(original ** 2)))
+
+        decoder = audio_codecs.open_decoder('wav')
+        streamed = b''.join(decoder.feed(encoded[i:i + 100]) for i in range(0, len(encoded), 100))
+        self.assertEqual(streamed + decoder.finish(), pcm)
+        self.assertEqual(decoder.duration_ms, 500)
+
+    @skipUnless(audio_codecs.flac_available(), "no flac binary")
+    def test_flac_round_trip(self):
+        from speech_recognition.audio import get_flac_converter
+        encoded = subprocess.run([get_flac_converter(), '--stdout', '--silent', '-'],
+                                 input=make_wav(self.PCM), capture_output=True, check=True).stdout
+        audio_format, pcm = audio_codecs.decode(encoded)
+        self.assertEqual(audio_format, audio_codecs.AudioFormat('flac', 16000, 1, 500))
+        self.assertEqual(pcm, self.PCM)
+
+        decoder = audio_codecs.open_decoder('flac')
+        try:
+            streamed = b''.join(decoder.feed(encoded[i:i + 100]) for i in range(0, len(encoded), 100))
+            self.assertEqual(streamed + decoder.finish(), self.PCM)
+        finally:
+            decoder.close()
+
+    def test_opus_header_split_across_chunks(self):
+        opuslib = mock.Mock()
+        opuslib.Decoder.return_value.decode.return_value = self.PCM[:640]
+        stream = ogg_page(opus_head()) + ogg_page(b'OpusTags') + ogg_page(b'\xfc' * 20, granule=960)
+        with mock.patch.dict(sys.modules, {'opuslib': opuslib}):
+            decoder = audio_codecs.open_decoder('ogg')
+        self.assertEqual(decoder.feed(stream[:6]), b'')
+        self.assertIsNone(decoder.format)
+        self.assertEqual(decoder.feed(stream[6:]), self.PCM[:640])
+        self.assertEqual(decoder.format, audio_codecs.AudioFormat('opus', 16000, 1, None))
+        opuslib.Decoder.assert_called_once_with(16000, 1)
+
+    def test_probe(self):
+        ima = audio_codecs.encode_ima_adpcm_wav(self.PCM, 16000)
+        opus = (ogg_page(opus_head(channels=2, pre_skip=312, input_rate=48000)) + ogg_page(b'OpusTags')
+                + ogg_page(b'\xfc' * 20, granule=48000 + 312))
+        AudioFormat = audio_codecs.AudioFormat
+        self.assertEqual(audio_codecs.probe(make_wav(self.PCM)), AudioFormat('pcm', 16000, 1, 500))
+        self.assertEqual(audio_codecs.probe(ima), AudioFormat('ima-adpcm', 16000, 1, 500))
+        self.assertEqual(audio_codecs.probe(flac_streaminfo(44100, 2, 24, 44100 * 2)),
+                         AudioFormat('flac', 44100, 2, 2000))
+        self.assertEqual(audio_codecs.probe(opus), AudioFormat('opus', 48000, 2, 1000))
+        self.assertIsNone(audio_codecs.probe(b'ID3\x04' + b'\0' * 64))
+
+    @mock.patch.object(audio_codecs, 'available_containers', return_value=['wav', 'flac', 'ogg'])
+    def test_negotiate(self, available_containers):
+        for content_type, container in audio_codecs.CONTENT_TYPES.items():
+            self.assertEqual(audio_codecs.negotiate(content_type), container)
+        self.assertEqual(audio_codecs.negotiate('audio/WAV; rate=16000'), 'wav')
+        self.assertEqual(audio_codecs.negotiate('audio/ogg; codecs=opus'), 'ogg')
+        self.assertIsNone(audio_codecs.negotiate('audio/ogg; codecs=vorbis'))
+        self.assertIsNone(audio_codecs.negotiate('audio/mpeg'))
+        self.assertIsNone(audio_codecs.negotiate(None))
+
+        available_containers.return_value = ['wav']
+        self.assertIsNone(audio_codecs.negotiate('audio/flac'))
+        self.assertIsNone(audio_codecs.negotiate('audio/ogg'))
+        self.assertEqual(audio_codecs.supported_content_types(),
+                         ['audio/wav', 'audio/x-wav', 'audio/wave', 'audio/vnd.wave'])
+
+    @mock.patch.object(audio_codecs, 'available_containers', return_value=['wav', 'flac'])
+    def test_unsupported_upload_is_rejected(self, available_containers):
+        for content_type in ('audio/mpeg', 'audio/ogg; codecs=opus'):
+            response = self.client.post('/api/audio/', b'\0' * 64, content_type=content_type)
+            self.assertEqual(response.status_code, 415)
+            supported = ['audio/wav', 'audio/x-wav', 'audio/wave', 'audio/vnd.wave', 'audio/flac', 'audio/x-flac']
+            self.assertEqual(response['Accept-Post'], ', '.join(supported))
+            self.assertEqual(response.json()['supported'], supported)
+        self.assertFalse(AudioFile.objects.exists())
+
+
+class SilenceSegmenterTests(SimpleTestCase):
+    """Frames of 10 samples at 1 kHz: 3 silent frames close a segment, 10 frames is the longest"""
+    FRAME = 20
+
+    def make_segmenter(self, **kwargs):
+        return SilenceSegmenter(1000, 2, frame_ms=10, silence_threshold=0.1, min_silence_ms=30,
+                                max_segment_ms=100, preroll_ms=20, **kwargs)
+
+    def frames(self, count, level=0.0):
+        return np.full(10 * count, int(level * 32767), dtype='<i2').tobytes()
+
+    def feed(self, segmenter, data, chunk=7):
+        """Feed ``data`` in chunks that don't line up with frames"""
+        segments = []
+        for offset in range(0, len(data), chunk):
+            segments += segmenter.feed(data[offset:offset + chunk])
+        return segments
+
+    def test_segment_closes_after_silence(self):
+        segmenter = self.make_segmenter()
+        speech = self.frames(2, 0.5)
+        segments = self.feed(segmenter, self.frames(5) + speech + self.frames(3) + self.frames(4))
+        # Only the pre-roll of the leading silence is kept
+        self.assertEqual(segments, [self.frames(2) + speech + self.frames(3)])
+        self.assertIsNone(segmenter.flush())
+
+    def test_short_pause_does_not_split(self):
+        segmenter = self.make_segmenter()
+        data = self.frames(2, 0.5) + self.frames(2) + self.frames(2, 0.5) + self.frames(3)
+        self.assertEqual(self.feed(segmenter, data), [data])
+
+    def test_long_speech_is_cut_at_max_segment(self):
+        segmenter = self.make_segmenter()
+        segments = self.feed(segmenter, self.frames(25, 0.5))
+        self.assertEqual([len(segment) for segment in segments], [10 * self.FRAME] * 2)
+        self.assertEqual(segmenter.flush(), self.frames(5, 0.5))
+
+    def test_flush_returns_partial_frame(self):
+        segmenter = self.make_segmenter()
+        data = self.frames(2, 0.5) + self.frames(1) + b'\0' * 6
+        self.assertEqual(self.feed(segmenter, data), [])
+        self.assertEqual(segmenter.flush(), data)
+
+    def test_levels_match_per_frame_rms(self):
+        segmenter = self.make_segmenter()
+        data = make_pcm(0.05, tone_hz=100, sample_rate=1000)
+        expected = [segmenter.frame_rms(data[i:i + self.FRAME]) for i in range(0, len(data), self.FRAME)]
+        np.testing.assert_allclose(segmenter.frames_rms(data), expected)
+
+    def test_unsigned_8_bit_silence(self):
+        segmenter = SilenceSegmenter(1000, 1, frame_ms=10, silence_threshold=0.1, min_silence_ms=30)
+        self.assertEqual(segmenter.feed(b'\x80' * 100), [])
+        self.assertIsNone(segmenter.flush())
+        with self.assertRaises(ValueError):
+            SilenceSegmenter(1000, 3)
+
+
+class ImmediateExecutor:
+    """Runs each submitted call at once, so a test sees recognitions as soon as feed() cuts a segment"""
+
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        pass
+
+
+class CountingProcessor:
+    """AudioProcessor stand-in that answers segment n with "part n" """
+
+    def __init__(self):
+        self.segments = []
+
+    def recognize(self, audio_data, source):
+        self.segments.append(audio_data)
+        return {"success": True, "error": None, "text": f"part {len(self.segments) - 1}"}
+
+
+class StreamingTranscriberTests(SimpleTestCase):
+    UTTERANCE = make_pcm(1.0, tone_hz=440) + make_pcm(0.6)
+
+    def setUp(self):
+        self.processor = CountingProcessor()
+        self.transcriber = StreamingTranscriber(self.processor, ImmediateExecutor())
+
+    def feed(self, data, chunk=4000):
+        for offset in range(0, len(data), chunk):
+            self.transcriber.feed(data[offset:offset + chunk])
+
+    def test_header_split_across_chunks(self):
+        wav = make_wav(self.UTTERANCE)
+        # The 44-byte header arrives a few bytes at a time
+        self.feed(wav[:40], chunk=5)
+        self.assertFalse(self.transcriber.streaming)
+        self.assertTrue(self.transcriber.active)
+        self.feed(wav[40:], chunk=5)
+        self.assertTrue(self.transcriber.streaming)
+        self.assertEqual(self.transcriber.sample_rate, 16000)
+        self.assertEqual(self.transcriber.finish()['text'], 'part 0')
+
+    def test_segments_cut_at_silence_and_joined(self):
+        self.feed(make_wav(self.UTTERANCE * 2 + make_pcm(1.0, tone_hz=330)))
+        # Both pauses closed a segment before the upload ended
+        self.assertEqual(len(self.processor.segments), 2)
+        result = self.transcriber.finish()
+        self.assertEqual(len(self.processor.segments), 3)
+        self.assertEqual((result['success'], result['text']), (True, 'part 0 part 1 part 2'))
+        self.assertEqual(len(result['pcm_digest']), 64)
+
+    def test_silence_is_rejected(self):
+        self.feed(make_wav(make_pcm(2.0)))
+        self.assertEqual(self.transcriber.finish()['error'], SILENT_ERROR)
+        self.assertEqual(self.processor.segments, [])
+
+    def test_stereo_and_other_containers_are_not_streamed(self):
+        self.feed(make_wav(self.UTTERANCE * 2, channels=2))
+        self.assertFalse(self.transcriber.streaming)
+        transcriber = StreamingTranscriber(self.processor, ImmediateExecutor())
+        transcriber.feed(MP3_PART)
+        self.assertFalse(transcriber.active)
+        self.assertEqual(self.processor.segments, [])
+
+
+@override_settings(ADMISSION_DEVICE_RATE=0)
+class StreamedUploadTests(TemporaryMediaRoot, TestCase):
+    URL = '/api/audio/?stream=1'
+
+    def post(self, wav):
+        return self.client.post(self.URL, wav, content_type='audio/wav', HTTP_TRANSFER_ENCODING='chunked')
+
+    @mock.patch.object(AudioProcessor, 'recognize', return_value={"success": True, "error": None, "text": "lights on"})
+    def test_transcribed_before_the_response(self, recognize):
+        with racing_worker(StreamingTranscriber, 'finish') as claimed:
+            response = self.post(make_wav(make_pcm(1.0, tone_hz=440) + make_pcm(0.6)))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['transcription'], 'lights on')
+        # The row was never up for grabs by the queue workers
+        self.assertEqual(claimed, [None])
+        upload = AudioFile.objects.get()
+        self.assertEqual((upload.status, upload.transcription, upload.claimed_at), ('done', 'lights on', None))
+
+    @mock.patch('api.views.get_queue')
+    def test_stereo_falls_back_to_the_queue(self, get_queue):
+        response = self.post(make_wav(make_pcm(1.0, tone_hz=440), channels=2))
+        self.assertEqual(response.status_code, 202)
+        upload = AudioFile.objects.get()
+        self.assertEqual((upload.status, upload.channels), (AudioFile.STATUS_QUEUED, 2))
+        get_queue.return_value.enqueue.assert_called_once_with(upload)
+
+
+RECOGNIZED = {"success": True, "error": None, "text": "turn on the lights"}
+
+
+def prepare_intent_clip(text="Okay, turning on the lights."):
+    """Store the canned response clip, as API_WARMUP would, so answering it needs no upstream"""
+    return write_media(clip_name(text, 'en'), MP3_PART)
+
+
+@override_settings(EAGER_RESPONSES=True, EAGER_POLL_INTERVAL=0.01)
+class EagerResponseTests(TemporaryMediaRoot, TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        prepare_intent_clip()
+        eager = services.EagerResponses(workers=1)
+        patcher = mock.patch.object(services, '_eager', eager)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def transcribed_upload(self):
+        upload = AudioFile.objects.create(audio_file='audio_files/a.wav')
+        upload.save_transcription(RECOGNIZED)
+        return upload
+
+    def test_response_started_on_transcription_is_reused(self):
+        upload = self.transcribed_upload()
+        pipeline = services.VoicePipeline()
+        handler = pipeline.respond(upload)
+        self.assertTrue(handler.processed)
+        self.assertTrue(handler.original_request['eager'])
+        self.assertEqual(pipeline.respond(upload).pk, handler.pk)
+        self.assertEqual(AIHandler.objects.count(), 1)
+        self.assertEqual(pipeline.upstreams(upload), ())
+
+    def test_failed_speculative_response_is_regenerated(self):
+        with mock.patch.object(services.VoicePipeline, 'generate', side_effect=RuntimeError('llm down')):
+            upload = self.transcribed_upload()
+            services.get_eager_responses()._executor.shutdown(wait=True)
+        handler = services.VoicePipeline().respond(upload)
+        self.assertTrue(handler.processed)
+        self.assertFalse(handler.original_request['eager'])
+
+    @override_settings(EAGER_RESPONSES=False)
+    def test_off_generates_on_request(self):
+        upload = self.transcribed_upload()
+        self.assertEqual(AIHandler.objects.count(), 0)
+        pipeline = services.VoicePipeline()
+        self.assertNotEqual(pipeline.respond(upload).pk, pipeline.respond(upload).pk)
+
+
+@contextmanager
+def racing_worker(owner, name):
+    """
+    Have a queue worker try to claim a job whenever ``owner.name`` is
+    called, as a running worker could; yields the list of jobs it claimed
+    """
+    original = getattr(owner, name)
+    claimed = []
+
+    def claim():
+        claimed.append(TranscriptionQueue(workers=1).claim_next())
+
+    if asyncio.iscoroutinefunction(original):
+        async def racing(*args, **kwargs):
+            await sync_to_async(claim)()
+            return await original(*args, **kwargs)
+    else:
+        def racing(*args, **kwargs):
+            claim()
+            return original(*args, **kwargs)
+    with mock.patch.object(owner, name, racing):
+        yield claimed
+
+
+class FakeWebSocket:
+    """The ASGI receive/send pair of one device connection"""
+
+    def __init__(self, messages):
+        self.incoming = asyncio.Queue()
+        for message in [{'type': 'websocket.connect'}, *messages, {'type': 'websocket.disconnect'}]:
+            self.incoming.put_nowait(message)
+        self.sent = []
+
+    async def receive(self):
+        return await self.incoming.get()
+
+    async def send(self, message):
+        self.sent.append(message)
+
+    def events(self):
+        """Text messages as dicts; binary ones as their bytes"""
+        return [json.loads(m['text']) if 'text' in m else m['bytes'] for m in self.sent if m['type'] == 'websocket.send']
+
+
+def text(data):
+    return {'type': 'websocket.receive', 'text': json.dumps(data)}
+
+
+def binary(data):
+    return {'type': 'websocket.receive', 'bytes': data}
+
+
+@override_settings(WS_AUDIO_FRAME_BYTES=32, ADMISSION_DEVICE_RATE=0)
+class DeviceSessionTests(TemporaryMediaRoot, TransactionTestCase):
+
+    def setUp(self):
+        super().setUp()
+        recognize = mock.patch.object(AudioProcessor, 'recognize', return_value=RECOGNIZED)
+        recognize.start()
+        self.addCleanup(recognize.stop)
+
+    def run_session(self, messages):
+        socket = FakeWebSocket(messages)
+        scope = {'type': 'websocket', 'path': settings.WS_DEVICE_PATH, 'headers': [(b'x-device-id', b'esp32-1')]}
+        asyncio.run(DeviceSession(scope, socket.receive, socket.send).run())
+        self.assertEqual(socket.sent[0], {'type': 'websocket.accept'})
+        events = socket.events()
+        self.assertEqual(events[0]['type'], 'ready')
+        return events[1:]
+
+    def test_interaction(self):
+        prepare_intent_clip()
+        speech = make_pcm(1.0, tone_hz=440) + make_pcm(0.5)
+        events = self.run_session([
+            text({'type': 'start', 'language': 'en'}),
+            *[binary(speech[offset:offset + 4000]) for offset in range(0, len(speech), 4000)],
+            text({'type': 'end'}),
+        ])
+        transcription, audio, *frames, done = events
+        self.assertEqual(transcription['type'], 'transcription')
+        self.assertEqual((transcription['status'], transcription['text']), ('done', 'turn on the lights'))
+        self.assertEqual(audio['type'], 'audio')
+        self.assertEqual((audio['text'], audio['bytes']), ('Okay, turning on the lights.', len(MP3_PART)))
+        self.assertEqual(b''.join(frames), MP3_PART)
+        self.assertEqual(len(frames), -(-len(MP3_PART) // 32))
+        self.assertEqual((done['type'], done['is_successful'], done['intent']), ('done', True, 'lights_on'))
+
+        upload = AudioFile.objects.get(pk=transcription['id'])
+        self.assertEqual((upload.device_id, upload.codec, upload.sample_rate), ('esp32-1', 'pcm', 16000))
+        self.assertEqual(str(AIHandler.objects.get().pk), done['response_id'])
+
+    def test_upload_is_not_claimed_by_queue_workers(self):
+        prepare_intent_clip()
+        speech = make_pcm(1.0, tone_hz=440) + make_pcm(0.5)
+        with racing_worker(StreamingTranscriber, 'finish') as claimed:
+            events = self.run_session([text({'type': 'start'}), binary(speech), text({'type': 'end'})])
+        self.assertEqual(claimed, [None])
+        self.assertEqual(AudioFile.objects.get(pk=events[0]['id']).status, AudioFile.STATUS_DONE)
+
+    def test_errors_keep_the_connection(self):
+        events = self.run_session([
+            binary(b'\0' * 64),
+            text({'type': 'end'}),
+            text({'type': 'start', 'audio_format': 'ogg'}),
+            {'type': 'websocket.receive', 'text': 'not json'},
+            text({'type': 'start', 'content_type': 'audio/x-raw;format=F32LE'}),
+            text({'type': 'rewind'}),
+            text({'type': 'start'}),
+            text({'type': 'start'}),
+            text({'type': 'cancel'}),
+        ])
+        self.assertEqual([event['type'] for event in events], ['error'] * 7)
+        self.assertIn('start', events[0]['error'])
+        self.assertIn('ogg', events[2]['error'])
+        self.assertIn('already in progress', events[6]['error'])
+        # The cancelled upload is deleted
+        self.assertEqual([files for _, _, files in os.walk(media_storage.path('audio_files')) if files], [])
+
+    @override_settings(ADMISSION_DEVICE_RATE=1.0, ADMISSION_DEVICE_BURST=1)
+    def test_rejected_start(self):
+        with mock.patch.object(admission, 'device_buckets', admission.TokenBuckets()):
+            events = self.run_session([text({'type': 'start'}), text({'type': 'cancel'}), text({'type': 'start'})])
+        self.assertEqual(len(events), 1)
+        self.assertEqual((events[0]['type'], events[0]['status'], events[0]['retry_after']), ('error', 429, 1))
+
+
+class FailingModel:
+    """Gemini stand-in that always fails"""
+
+    def generate_content(self, prompt, **kwargs):
+        raise RuntimeError('quota exceeded')
+
+    async def generate_content_async(self, prompt, **kwargs):
+        self.generate_content(prompt)
+
+
+class FakeModel:
+    """Gemini stand-in that answers every prompt with ``answer``"""
+
+    def __init__(self, answer):
+        self.answer = answer
+
+    async def generate_content_async(self, prompt, **kwargs):
+        return mock.Mock(text=self.answer)
+
+
+@override_settings(EAGER_RESPONSES=False, ADMISSION_DEVICE_RATE=0)
+class AIProcessViewTests(TemporaryMediaRoot, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        # Failures here must not open the shared LLM circuit for other tests
+        patcher = mock.patch.object(upstream.llm, 'breaker', upstream.CircuitBreaker())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def transcribed(self, text):
+        upload = AudioFile.objects.create(audio_file='audio_files/a.wav')
+        upload.save_transcription({"success": True, "error": None, "text": text})
+        return upload
+
+    def test_answer(self):
+        prepare_intent_clip()
+        upload = self.transcribed('turn on the lights')
+        # audio_link is validated as a URL, which "testserver" isn't
+        response = self.client.get(f'/api/audio/ai-process/{upload.pk}/', HTTP_HOST='127.0.0.1:8000')
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual((body['response_text'], body['intent'], body['is_successful']),
+                         ('Okay, turning on the lights.', 'lights_on', True))
+        self.assertTrue(body['audio_link'].endswith(clip_name('Okay, turning on the lights.', 'en')))
+
+    @mock.patch('api.speech_generator.get_model', return_value=FailingModel())
+    def test_failed_generation_reports_the_error(self, get_model):
+        upload = self.transcribed('what is the weather like in Hanoi')
+        response = self.client.get(f'/api/audio/ai-process/{upload.pk}/')
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual(response.json(), {
+            'error': 'quota exceeded', 'response_id': str(upload.pk), 'request_text': 'what is the weather like in Hanoi',
+        })
+
+
+def stage_buckets(exposition):
+    """{(stage, le): count} of voice_pipeline_stage_seconds in a Prometheus exposition"""
+    pattern = r'^voice_pipeline_stage_seconds_bucket\{stage="(\w+)",le="([^"]+)"\} (\d+)$'
+    return {(stage, le): int(count) for stage, le, count in re.findall(pattern, exposition, re.MULTILINE)}
+
+
+@override_settings(EAGER_RESPONSES=False, ADMISSION_DEVICE_RATE=0)
+class MetricsTests(TemporaryMediaRoot, TestCase):
+
+    def test_histogram_exposition(self):
+        histogram = Histogram('test_seconds', "Test stages", 'stage', buckets=(0.1, 1.0))
+        for seconds in (0.05, 0.1, 0.5, 3.0):
+            histogram.observe('decode', seconds)
+        self.assertEqual(histogram.render(), [
+            '# HELP test_seconds Test stages',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{stage="decode",le="0.1"} 2',
+            'test_seconds_bucket{stage="decode",le="1.0"} 3',
+            'test_seconds_bucket{stage="decode",le="+Inf"} 4',
+            'test_seconds_sum{stage="decode"} 3.65',
+            'test_seconds_count{stage="decode"} 4',
+        ])
+
+    @mock.patch('api.views.get_queue')
+    @mock.patch.object(AudioProcessor, 'recognize', return_value=RECOGNIZED)
+    def test_stage_timings_are_stored_and_exposed(self, recognize, get_queue):
+        before = stage_buckets(self.client.get('/api/metrics/').content.decode())
+        prepare_intent_clip()
+
+        # A tone no other test uploads, so the recognizer isn't skipped for a cached transcription
+        response = self.client.post('/api/audio/', make_wav(make_pcm(1.0, tone_hz=659)), content_type='audio/wav')
+        self.assertEqual(response.status_code, 202)
+        queue = TranscriptionQueue(workers=1)
+        queue.process(queue.claim_next())
+        upload = AudioFile.objects.get()
+        self.assertEqual(set(upload.stage_timings), {'upload', 'queue_wait', 'decode', 'recognize'})
+
+        response = self.client.get(f'/api/audio/ai-process/{upload.pk}/', HTTP_HOST='127.0.0.1:8000')
+        self.assertEqual(response.status_code, 200)
+        handler = AIHandler.objects.get()
+        self.assertEqual(set(handler.stage_timings), {'tts'})
+
+        response = self.client.get('/api/metrics/')
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        after = stage_buckets(response.content.decode())
+        # Each stored duration went into its own bucket and every one above it
+        for stage, seconds in {**upload.stage_timings, **handler.stage_timings}.items():
+            deltas = [after[stage, str(bound)] - before.get((stage, str(bound)), 0) for bound in DEFAULT_BUCKETS]
+            self.assertEqual(deltas, [int(seconds <= bound) for bound in DEFAULT_BUCKETS], stage)
+            self.assertEqual(after[stage, '+Inf'] - before.get((stage, '+Inf'), 0), 1, stage)
+
+
+@override_settings(EAGER_RESPONSES=False, ADMISSION_DEVICE_RATE=0)
+class AsyncViewTests(TemporaryMediaRoot, TestCase):
+    # A tone no other test uploads, so the transcription cache can't answer for the recognizer
+    SPEECH = make_wav(make_pcm(1.0, tone_hz=523) + make_pcm(0.5))
+    # audio_link must validate as a URL, which http://testserver/ doesn't; AsyncClient always sends that Host
+    HOST = {'x-forwarded-host': '127.0.0.1:8000'}
+
+    def setUp(self):
+        super().setUp()
+        recognizer = RecognizerChain([StubBackend('fake', 'play some music', 0.9)], min_confidence=0.6)
+        for patcher in (mock.patch('api.audio_processor.get_recognizer', return_value=recognizer),
+                        mock.patch.object(upstream.llm, 'breaker', upstream.CircuitBreaker())):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    async def transcribed(self, text):
+        upload = await AudioFile.objects.acreate(audio_file='audio_files/a.wav')
+        await sync_to_async(upload.save_transcription)({"success": True, "error": None, "text": text})
+        return upload
+
+    async def test_streamed_upload(self):
+        with racing_worker(AudioProcessor, 'aconvert_wav_bytes_to_text') as claimed:
+            response = await self.async_client.post('/api/async/audio/?stream=1', self.SPEECH, content_type='audio/wav')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['transcription'], 'play some music')
+        self.assertEqual(claimed, [None])
+        upload = await AudioFile.objects.aget()
+        self.assertEqual((upload.status, upload.transcription), (AudioFile.STATUS_DONE, 'play some music'))
+
+    @mock.patch('api.async_views.get_queue')
+    async def test_queued_upload(self, get_queue):
+        response = await self.async_client.post('/api/async/audio/', self.SPEECH, content_type='audio/wav')
+        self.assertEqual(response.status_code, 202)
+        upload = await AudioFile.objects.aget()
+        self.assertEqual((upload.status, upload.sample_rate), (AudioFile.STATUS_QUEUED, 16000))
+        get_queue.return_value.enqueue.assert_called_once()
+
+    async def test_unsupported_upload(self):
+        response = await self.async_client.post('/api/async/audio/', b'ID3', content_type='audio/mpeg')
+        self.assertEqual(response.status_code, 415)
+        self.assertIn('audio/wav', response['Accept-Post'])
+
+    @override_settings(USE_X_FORWARDED_HOST=True)
+    async def test_answer(self):
+        answer = 'Playing some music for you.'
+        await sync_to_async(write_media)(clip_name(answer, 'en'), MP3_PART)
+        upload = await self.transcribed('play some music')
+        with mock.patch('api.speech_generator.get_model', return_value=FakeModel(answer)):
+            response = await self.async_client.get(f'/api/async/audio/ai-process/{upload.pk}/', headers=self.HOST)
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual((body['response_text'], body['is_successful'], body['intent']), (answer, True, None))
+        self.assertTrue(body['audio_link'].endswith(clip_name(answer, 'en')))
+
+    @mock.patch('api.speech_generator.get_model', return_value=FailingModel())
+    async def test_failed_generation_reports_the_error(self, get_model):
+        upload = await self.transcribed('play something I have never heard')
+        response = await self.async_client.get(f'/api/async/audio/ai-process/{upload.pk}/')
+        self.assertEqual(response.status_code, 502)
+        self.assertEqual(response.json()['error'], 'quota exceeded')
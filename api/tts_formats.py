@@ -0,0 +1,236 @@
+"""
+Playback formats for generated speech.
+
+gTTS answers with MP3, which not every device firmware can decode. A
+response can ask for any of OUTPUT_FORMATS instead; the clip is transcoded
+once, when it is first asked for in that format (or right after synthesis
+for TTS_PRETRANSCODE_FORMATS), and the result is stored next to the MP3:
+
+    generated_audio/3f/<key>.mp3          gTTS output
+    generated_audio/3f/<key>.wav          the same clip as 16-bit PCM WAV
+    generated_audio/3f/<key>.pcm.raw      ... and as raw 16-bit PCM
+
+The format name is spelled out before the extension where the extension
+alone doesn't tell the formats apart (.raw, IMA-ADPCM .wav).
+
+Every later download of a variant is a plain file read. Variants live in
+generated_audio/ like the clips, so the sweeper ages them the same way.
+
+Decoding the MP3 takes pydub and ffmpeg. Without ffmpeg only mp3 can be
+served; requests for another format get a 406 (see requested_format) and
+`manage.py check` warns about it.
+"""
+import io
+import os
+import wave
+import shutil
+import functools
+import audioop
+import logging
+import posixpath
+from collections import namedtuple
+import numpy as np
+from django.conf import settings
+from .cache import SingleFlight
+from .storage import media_storage, write_atomic
+
+logger = logging.getLogger(__name__)
+
+# ``streamable`` formats have no container header, so the clips of a
+# streamed answer can be concatenated into one playable body
+OutputFormat = namedtuple('OutputFormat', ['name', 'content_type', 'extension', 'streamable'])
+
+OUTPUT_FORMATS = {fmt.name: fmt for fmt in (
+    OutputFormat('mp3', 'audio/mpeg', '.mp3', True),
+    OutputFormat('wav', 'audio/wav', '.wav', False),
+    # Little-endian, as the ESP32 feeds it to I2S
+    OutputFormat('pcm', 'audio/x-raw;format=S16LE;rate={rate};channels=1', '.raw', True),
+    OutputFormat('ulaw', 'audio/PCMU;rate={rate};channels=1', '.raw', True),
+    OutputFormat('adpcm', 'audio/vnd.wave;codec=11', '.wav', False),
+)}
+# The format gTTS produces, stored as is
+SOURCE_FORMAT = 'mp3'
+
+# Block size of IMA-ADPCM variants: 1017 samples, about 64 ms at 16 kHz
+ADPCM_BLOCK_ALIGN = 512
+
+
+class UnsupportedFormatError(ValueError):
+    """Raised for an output format name not in OUTPUT_FORMATS"""
+
+
+class TranscoderUnavailable(UnsupportedFormatError):
+    """Raised for a format other than SOURCE_FORMAT when ffmpeg isn't installed"""
+
+
+@functools.lru_cache(maxsize=None)
+def transcoder_available():
+    """Whether pydub finds ffmpeg (or avconv) to decode MP3 clips with; looked up once per process"""
+    import warnings
+    with warnings.catch_warnings():
+        # pydub warns on import when it can't find either
+        warnings.simplefilter('ignore', RuntimeWarning)
+        from pydub import AudioSegment
+    return shutil.which(AudioSegment.converter) is not None
+
+
+def available_formats():
+    """Names of the OUTPUT_FORMATS this server can produce"""
+    return list(OUTPUT_FORMATS) if transcoder_available() else [SOURCE_FORMAT]
+
+
+def check_transcoder(app_configs, **kwargs):
+    """System check: warn when ffmpeg is missing, so only mp3 responses can be served"""
+    from django.core.checks import Warning
+    if transcoder_available():
+        return []
+    return [Warning(
+        "ffmpeg is not installed, so generated speech can only be served as mp3.",
+        hint="Install ffmpeg (see README.md); until then requests for another audio_format get a 406.",
+        id='api.W001',
+    )]
+
+
+def content_type(name):
+    """Content-Type of a variant in format ``name``"""
+    return OUTPUT_FORMATS[name].content_type.format(rate=settings.TTS_OUTPUT_SAMPLE_RATE)
+
+
+def requested_format(request):
+    """
+    Output format asked for with ?audio_format= or the X-Audio-Format
+    header, else TTS_DEFAULT_FORMAT. Raises UnsupportedFormatError, or
+    TranscoderUnavailable if it can't be made without ffmpeg.
+
+    (Not ?format=, which DRF keeps for picking the response renderer.)
+    """
+    name = request.GET.get('audio_format') or request.headers.get('X-Audio-Format') or settings.TTS_DEFAULT_FORMAT
+    name = name.strip().lower()
+    return check_format(name)
+
+
+def check_format(name):
+    """Return ``name`` if this server can produce it, else raise UnsupportedFormatError"""
+    if name not in OUTPUT_FORMATS:
+        raise UnsupportedFormatError(f"Unsupported audio format: {name}")
+    if name != SOURCE_FORMAT and not transcoder_available():
+        raise TranscoderUnavailable(f"Can't produce {name} audio: ffmpeg is not installed on this server")
+    return name
+
+
+def suffix(name):
+    """File name suffix of format ``name``: its extension, prefixed by the name unless they're the same"""
+    fmt = OUTPUT_FORMATS[name]
+    if fmt.extension == f".{name}":
+        return fmt.extension
+    return f".{name}{fmt.extension}"
+
+
+def variant_name(source_name, name):
+    """Storage name of the ``name`` variant of a clip: same directory, same key"""
+    if name == SOURCE_FORMAT:
+        return source_name
+    stem = posixpath.splitext(source_name)[0]
+    return f"{stem}{suffix(name)}"
+
+
+def format_of(stored_name):
+    """Output format of a stored clip or variant, from its name (None if it is neither)"""
+    # Longest first, so <key>.adpcm.wav isn't taken for a wav variant
+    for name in sorted(OUTPUT_FORMATS, key=lambda name: len(suffix(name)), reverse=True):
+        if stored_name.endswith(suffix(name)):
+            return name
+    return None
+
+
+# Concurrent requests for the same variant share a single transcode
+transcode_flight = SingleFlight()
+
+
+def variant(source_name, name):
+    """
+    Storage name of the clip in format ``name``, transcoding it the first
+    time it is asked for.
+    """
+    target = variant_name(source_name, name)
+    if target == source_name:
+        return target
+    try:
+        os.utime(media_storage.path(target))
+    except FileNotFoundError:
+        transcode_flight.do(target, transcode, source_name, [name])
+    return target
+
+
+def transcode(source_name, names):
+    """Write the missing variants of a clip, decoding the source once"""
+    missing = [name for name in names
+               if name != SOURCE_FORMAT and not os.path.exists(media_storage.path(variant_name(source_name, name)))]
+    if not missing:
+        return
+    rate = settings.TTS_OUTPUT_SAMPLE_RATE
+    pcm16 = decode_clip(media_storage.path(source_name), rate)
+    for name in missing:
+        write_atomic(media_storage.path(variant_name(source_name, name)), encode(pcm16, rate, name))
+    logger.info(f"Transcoded {source_name} to {', '.join(missing)}")
+
+
+def pretranscode(source_name):
+    """Make the TTS_PRETRANSCODE_FORMATS variants of a new clip; failures are only logged"""
+    if not settings.TTS_PRETRANSCODE_FORMATS:
+        return
+    try:
+        transcode(source_name, settings.TTS_PRETRANSCODE_FORMATS)
+    except Exception as e:
+        logger.error(f"Pre-transcoding {source_name} failed: {e}")
+
+
+def decode_clip(path, sample_rate):
+    """
+    16-bit mono PCM at ``sample_rate`` for a stored clip.
+
+    WAV, FLAC and Ogg Opus are read by audio_codecs; anything else (the MP3
+    from gTTS) goes through pydub, which needs ffmpeg: without it this
+    raises TranscoderUnavailable.
+    """
+    from .audio_codecs import sniff, needs_decoding, decode
+    from .audio_processor import pcm_view, WAVE_FORMAT_IEEE_FLOAT
+    from .preprocessing import decode as to_float, resample
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    if sniff(data) is None:
+        if not transcoder_available():
+            raise TranscoderUnavailable(f"Can't decode {os.path.basename(path)}: ffmpeg is not installed")
+        from pydub import AudioSegment
+        segment = AudioSegment.from_file(io.BytesIO(data)).set_channels(1).set_sample_width(2)
+        samples, source_rate = to_float(segment.raw_data, 2, 1), segment.frame_rate
+    elif needs_decoding(data):
+        audio_format, pcm = decode(data)
+        samples, source_rate = to_float(pcm, 2, audio_format.channels), audio_format.sample_rate
+    else:
+        info, pcm = pcm_view(data)
+        samples = to_float(pcm, info.sample_width, info.channels, info.format_tag == WAVE_FORMAT_IEEE_FLOAT)
+        source_rate = info.sample_rate
+    samples = resample(samples, source_rate, sample_rate)
+    return (np.clip(samples, -1, 1) * 32767).astype('<i2').tobytes()
+
+
+def encode(pcm16, sample_rate, name):
+    """Bytes of mono 16-bit PCM in output format ``name``"""
+    if name == 'pcm':
+        return pcm16
+    if name == 'ulaw':
+        return audioop.lin2ulaw(pcm16, 2)
+    if name == 'wav':
+        buffer = io.BytesIO()
+        with wave.open(buffer, 'wb') as w:
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(sample_rate)
+            w.writeframes(pcm16)
+        return buffer.getvalue()
+    if name == 'adpcm':
+        from .audio_codecs import encode_ima_adpcm_wav
+        return encode_ima_adpcm_wav(pcm16, sample_rate, ADPCM_BLOCK_ALIGN)
+    raise UnsupportedFormatError(f"Cannot encode {name}")
@@ -0,0 +1,600 @@
+"""
+Shared layer for calls to the remote APIs: Google STT, Gemini and gTTS.
+
+Every call goes through an Upstream, which
+
+- caps each attempt at UPSTREAM_TIMEOUTS[name] and at what is left of the
+  request's deadline() budget, so a hung upstream can't stall a request;
+- sends one hedged duplicate when the first attempt is slower than the
+  UPSTREAM_HEDGE_PERCENTILE of recent calls, and takes whichever answers
+  first;
+- keeps a circuit breaker that fails fast with CircuitOpenError after
+  UPSTREAM_BREAKER_FAILURES consecutive failures, letting one trial call
+  through every UPSTREAM_BREAKER_RESET seconds;
+- keeps at most ADMISSION_CONCURRENCY[name] calls in flight. Calls beyond
+  it queue for a slot, INTERACTIVE ones before BATCH ones (see
+  priority()), and fail with Overloaded when they couldn't get one within
+  the deadline.
+
+Attempts run in a shared thread pool (or as tasks for acall), and HTTP
+goes over one pooled keep-alive session instead of a connection per call.
+"""
+import io
+import re
+import time
+import heapq
+import base64
+import asyncio
+import itertools
+import logging
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import speech_recognition as sr
+from django.conf import settings
+from .metrics import queue_wait_seconds
+
+logger = logging.getLogger(__name__)
+
+
+class UpstreamError(Exception):
+    """An upstream call was not attempted or did not finish in time"""
+
+
+class CircuitOpenError(UpstreamError):
+    pass
+
+
+class DeadlineExceeded(UpstreamError):
+    pass
+
+
+class Overloaded(UpstreamError):
+    """Too many calls are queued for an upstream; worth retrying after ``retry_after`` seconds"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+# Queueing order for a concurrency slot; lower goes first
+INTERACTIVE = 0
+BATCH = 1
+
+_deadline = contextvars.ContextVar('upstream_deadline', default=None)
+_priority = contextvars.ContextVar('upstream_priority', default=INTERACTIVE)
+
+
+@contextmanager
+def deadline(seconds):
+    """
+    Limit the upstream calls made inside the block to ``seconds`` in total.
+    A nested block can shorten the budget but never extend it.
+    """
+    end = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(end if current is None else min(current, end))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining():
+    """Seconds left of the current deadline, or None outside deadline()"""
+    end = _deadline.get()
+    return None if end is None else end - time.monotonic()
+
+
+@contextmanager
+def priority(level):
+    """Queue the upstream calls made inside the block at ``level`` (INTERACTIVE or BATCH)"""
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class LatencyWindow:
+    """Latencies of the most recent successful calls"""
+
+    def __init__(self, size=200):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, p, min_samples):
+        with self._lock:
+            if len(self._samples) < min_samples:
+                return None
+            samples = sorted(self._samples)
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker: closed, open, then half-open for one trial call"""
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= settings.UPSTREAM_BREAKER_RESET:
+                # Let exactly one caller probe the upstream
+                self.state = self.HALF_OPEN
+                return True
+            return self.state == self.CLOSED
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        """Count a failure; return True if it opened the circuit"""
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or (
+                self.state == self.CLOSED and self.failures >= settings.UPSTREAM_BREAKER_FAILURES
+            ):
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+
+class _Waiter:
+    __slots__ = ('wake', 'granted')
+
+    def __init__(self, wake):
+        self.wake = wake
+        self.granted = False
+
+
+class Limiter:
+    """
+    Concurrency slots of one upstream. Callers beyond the limit wait in
+    priority order, first come first served within a priority, and a
+    finished call hands its slot straight to the next waiter. The moving
+    average of how long slots are held gives the expected wait of a new caller.
+    """
+    # Weight of the newest hold time in the moving average
+    HOLD_WEIGHT = 0.2
+
+    def __init__(self, name):
+        self.name = name
+        self.active = 0
+        self.hold = None
+        self._waiters = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    @property
+    def limit(self):
+        return settings.ADMISSION_CONCURRENCY.get(self.name)
+
+    def queued(self):
+        """Number of waiters per priority"""
+        counts = dict.fromkeys((INTERACTIVE, BATCH), 0)
+        with self._lock:
+            for level, _, _ in self._waiters:
+                counts[level] = counts.get(level, 0) + 1
+        return counts
+
+    def estimated_wait(self, level=INTERACTIVE):
+        """Seconds a caller at ``level`` would wait for a slot right now"""
+        with self._lock:
+            return self._estimate(level)
+
+    def try_acquire(self):
+        """Take a slot only if one is free"""
+        with self._lock:
+            if self._free():
+                self.active += 1
+                return True
+            return False
+
+    def acquire(self, timeout):
+        """Take a slot, waiting at most ``timeout`` seconds; return the seconds waited"""
+        level = _priority.get()
+        with self._lock:
+            if self._free():
+                self.active += 1
+                return 0.0
+            event = threading.Event()
+            entry = self._enqueue(level, timeout, event.set)
+        start = time.monotonic()
+        event.wait(timeout)
+        if not self._withdraw(entry):
+            raise self._timed_out(level, timeout)
+        return time.monotonic() - start
+
+    async def aacquire(self, timeout):
+        """acquire() that waits on the event loop"""
+        level = _priority.get()
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._free():
+                self.active += 1
+                return 0.0
+            granted = loop.create_future()
+            entry = self._enqueue(level, timeout, lambda: loop.call_soon_threadsafe(_resolve, granted))
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(granted), timeout)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            if self._withdraw(entry):
+                self.release()
+            raise
+        if not self._withdraw(entry):
+            raise self._timed_out(level, timeout)
+        return time.monotonic() - start
+
+    def release(self, held=None):
+        """Give a slot back, ``held`` seconds after it was taken (None if it wasn't used)"""
+        with self._lock:
+            if held is not None:
+                self.hold = held if self.hold is None else self.hold + self.HOLD_WEIGHT * (held - self.hold)
+            if self._waiters:
+                _, _, waiter = heapq.heappop(self._waiters)
+                waiter.granted = True
+                waiter.wake()
+                return
+            self.active -= 1
+
+    def _free(self):
+        limit = self.limit
+        return limit is None or (self.active < limit and not self._waiters)
+
+    def _estimate(self, level):
+        limit = self.limit
+        if limit is None or self.hold is None:
+            return 0.0
+        ahead = sum(1 for waiting, _, _ in self._waiters if waiting <= level)
+        if not ahead and self.active < limit:
+            return 0.0
+        # A slot frees up every hold / limit seconds on average
+        return (ahead + 1) * self.hold / limit
+
+    def _enqueue(self, level, timeout, wake):
+        """Queue a waiter, or raise Overloaded at once if it can't get a slot within ``timeout``"""
+        wait = self._estimate(level)
+        if wait > timeout:
+            raise Overloaded(f"{self.name} is overloaded: about {wait:.1f}s of calls queued", wait)
+        entry = (level, next(self._seq), _Waiter(wake))
+        heapq.heappush(self._waiters, entry)
+        return entry
+
+    def _withdraw(self, entry):
+        """Take a waiter out of the queue; return True if it was granted a slot meanwhile"""
+        with self._lock:
+            if entry[2].granted:
+                return True
+            self._waiters.remove(entry)
+            heapq.heapify(self._waiters)
+            return False
+
+    def _timed_out(self, level, timeout):
+        return Overloaded(
+            f"no {self.name} slot came free within {timeout:.1f}s", self.estimated_wait(level) or timeout
+        )
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Shared pool that runs upstream attempts, so the caller can stop waiting on them"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=settings.UPSTREAM_POOL_SIZE, thread_name_prefix="upstream")
+        return _pool
+
+
+class Upstream:
+    """One remote API with its own timeout, latency window, breaker, concurrency slots and counters"""
+    COUNTERS = ('calls', 'failures', 'timeouts', 'short_circuits', 'shed', 'hedges', 'hedge_wins', 'fallbacks')
+
+    def __init__(self, name):
+        self.name = name
+        self.latency = LatencyWindow()
+        self.breaker = CircuitBreaker()
+        self.limiter = Limiter(name)
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self._lock = threading.Lock()
+
+    def count(self, counter):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = {**self.counters, 'state': self.breaker.state}
+        return {**stats, 'in_flight': self.limiter.active, 'queued': self.limiter.queued()}
+
+    def call(self, fn, *args, hedge=True, ignore=(), **kwargs):
+        """
+        Return fn(*args, timeout=..., **kwargs), run under the breaker and the deadline.
+
+        ``timeout`` is the seconds the attempt may take. Exceptions listed in
+        ``ignore`` are regular answers (e.g. sr.UnknownValueError) and don't
+        count against the breaker. Raises Overloaded, CircuitOpenError,
+        DeadlineExceeded or the error of the last failed attempt.
+        """
+        timeout = self._begin()
+        start = time.monotonic()
+        end = start + timeout
+        hedge_at = self._hedge_at(start) if hedge else None
+        pool = get_pool()
+        primary = self._hold(pool.submit(fn, *args, timeout=timeout, **kwargs))
+        pending = {primary}
+        error = None
+        while pending:
+            now = time.monotonic()
+            wake = end if hedge_at is None else min(end, hedge_at)
+            done, pending = wait(pending, timeout=max(0.0, wake - now), return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except ignore:
+                    self._succeeded(start, future is not primary)
+                    raise
+                except Exception as e:
+                    error = e
+                    continue
+                self._succeeded(start, future is not primary)
+                return result
+            if time.monotonic() >= end:
+                break
+            if hedge_at is not None and time.monotonic() >= hedge_at:
+                hedge_at = None
+                # A hedge only uses a spare slot, so hedging stops under load
+                if pending and self.limiter.try_acquire():
+                    self.count('hedges')
+                    pending.add(self._hold(pool.submit(fn, *args, timeout=end - time.monotonic(), **kwargs)))
+        return self._failed(error, pending, timeout)
+
+    async def acall(self, fn, *args, hedge=True, ignore=(), **kwargs):
+        """call() for coroutine functions; attempts still running at the end are cancelled"""
+        timeout = await self._abegin()
+        start = time.monotonic()
+        end = start + timeout
+        hedge_at = self._hedge_at(start) if hedge else None
+        primary = self._hold(asyncio.ensure_future(fn(*args, timeout=timeout, **kwargs)))
+        pending = {primary}
+        error = None
+        try:
+            while pending:
+                now = time.monotonic()
+                wake = end if hedge_at is None else min(end, hedge_at)
+                done, pending = await asyncio.wait(
+                    pending, timeout=max(0.0, wake - now), return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    try:
+                        result = task.result()
+                    except ignore:
+                        self._succeeded(start, task is not primary)
+                        raise
+                    except Exception as e:
+                        error = e
+                        continue
+                    self._succeeded(start, task is not primary)
+                    return result
+                if time.monotonic() >= end:
+                    break
+                if hedge_at is not None and time.monotonic() >= hedge_at:
+                    hedge_at = None
+                    if pending and self.limiter.try_acquire():
+                        self.count('hedges')
+                        pending.add(self._hold(
+                            asyncio.ensure_future(fn(*args, timeout=end - time.monotonic(), **kwargs))
+                        ))
+            return self._failed(error, pending, timeout)
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def _begin(self):
+        """Take a slot, then check the deadline and the breaker; return the timeout of this call"""
+        try:
+            waited = self.limiter.acquire(self._budget())
+        except Overloaded:
+            self.count('shed')
+            raise
+        return self._admit(waited)
+
+    async def _abegin(self):
+        """_begin() that waits for the slot on the event loop"""
+        try:
+            waited = await self.limiter.aacquire(self._budget())
+        except Overloaded:
+            self.count('shed')
+            raise
+        return self._admit(waited)
+
+    def _budget(self):
+        """Seconds the call may wait for a slot: what is left of the deadline"""
+        left = remaining()
+        if left is not None and left <= 0:
+            self.count('timeouts')
+            raise DeadlineExceeded(f"no time left to call {self.name}")
+        return settings.UPSTREAM_DEADLINE if left is None else left
+
+    def _admit(self, waited):
+        """Check the deadline and the breaker for a call holding a slot; return its timeout"""
+        queue_wait_seconds.observe(self.name, waited)
+        timeout = settings.UPSTREAM_TIMEOUTS[self.name]
+        left = remaining()
+        try:
+            if left is not None:
+                if left <= 0:
+                    self.count('timeouts')
+                    raise DeadlineExceeded(f"no time left to call {self.name}")
+                timeout = min(timeout, left)
+            # Checked last: a half-open breaker expects the call it allows to happen
+            if not self.breaker.allow():
+                self.count('short_circuits')
+                raise CircuitOpenError(f"{self.name} circuit is open")
+        except UpstreamError:
+            self.limiter.release()
+            raise
+        self.count('calls')
+        return timeout
+
+    def _hold(self, attempt):
+        """Give the slot back once ``attempt`` (a future or task) has finished"""
+        started = time.monotonic()
+        attempt.add_done_callback(lambda _: self.limiter.release(time.monotonic() - started))
+        return attempt
+
+    def _hedge_at(self, start):
+        """When to send a hedge for a call started at ``start``, or None"""
+        if settings.UPSTREAM_HEDGE_PERCENTILE is None:
+            return None
+        with self._lock:
+            if self.counters['hedges'] >= settings.UPSTREAM_HEDGE_MAX_RATIO * self.counters['calls']:
+                return None
+        delay = self.latency.percentile(settings.UPSTREAM_HEDGE_PERCENTILE, settings.UPSTREAM_HEDGE_MIN_SAMPLES)
+        return None if delay is None else start + delay
+
+    def _succeeded(self, start, hedged):
+        self.latency.add(time.monotonic() - start)
+        self.breaker.record_success()
+        if hedged:
+            self.count('hedge_wins')
+
+    def _failed(self, error, pending, timeout):
+        self.count('failures')
+        if self.breaker.record_failure():
+            logger.warning(f"Circuit for {self.name} opened after {self.breaker.failures} failures")
+        if pending or error is None:
+            self.count('timeouts')
+            raise DeadlineExceeded(f"{self.name} did not answer within {timeout:.1f}s")
+        raise error
+
+
+stt = Upstream('stt')
+llm = Upstream('llm')
+tts = Upstream('tts')
+UPSTREAMS = {upstream.name: upstream for upstream in (stt, llm, tts)}
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Return the worker-wide requests session that keeps connections to the APIs alive"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=4, pool_maxsize=settings.UPSTREAM_POOL_SIZE
+            )
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+def recognize_google(audio_data, language, endpoint=None, timeout=None):
+    """
+    sr.Recognizer.recognize_google(with_confidence=True) over the pooled session.
+
+    Returns (text, confidence), see parse_google, and raises
+    sr.UnknownValueError or sr.RequestError like the original. The request builder and parser aren't
+    public API, hence the pinned SpeechRecognition version.
+    """
+    import requests
+    from speech_recognition.recognizers.google import ENDPOINT, create_request_builder
+
+    request = create_request_builder(endpoint=endpoint or ENDPOINT, language=language, filter_level=0).build(audio_data)
+    try:
+        response = get_session().post(
+            request.full_url, data=request.data, headers=dict(request.header_items()), timeout=timeout
+        )
+        response.raise_for_status()
+    except requests.HTTPError as e:
+        raise sr.RequestError(f"recognition request failed: {e.response.reason}")
+    except requests.RequestException as e:
+        # The message of requests' exceptions repeats the URL, API key included
+        raise sr.RequestError(f"recognition connection failed: {type(e).__name__}")
+    return parse_google(response.text)
+
+
+def parse_google(response_text):
+    """
+    (text, confidence) of a Google Web Speech response, as recognize_google
+    parses it, except that confidence is None when Google didn't send one:
+    SpeechRecognition reports 0.5 then, which reads as an unsure answer.
+    """
+    from speech_recognition.recognizers.google import OutputParser
+    best = OutputParser.find_best_hypothesis(OutputParser.convert_to_result(response_text)["alternative"])
+    return best["transcript"], best.get("confidence")
+
+
+# gTTS answers with base64 MP3 inside a batchexecute envelope
+_GTTS_AUDIO = re.compile(r'jQ1olc","\[\\"(.*)\\"]')
+
+
+def gtts_audio(text):
+    """Extract the MP3 bytes from a gTTS API response body"""
+    import gtts
+    audio = bytearray()
+    for line in text.splitlines():
+        if "jQ1olc" in line:
+            match = _GTTS_AUDIO.search(line)
+            if not match:
+                raise gtts.gTTSError("TTS response had no audio")
+            audio += base64.b64decode(match.group(1).encode("ascii"))
+    return bytes(audio)
+
+
+def synthesize(tts, timeout=None):
+    """
+    Return the MP3 bytes for a gTTS-like object.
+
+    Real gTTS objects are sent over the pooled session; anything else (the
+    benchmark stand-ins) is asked to write_to_fp(). _prepare_requests() and
+    the response format aren't public API, hence the pinned gTTS version.
+    """
+    import gtts
+    import requests
+    # gtts.tts.gTTS is the real class even when gtts.gTTS was swapped for a stand-in
+    if not isinstance(tts, gtts.tts.gTTS):
+        buffer = io.BytesIO()
+        tts.write_to_fp(buffer)
+        return buffer.getvalue()
+
+    audio = b''
+    for prepared in tts._prepare_requests():
+        try:
+            response = get_session().send(prepared, timeout=timeout)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            raise gtts.gTTSError(f"TTS request failed: {e}")
+        audio += gtts_audio(response.text)
+    return audio
@@ -1,6 +1,7 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import AudioFileViewSet, AIProcessViewSet, RawAudioUploadViewSet
+from .views import AudioFileViewSet, AIProcessViewSet, RawAudioUploadViewSet, metrics
+from . import async_views
 
 router = DefaultRouter()
 router.register(r'audio', RawAudioUploadViewSet, basename='raw-audio')
@@ -8,5 +9,9 @@ router.register(r'audio/multipart', AudioFileViewSet)
 router.register(r'audio/ai-process', AIProcessViewSet, basename='ai-process')
 
 urlpatterns = [
+    path('metrics/', metrics, name='metrics'),
+    # Async variants of the device endpoints, for ASGI deployments
+    path('async/audio/', async_views.upload_audio, name='async-audio-upload'),
+    path('async/audio/ai-process/<uuid:pk>/', async_views.ai_process, name='async-ai-process'),
     path('', include(router.urls)),
 ]
\ No newline at end of file
@@ -1,74 +1,263 @@
-import os
-import requests
+import json
+import time
 import logging
+from datetime import datetime
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.parsers import FileUploadParser
 from rest_framework.response import Response
 from .models import AudioFile, AIHandler
-from .serializers import AudioFileSerializer, AudioTranscriptionResultSerializer, AIProcessSerializer
-from .audio_processor import AudioProcessor
-from .speech_generator import SpeechProcessor
+from .serializers import (
+    AudioFileSerializer, AudioFileListSerializer, AudioTranscriptionResultSerializer,
+    AIProcessSerializer, AIHandlerListSerializer,
+)
+from .pagination import HistoryPagination
+from .services import VoicePipeline, VoicePipelineError
+from .jobs import get_queue
+from .storage import UPLOADS, media_storage, get_sweeper
+from .streaming import StreamingTranscriber
+from .audio_codecs import EXTENSIONS, negotiate, probe_file, supported_content_types
+from .tts_formats import (
+    OUTPUT_FORMATS, UnsupportedFormatError, available_formats, content_type, requested_format, variant,
+)
+from .metrics import StageTimer, observe_stages, render_metrics
+from . import admission, upstream
 import uuid
 from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+from django.views.decorators.http import require_GET
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 
 logger = logging.getLogger(__name__)
 
+
+def iter_request_body(request, chunk_size=8192):
+    """
+    Yield the raw request body in chunks without buffering it all.
+
+    Django only reads as far as Content-Length, which a chunked upload
+    doesn't have, so such a body is read from wsgi.input directly when the
+    server de-chunks it and marks its end (wsgi.input_terminated, as
+    gunicorn and mod_wsgi do).
+    """
+    stream = request.stream
+    meta = request.META
+    if (meta.get("HTTP_TRANSFER_ENCODING", "").lower() == "chunked" and not meta.get("CONTENT_LENGTH")
+            and meta.get("wsgi.input_terminated")):
+        stream = meta["wsgi.input"]
+    if stream is None:
+        return
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def device_id_from(request):
+    """The uploading device as reported in the X-Device-Id header, if any"""
+    device_id = request.headers.get("X-Device-Id", "").strip()
+    return device_id[:64] or None
+
+
+def rejected(error):
+    """The 429 or 503 for an error from admission.admit()"""
+    body, code, headers = admission.rejection(error)
+    return Response(body, status=code, headers=headers)
+
+
+def unsupported_upload(content_type):
+    """Body and headers of the 415 for an upload Content-Type this server can't decode"""
+    supported = supported_content_types()
+    return (
+        {"error": f"Unsupported Content-Type: {content_type or 'none'}", "supported": supported},
+        {"Accept-Post": ", ".join(supported)},
+    )
+
+
+def unsupported_format(error):
+    """Body of the 406 for a response audio format this server can't produce"""
+    return {"error": str(error), "supported": available_formats()}
+
+
+def generation_failed(audio_file, handler):
+    """Body of the 502 for a transcribed upload whose AI response couldn't be generated"""
+    return {
+        "error": handler.error_message or "Response generation failed",
+        "response_id": str(audio_file.pk),
+        "request_text": audio_file.transcription,
+    }
+
+
+def format_fields(audio_format):
+    """AudioFile fields for the AudioFormat read from an upload's header"""
+    if audio_format is None:
+        return {}
+    return {
+        "codec": audio_format.codec,
+        "sample_rate": audio_format.sample_rate,
+        "channels": audio_format.channels,
+        "duration_ms": audio_format.duration_ms,
+    }
+
+
+def inline_job_fields():
+    """
+    AudioFile fields for an upload transcribed within its own request:
+    running and claimed, so TranscriptionQueue workers don't pick it up
+    too (and recover() requeues it if this process dies before saving)
+    """
+    return {"status": AudioFile.STATUS_RUNNING, "claimed_at": timezone.now()}
+
+
+def parse_bool(name, value):
+    if value.lower() in ("1", "true"):
+        return True
+    if value.lower() in ("0", "false"):
+        return False
+    raise ValidationError({name: "Expected true or false"})
+
+
+def parse_timestamp(name, value):
+    """Parse an ISO 8601 date or datetime; naive values are in the server time zone"""
+    parsed = parse_datetime(value)
+    if parsed is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValidationError({name: "Expected an ISO 8601 date or datetime"})
+        parsed = datetime.combine(day, datetime.min.time())
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+class HistoryFilterMixin:
+    """
+    Query-string filters for the history listings.
+
+    ?created_after= / ?created_before= bound created_at, ?device= matches
+    the uploading device, and each name in ``boolean_filters`` takes
+    true/false. Every filter lines up with a composite index that ends in
+    (created_at, id), so filtered pages stay index range scans.
+    """
+    boolean_filters = {}
+    device_field = 'device_id'
+
+    def filter_history(self, queryset):
+        params = self.request.query_params
+        for name, field in self.boolean_filters.items():
+            if name in params:
+                queryset = queryset.filter(**{field: parse_bool(name, params[name])})
+        if params.get('device'):
+            queryset = queryset.filter(**{self.device_field: params['device']})
+        if params.get('created_after'):
+            queryset = queryset.filter(created_at__gte=parse_timestamp('created_after', params['created_after']))
+        if params.get('created_before'):
+            queryset = queryset.filter(created_at__lt=parse_timestamp('created_before', params['created_before']))
+        return queryset
+
+
 # Create your views here.
 class RawAudioUploadViewSet(viewsets.ViewSet):
-    """ViewSet for handling raw WAV uploads from ESP32 with chunked encoding"""
-    parser_classes = [FileParser]  # Use FileParser for raw data
+    """ViewSet for handling raw audio uploads from ESP32 with chunked encoding"""
+    parser_classes = [FileUploadParser]  # Body is read straight from request.stream
+    # Only match UUIDs so the detail route doesn't shadow audio/multipart/
+    lookup_value_regex = '[0-9a-fA-F-]{36}'
 
-    @action(detail=False, methods=['post'], url_path='')
     def create(self, request):
-        """Handle POST requests with raw audio/wav data"""
-        if request.content_type != "audio/wav":
-            logger.error(f"Invalid Content-Type: {request.content_type}")
-            return Response(
-                {"error": "Expected Content-Type: audio/wav"},
-                status=status.HTTP_400_BAD_REQUEST
-            )
+        """
+        Handle POST requests with raw audio data.
+
+        The Content-Type picks the decoder: audio/wav (PCM or IMA-ADPCM),
+        audio/flac, or audio/ogg;codecs=opus where opuslib is installed.
+        Anything else gets a 415 listing what this server accepts.
+
+        By default the upload is queued and a 202 is returned. With ?stream=1
+        the audio is transcribed segment by segment while it arrives and the
+        transcription is returned directly with a 201.
+        """
+        container = negotiate(request.content_type)
+        if container is None:
+            logger.error(f"Unsupported Content-Type: {request.content_type}")
+            body, headers = unsupported_upload(request.content_type)
+            return Response(body, status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, headers=headers)
 
+        streaming = request.query_params.get("stream") in ("1", "true")
         try:
-            # Ensure audio_files directory exists
-            upload_dir = settings.AUDIO_FOLDER
-            os.makedirs(upload_dir, exist_ok=True)
+            # A queued upload is transcribed later, so only a streamed one needs STT now
+            admission.admit(device_id_from(request), ('stt',) if streaming else ())
+        except admission.REJECTIONS as e:
+            return rejected(e)
 
-            # Generate filename with timestamp
+        try:
+            # Generate filename with timestamp, suffixed so concurrent uploads don't collide
             timestamp = str(int(time.time()))
-            filename = f"recording_{timestamp}.wav"
-            file_path = os.path.join(upload_dir, filename)
+            filename = f"recording_{timestamp}_{uuid.uuid4().hex[:8]}{EXTENSIONS[container]}"
+            name = media_storage.shard(f"{UPLOADS}/{filename}")
+            file_path = media_storage.create_path(name)
+
+            transcriber = StreamingTranscriber(container=container) if streaming else None
 
             # Stream chunked data to file
             total_bytes = 0
-            with open(file_path, "wb") as f:
-                for chunk in request.streaming_content:
+            timer = StageTimer()
+            with timer.stage("upload"), open(file_path, "wb") as f:
+                for chunk in iter_request_body(request):
                     total_bytes += len(chunk)
                     f.write(chunk)
+                    if transcriber:
+                        transcriber.feed(chunk)
 
             logger.info(f"Saved file: {filename}, Size: {total_bytes} bytes")
-
-            # Calculate duration (16 kHz, 16-bit, mono)
-            duration_sec = (total_bytes - 44) / (16000 * 2)
+            audio_format = probe_file(file_path)
 
             # Save to AudioFile model
             audio_file_instance = AudioFile.objects.create(
-                audio_file=f"audio_files/{filename}",
-                original_filename=filename
+                audio_file=name,
+                original_filename=filename,
+                device_id=device_id_from(request),
+                stage_timings=timer.stages,
+                **format_fields(audio_format),
+                # Transcribed right here rather than by the queue
+                **(inline_job_fields() if transcriber and transcriber.streaming else {})
             )
+            file_url = f"http://{request.get_host()}{settings.MEDIA_URL}{name}"
+            get_sweeper().start()
+
+            if transcriber and transcriber.streaming:
+                # Only the last segment is still being recognized at this point
+                with timer.stage("recognize_tail"):
+                    result = transcriber.finish()
+                result["timings"] = {**result.get("timings", {}), **timer.stages}
+                observe_stages(result["timings"])
+                audio_file_instance.save_transcription(result)
+                if result.get("retry_after"):
+                    return rejected(upstream.Overloaded(result["error"], result["retry_after"]))
+                return Response({
+                    "id": str(audio_file_instance.id),
+                    "status": audio_file_instance.status,
+                    "filename": filename,
+                    "url": file_url,
+                    "format": audio_format._asdict() if audio_format else None,
+                    "transcription": result.get("text") if result.get("success") else None,
+                    "transcription_error": result.get("error") if not result.get("success") else None
+                }, status=status.HTTP_201_CREATED)
 
-            # Process transcription
-            processor = AudioProcessor()
-            result = processor.convert_wav_to_text(file_path)
-            audio_file_instance.save_transcription(result)
+            # Hand it to the transcription workers
+            observe_stages(timer.stages)
+            get_queue().enqueue(audio_file_instance)
 
-            # Return response similar to Express
+            # Poll GET /api/audio/<id>/ until status is "done"
             return Response({
-                "status": "success",
+                "id": str(audio_file_instance.id),
+                "status": audio_file_instance.status,
                 "filename": filename,
-                "url": f"http://{request.get_host()}{settings.MEDIA_URL}audio_files/{filename}",
-                "transcription": result.get("text") if result.get("success") else None,
-                "transcription_error": result.get("error") if not result.get("success") else None
-            }, status=status.HTTP_201_CREATED)
+                "url": file_url,
+                "format": audio_format._asdict() if audio_format else None,
+            }, status=status.HTTP_202_ACCEPTED)
 
         except Exception as e:
             logger.error(f"Error processing upload: {str(e)}")
@@ -77,85 +266,105 @@ class RawAudioUploadViewSet(viewsets.ViewSet):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+    def retrieve(self, request, pk=None):
+        """Return the transcription job state for a previous upload"""
+        audio_file = get_object_or_404(AudioFile, pk=pk)
+        return Response(AudioTranscriptionResultSerializer(audio_file).data)
+
 
-class AudioFileViewSet(viewsets.ModelViewSet):
+class AudioFileViewSet(HistoryFilterMixin, viewsets.ModelViewSet):
     """ViewSet for handling audio file uploads and transcription"""
     
     queryset = AudioFile.objects.all()
     serializer_class = AudioFileSerializer
+    pagination_class = HistoryPagination
+    boolean_filters = {'is_processed': 'is_processed', 'is_successful': 'is_successful'}
+    
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action == 'list':
+            queryset = self.filter_history(queryset).only(*AudioFileListSerializer.Meta.fields)
+        return queryset
     
     def get_serializer_class(self):
+        if self.action == 'list':
+            return AudioFileListSerializer
         if self.action == 'retrieve' and self.request.method == 'GET':
             return AudioTranscriptionResultSerializer
         return AudioFileSerializer
     
+    def create(self, request, *args, **kwargs):
+        """Accept the upload; transcription finishes in the background"""
+        try:
+            admission.admit(device_id_from(request))
+        except admission.REJECTIONS as e:
+            return rejected(e)
+        response = super().create(request, *args, **kwargs)
+        response.status_code = status.HTTP_202_ACCEPTED
+        return response
+    
     def perform_create(self, serializer):
-        """Handle file upload and start transcription process"""
+        """Handle file upload and queue the transcription"""
         audio_file = self.request.FILES.get('audio_file')
         original_filename = audio_file.name if audio_file else None
         
         # Save the AudioFile instance
-        instance = serializer.save(original_filename=original_filename)
-        
-        # Initialize the audio processor
-        processor = AudioProcessor()
+        instance = serializer.save(original_filename=original_filename, device_id=device_id_from(self.request))
         
-        # Get the file path
-        file_path = instance.get_file_path()
-        
-        # Process the audio file
-        if file_path and os.path.exists(file_path):
-            result = processor.convert_wav_to_text(file_path)
-            instance.save_transcription(result)
+        # Transcription runs on the worker pool, clients poll the status field
+        get_queue().enqueue(instance)
+
+class AIProcessViewSet(HistoryFilterMixin, viewsets.ViewSet):
+    boolean_filters = {'is_successful': 'processed'}
+    device_field = 'audio_source__device_id'
+
+    def list(self, request):
+        """Response history, newest first, in keyset-paginated pages"""
+        queryset = self.filter_history(AIHandler.objects.only(*AIHandlerListSerializer.Meta.fields))
+        paginator = HistoryPagination()
+        page = paginator.paginate_queryset(queryset, request, view=self)
+        serializer = AIHandlerListSerializer(page, many=True, context={'request': request})
+        return paginator.get_paginated_response(serializer.data)
 
-class AIProcessViewSet(viewsets.ViewSet):
     def retrieve(self, request, pk=None):
+        """
+        Answer a transcribed upload. The audio comes in the format asked for
+        with ?audio_format= or X-Audio-Format (see api/tts_formats.py).
+        """
+        try:
+            audio_format = requested_format(request)
+        except UnsupportedFormatError as e:
+            return Response(unsupported_format(e), status=status.HTTP_406_NOT_ACCEPTABLE)
+
         try:
             # Validate UUID
             uuid_obj = uuid.UUID(pk)
 
-            # Fetch JSON from /api/audio/<uuid>/
-            audio_api_url = f"http://127.0.0.1:8000/api/audio/{pk}/"
-            response = requests.get(audio_api_url)
-
-            if response.status_code != 200:
-                return Response({
-                    'error': 'Failed to fetch transcription data'
-                }, status=status.HTTP_400_BAD_REQUEST)
-
-            data = response.json()
-            transcription = data.get('transcription')
-            is_successful = data.get('is_successful')
-            created_at = data.get('created_at')
-            error_message = data.get('error_message')
-
-            # Check if transcription is successful and available
-            if not is_successful or transcription is None:
-                return Response({
-                    'error': 'Transcription failed or unavailable',
-                    'error_message': error_message or 'No transcription provided',
-                    'response_id': str(uuid_obj),
-                    'created_at': created_at
-                }, status=status.HTTP_400_BAD_REQUEST)
-
-            if not created_at:
-                return Response({
-                    'error': 'No created_at found in response'
-                }, status=status.HTTP_400_BAD_REQUEST)
+            # Transcription lookup, LLM and TTS all run in-process
+            pipeline = VoicePipeline()
+            audio_file = pipeline.get_transcription(uuid_obj)
+            admission.admit(device_id_from(request), pipeline.upstreams(audio_file))
+            handler = pipeline.respond(audio_file)
+            if not handler.processed:
+                # The LLM or TTS failed; say why instead of an empty answer
+                return Response(generation_failed(audio_file, handler), status=status.HTTP_502_BAD_GATEWAY)
 
-            # Process transcription
-            processor = SpeechProcessor()
-            response_text = processor.process_text(transcription)
-            audio_path = processor.generate_speech(response_text)
+            audio_path = handler.audio_file.name if handler.audio_file else None
+            if audio_path:
+                # Transcoded on the first request for this format, a stored file afterwards
+                audio_path = variant(audio_path, audio_format)
 
             # Prepare response data
             response_data = {
                 'response_id': uuid_obj,
-                'request_text': transcription,
-                'response_text': response_text,
+                'request_text': audio_file.transcription,
+                'response_text': handler.response_text,
                 'audio_link': request.build_absolute_uri(f"{settings.MEDIA_URL}{audio_path}") if audio_path else None,
+                'audio_format': audio_format,
+                'intent': handler.intent,
+                'action': handler.action,
                 'is_successful': bool(audio_path),
-                'created_at': created_at
+                'created_at': audio_file.created_at
             }
 
             # Serialize and return response
@@ -165,15 +374,82 @@ class AIProcessViewSet(viewsets.ViewSet):
             else:
                 return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+        except UnsupportedFormatError as e:
+            # The clip can't be transcoded, e.g. ffmpeg is missing
+            return Response(unsupported_format(e), status=status.HTTP_406_NOT_ACCEPTABLE)
         except ValueError:
             return Response({
                 'error': 'Invalid UUID format'
             }, status=status.HTTP_400_BAD_REQUEST)
-        except requests.RequestException as e:
+        except VoicePipelineError as e:
             return Response({
-                'error': f'Error fetching transcription: {str(e)}'
-            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+                'error': e.message,
+                **e.details
+            }, status=status.HTTP_400_BAD_REQUEST)
+        except admission.REJECTIONS as e:
+            return rejected(e)
         except Exception as e:
             return Response({
                 'error': f'Processing error: {str(e)}'
-            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
\ No newline at end of file
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    @action(detail=True, methods=['get'])
+    def stream(self, request, pk=None):
+        """
+        Stream the response one sentence at a time so playback can start
+        before the whole answer is generated.
+
+        ?transport=audio (default) sends the audio of each sentence as a
+        chunk of one body, which works for the formats without a container
+        header (mp3, pcm, ulaw). ?transport=manifest sends one JSON line per
+        sentence with its audio_link, then a final line with done=true.
+        """
+        manifest = request.query_params.get('transport') == 'manifest'
+        try:
+            audio_format = requested_format(request)
+            if not manifest and not OUTPUT_FORMATS[audio_format].streamable:
+                raise UnsupportedFormatError(f"{audio_format} clips can't be concatenated; use transport=manifest")
+        except UnsupportedFormatError as e:
+            return Response(unsupported_format(e), status=status.HTTP_406_NOT_ACCEPTABLE)
+
+        try:
+            uuid_obj = uuid.UUID(pk)
+            pipeline = VoicePipeline()
+            audio_file = pipeline.get_transcription(uuid_obj)
+            admission.admit(device_id_from(request), pipeline.upstreams(audio_file))
+        except ValueError:
+            return Response({'error': 'Invalid UUID format'}, status=status.HTTP_400_BAD_REQUEST)
+        except VoicePipelineError as e:
+            return Response({'error': e.message, **e.details}, status=status.HTTP_400_BAD_REQUEST)
+        except admission.REJECTIONS as e:
+            return rejected(e)
+
+        events = pipeline.stream_respond(audio_file, audio_format=audio_format)
+
+        if manifest:
+            def manifest():
+                for event in events:
+                    if 'audio_path' in event:
+                        event['audio_link'] = request.build_absolute_uri(f"{settings.MEDIA_URL}{event.pop('audio_path')}")
+                    yield json.dumps(event) + "\n"
+            return StreamingHttpResponse(manifest(), content_type='application/x-ndjson')
+
+        def audio():
+            for event in events:
+                if 'audio_path' in event:
+                    with open(media_storage.path(event['audio_path']), 'rb') as f:
+                        yield f.read()
+        # Concatenated MP3 frames or raw samples play as one stream
+        response = StreamingHttpResponse(audio(), content_type=content_type(audio_format))
+        # There is no JSON to carry the device action of a local intent
+        intent = pipeline.speech_processor.intents.match(audio_file.transcription)
+        if intent is not None:
+            response['X-Intent'] = intent.name
+            response['X-Intent-Action'] = json.dumps(intent.action)
+        return response
+
+
+@require_GET
+def metrics(request):
+    """Prometheus scrape endpoint: per-stage latency histograms and cache counters"""
+    return HttpResponse(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
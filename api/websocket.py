@@ -0,0 +1,322 @@
+"""
+WebSocket sessions for devices, for ASGI deployments (see
+embedded_backend/asgi.py, which routes WS_DEVICE_PATH here).
+
+Over HTTP every interaction is an upload, an AI-process request and a
+media download, each with its own connection setup and headers. A device
+can instead keep one connection open and run any number of interactions
+over it. Text messages are JSON, binary messages are audio:
+
+    server  {"type": "ready", "accept": [...], "audio_formats": [...]}
+    device  {"type": "start", "content_type": "audio/x-raw;format=S16LE;rate=16000;channels=1",
+             "audio_format": "pcm", "language": "en"}          (all optional)
+    device  <binary audio> ...                                 (any framing)
+    device  {"type": "end"}
+    server  {"type": "transcription", "id", "status", "text", "error"}
+    server  {"type": "audio", "index", "text", "content_type", "bytes"}
+    server  <binary audio> ...                                 (one sentence)
+            ... one "audio" message and its frames per sentence ...
+    server  {"type": "done", "response_id", "response_text", "is_successful", "error", "intent", "action"}
+
+content_type is raw little-endian PCM (the default) or any type the upload
+endpoint accepts. The upload goes through the same pipeline as POST
+/api/audio/?stream=1: it is stored as an AudioFile and transcribed segment
+by segment while it arrives, then answered sentence by sentence as
+GET /api/audio/ai-process/<id>/stream/ does. {"type": "cancel"} drops an
+interaction before its end; errors are reported as {"type": "error"} and
+leave the connection open. A start or response turned away by admission
+control (api/admission.py) is an error with "status" (429 or 503) and
+"retry_after" in seconds.
+"""
+import json
+import time
+import uuid
+import struct
+import asyncio
+import logging
+from urllib.parse import parse_qs
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils.http import parse_header_parameters
+from .models import AudioFile
+from .audio_processor import AudioProcessor
+from .audio_codecs import EXTENSIONS, negotiate, probe_file, supported_content_types
+from .services import VoicePipeline
+from .storage import UPLOADS, media_storage, get_sweeper
+from .streaming import StreamingTranscriber
+from .tts_formats import UnsupportedFormatError, available_formats, check_format, content_type as output_content_type
+from .metrics import StageTimer, observe_stages
+from .views import format_fields, inline_job_fields
+from . import admission
+
+logger = logging.getLogger(__name__)
+
+# Headerless 16-bit PCM, the type tts_formats uses for the pcm output format
+RAW_PCM = 'audio/x-raw'
+DEFAULT_UPLOAD_TYPE = f"{RAW_PCM};format=S16LE;rate=16000;channels=1"
+
+
+class SessionError(Exception):
+    """A message the session can't act on; reported to the device, which stays connected"""
+
+
+def pcm_wav_header(sample_rate, channels):
+    """Header of a 16-bit PCM WAV with zero sizes, which the readers take as "up to the end" """
+    return struct.pack(
+        '<4sI4s4sIHHIIHH4sI', b'RIFF', 0, b'WAVE', b'fmt ', 16, 1, channels, sample_rate,
+        sample_rate * channels * 2, channels * 2, 16, b'data', 0,
+    )
+
+
+class SessionUpload:
+    """
+    The audio of one interaction: written to storage and fed to a
+    StreamingTranscriber as it arrives. Raw PCM is stored as a WAV. The
+    methods block, so the session calls them in a thread.
+    """
+
+    def __init__(self, content_type, device_id):
+        media_type, params = parse_header_parameters(content_type)
+        self.raw = media_type.lower() == RAW_PCM
+        if self.raw:
+            if params.get('format', 'S16LE').upper() != 'S16LE':
+                raise SessionError(f"Unsupported raw PCM format: {params['format']}")
+            try:
+                sample_rate, channels = int(params.get('rate', 16000)), int(params.get('channels', 1))
+            except ValueError:
+                raise SessionError(f"Invalid raw PCM parameters: {content_type}")
+            container = 'wav'
+        else:
+            container = negotiate(content_type)
+            if container is None:
+                raise SessionError(f"Unsupported Content-Type: {content_type}")
+
+        self.device_id = device_id
+        self.filename = f"recording_{int(time.time())}_{uuid.uuid4().hex[:8]}{EXTENSIONS[container]}"
+        self.name = media_storage.shard(f"{UPLOADS}/{self.filename}")
+        self.path = media_storage.create_path(self.name)
+        self.file = open(self.path, 'wb')
+        self.size = 0
+        self.started = time.perf_counter()
+        self.transcriber = StreamingTranscriber(container=container)
+        if self.raw:
+            header = pcm_wav_header(sample_rate, channels)
+            self.file.write(header)
+            self.transcriber.feed(header)
+
+    def feed(self, data):
+        self.size += len(data)
+        if self.size > settings.WS_MAX_UPLOAD_BYTES:
+            raise SessionError(f"Upload exceeds {settings.WS_MAX_UPLOAD_BYTES} bytes")
+        self.file.write(data)
+        self.transcriber.feed(data)
+
+    def finish(self):
+        """Store the AudioFile, transcribe the rest and return the saved row"""
+        timer = StageTimer()
+        timer.stages['upload'] = time.perf_counter() - self.started
+        if self.raw:
+            # Fill in the sizes now that the length is known
+            self.file.seek(4)
+            self.file.write(struct.pack('<I', 36 + self.size))
+            self.file.seek(40)
+            self.file.write(struct.pack('<I', self.size))
+        self.file.close()
+        try:
+            audio_file = AudioFile.objects.create(
+                audio_file=self.name,
+                original_filename=self.filename,
+                device_id=self.device_id,
+                stage_timings=timer.stages,
+                **format_fields(probe_file(self.path)),
+                **inline_job_fields(),
+            )
+            get_sweeper().start()
+
+            if self.transcriber.streaming:
+                with timer.stage('recognize_tail'):
+                    result = self.transcriber.finish()
+            else:
+                # Not mono, or a header the streaming path can't read
+                result = AudioProcessor().convert_wav_to_text(self.path)
+            result['timings'] = {**result.get('timings', {}), **timer.stages}
+            observe_stages(result['timings'])
+            # The session answers on its own right after this
+            audio_file.save_transcription(result, eager=False)
+            return audio_file
+        finally:
+            close_old_connections()
+
+    def discard(self):
+        self.file.close()
+        try:
+            media_storage.delete(self.name)
+        except OSError:
+            pass
+
+
+async def iterate_in_thread(iterator):
+    """Run a blocking iterator in a worker thread and yield its items on the event loop"""
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    finished = object()
+
+    def run():
+        try:
+            for item in iterator:
+                loop.call_soon_threadsafe(queue.put_nowait, (item, None))
+            loop.call_soon_threadsafe(queue.put_nowait, (finished, None))
+        except BaseException as e:
+            loop.call_soon_threadsafe(queue.put_nowait, (None, e))
+        finally:
+            close_old_connections()
+
+    worker = loop.run_in_executor(None, run)
+    try:
+        while True:
+            item, error = await queue.get()
+            if error is not None:
+                raise error
+            if item is finished:
+                return
+            yield item
+    finally:
+        await worker
+
+
+class DeviceSession:
+    """One device connection; see the module docstring for the protocol"""
+
+    def __init__(self, scope, receive, send):
+        self.scope = scope
+        self.receive = receive
+        self.send = send
+        query = parse_qs(scope.get('query_string', b'').decode())
+        headers = {name.decode().lower(): value.decode() for name, value in scope.get('headers', [])}
+        device_id = (query.get('device_id', [''])[0] or headers.get('x-device-id', '')).strip()
+        self.device_id = device_id[:64] or None
+        self.upload = None
+        self.audio_format = settings.TTS_DEFAULT_FORMAT
+        self.language = 'en'
+
+    async def run(self):
+        message = await self.receive()
+        if message['type'] != 'websocket.connect':
+            return
+        await self.send({'type': 'websocket.accept'})
+        await self.send_json({
+            'type': 'ready',
+            'accept': [DEFAULT_UPLOAD_TYPE, *supported_content_types()],
+            'audio_formats': available_formats(),
+        })
+        try:
+            while True:
+                message = await self.receive()
+                if message['type'] == 'websocket.disconnect':
+                    break
+                try:
+                    if message.get('bytes') is not None:
+                        await self.on_audio(message['bytes'])
+                    elif message.get('text') is not None:
+                        await self.on_command(message['text'])
+                except SessionError as e:
+                    await self.send_json({'type': 'error', 'error': str(e)})
+                except admission.REJECTIONS as e:
+                    body, code, _ = admission.rejection(e)
+                    await self.send_json({'type': 'error', 'status': code, **body})
+                except Exception as e:
+                    logger.error(f"Device session error: {e}")
+                    await self.send_json({'type': 'error', 'error': f"Processing error: {e}"})
+        finally:
+            if self.upload is not None:
+                await asyncio.to_thread(self.upload.discard)
+
+    async def send_json(self, data):
+        await self.send({'type': 'websocket.send', 'text': json.dumps(data, default=str)})
+
+    async def on_audio(self, data):
+        if self.upload is None:
+            raise SessionError('Send {"type": "start"} before audio')
+        try:
+            await asyncio.to_thread(self.upload.feed, data)
+        except SessionError:
+            await asyncio.to_thread(self.upload.discard)
+            self.upload = None
+            raise
+
+    async def on_command(self, text):
+        try:
+            command = json.loads(text)
+            kind = command['type']
+        except (ValueError, TypeError, KeyError):
+            raise SessionError('Expected a JSON object with a "type"')
+
+        if kind == 'start':
+            if self.upload is not None:
+                raise SessionError('An interaction is already in progress; send end or cancel first')
+            audio_format = str(command.get('audio_format') or settings.TTS_DEFAULT_FORMAT).strip().lower()
+            try:
+                check_format(audio_format)
+            except UnsupportedFormatError as e:
+                raise SessionError(str(e))
+            admission.admit(self.device_id, ('stt',))
+            self.audio_format = audio_format
+            self.language = command.get('language') or 'en'
+            self.upload = await asyncio.to_thread(
+                SessionUpload, command.get('content_type') or DEFAULT_UPLOAD_TYPE, self.device_id
+            )
+        elif kind == 'end':
+            if self.upload is None:
+                raise SessionError('No interaction in progress')
+            upload, self.upload = self.upload, None
+            await self.respond(await asyncio.to_thread(upload.finish))
+        elif kind == 'cancel':
+            if self.upload is not None:
+                upload, self.upload = self.upload, None
+                await asyncio.to_thread(upload.discard)
+        else:
+            raise SessionError(f"Unknown message type: {kind}")
+
+    async def respond(self, audio_file):
+        """Send the transcription, then the answer sentence by sentence as its audio is ready"""
+        await self.send_json({
+            'type': 'transcription',
+            'id': str(audio_file.pk),
+            'status': audio_file.status,
+            'text': audio_file.transcription if audio_file.is_successful else None,
+            'error': audio_file.error_message if not audio_file.is_successful else None,
+        })
+        if not audio_file.is_successful:
+            return
+
+        pipeline = VoicePipeline()
+        admission.admit(self.device_id, pipeline.upstreams(audio_file))
+        events = pipeline.stream_respond(audio_file, self.language, self.audio_format)
+        async for event in iterate_in_thread(events):
+            if event.get('done'):
+                event.pop('done')
+                await self.send_json({'type': 'done', **event})
+                continue
+            data = await asyncio.to_thread(read_media, event['audio_path'])
+            await self.send_json({
+                'type': 'audio', 'index': event['index'], 'text': event['text'],
+                'content_type': output_content_type(self.audio_format), 'bytes': len(data),
+            })
+            frame = settings.WS_AUDIO_FRAME_BYTES
+            for offset in range(0, len(data), frame):
+                await self.send({'type': 'websocket.send', 'bytes': data[offset:offset + frame]})
+
+
+def read_media(name):
+    with open(media_storage.path(name), 'rb') as f:
+        return f.read()
+
+
+async def websocket_application(scope, receive, send):
+    """ASGI entry point for websocket scopes; only WS_DEVICE_PATH is served"""
+    if scope['path'] != settings.WS_DEVICE_PATH:
+        # Closing before accepting rejects the handshake with a 403
+        await receive()
+        await send({'type': 'websocket.close'})
+        return
+    await DeviceSession(scope, receive, send).run()
@@ -0,0 +1,156 @@
+"""
+LLM calls during a surge, with and without admission control
+(api/admission.py and the upstream concurrency slots in api/upstream.py).
+
+The upstream is a simulated API with --capacity workers: up to that many
+calls take --service seconds, more share the workers and all of them slow
+down, and past --quota calls in flight it answers 429 at once. Device
+requests arrive at --surge times what it can serve, each with the
+--deadline budget of a view, while --batch workers keep backlog calls
+going at the same time. Modes:
+
+  none        no concurrency limit (ADMISSION_CONCURRENCY None)
+  fifo        --capacity slots, batch calls queued like device requests
+  priority    --capacity slots, device requests ahead of batch calls
+
+"ok" counts device requests answered, "shed" those turned away up front
+with a 503, "failed" those that reached the API and failed (429, timeout,
+open circuit). Latency percentiles are over answered requests.
+
+    python -m benchmarks.admission [--seconds 6] [--capacity 8] [--surge 2]
+"""
+import time
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .common import setup_django, percentile
+
+
+class CongestedAPI:
+    """Processor-sharing model of a remote API with a fixed number of workers and an in-flight quota"""
+
+    def __init__(self, capacity, service, quota):
+        self.capacity = capacity
+        self.service = service
+        self.quota = quota
+        self.in_flight = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, prompt, timeout):
+        with self._lock:
+            if self.in_flight >= self.quota:
+                self.rejected += 1
+                raise RuntimeError("429 Resource has been exhausted")
+            self.in_flight += 1
+        try:
+            work = self.service
+            deadline = time.monotonic() + timeout
+            while work > 0:
+                if time.monotonic() > deadline:
+                    raise TimeoutError("read timed out")
+                time.sleep(0.01)
+                work -= 0.01 * min(1.0, self.capacity / self.in_flight)
+            return prompt
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+def run(mode, args):
+    from django.conf import settings
+    from api import admission, upstream
+
+    settings.ADMISSION_CONCURRENCY = {'stt': None, 'llm': None if mode == 'none' else args.capacity, 'tts': None}
+    llm = upstream.UPSTREAMS['llm'] = upstream.Upstream('llm')
+    api = CongestedAPI(args.capacity, args.service, args.quota)
+    batch_level = upstream.BATCH if mode == 'priority' else upstream.INTERACTIVE
+    stop = threading.Event()
+    batch_done = [0]
+
+    def device_request(i):
+        start = time.monotonic()
+        try:
+            admission.admit(f"device{i}", ('llm',))
+        except admission.REJECTIONS:
+            return 'shed', time.monotonic() - start
+        try:
+            with upstream.deadline(args.deadline):
+                llm.call(api, f"request {i}")
+        except upstream.Overloaded:
+            return 'shed', time.monotonic() - start
+        except Exception:
+            return 'failed', time.monotonic() - start
+        return 'ok', time.monotonic() - start
+
+    def batch_worker():
+        with upstream.priority(batch_level):
+            while not stop.is_set():
+                try:
+                    with upstream.deadline(args.deadline):
+                        llm.call(api, "backlog")
+                    batch_done[0] += 1
+                except upstream.Overloaded as e:
+                    stop.wait(e.retry_after)
+                except Exception:
+                    stop.wait(0.1)
+
+    batch = [threading.Thread(target=batch_worker, daemon=True) for _ in range(args.batch)]
+    for thread in batch:
+        thread.start()
+
+    rate = args.surge * args.capacity / args.service
+    rng = random.Random(1)
+    futures = []
+    with ThreadPoolExecutor(max_workers=512) as pool:
+        end = time.monotonic() + args.seconds
+        i = 0
+        while time.monotonic() < end:
+            futures.append(pool.submit(device_request, i))
+            i += 1
+            time.sleep(rng.expovariate(rate))
+        results = [future.result() for future in futures]
+    stop.set()
+    for thread in batch:
+        thread.join()
+    return results, batch_done[0], api.rejected, llm.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=float, default=6.0, help="Length of the surge")
+    parser.add_argument('--capacity', type=int, default=8, help="Calls the API serves at full speed")
+    parser.add_argument('--service', type=float, default=0.5, help="Seconds per call at full speed")
+    parser.add_argument('--quota', type=int, default=24, help="Calls in flight before the API answers 429")
+    parser.add_argument('--surge', type=float, default=2.0, help="Arrival rate as a multiple of what the API serves")
+    parser.add_argument('--batch', type=int, default=4, help="Backlog workers running alongside")
+    parser.add_argument('--deadline', type=float, default=3.0, help="UPSTREAM_DEADLINE of each request")
+    args = parser.parse_args()
+
+    setup_django()
+    from django.conf import settings
+    settings.UPSTREAM_DEADLINE = args.deadline
+    settings.UPSTREAM_TIMEOUTS = {**settings.UPSTREAM_TIMEOUTS, 'llm': args.deadline}
+    settings.UPSTREAM_HEDGE_PERCENTILE = None
+    settings.UPSTREAM_POOL_SIZE = 128
+    settings.ADMISSION_DEVICE_RATE = 0
+
+    print(f"{args.surge:.1f}x surge for {args.seconds:.0f}s: API of {args.capacity} workers x {args.service}s, "
+          f"429 past {args.quota} in flight, {args.deadline:.0f}s deadline, {args.batch} batch workers")
+    print(f"{'mode':9} {'requests':>8} {'ok':>5} {'shed':>5} {'failed':>6} {'p50 ms':>7} {'p95 ms':>7} "
+          f"{'shed p95':>8} {'api 429':>7} {'batch':>6}")
+    for mode in ('none', 'fifo', 'priority'):
+        results, batch_done, rejected, stats = run(mode, args)
+        ok = [latency * 1000 for outcome, latency in results if outcome == 'ok']
+        shed = [latency * 1000 for outcome, latency in results if outcome == 'shed']
+        failed = sum(1 for outcome, _ in results if outcome == 'failed')
+        print(f"{mode:9} {len(results):8} {len(ok):5} {len(shed):5} {failed:6} "
+              f"{percentile(ok, 50) if ok else 0:7.0f} {percentile(ok, 95) if ok else 0:7.0f} "
+              f"{percentile(shed, 95) if shed else 0:8.0f} {rejected:7} {batch_done:6}")
+        # Let the calls abandoned at the deadline finish before the next mode
+        time.sleep(args.deadline)
+
+
+if __name__ == '__main__':
+    main()
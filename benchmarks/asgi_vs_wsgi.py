@@ -0,0 +1,164 @@
+"""
+Throughput of the AI-process endpoint under WSGI and ASGI, with the
+remote APIs replaced by the local fakes in fake_services.
+
+Three setups answer the same requests, called in-process with no HTTP
+server in front:
+
+  wsgi        the DRF view on the WSGI app, in a pool of --wsgi-threads
+              threads (like gunicorn --threads)
+  asgi sync   the same DRF view on the ASGI app; Django runs sync views
+              in a thread, so requests still queue for threads
+  asgi async  /api/async/audio/ai-process/ on the ASGI app, one event loop
+
+    python -m benchmarks.asgi_vs_wsgi [--levels 16,64,256] [--wsgi-threads 32]
+"""
+import io
+import sys
+import time
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from .common import setup_django, percentile
+from .fake_services import FakeServices, ServiceProfile, install
+
+HOST = ('127.0.0.1', 8000)
+
+
+def seed(count, tag):
+    """Transcribed uploads with distinct questions, so every request misses the LLM cache"""
+    from api.models import AudioFile
+    files = [
+        AudioFile(
+            audio_file=f"audio_files/{tag}_{i}.wav", original_filename=f"{tag}_{i}.wav",
+            transcription=f"{tag} question number {i}", is_processed=True, is_successful=True,
+            status=AudioFile.STATUS_DONE,
+        )
+        for i in range(count)
+    ]
+    AudioFile.objects.bulk_create(files)
+    return [str(audio_file.pk) for audio_file in files]
+
+
+def wsgi_call(application, path):
+    environ = {
+        'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': '', 'SERVER_NAME': HOST[0],
+        'SERVER_PORT': str(HOST[1]), 'HTTP_HOST': '%s:%d' % HOST, 'wsgi.input': io.BytesIO(),
+        'wsgi.url_scheme': 'http', 'wsgi.errors': sys.stderr,
+    }
+    status = []
+    body = b''.join(application(environ, lambda s, headers: status.append(s)))
+    return int(status[0].split()[0]), body
+
+
+async def asgi_call(application, path):
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+        'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': b'',
+        'headers': [(b'host', b'%s:%d' % (HOST[0].encode(), HOST[1]))], 'server': HOST,
+        'client': ('127.0.0.1', 50000),
+    }
+    sent = False
+    disconnect = asyncio.Event()
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        # The client stays connected until the response is complete
+        await disconnect.wait()
+        return {'type': 'http.disconnect'}
+
+    status = []
+    chunks = []
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            status.append(message['status'])
+        elif message['type'] == 'http.response.body':
+            chunks.append(message.get('body', b''))
+
+    await application(scope, receive, send)
+    disconnect.set()
+    return status[0], b''.join(chunks)
+
+
+def run_wsgi(application, paths, threads):
+    def timed(path):
+        start = time.perf_counter()
+        status, _ = wsgi_call(application, path)
+        return status, time.perf_counter() - start
+
+    # Latency counts from submission, so time spent waiting for a thread is included
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        futures = [(time.perf_counter(), pool.submit(timed, path)) for path in paths]
+        results = [(future.result()[0], time.perf_counter() - submitted) for submitted, future in futures]
+    return results, time.perf_counter() - start
+
+
+def run_asgi(application, paths):
+    async def timed(path):
+        start = time.perf_counter()
+        status, _ = await asgi_call(application, path)
+        return status, time.perf_counter() - start
+
+    async def main():
+        return await asyncio.gather(*(timed(path) for path in paths))
+
+    start = time.perf_counter()
+    results = asyncio.run(main())
+    return results, time.perf_counter() - start
+
+
+def report(name, concurrency, results, wall):
+    latencies = [latency for status, latency in results if status == 200]
+    failed = len(results) - len(latencies)
+    print(f"{name:12} {concurrency:6} {len(latencies) / wall:10.1f} "
+          f"{percentile(latencies, 50) * 1000:9.0f} {percentile(latencies, 95) * 1000:9.0f} "
+          f"{percentile(latencies, 99) * 1000:9.0f} {failed:7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--levels', default='16,64,256', help="Concurrent requests per run")
+    parser.add_argument('--wsgi-threads', type=int, default=32)
+    parser.add_argument('--llm-latency', type=float, default=0.4)
+    parser.add_argument('--tts-latency', type=float, default=0.15)
+    args = parser.parse_args()
+
+    setup_django()
+    services = FakeServices(
+        llm=ServiceProfile(args.llm_latency, args.llm_latency / 4),
+        tts=ServiceProfile(args.tts_latency, args.tts_latency / 4),
+        token_delay=0,
+    ).start()
+    install(services)
+
+    from django.core.wsgi import get_wsgi_application
+    from django.core.asgi import get_asgi_application
+    wsgi_app = get_wsgi_application()
+    asgi_app = get_asgi_application()
+
+    print(f"LLM {args.llm_latency * 1000:.0f} ms + TTS {args.tts_latency * 1000:.0f} ms per request, "
+          f"{args.wsgi_threads} WSGI threads")
+    print(f"{'setup':12} {'conc.':>6} {'req/s':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'failed':>7}")
+    try:
+        for concurrency in [int(level) for level in args.levels.split(',')]:
+            ids = seed(concurrency, f'wsgi{concurrency}')
+            report('wsgi', concurrency,
+                   *run_wsgi(wsgi_app, [f'/api/audio/ai-process/{pk}/' for pk in ids], args.wsgi_threads))
+
+            ids = seed(concurrency, f'asgisync{concurrency}')
+            report('asgi sync', concurrency, *run_asgi(asgi_app, [f'/api/audio/ai-process/{pk}/' for pk in ids]))
+
+            ids = seed(concurrency, f'asgiasync{concurrency}')
+            report('asgi async', concurrency,
+                   *run_asgi(asgi_app, [f'/api/async/audio/ai-process/{pk}/' for pk in ids]))
+    finally:
+        services.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Shared helpers for the benchmark scripts. Run them from the repo root, e.g.
+``python -m benchmarks.wav_ingest``."""
+import io
+import os
+import sys
+import math
+import time
+import wave
+import struct
+import tempfile
+import tracemalloc
+
+
+def setup_django(isolated=True):
+    """
+    Configure Django so benchmarks can import the api app. With ``isolated``
+    the database and MEDIA_ROOT are moved to a fresh temp directory and
+    migrated, so benchmark runs never touch db.sqlite3 or media/.
+    """
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'embedded_backend.settings')
+    import django
+    from django.conf import settings
+    if isolated:
+        workdir = tempfile.mkdtemp(prefix='bench-')
+        settings.DATABASES['default']['NAME'] = os.path.join(workdir, 'bench.sqlite3')
+        settings.MEDIA_ROOT = os.path.join(workdir, 'media')
+        settings.AUDIO_FOLDER = os.path.join(settings.MEDIA_ROOT, 'audio_files')
+    # The queue starts with the first upload, after the database has been migrated
+    settings.TRANSCRIPTION_AUTOSTART = False
+    django.setup()
+    if isolated:
+        from django.core.management import call_command
+        call_command('migrate', verbosity=0)
+
+
+def make_wav(seconds=3.0, sample_rate=16000, channels=1, sample_width=2, tone_hz=440.0):
+    """Return the bytes of a PCM WAV file holding a sine tone"""
+    frames = int(seconds * sample_rate)
+    peak = (1 << (8 * sample_width - 1)) - 1
+    fmt = {1: 'B', 2: 'h', 4: 'i'}[sample_width]
+    samples = []
+    for i in range(frames):
+        value = int(0.5 * peak * math.sin(2 * math.pi * tone_hz * i / sample_rate))
+        if sample_width == 1:
+            value += 128
+        samples.extend([value] * channels)
+    buf = io.BytesIO()
+    with wave.open(buf, 'wb') as w:
+        w.setnchannels(channels)
+        w.setsampwidth(sample_width)
+        w.setframerate(sample_rate)
+        w.writeframes(struct.pack(f'<{len(samples)}{fmt}', *samples))
+    return buf.getvalue()
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, math.ceil(pct / 100 * len(ordered)) - 1)
+    return ordered[index]
+
+
+def measure(fn, repeat=20):
+    """Call fn repeatedly and return (median seconds, peak traced bytes)"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return percentile(timings, 50), peak
@@ -0,0 +1,256 @@
+"""
+Per-interaction latency of a device on the WebSocket session
+(api/websocket.py) versus the HTTP flows, with Google STT, Gemini and gTTS
+replaced by the local fakes in fake_services.
+
+The ASGI app runs in-process behind a simulated device link: every message
+takes --rtt-ms / 2 plus its size over --link-kbps, and each new HTTP
+connection first pays --handshake-rtts round trips (1 for TCP, 2 with
+TLS 1.3). Flows, for the same pre-recorded clip:
+
+  http        POST /api/audio/?stream=1, GET /api/audio/ai-process/<id>/,
+              GET the audio_link; a new connection per request, as the
+              firmware's HTTP client does
+  http stream POST as above, then GET .../stream/ (audio of each sentence
+              as it is ready)
+  websocket   start, the clip in 100 ms frames, end on an open session;
+              transcription and audio come back on the same connection
+
+Latency counts from the first byte sent to the first and the last byte
+of response audio received.
+
+    python -m benchmarks.device_websocket [--interactions 10] [--rtt-ms 80] [--link-kbps 1000]
+"""
+import json
+import time
+import asyncio
+import argparse
+from urllib.parse import urlsplit
+from .common import setup_django, make_wav, percentile
+from .fake_services import FakeServices, ServiceProfile, install
+
+HOST = ('127.0.0.1', 8000)
+# Typical sizes of the HTTP headers the firmware sends and receives
+REQUEST_HEADER_BYTES = 300
+RESPONSE_HEADER_BYTES = 250
+# WebSocket frame header of a masked client message / a server message
+WS_CLIENT_OVERHEAD = 8
+WS_SERVER_OVERHEAD = 4
+
+
+class Link:
+    """One direction of the device's connection: latency plus serialization at a fixed bandwidth"""
+
+    def __init__(self, rtt, kbps):
+        self.one_way = rtt / 2
+        self.bytes_per_second = kbps * 1000 / 8
+        self.free_at = 0.0
+
+    def arrival(self, size, sent_at):
+        """When a message of ``size`` bytes handed to the link at ``sent_at`` is fully received"""
+        self.free_at = max(self.free_at, sent_at) + size / self.bytes_per_second
+        return self.free_at + self.one_way
+
+
+def message_size(message):
+    if message.get('bytes') is not None:
+        return len(message['bytes'])
+    return len((message.get('text') or '').encode())
+
+
+async def http_request(app, link_up, link_down, method, path, body=b'', headers=(), handshake=0.0):
+    """
+    One request on a new connection. Returns (status, headers, chunks) where
+    chunks are (arrival time, bytes) as the device would receive them.
+    """
+    loop = asyncio.get_running_loop()
+    sent_at = loop.time() + handshake
+    await asyncio.sleep(link_up.arrival(REQUEST_HEADER_BYTES + len(body), sent_at) - loop.time())
+    parts = urlsplit(path)
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method,
+        'scheme': 'http', 'path': parts.path, 'raw_path': parts.path.encode(), 'query_string': parts.query.encode(),
+        'headers': [(b'host', b'%s:%d' % (HOST[0].encode(), HOST[1])), (b'content-length', str(len(body)).encode()),
+                    *headers],
+        'server': HOST, 'client': ('127.0.0.1', 50000),
+    }
+    delivered = False
+    disconnect = asyncio.Event()
+
+    async def receive():
+        nonlocal delivered
+        if not delivered:
+            delivered = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+        await disconnect.wait()
+        return {'type': 'http.disconnect'}
+
+    response = {}
+    chunks = []
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+            response['headers'] = dict(message['headers'])
+            link_down.arrival(RESPONSE_HEADER_BYTES, loop.time())
+        elif message['type'] == 'http.response.body' and message.get('body'):
+            chunks.append((link_down.arrival(len(message['body']), loop.time()), message['body']))
+
+    await app(scope, receive, send)
+    disconnect.set()
+    if chunks:
+        await asyncio.sleep(max(0.0, chunks[-1][0] - loop.time()))
+    return response['status'], response['headers'], chunks
+
+
+async def http_flow(app, args, wav, stream):
+    loop = asyncio.get_running_loop()
+    rtt = args.rtt_ms / 1000
+    up, down = Link(rtt, args.link_kbps), Link(rtt, args.link_kbps)
+    handshake = args.handshake_rtts * rtt
+    start = loop.time()
+    status, _, chunks = await http_request(app, up, down, 'POST', '/api/audio/?stream=1', wav,
+                                           [(b'content-type', b'audio/wav')], handshake)
+    upload = json.loads(b''.join(chunk for _, chunk in chunks))
+    if stream:
+        status, _, chunks = await http_request(app, up, down, 'GET', f"/api/audio/ai-process/{upload['id']}/stream/",
+                                               handshake=handshake)
+    else:
+        status, _, chunks = await http_request(app, up, down, 'GET', f"/api/audio/ai-process/{upload['id']}/",
+                                               handshake=handshake)
+        link = json.loads(b''.join(chunk for _, chunk in chunks))['audio_link']
+        status, _, chunks = await http_request(app, up, down, 'GET', urlsplit(link).path, handshake=handshake)
+    if status != 200 or not chunks:
+        raise RuntimeError(f"HTTP flow failed with {status}")
+    return chunks[0][0] - start, chunks[-1][0] - start
+
+
+class WebSocketDevice:
+    """A device holding one session open on the in-process ASGI app"""
+
+    def __init__(self, app, args):
+        rtt = args.rtt_ms / 1000
+        self.app = app
+        self.up, self.down = Link(rtt, args.link_kbps), Link(rtt, args.link_kbps)
+        self.to_server = asyncio.Queue()
+        self.to_device = asyncio.Queue()
+        self.handshake = args.handshake_rtts * rtt
+
+    async def connect(self):
+        from django.conf import settings
+        self.loop = asyncio.get_running_loop()
+        scope = {'type': 'websocket', 'path': settings.WS_DEVICE_PATH, 'query_string': b'device_id=bench',
+                 'headers': [(b'host', b'%s:%d' % (HOST[0].encode(), HOST[1]))], 'server': HOST}
+        self.task = asyncio.create_task(self.app(scope, self.server_receive, self.server_send))
+        # The upgrade request costs the handshake plus one round trip
+        self.deliver({'type': 'websocket.connect'}, REQUEST_HEADER_BYTES, self.loop.time() + self.handshake)
+        ready = await self.receive()
+        assert json.loads(ready['text'])['type'] == 'ready'
+
+    def deliver(self, message, size, sent_at=None):
+        arrival = self.up.arrival(size, self.loop.time() if sent_at is None else sent_at)
+        self.loop.call_at(arrival, self.to_server.put_nowait, message)
+
+    async def server_receive(self):
+        return await self.to_server.get()
+
+    async def server_send(self, message):
+        if message['type'] == 'websocket.send':
+            arrival = self.down.arrival(message_size(message) + WS_SERVER_OVERHEAD, self.loop.time())
+            self.loop.call_at(arrival, self.to_device.put_nowait, (arrival, message))
+        elif message['type'] == 'websocket.accept':
+            self.down.arrival(RESPONSE_HEADER_BYTES, self.loop.time())
+
+    async def receive(self):
+        return (await self.to_device.get())[1]
+
+    def send(self, message):
+        self.deliver(message, message_size(message) + WS_CLIENT_OVERHEAD)
+
+    async def interaction(self, pcm, sample_rate):
+        start = self.loop.time()
+        self.send({'type': 'websocket.receive', 'text': json.dumps({
+            'type': 'start', 'content_type': f"audio/x-raw;format=S16LE;rate={sample_rate};channels=1"})})
+        frame = sample_rate // 10 * 2
+        for offset in range(0, len(pcm), frame):
+            self.send({'type': 'websocket.receive', 'bytes': pcm[offset:offset + frame]})
+        self.send({'type': 'websocket.receive', 'text': json.dumps({'type': 'end'})})
+        first = None
+        while True:
+            arrival, message = await self.to_device.get()
+            if message.get('bytes') is not None and first is None:
+                first = arrival
+            if message.get('text'):
+                event = json.loads(message['text'])
+                if event['type'] == 'error':
+                    raise RuntimeError(event['error'])
+                if event['type'] == 'done':
+                    return first - start, arrival - start
+
+    async def close(self):
+        self.to_server.put_nowait({'type': 'websocket.disconnect', 'code': 1000})
+        await self.task
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--interactions', type=int, default=10)
+    parser.add_argument('--seconds', type=float, default=2.0, help="Length of each spoken command")
+    parser.add_argument('--rtt-ms', type=float, default=80.0)
+    parser.add_argument('--link-kbps', type=float, default=1000.0)
+    parser.add_argument('--handshake-rtts', type=int, default=2)
+    args = parser.parse_args()
+
+    setup_django()
+    services = FakeServices(
+        stt=ServiceProfile(0.2, 0.01), llm=ServiceProfile(0.3, 0.01), tts=ServiceProfile(0.15, 0.01), token_delay=0.01,
+    ).start()
+    install(services)
+    from embedded_backend.asgi import application
+
+    sample_rate = 16000
+    clips = {}
+
+    def clip(flow, i):
+        # A different tone per interaction, so no cache answers for another flow
+        key = (flow, i)
+        if key not in clips:
+            clips[key] = make_wav(args.seconds, sample_rate, tone_hz=200 + 7 * i + 1000 * flow)
+        return clips[key]
+
+    async def run():
+        results = {}
+        for flow, label in enumerate(('http', 'http stream', 'websocket')):
+            latencies = []
+            device = None
+            if label == 'websocket':
+                device = WebSocketDevice(application, args)
+                await device.connect()
+            for i in range(args.interactions):
+                wav = clip(flow, i)
+                if device is not None:
+                    latencies.append(await device.interaction(wav[44:], sample_rate))
+                else:
+                    latencies.append(await http_flow(application, args, wav, stream=label == 'http stream'))
+            if device is not None:
+                await device.close()
+            results[label] = latencies
+        return results
+
+    try:
+        results = asyncio.run(run())
+    finally:
+        services.stop()
+
+    print(f"{args.interactions} interactions of {args.seconds:.1f} s, RTT {args.rtt_ms:.0f} ms, "
+          f"{args.link_kbps:.0f} kbit/s, {args.handshake_rtts} RTT per new connection")
+    print(f"{'flow':12} {'first audio p50':>16} {'p95':>7} {'last audio p50':>15} {'p95':>7}")
+    for label, latencies in results.items():
+        first = [f * 1000 for f, _ in latencies]
+        last = [l * 1000 for _, l in latencies]
+        print(f"{label:12} {percentile(first, 50):16.0f} {percentile(first, 95):7.0f} "
+              f"{percentile(last, 50):15.0f} {percentile(last, 95):7.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+Speculative responses (EAGER_RESPONSES, api/services.py): how long a device
+waits for the spoken answer with the AI response started when the
+transcription is saved, versus when GET /api/audio/ai-process/<id>/ asks
+for it. Google STT, Gemini and gTTS are the local fakes in fake_services;
+the ASGI app runs in-process behind the simulated link of
+benchmarks/device_websocket.py. Flows, with a new connection per request:
+
+  stream   POST /api/audio/?stream=1 (transcribed before the 201), then
+           GET ai-process and the audio_link
+  queued   POST /api/audio/ (202), GET /api/audio/<id>/ every --poll-ms
+           until the transcription is done, then as above
+
+Latency counts from the first byte of the upload to the last byte of
+response audio received.
+
+    python -m benchmarks.eager_responses [--interactions 10] [--rtt-ms 80] [--poll-ms 500]
+"""
+import json
+import asyncio
+import argparse
+from urllib.parse import urlsplit
+from .common import setup_django, make_wav, percentile
+from .fake_services import FakeServices, ServiceProfile, install
+from .device_websocket import Link, http_request
+
+
+async def interaction(app, args, wav, queued):
+    loop = asyncio.get_running_loop()
+    rtt = args.rtt_ms / 1000
+    up, down = Link(rtt, args.link_kbps), Link(rtt, args.link_kbps)
+    handshake = args.handshake_rtts * rtt
+
+    async def get(path):
+        status, _, chunks = await http_request(app, up, down, 'GET', path, handshake=handshake)
+        return status, b''.join(chunk for _, chunk in chunks), chunks
+
+    start = loop.time()
+    path = '/api/audio/' if queued else '/api/audio/?stream=1'
+    _, _, chunks = await http_request(app, up, down, 'POST', path, wav, [(b'content-type', b'audio/wav')], handshake)
+    upload = json.loads(b''.join(chunk for _, chunk in chunks))
+    if queued:
+        while True:
+            await asyncio.sleep(args.poll_ms / 1000)
+            _, body, _ = await get(f"/api/audio/{upload['id']}/")
+            if json.loads(body)['status'] == 'done':
+                break
+    status, body, _ = await get(f"/api/audio/ai-process/{upload['id']}/")
+    if status != 200:
+        raise RuntimeError(f"AI process failed with {status}: {body[:200]}")
+    status, _, chunks = await get(urlsplit(json.loads(body)['audio_link']).path)
+    if status != 200 or not chunks:
+        raise RuntimeError(f"Audio download failed with {status}")
+    return chunks[-1][0] - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--interactions', type=int, default=10)
+    parser.add_argument('--seconds', type=float, default=2.0, help="Length of each spoken command")
+    parser.add_argument('--rtt-ms', type=float, default=80.0)
+    parser.add_argument('--link-kbps', type=float, default=1000.0)
+    parser.add_argument('--handshake-rtts', type=int, default=2)
+    parser.add_argument('--poll-ms', type=float, default=500.0, help="Status polling interval of the queued flow")
+    args = parser.parse_args()
+
+    setup_django()
+    services = FakeServices(
+        stt=ServiceProfile(0.2, 0.01), llm=ServiceProfile(0.6, 0.01), tts=ServiceProfile(0.2, 0.01),
+    ).start()
+    install(services)
+    from django.conf import settings
+    from embedded_backend.asgi import application
+    settings.TRANSCRIPTION_POLL_INTERVAL = 0.05
+
+    async def run():
+        results = {}
+        for flow, queued in enumerate((False, True)):
+            for eager in (False, True):
+                settings.EAGER_RESPONSES = eager
+                latencies = []
+                for i in range(args.interactions):
+                    # A different tone per interaction, so no cache answers for another run
+                    wav = make_wav(args.seconds, tone_hz=200 + 7 * i + 1000 * (2 * flow + eager))
+                    latencies.append(await interaction(application, args, wav, queued))
+                results[('queued' if queued else 'stream', eager)] = latencies
+        return results
+
+    try:
+        results = asyncio.run(run())
+    finally:
+        services.stop()
+
+    print(f"{args.interactions} interactions of {args.seconds:.1f} s, RTT {args.rtt_ms:.0f} ms, "
+          f"{args.handshake_rtts} RTT per new connection, polling every {args.poll_ms:.0f} ms")
+    print(f"{'flow':8} {'eager':6} {'p50 ms':>8} {'p95 ms':>8}")
+    for (flow, eager), latencies in results.items():
+        latencies = [latency * 1000 for latency in latencies]
+        print(f"{flow:8} {'on' if eager else 'off':6} {percentile(latencies, 50):8.0f} {percentile(latencies, 95):8.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,301 @@
+"""
+End-to-end load test against local fakes of Google STT, Gemini and gTTS.
+
+The app runs in a threaded WSGI server in this process. A fleet of
+simulated ESP32 clients each does what the firmware does: a chunked
+audio/wav POST to /api/audio/, polling /api/audio/<id>/ until the
+transcription is done, GET /api/audio/ai-process/<id>/ and finally a
+download of the response audio. With --stream the POST goes to
+/api/audio/?stream=1 and returns the transcription itself. Latency
+percentiles per phase, the time from the first byte of the upload to the
+transcription ("transcript") and throughput are reported per concurrency
+level.
+
+    python -m benchmarks.end_to_end [--levels 1,4,16] [--requests 5] [--stream] [--json out.json]
+"""
+import json
+import time
+import argparse
+import threading
+import http.client
+from urllib.parse import urlsplit
+from .common import setup_django, make_wav, percentile
+from .fake_services import FakeServices, ServiceProfile, install
+
+PHASES = ['upload', 'transcribe', 'respond', 'download', 'total']
+# Not a phase: from the start of the upload until the transcription is known
+METRICS = PHASES + ['transcript']
+
+
+class ChunkedInput:
+    """
+    wsgi.input for a chunked request body, de-chunked as the app reads it,
+    the way gunicorn's is: read() returns at most what is left of the
+    current chunk, and b'' once the last one has been read.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.left = 0
+        self.done = False
+
+    def read(self, size=-1):
+        body = bytearray()
+        while not self.done and (size < 0 or not body):
+            if not self.left:
+                self.left = int(self.stream.readline().split(b';')[0], 16)
+                if not self.left:
+                    # Skip trailers up to the blank line
+                    while self.stream.readline() not in (b'\r\n', b'\n', b''):
+                        pass
+                    self.done = True
+                    break
+            data = self.stream.read(self.left if size < 0 else min(self.left, size))
+            if not data:
+                self.done = True
+                break
+            body += data
+            self.left -= len(data)
+            if not self.left:
+                self.stream.readline()
+        return bytes(body)
+
+    def readline(self, size=-1):
+        line = bytearray()
+        while not line.endswith(b'\n') and (size < 0 or len(line) < size):
+            byte = self.read(1)
+            if not byte:
+                break
+            line += byte
+        return bytes(line)
+
+
+def start_app_server():
+    """Serve the Django WSGI app on a free local port in a background thread"""
+    from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler, ServerHandler
+    from django.core.wsgi import get_wsgi_application
+
+    class Handler(WSGIRequestHandler):
+        """
+        runserver's handler passes chunked bodies through still framed, so
+        de-chunk them while they are read and mark the end of the input,
+        as gunicorn does. The body reaches the app chunk by chunk, without
+        a Content-Length.
+        """
+
+        def log_message(self, format, *args):
+            pass
+
+        def handle_one_request(self):
+            self.raw_requestline = self.rfile.readline(65537)
+            if not self.raw_requestline or not self.parse_request():
+                self.close_connection = True
+                return
+            environ = self.get_environ()
+            handler = ServerHandler(self.rfile, self.wfile, self.get_stderr(), environ)
+            if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                # In place of the LimitedStream ServerHandler wraps around a body with no Content-Length
+                handler.stdin = ChunkedInput(self.rfile)
+                environ['wsgi.input_terminated'] = True
+            handler.request_handler = self
+            handler.run(self.server.get_app())
+
+    server = ThreadedWSGIServer(('127.0.0.1', 0), Handler, allow_reuse_address=True)
+    server.daemon_threads = True
+    server.set_app(get_wsgi_application())
+    threading.Thread(target=server.serve_forever, name='app-server', daemon=True).start()
+    return server
+
+
+class Device:
+    """One simulated ESP32 running a fixed number of voice interactions"""
+
+    def __init__(self, host, device_id, clips, args):
+        self.host = host
+        self.device_id = device_id
+        self.clips = clips
+        self.args = args
+        self.records = []
+
+    def request(self, method, path, body=None, headers=None):
+        conn = http.client.HTTPConnection(self.host, timeout=120)
+        headers = {'X-Device-Id': self.device_id, **(headers or {})}
+        try:
+            conn.request(method, path, body=body, headers=headers, encode_chunked=body is not None)
+            response = conn.getresponse()
+            return response.status, response.read()
+        finally:
+            conn.close()
+
+    def upload_chunks(self, wav):
+        size = self.args.chunk_size
+        for offset in range(0, len(wav), size):
+            if offset and self.args.chunk_interval:
+                time.sleep(self.args.chunk_interval)
+            yield wav[offset:offset + size]
+
+    def interact(self, wav):
+        record = {'ok': False, 'error': None}
+        start = mark = time.perf_counter()
+
+        def phase(name):
+            nonlocal mark
+            now = time.perf_counter()
+            record[name] = now - mark
+            mark = now
+
+        path = '/api/audio/?stream=1' if self.args.stream else '/api/audio/'
+        status, body = self.request('POST', path, self.upload_chunks(wav), {'Content-Type': 'audio/wav'})
+        phase('upload')
+        if status != (201 if self.args.stream else 202):
+            record['error'] = f"upload {status}"
+            return record
+        upload = json.loads(body)
+        upload_id = upload['id']
+
+        if self.args.stream:
+            phase('transcribe')
+            if not upload.get('transcription'):
+                record['error'] = f"transcription: {upload.get('transcription_error')}"
+                return record
+        else:
+            while True:
+                status, body = self.request('GET', f'/api/audio/{upload_id}/')
+                job = json.loads(body)
+                if job.get('status') == 'done':
+                    break
+                time.sleep(self.args.poll_interval)
+            phase('transcribe')
+            if not job.get('is_successful'):
+                record['error'] = f"transcription: {job.get('error_message')}"
+                return record
+        record['transcript'] = time.perf_counter() - start
+
+        status, body = self.request('GET', f'/api/audio/ai-process/{upload_id}/')
+        phase('respond')
+        answer = json.loads(body)
+        if status != 200 or not answer.get('is_successful'):
+            record['error'] = f"respond {status}"
+            return record
+
+        status, _ = self.request('GET', urlsplit(answer['audio_link']).path)
+        phase('download')
+        if status != 200:
+            record['error'] = f"download {status}"
+            return record
+        record['total'] = time.perf_counter() - start
+        record['ok'] = True
+        return record
+
+    def run(self):
+        for wav in self.clips:
+            try:
+                self.records.append(self.interact(wav))
+            except Exception as e:
+                self.records.append({'ok': False, 'error': f"{type(e).__name__}: {e}"})
+
+
+def run_level(host, concurrency, clips, args):
+    per_device = [clips[i::concurrency] for i in range(concurrency)]
+    devices = [Device(host, f"bench-{concurrency}-{i}", device_clips, args) for i, device_clips in enumerate(per_device)]
+    threads = [threading.Thread(target=device.run) for device in devices]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    records = [record for device in devices for record in device.records]
+    ok = [record for record in records if record['ok']]
+    errors = {}
+    for record in records:
+        if not record['ok']:
+            errors[record['error']] = errors.get(record['error'], 0) + 1
+    return {
+        'concurrency': concurrency,
+        'interactions': len(records),
+        'succeeded': len(ok),
+        'throughput': len(ok) / wall,
+        'errors': errors,
+        'latency': {
+            name: {pct: percentile([record[name] for record in ok], pct) for pct in (50, 95, 99)}
+            for name in METRICS
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--levels', default='1,4,16', help="Comma-separated concurrency levels")
+    parser.add_argument('--requests', type=int, default=5, help="Interactions per device")
+    parser.add_argument('--clip-seconds', type=float, default=2.0)
+    parser.add_argument('--chunk-size', type=int, default=1024, help="Bytes per HTTP chunk, like the firmware")
+    parser.add_argument('--chunk-interval', type=float, default=0.0, help="Pause between chunks (upload pacing)")
+    parser.add_argument('--poll-interval', type=float, default=0.1)
+    parser.add_argument('--stream', action='store_true', help="Transcribe while uploading (?stream=1)")
+    parser.add_argument('--transcription-workers', type=int, default=None)
+    for name, latency in (('stt', 0.3), ('llm', 0.4), ('tts', 0.15)):
+        parser.add_argument(f'--{name}-latency', type=float, default=latency)
+        parser.add_argument(f'--{name}-jitter', type=float, default=latency / 4)
+        parser.add_argument(f'--{name}-failure-rate', type=float, default=0.0)
+    parser.add_argument('--token-delay', type=float, default=0.01, help="Delay between streamed LLM tokens")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="Also write the results to this file, e.g. for CI comparisons")
+    args = parser.parse_args()
+
+    setup_django()
+    from django.conf import settings
+    if args.transcription_workers:
+        settings.TRANSCRIPTION_WORKERS = args.transcription_workers
+    settings.TRANSCRIPTION_POLL_INTERVAL = min(settings.TRANSCRIPTION_POLL_INTERVAL, args.poll_interval)
+    # Each simulated device polls far faster than a real one; measure the pipeline, not the rate limit
+    settings.ADMISSION_DEVICE_RATE = 0
+
+    services = FakeServices(
+        **{name: ServiceProfile(getattr(args, f'{name}_latency'), getattr(args, f'{name}_jitter'),
+                                getattr(args, f'{name}_failure_rate')) for name in ('stt', 'llm', 'tts')},
+        token_delay=args.token_delay, seed=args.seed,
+    ).start()
+    install(services)
+    app = start_app_server()
+    host = '%s:%d' % app.server_address[:2]
+
+    levels = [int(level) for level in args.levels.split(',')]
+    results = []
+    clip_id = 0
+    try:
+        print(f"{args.clip_seconds:.1f}s clips, {args.requests} interactions per device")
+        for concurrency in levels:
+            # Every clip is different, so neither the transcription nor the LLM cache can answer
+            clips = []
+            for _ in range(concurrency * args.requests):
+                clip_id += 1
+                clips.append(make_wav(args.clip_seconds, tone_hz=200 + clip_id * 7 % 1800))
+            results.append(run_level(host, concurrency, clips, args))
+            report(results[-1])
+    finally:
+        app.shutdown()
+        services.stop()
+        from api.jobs import get_queue
+        get_queue().stop(wait=False)
+
+    print(f"Fake API calls: {services.calls}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2)
+
+
+def report(result):
+    print(f"\nconcurrency {result['concurrency']}: {result['succeeded']}/{result['interactions']} ok, "
+          f"{result['throughput']:.2f} interactions/s")
+    print(f"  {'phase':12} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name in METRICS:
+        values = result['latency'][name]
+        print(f"  {name:12} {values[50] * 1000:9.1f} {values[95] * 1000:9.1f} {values[99] * 1000:9.1f}")
+    for error, count in result['errors'].items():
+        print(f"  error x{count}: {error}")
+
+
+if __name__ == '__main__':
+    main()
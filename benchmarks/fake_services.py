@@ -0,0 +1,240 @@
+"""
+Local HTTP stand-ins for the three external APIs the service calls: the
+Google Web Speech endpoint, Gemini and gTTS. Each one has its own latency,
+jitter and failure rate, so end-to-end runs exercise real sockets and
+error paths without network access.
+
+The STT fake speaks the Web Speech wire format and is reached through
+GOOGLE_SPEECH_ENDPOINT. Gemini and gTTS have no endpoint setting, so
+install() swaps in RemoteLLM and RemoteTTS, thin HTTP clients with the
+generate_content() / write_to_fp() interface of the real SDKs, plus the
+async methods the async views use.
+"""
+import sys
+import json
+import time
+import zlib
+import random
+import threading
+import http.client
+from urllib.parse import urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from .fakes import FakeChunk, FakeLLM
+
+STT_PATH = '/speech-api/v2/recognize'
+LLM_PATH = '/llm/generate'
+TTS_PATH = '/tts/synthesize'
+
+COMMANDS = [
+    "turn on the living room light", "set the air conditioner to twenty degrees",
+    "what is the weather today", "open the garage door", "play some music",
+    "how long until the washing machine is done", "lock the front door",
+]
+
+
+class ServiceProfile:
+    """
+    Latency model of one fake API: ``latency`` +/- ``jitter`` seconds, failing
+    at ``failure_rate``. A ``slow_rate`` fraction of calls takes ``slow_latency``
+    instead, the long tail hedging is meant to cut.
+    """
+
+    def __init__(self, latency=0.2, jitter=0.05, failure_rate=0.0, slow_rate=0.0, slow_latency=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+
+
+class FakeServiceHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so pooled clients reuse connections like they would with Google
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        route = {STT_PATH: ('stt', self.recognize), LLM_PATH: ('llm', self.generate), TTS_PATH: ('tts', self.synthesize)}
+        name, handler = route.get(urlsplit(self.path).path, (None, None))
+        if handler is None:
+            self.send_error(404)
+            return
+        delay, fail = self.server.draw(name)
+        self.server.count(name, fail)
+        time.sleep(delay)
+        if fail:
+            self.send_error(503, "Injected failure")
+            return
+        handler(body)
+
+    def reply(self, payload, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def recognize(self, body):
+        # The transcript depends on the audio, so distinct clips ask distinct questions
+        digest = zlib.crc32(body)
+        transcript = f"{COMMANDS[digest % len(COMMANDS)]} number {digest % 1000}"
+        result = {"result": [{"alternative": [{"transcript": transcript, "confidence": 0.92}], "final": True}],
+                  "result_index": 0}
+        self.reply(('{"result":[]}\n' + json.dumps(result) + '\n').encode(), 'application/json')
+
+    def generate(self, body):
+        request = json.loads(body)
+        # The first token already waited out the profile latency
+        tokens = FakeLLM(first_token_delay=0, token_delay=self.server.token_delay)._tokens(request['prompt'])
+        if not request.get('stream'):
+            self.reply(''.join(tokens).encode(), 'text/plain; charset=utf-8')
+            return
+        # No Content-Length: the body ends when the connection closes
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        for token in tokens:
+            self.wfile.write(json.dumps(token).encode() + b'\n')
+            self.wfile.flush()
+
+    def synthesize(self, body):
+        text = json.loads(body)['text']
+        time.sleep(self.server.tts_char_delay * len(text))
+        self.reply(b'ID3' + text.encode(), 'audio/mpeg')
+
+
+class FakeServices(ThreadingHTTPServer):
+    """One threaded server hosting the STT, LLM and TTS fakes on a free local port"""
+    daemon_threads = True
+    # Hundreds of clients may connect at once in the ASGI benchmark
+    request_queue_size = 1024
+
+    def __init__(self, stt=None, llm=None, tts=None, token_delay=0.01, tts_char_delay=0.001, seed=0):
+        super().__init__(('127.0.0.1', 0), FakeServiceHandler)
+        self.profiles = {'stt': stt or ServiceProfile(), 'llm': llm or ServiceProfile(), 'tts': tts or ServiceProfile()}
+        self.token_delay = token_delay
+        self.tts_char_delay = tts_char_delay
+        self.calls = {name: {'ok': 0, 'failed': 0} for name in self.profiles}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def handle_error(self, request, client_address):
+        # Clients abandon hedged or timed-out calls mid-response
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def draw(self, name):
+        """Return (delay, fail) for the next call to a service"""
+        profile = self.profiles[name]
+        with self._lock:
+            delay = max(0.0, self._random.uniform(profile.latency - profile.jitter, profile.latency + profile.jitter))
+            if self._random.random() < profile.slow_rate:
+                delay = profile.slow_latency
+            return delay, self._random.random() < profile.failure_rate
+
+    def count(self, name, failed):
+        with self._lock:
+            self.calls[name]['failed' if failed else 'ok'] += 1
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='fake-services', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def _post(url, payload, timeout=None):
+    parts = urlsplit(url)
+    conn = http.client.HTTPConnection(parts.netloc, timeout=timeout or 60)
+    conn.request('POST', parts.path, body=json.dumps(payload), headers={'Content-Type': 'application/json'})
+    response = conn.getresponse()
+    if response.status != 200:
+        conn.close()
+        raise RuntimeError(f"{parts.path} returned {response.status}")
+    return conn, response
+
+
+class RemoteLLM:
+    """GenerativeModel look-alike that calls the fake LLM over HTTP"""
+
+    def __init__(self, url):
+        self.url = url + LLM_PATH
+
+    def generate_content(self, prompt, generation_config=None, stream=False, request_options=None):
+        timeout = (request_options or {}).get('timeout')
+        conn, response = _post(self.url, {'prompt': prompt, 'stream': stream}, timeout)
+        if not stream:
+            try:
+                return FakeChunk(response.read().decode())
+            finally:
+                conn.close()
+
+        def chunks():
+            try:
+                for line in response:
+                    yield FakeChunk(json.loads(line))
+            finally:
+                conn.close()
+        return chunks()
+
+    async def generate_content_async(self, prompt, generation_config=None, request_options=None):
+        from api.async_clients import post
+        response = await post(self.url, json={'prompt': prompt, 'stream': False},
+                              timeout=(request_options or {}).get('timeout'))
+        if response.status_code != 200:
+            raise RuntimeError(f"{LLM_PATH} returned {response.status_code}")
+        return FakeChunk(response.text)
+
+
+class RemoteTTS:
+    """gTTS look-alike that calls the fake TTS over HTTP; build one with bound()"""
+    url = None
+
+    def __init__(self, text, lang='en', **kwargs):
+        self.text = text
+        self.lang = lang
+
+    def write_to_fp(self, fp):
+        conn, response = _post(self.url, {'text': self.text, 'lang': self.lang})
+        try:
+            fp.write(response.read())
+        finally:
+            conn.close()
+
+    async def aread(self):
+        from api.async_clients import post
+        response = await post(self.url, json={'text': self.text, 'lang': self.lang})
+        if response.status_code != 200:
+            raise RuntimeError(f"{TTS_PATH} returned {response.status_code}")
+        return response.content
+
+    @classmethod
+    def bound(cls, url):
+        return type('RemoteTTS', (cls,), {'url': url + TTS_PATH})
+
+
+def install(services):
+    """
+    Point the app at running FakeServices: recognition goes to the STT fake
+    and the Gemini model and gTTS class are replaced by the HTTP clients.
+    Call after Django is set up and before the first request.
+    """
+    import gtts
+    from django.conf import settings
+    from api import speech_generator
+
+    settings.RECOGNIZER_BACKENDS = ['google']
+    settings.GOOGLE_SPEECH_ENDPOINT = services.url + STT_PATH
+    speech_generator._model = RemoteLLM(services.url)
+    gtts.gTTS = RemoteTTS.bound(services.url)
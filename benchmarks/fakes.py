@@ -0,0 +1,62 @@
+"""
+Local stand-ins for Gemini and gTTS with configurable latency, so the
+response path can be measured without network access.
+"""
+import time
+
+
+class FakeChunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeLLM:
+    """
+    Mimics GenerativeModel.generate_content. The answer is emitted one word
+    at a time, ``first_token_delay`` after the call and ``token_delay``
+    apart, so streamed and blocking consumers see realistic timing.
+    """
+
+    def __init__(self, answer=None, first_token_delay=0.3, token_delay=0.03):
+        self.answer = answer or (
+            "Sure, I can help with that. The air conditioner is now switching on. "
+            "It will reach the set temperature in a few minutes. "
+            "Let me know if you want it cooler."
+        )
+        self.first_token_delay = first_token_delay
+        self.token_delay = token_delay
+
+    def _tokens(self, prompt):
+        time.sleep(self.first_token_delay)
+        # Make each answer unique to the prompt so TTS dedup doesn't hide the cost
+        words = f"{self.answer} Reference {abs(hash(prompt)) % 10000}.".split(' ')
+        for i, word in enumerate(words):
+            if i:
+                time.sleep(self.token_delay)
+            yield word if i == len(words) - 1 else word + ' '
+
+    def generate_content(self, prompt, generation_config=None, stream=False, request_options=None):
+        if stream:
+            return (FakeChunk(token) for token in self._tokens(prompt))
+        return FakeChunk(''.join(self._tokens(prompt)))
+
+
+class FakeTTS:
+    """
+    Mimics gtts.gTTS. Synthesis takes ``base_delay`` plus ``per_char_delay``
+    for every character and writes a small dummy MP3 payload.
+    """
+
+    base_delay = 0.15
+    per_char_delay = 0.002
+
+    def __init__(self, text, lang='en', **kwargs):
+        self.text = text
+
+    def write_to_fp(self, fp):
+        time.sleep(self.base_delay + self.per_char_delay * len(self.text))
+        fp.write(b'ID3' + self.text.encode())
+
+    @classmethod
+    def with_delays(cls, base_delay, per_char_delay):
+        return type('FakeTTS', (cls,), {'base_delay': base_delay, 'per_char_delay': per_char_delay})
@@ -0,0 +1,114 @@
+"""
+History listing on a large seeded table: latency of the keyset-paginated
+/api/audio/multipart/ list (plain and filtered), and keyset versus OFFSET
+pages at increasing depth, with the SQLite query plan of each.
+
+    python -m benchmarks.history [--rows 1000000] [--devices 500] [--repeat 5]
+
+Seeding a million rows takes a few minutes; --rows 100000 is quicker.
+"""
+import time
+import uuid
+import random
+import argparse
+from urllib.parse import quote
+from datetime import timedelta
+from .common import setup_django, percentile
+
+
+def seed(rows, devices, batch_size=10000):
+    """Insert rows spread over the last year, newest last, like a long-running server"""
+    from django.utils import timezone
+    from api.models import AudioFile
+
+    # Keep the generated timestamps instead of stamping every row with now()
+    created_at = AudioFile._meta.get_field('created_at')
+    created_at.auto_now_add = False
+    rng = random.Random(0)
+    start = timezone.now() - timedelta(days=365)
+    step = timedelta(days=365) / rows
+    try:
+        for offset in range(0, rows, batch_size):
+            batch = []
+            for i in range(offset, min(offset + batch_size, rows)):
+                ok = rng.random() < 0.9
+                batch.append(AudioFile(
+                    id=uuid.UUID(int=rng.getrandbits(128), version=4),
+                    original_filename=f"recording_{i}.wav",
+                    audio_file=f"audio_files/recording_{i}.wav",
+                    device_id=f"esp-{rng.randrange(devices):04d}",
+                    transcription="turn on the living room light" if ok else None,
+                    error_message=None if ok else "API unavailable",
+                    is_processed=True,
+                    is_successful=ok,
+                    status=AudioFile.STATUS_DONE,
+                    created_at=start + step * i,
+                ))
+            AudioFile.objects.bulk_create(batch)
+    finally:
+        created_at.auto_now_add = True
+
+
+def timed(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return percentile(timings, 50)
+
+
+def query_plan(queryset):
+    from django.db import connection
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+        return '; '.join(row[-1] for row in cursor.fetchall())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--devices', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.db import connection
+    from django.test import Client
+    from api.models import AudioFile
+    from api.pagination import HistoryPagination
+
+    start = time.perf_counter()
+    seed(args.rows, args.devices)
+    with connection.cursor() as cursor:
+        cursor.execute("ANALYZE")
+    print(f"Seeded {args.rows} rows in {time.perf_counter() - start:.1f}s\n")
+
+    client = Client(HTTP_HOST='127.0.0.1:8000')
+    middle = AudioFile.objects.order_by('created_at').values_list('created_at', flat=True)[args.rows // 2]
+    requests = [
+        ("first page", "/api/audio/multipart/"),
+        ("one device", "/api/audio/multipart/?device=esp-0007"),
+        ("failed, older half", f"/api/audio/multipart/?is_successful=false&created_before={quote(middle.isoformat())}"),
+        ("200 rows", "/api/audio/multipart/?page_size=200"),
+    ]
+    print(f"{'GET /api/audio/multipart/':28} {'p50 ms':>9}")
+    for name, url in requests:
+        assert client.get(url).status_code == 200
+        print(f"{name:28} {timed(lambda: client.get(url), args.repeat) * 1000:9.2f}")
+
+    ordering = HistoryPagination.ordering
+    page_size = HistoryPagination.page_size
+    print(f"\n{'page at depth':28} {'keyset ms':>10} {'OFFSET ms':>10}  plans (keyset | offset)")
+    for depth in sorted({1000, args.rows // 10, args.rows * 9 // 10}):
+        boundary = AudioFile.objects.order_by(*ordering).values_list('created_at', flat=True)[depth]
+        keyset = AudioFile.objects.filter(created_at__lt=boundary).order_by(*ordering)[:page_size]
+        offset = AudioFile.objects.order_by(*ordering)[depth:depth + page_size]
+        keyset_ms = timed(lambda: list(keyset.all()), args.repeat) * 1000
+        offset_ms = timed(lambda: list(offset.all()), args.repeat) * 1000
+        print(f"{depth:<28} {keyset_ms:10.2f} {offset_ms:10.2f}  {query_plan(keyset)} | {query_plan(offset)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Local intent fast path (api/intents.py): how long matching a transcription
+takes for intent tables of growing size, and the latency of
+VoicePipeline.respond for a device command answered locally versus a
+question that goes to the LLM (FakeLLM and FakeTTS from benchmarks/fakes.py,
+with their default delays standing in for Gemini and gTTS).
+
+    python -m benchmarks.local_intents [--requests 20]
+"""
+import time
+import argparse
+from .common import setup_django, percentile
+from .fakes import FakeLLM, FakeTTS
+
+
+def synthetic_table(size):
+    """LOCAL_INTENTS-shaped table with ``size`` devices, two patterns each"""
+    return [{
+        'name': f"device{i}_on",
+        'patterns': [rf"(please )?turn on the device {i}", rf"device {i} on"],
+        'response': f"Okay, turning on device {i}.",
+        'action': {'device': f"device{i}", 'command': 'on'},
+    } for i in range(size)]
+
+
+def time_match(matcher, text, repeat=2000):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        matcher.match(text)
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=20)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.conf import settings
+    from api.intents import IntentMatcher, prerender
+    from api.models import AudioFile
+    from api.services import VoicePipeline
+    from api.speech_generator import SpeechProcessor
+
+    print(f"{'intents':>8} {'hit us':>8} {'miss us':>8}")
+    for size in (len(settings.LOCAL_INTENTS), 50, 200):
+        table = settings.LOCAL_INTENTS if size == len(settings.LOCAL_INTENTS) else synthetic_table(size)
+        matcher = IntentMatcher(table, settings.LOCAL_INTENT_WAKE_WORDS)
+        hit = "OK Google turn on the AC" if table is settings.LOCAL_INTENTS else f"ok google turn on the device {size - 1}"
+        print(f"{size:8} {time_match(matcher, hit):8.1f} {time_match(matcher, 'what is the weather like in hanoi today'):8.1f}")
+
+    processor = SpeechProcessor(llm=FakeLLM(), tts_class=FakeTTS)
+    prerender(processor)
+    pipeline = VoicePipeline(processor)
+    cases = [
+        ('local intent', lambda i: "OK Google turn on the AC"),
+        ('llm', lambda i: f"what is the weather like in city number {i}"),
+    ]
+    print(f"\n{'respond':14} {'p50 ms':>8} {'p95 ms':>8}")
+    for label, question in cases:
+        latencies = []
+        for i in range(args.requests):
+            audio_file = AudioFile.objects.create(transcription=question(i), status=AudioFile.STATUS_DONE,
+                                                  is_processed=True, is_successful=True)
+            start = time.perf_counter()
+            pipeline.respond(audio_file)
+            latencies.append((time.perf_counter() - start) * 1000)
+        print(f"{label:14} {percentile(latencies, 50):8.1f} {percentile(latencies, 95):8.1f}")
+
+
+if __name__ == '__main__':
+    main()
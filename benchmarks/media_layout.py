@@ -0,0 +1,69 @@
+"""
+Flat versus sharded media directories (api/storage.py): time to create
+--files small files, open random ones by name, list the directory that a
+new upload lands in, and run one MediaSweeper scan of the sharded tree.
+
+    python -m benchmarks.media_layout [--files 100000]
+"""
+import os
+import time
+import random
+import shutil
+import argparse
+import tempfile
+from .common import setup_django
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=100000)
+    parser.add_argument('--lookups', type=int, default=10000)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.conf import settings
+    from api.storage import ShardedStorage, MediaSweeper
+
+    names = [f"recording_{i}_{random.getrandbits(32):08x}.wav" for i in range(args.files)]
+    sample = random.Random(0).sample(range(len(names)), min(args.lookups, len(names)))
+    payload = b'RIFF' + bytes(60)
+
+    print(f"{args.files} files, {len(sample)} random lookups")
+    print(f"{'layout':10} {'create s':>9} {'lookup us':>10} {'list dir ms':>12} {'entries':>8}")
+    for layout in ('flat', 'sharded'):
+        root = tempfile.mkdtemp(prefix=f'media-{layout}-')
+        storage = ShardedStorage(location=root)
+        relative = [f"audio_files/{name}" if layout == 'flat' else storage.shard(f"audio_files/{name}")
+                    for name in names]
+
+        def create():
+            for name in relative:
+                with open(storage.create_path(name) if layout == 'sharded' else storage.path(name), 'wb') as f:
+                    f.write(payload)
+        os.makedirs(storage.path('audio_files'), exist_ok=True)
+        create_s, _ = timed(create)
+
+        paths = [storage.path(relative[i]) for i in sample]
+        lookup_s, _ = timed(lambda: [os.stat(path) for path in paths])
+
+        newest = os.path.dirname(storage.path(relative[-1]))
+        list_s, entries = timed(lambda: len(os.listdir(newest)))
+        print(f"{layout:10} {create_s:9.2f} {lookup_s / len(paths) * 1e6:10.1f} {list_s * 1000:12.2f} {entries:8}")
+
+        if layout == 'sharded':
+            settings.MEDIA_ROOT = root
+            sweeper = MediaSweeper(storage=storage, dry_run=True)
+            scan_s, scanned = timed(lambda: sum(1 for _ in sweeper._scan('audio_files')))
+            print(f"\nsweeper scan of the sharded tree: {scanned} files in {scan_s:.2f}s "
+                  f"({scanned / scan_s:.0f} files/s)")
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""
+Serving generated clips at MEDIA_URL (api/media.py): requests per second
+and MB/s for whole files, resumed downloads (Range over the second half)
+and ETag revalidations (304), with the body sent two ways:
+
+  copy        no wsgi.file_wrapper, so the WSGI server iterates the
+              FileResponse and writes every block (like wsgiref/runserver)
+  sendfile    a wsgi.file_wrapper that hands the file descriptor to
+              os.sendfile with the response's Content-Length, as gunicorn
+              does; the bytes never pass through Python
+
+The WSGI app is called in-process and bodies go to a local socket pair, so
+the numbers are the server's side of the transfer only.
+
+    python -m benchmarks.media_serving [--kb 256] [--clips 20] [--requests 400]
+"""
+import io
+import os
+import sys
+import time
+import shutil
+import socket
+import argparse
+import threading
+from .common import setup_django
+
+
+class SendfileWrapper:
+    """The parts of gunicorn's wsgi.file_wrapper that matter here"""
+
+    def __init__(self, filelike, block_size=8192):
+        self.filelike = filelike
+        self.block_size = block_size
+
+    def close(self):
+        self.filelike.close()
+
+
+def drain(sock):
+    while sock.recv(1 << 20):
+        pass
+
+
+def serve(app, environ, sock):
+    """Call the app and write its body to ``sock``; returns the status code"""
+    captured = {}
+
+    def start_response(status, headers, exc_info=None):
+        captured['status'] = int(status.split()[0])
+        captured['headers'] = dict(headers)
+
+    body = app(environ, start_response)
+    try:
+        if isinstance(body, SendfileWrapper):
+            fd = body.filelike.fileno()
+            offset = os.lseek(fd, 0, os.SEEK_CUR)
+            remaining = int(captured['headers']['Content-Length'])
+            while remaining:
+                sent = os.sendfile(sock.fileno(), fd, offset, remaining)
+                offset += sent
+                remaining -= sent
+        else:
+            for block in body:
+                sock.sendall(block)
+    finally:
+        body.close()
+    return captured['status']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--kb', type=int, default=256, help="Size of each clip")
+    parser.add_argument('--clips', type=int, default=20)
+    parser.add_argument('--requests', type=int, default=400)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.conf import settings
+    from django.core.wsgi import get_wsgi_application
+    from api.storage import media_storage, GENERATED
+
+    size = args.kb * 1024
+    paths = []
+    for i in range(args.clips):
+        name = media_storage.shard(f"{GENERATED}/clip{i:05d}.pcm.raw")
+        with open(media_storage.create_path(name), 'wb') as f:
+            f.write(os.urandom(size))
+        paths.append(f"{settings.MEDIA_URL}{name}")
+
+    app = get_wsgi_application()
+    sender, receiver = socket.socketpair()
+    sender.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+    threading.Thread(target=drain, args=(receiver,), daemon=True).start()
+
+    def environ(path, file_wrapper, **headers):
+        env = {
+            'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'SERVER_NAME': '127.0.0.1', 'SERVER_PORT': '8000',
+            'wsgi.url_scheme': 'http', 'wsgi.input': io.BytesIO(), 'wsgi.errors': sys.stderr,
+        }
+        if file_wrapper:
+            env['wsgi.file_wrapper'] = SendfileWrapper
+        env.update({f"HTTP_{key}": value for key, value in headers.items()})
+        return env
+
+    first_path = paths[0]
+    etag = {}
+
+    def capture(status, headers, exc_info=None):
+        etag['value'] = dict(headers)['ETag']
+    app(environ(first_path, False), capture).close()
+
+    cases = [
+        ('whole file', {}, size),
+        ('range 2nd half', {'RANGE': f"bytes={size // 2}-"}, size - size // 2),
+        ('304', {'IF_NONE_MATCH': etag['value']}, 0),
+    ]
+    print(f"{args.requests} requests over {args.clips} clips of {args.kb} KB")
+    print(f"{'request':16} {'body':9} {'req/s':>8} {'MB/s':>8}")
+    for label, headers, body_bytes in cases:
+        for mode in ('copy', 'sendfile'):
+            if not body_bytes and mode == 'sendfile':
+                continue
+            start = time.perf_counter()
+            for i in range(args.requests):
+                path = paths[i % len(paths)] if label != '304' else first_path
+                serve(app, environ(path, mode == 'sendfile', **headers), sender)
+            elapsed = time.perf_counter() - start
+            print(f"{label:16} {mode if body_bytes else '-':9} {args.requests / elapsed:8.0f} "
+                  f"{args.requests * body_bytes / elapsed / 1e6:8.1f}")
+    sender.close()
+    shutil.rmtree(settings.MEDIA_ROOT)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+"""
+Throughput of the NumPy preprocessing stage (downmix, resample, trim,
+normalize) in clips per second for typical device recordings.
+
+    python -m benchmarks.preprocess [--seconds 3] [--repeat 50]
+"""
+import time
+import argparse
+from .common import setup_django, make_wav
+
+FORMATS = [
+    ("16 kHz mono 16-bit", dict(sample_rate=16000)),
+    ("44.1 kHz stereo 16-bit", dict(sample_rate=44100, channels=2)),
+    ("48 kHz mono 32-bit", dict(sample_rate=48000, sample_width=4)),
+    ("8 kHz mono 8-bit", dict(sample_rate=8000, sample_width=1)),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--seconds', type=float, default=3.0)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    setup_django()
+    from api.audio_processor import pcm_view
+    from api.preprocessing import preprocess
+
+    print(f"{args.seconds:.1f}s clips, {args.repeat} runs each")
+    print(f"{'format':24} {'clips/s':>9} {'audio x realtime':>17}")
+    for name, options in FORMATS:
+        info, pcm = pcm_view(make_wav(args.seconds, **options))
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            preprocess(pcm, info.sample_rate, info.sample_width, info.channels)
+        elapsed = time.perf_counter() - start
+        clips_per_second = args.repeat / elapsed
+        print(f"{name:24} {clips_per_second:9.1f} {clips_per_second * args.seconds:17.0f}")
+
+
+if __name__ == '__main__':
+    main()
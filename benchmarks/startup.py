@@ -0,0 +1,91 @@
+"""
+Cold-start cost of a worker: import time of the URLconf, wall time of a
+manage.py command, and time-to-first-request of the WSGI and ASGI apps.
+Every sample runs in a fresh interpreter.
+
+    python -m benchmarks.startup [--runs 5]
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+from .common import percentile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Each probe prints the seconds it measured on its last line
+PROBES = {
+    'import api.urls': """
+import os, time
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'embedded_backend.settings')
+start = time.perf_counter()
+import django
+django.setup()
+import api.urls
+print(time.perf_counter() - start)
+""",
+    'wsgi first request': """
+import io, time
+start = time.perf_counter()
+from embedded_backend.wsgi import application
+environ = {
+    'REQUEST_METHOD': 'GET', 'PATH_INFO': '/api/', 'QUERY_STRING': '', 'SERVER_NAME': 'localhost',
+    'SERVER_PORT': '8000', 'wsgi.input': io.BytesIO(), 'wsgi.url_scheme': 'http', 'wsgi.errors': io.StringIO(),
+}
+body = b''.join(application(environ, lambda status, headers: None))
+print(time.perf_counter() - start)
+""",
+    'asgi first request': """
+import time, asyncio
+start = time.perf_counter()
+from embedded_backend.asgi import application
+async def main():
+    scope = {'type': 'http', 'method': 'GET', 'path': '/api/', 'query_string': b'', 'headers': [],
+             'server': ('localhost', 8000), 'scheme': 'http', 'asgi': {'version': '3.0'}}
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+    async def send(message):
+        pass
+    await application(scope, receive, send)
+asyncio.run(main())
+print(time.perf_counter() - start)
+""",
+}
+
+
+def run_probe(code, env):
+    output = subprocess.run(
+        [sys.executable, '-W', 'ignore', '-c', code], cwd=REPO_ROOT, env=env,
+        capture_output=True, text=True, check=True,
+    ).stdout
+    return float(output.strip().splitlines()[-1])
+
+
+def run_command(args, env):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-W', 'ignore', 'manage.py', *args], cwd=REPO_ROOT, env=env,
+                   capture_output=True, check=True)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--warmup', action='store_true', help="Measure with API_WARMUP=1")
+    args = parser.parse_args()
+
+    env = dict(os.environ, API_WARMUP='1' if args.warmup else '0')
+    env.pop('DJANGO_SETTINGS_MODULE', None)
+
+    results = {name: [run_probe(code, env) for _ in range(args.runs)] for name, code in PROBES.items()}
+    results['manage.py check'] = [run_command(['check'], env) for _ in range(args.runs)]
+
+    print(f"API_WARMUP={env['API_WARMUP']}, {args.runs} cold starts each")
+    print(f"{'measurement':24} {'p50 ms':>9} {'max ms':>9}")
+    for name, values in results.items():
+        print(f"{name:24} {percentile(values, 50) * 1000:9.1f} {max(values) * 1000:9.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+Time-to-first-audio of the blocking response path (full LLM answer, then
+one TTS call) versus the sentence-streamed path, using local fakes.
+
+    python -m benchmarks.time_to_first_audio [--runs 5] [--token-delay 0.03]
+"""
+import time
+import argparse
+from .common import setup_django, percentile
+from .fakes import FakeLLM, FakeTTS
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--first-token-delay', type=float, default=0.3)
+    parser.add_argument('--token-delay', type=float, default=0.03)
+    parser.add_argument('--tts-base-delay', type=float, default=0.15)
+    parser.add_argument('--tts-char-delay', type=float, default=0.002)
+    args = parser.parse_args()
+
+    setup_django()
+    from api.speech_generator import SpeechProcessor
+
+    processor = SpeechProcessor(
+        llm=FakeLLM(first_token_delay=args.first_token_delay, token_delay=args.token_delay),
+        tts_class=FakeTTS.with_delays(args.tts_base_delay, args.tts_char_delay),
+    )
+
+    blocking, streamed_first, streamed_total = [], [], []
+    for run in range(args.runs):
+        start = time.perf_counter()
+        processor.generate_speech(processor.process_text(f"blocking question {run}"))
+        blocking.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        first = None
+        for _ in processor.stream_response(f"streamed question {run}"):
+            if first is None:
+                first = time.perf_counter() - start
+        streamed_first.append(first)
+        streamed_total.append(time.perf_counter() - start)
+
+    print(f"{'mode':28} {'p50 ms':>9} {'max ms':>9}")
+    for name, values in [
+        ("blocking: first audio", blocking),
+        ("streamed: first audio", streamed_first),
+        ("streamed: last audio", streamed_total),
+    ]:
+        print(f"{name:28} {percentile(values, 50) * 1000:9.1f} {max(values) * 1000:9.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Playback formats of generated speech (api/tts_formats.py): size per second
+of audio for each format, the one-off cost of transcoding a clip on its
+first request, and the cost of every later request, which reuses the
+stored variant.
+
+gTTS clips are MP3, and decoding MP3 needs ffmpeg; the source here is a
+24 kHz WAV (gTTS' rate) so the numbers cover resampling and encoding
+without depending on it. Pass --mp3 FILE to time a real clip instead.
+
+    python -m benchmarks.tts_formats [--seconds 5] [--clips 50] [--mp3 FILE]
+"""
+import os
+import time
+import shutil
+import argparse
+from .common import setup_django, make_wav
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=float, default=5.0, help="Length of the generated source clip")
+    parser.add_argument('--clips', type=int, default=50)
+    parser.add_argument('--mp3', help="Time this MP3 file instead of a generated WAV (needs ffmpeg)")
+    args = parser.parse_args()
+
+    setup_django()
+    from django.conf import settings
+    from api.storage import media_storage, GENERATED
+    from api.tts_formats import OUTPUT_FORMATS, SOURCE_FORMAT, variant
+
+    if args.mp3:
+        with open(args.mp3, 'rb') as f:
+            source = f.read()
+        extension = '.mp3'
+    else:
+        source = make_wav(args.seconds, sample_rate=24000, tone_hz=220.0)
+        # Not .wav, which would be the name of the wav variant
+        extension = '.src'
+    names = []
+    for i in range(args.clips):
+        name = media_storage.shard(f"{GENERATED}/clip{i:05d}{extension}")
+        with open(media_storage.create_path(name), 'wb') as f:
+            f.write(source)
+        names.append(name)
+
+    print(f"{args.clips} clips of {args.seconds:.1f} s, output at {settings.TTS_OUTPUT_SAMPLE_RATE} Hz")
+    print(f"{'format':8} {'KB/s':>7} {'first ms':>9} {'reuse ms':>9}")
+    for name in OUTPUT_FORMATS:
+        if name == SOURCE_FORMAT:
+            continue
+        start = time.perf_counter()
+        paths = [variant(clip, name) for clip in names]
+        first = (time.perf_counter() - start) / len(names)
+        start = time.perf_counter()
+        for clip in names:
+            with open(media_storage.path(variant(clip, name)), 'rb') as f:
+                f.read()
+        reuse = (time.perf_counter() - start) / len(names)
+        size = os.path.getsize(media_storage.path(paths[0]))
+        print(f"{name:8} {size / args.seconds / 1024:7.1f} {first * 1000:9.2f} {reuse * 1000:9.3f}")
+    print(f"{'source':8} {len(source) / args.seconds / 1024:7.1f}")
+    shutil.rmtree(settings.MEDIA_ROOT)
+
+
+if __name__ == '__main__':
+    main()
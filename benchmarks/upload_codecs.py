@@ -0,0 +1,132 @@
+"""
+Upload codecs (api/audio_codecs.py): bytes on the wire per second of audio
+for 16-bit PCM, IMA-ADPCM and FLAC, how long an upload of --seconds takes
+over a --link-kbps connection, decode speed (whole file and in
+--chunk-byte pieces as the streaming path sees them), and how far the
+decoded audio is from the original.
+
+The test signal is synthetic speech: voiced stretches with a wandering
+pitch and harmonics, fricative noise bursts, pauses and a noise floor.
+Real recordings are noisier; FLAC usually lands between 50% and 65% of
+PCM on them, while IMA-ADPCM is always 25% plus block headers.
+
+    python -m benchmarks.upload_codecs [--seconds 10] [--link-kbps 256]
+"""
+import io
+import time
+import wave
+import argparse
+import numpy as np
+from .common import setup_django
+
+
+def speech_like(seconds, sample_rate, seed=0):
+    """16-bit mono PCM that compresses roughly like a spoken command"""
+    rng = np.random.default_rng(seed)
+    n = int(seconds * sample_rate)
+    t = np.arange(n) / sample_rate
+    signal = np.zeros(n)
+    position = 0
+    while position < n:
+        length = int(rng.uniform(0.08, 0.35) * sample_rate)
+        kind = rng.choice(['voiced', 'voiced', 'fricative', 'pause'])
+        span = slice(position, min(n, position + length))
+        envelope = np.hanning(span.stop - span.start)
+        if kind == 'voiced':
+            pitch = rng.uniform(100, 220) * (1 + 0.1 * np.sin(2 * np.pi * 3 * t[span]))
+            phase = 2 * np.pi * np.cumsum(pitch) / sample_rate
+            voiced = sum(np.sin(k * phase) / k for k in range(1, 12))
+            signal[span] = 0.3 * envelope * voiced
+        elif kind == 'fricative':
+            signal[span] = 0.08 * envelope * rng.standard_normal(span.stop - span.start)
+        position = span.stop
+    signal += 0.002 * rng.standard_normal(n)
+    return (np.clip(signal, -1, 1) * 32767).astype('<i2').tobytes()
+
+
+def wav_bytes(pcm16, sample_rate):
+    buf = io.BytesIO()
+    with wave.open(buf, 'wb') as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(sample_rate)
+        w.writeframes(pcm16)
+    return buf.getvalue()
+
+
+def ima_adpcm_wav(pcm16, sample_rate):
+    """The upload an ESP32 encoding IMA-ADPCM as it records would send"""
+    from api.audio_codecs import encode_ima_adpcm_wav
+    return encode_ima_adpcm_wav(pcm16, sample_rate)
+
+
+def flac_bytes(pcm16, sample_rate):
+    import speech_recognition as sr
+    return sr.AudioData(pcm16, sample_rate, 2).get_flac_data()
+
+
+def snr_db(reference, decoded):
+    a = np.frombuffer(reference, dtype='<i2').astype(np.float64)
+    b = np.frombuffer(decoded, dtype='<i2').astype(np.float64)[:len(a)]
+    noise = np.sum((a[:len(b)] - b) ** 2)
+    return float('inf') if noise == 0 else 10 * np.log10(np.sum(a ** 2) / noise)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--sample-rate', type=int, default=16000)
+    parser.add_argument('--link-kbps', type=float, default=256.0, help="Effective upload bandwidth of the device")
+    parser.add_argument('--chunk-bytes', type=int, default=1024)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    setup_django(isolated=False)
+    from api.audio_codecs import decode, open_decoder, sniff, probe, available_containers
+    from api.audio_processor import pcm_view
+
+    pcm = speech_like(args.seconds, args.sample_rate)
+    uploads = {
+        'pcm': wav_bytes(pcm, args.sample_rate),
+        'ima-adpcm': ima_adpcm_wav(pcm, args.sample_rate),
+    }
+    if 'flac' in available_containers():
+        uploads['flac'] = flac_bytes(pcm, args.sample_rate)
+
+    print(f"{args.seconds:.0f} s of synthetic speech at {args.sample_rate} Hz, "
+          f"{args.link_kbps:.0f} kbit/s uplink, streaming in {args.chunk_bytes}-byte chunks")
+    print(f"{'codec':10} {'KB/s':>7} {'vs pcm':>7} {'upload s':>9} {'decode x rt':>12} "
+          f"{'stream x rt':>12} {'snr dB':>7} {'duration':>9}")
+    for codec, upload in uploads.items():
+        per_second = len(upload) / args.seconds / 1024
+        upload_s = len(upload) * 8 / (args.link_kbps * 1000)
+
+        def whole():
+            if codec == 'pcm':
+                return bytes(pcm_view(upload)[1])
+            return decode(upload)[1]
+
+        def streamed():
+            if codec == 'pcm':
+                return whole()
+            decoder = open_decoder(sniff(upload))
+            parts = [decoder.feed(upload[i:i + args.chunk_bytes]) for i in range(0, len(upload), args.chunk_bytes)]
+            parts.append(decoder.finish())
+            return b''.join(parts)
+
+        timings = {}
+        for name, fn in (('whole', whole), ('streamed', streamed)):
+            best = float('inf')
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                decoded = fn()
+                best = min(best, time.perf_counter() - start)
+            timings[name] = best
+        audio_format = probe(upload)
+        print(f"{codec:10} {per_second:7.1f} {len(upload) / len(uploads['pcm']):7.0%} {upload_s:9.2f} "
+              f"{args.seconds / timings['whole']:12.0f} {args.seconds / timings['streamed']:12.0f} "
+              f"{snr_db(pcm, decoded):7.1f} {audio_format.duration_ms / 1000:8.2f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Effect of the upstream layer (api/upstream.py) on LLM calls to the local
+fake, in three scenarios:
+
+  tail      a --slow-rate fraction of calls takes --slow-latency seconds;
+            latency percentiles without and with hedging
+  outage    every call fails; how quickly callers get an answer once the
+            circuit opens
+  hang      every call hangs for a minute; the attempt timeout bounds it
+
+    python -m benchmarks.upstream_tail [--calls 400] [--concurrency 4]
+"""
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from .common import setup_django, percentile
+from .fake_services import FakeServices, ServiceProfile, install
+
+
+def reset(upstream):
+    from api.upstream import LatencyWindow, CircuitBreaker
+    upstream.latency = LatencyWindow()
+    upstream.breaker = CircuitBreaker()
+    upstream.counters = dict.fromkeys(upstream.COUNTERS, 0)
+
+
+def run(processor, tag, calls, concurrency):
+    """Ask ``calls`` distinct questions; return (latency, ok) per call"""
+    def ask(i):
+        start = time.perf_counter()
+        try:
+            processor.process_text(f"{tag} question {i}")
+            ok = True
+        except Exception:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(ask, range(calls)))
+
+
+def report(name, results, upstream):
+    latencies = [latency for latency, _ in results]
+    failed = sum(1 for _, ok in results if not ok)
+    counters = upstream.stats()
+    print(f"{name:22} {percentile(latencies, 50) * 1000:8.0f} {percentile(latencies, 95) * 1000:8.0f} "
+          f"{percentile(latencies, 99) * 1000:8.0f} {max(latencies) * 1000:8.0f} {failed:7} "
+          f"{counters['hedges']:7} {counters['hedge_wins']:5} {counters['short_circuits']:7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=400)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.2)
+    parser.add_argument('--slow-rate', type=float, default=0.03)
+    parser.add_argument('--slow-latency', type=float, default=3.0)
+    args = parser.parse_args()
+
+    setup_django()
+    from django.conf import settings
+    from api import upstream
+    from api.speech_generator import SpeechProcessor
+
+    profile = ServiceProfile(args.latency, args.latency / 4, slow_rate=args.slow_rate, slow_latency=args.slow_latency)
+    services = FakeServices(llm=profile, token_delay=0).start()
+    install(services)
+    processor = SpeechProcessor()
+
+    print(f"LLM {args.latency * 1000:.0f} ms, {args.slow_rate:.0%} of calls {args.slow_latency * 1000:.0f} ms, "
+          f"{args.calls} calls x {args.concurrency} threads")
+    print(f"{'scenario':22} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8} {'failed':>7} "
+          f"{'hedges':>7} {'won':>5} {'tripped':>7}")
+    try:
+        for hedge in (None, settings.UPSTREAM_HEDGE_PERCENTILE or 95):
+            settings.UPSTREAM_HEDGE_PERCENTILE = hedge
+            reset(upstream.llm)
+            results = run(processor, f"tail{hedge}", args.calls, args.concurrency)
+            report(f"tail, hedge p{hedge}" if hedge else "tail, no hedging", results, upstream.llm)
+
+        profile.slow_rate = 0.0
+        profile.failure_rate = 1.0
+        reset(upstream.llm)
+        report("outage", run(processor, "outage", args.calls // 4, 1), upstream.llm)
+
+        profile.failure_rate = 0.0
+        profile.slow_rate = 1.0
+        profile.slow_latency = 60.0
+        settings.UPSTREAM_TIMEOUTS = {**settings.UPSTREAM_TIMEOUTS, 'llm': 2.0}
+        reset(upstream.llm)
+        report("hang, 2 s timeout", run(processor, "hang", args.concurrency, args.concurrency), upstream.llm)
+    finally:
+        services.stop()
+
+
+if __name__ == '__main__':
+    main()
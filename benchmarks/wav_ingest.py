@@ -0,0 +1,67 @@
+"""
+Compare the old pydub + temp file WAV ingest with the in-memory path in
+AudioProcessor. Both sides stop at a ready sr.AudioData (plus the FLAC
+encode recognize_google does), so no network is involved. The in-memory
+path includes preprocessing unless AUDIO_PREPROCESS is off.
+
+    python -m benchmarks.wav_ingest [--seconds 5] [--repeat 20]
+"""
+import os
+import argparse
+import tempfile
+from .common import setup_django, make_wav, measure
+
+
+def legacy_ingest(path):
+    """The pre-change path: decode with pydub, export to a temp file, re-read it"""
+    import speech_recognition as sr
+    from pydub import AudioSegment
+    audio = AudioSegment.from_wav(path)
+    temp_path = os.path.join(tempfile.gettempdir(), "temp_audio.wav")
+    try:
+        audio.export(temp_path, format="wav")
+        with sr.AudioFile(temp_path) as source:
+            return sr.Recognizer().record(source)
+    finally:
+        os.remove(temp_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    setup_django()
+    import mmap
+    from api.audio_processor import AudioProcessor
+
+    processor = AudioProcessor()
+    wav = make_wav(args.seconds)
+    fd, path = tempfile.mkstemp(suffix=".wav")
+    with os.fdopen(fd, "wb") as f:
+        f.write(wav)
+
+    def mmap_ingest():
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            audio_data, _ = processor.load_audio_data(mapped)
+            audio_data.get_flac_data()
+            del audio_data
+
+    cases = [
+        ("legacy pydub + temp file", lambda: legacy_ingest(path).get_flac_data()),
+        ("in-memory from upload buffer", lambda: processor.load_audio_data(wav)[0].get_flac_data()),
+        ("in-memory from mmap", mmap_ingest),
+    ]
+    try:
+        print(f"{args.seconds:.1f}s clip, {len(wav)} bytes, median of {args.repeat} runs")
+        print(f"{'path':32} {'latency ms':>12} {'peak KiB':>10}")
+        for name, fn in cases:
+            latency, peak = measure(fn, args.repeat)
+            print(f"{name:32} {latency * 1000:12.2f} {peak / 1024:10.1f}")
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,8 @@
 ASGI config for embedded_backend project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+HTTP goes to Django; WebSocket connections go to the device sessions of
+api/websocket.py, which Django itself does not handle.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
@@ -12,5 +14,16 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'embedded_backend.settings')
+# A server process: start the transcription workers with it (see TRANSCRIPTION_AUTOSTART)
+os.environ.setdefault('TRANSCRIPTION_AUTOSTART', '1')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported once the apps are loaded
+from api.websocket import websocket_application  # noqa: E402
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'websocket':
+        return await websocket_application(scope, receive, send)
+    return await django_application(scope, receive, send)
@@ -81,6 +81,11 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Transcription workers write from several threads; wait for the
+        # SQLite write lock instead of failing with "database is locked"
+        'OPTIONS': {
+            'timeout': 20,
+        },
     }
 }
 
@@ -139,4 +144,185 @@ AUDIO_FOLDER = os.path.join(MEDIA_ROOT, 'audio_files')
 from dotenv import load_dotenv
 load_dotenv()
 
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
\ No newline at end of file
+GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+
+# Background transcription queue (see api/jobs.py)
+TRANSCRIPTION_WORKERS = int(os.getenv("TRANSCRIPTION_WORKERS", "2"))
+# "thread" runs recognition in the worker threads, "process" hands it to a process pool
+TRANSCRIPTION_WORKER_MODE = os.getenv("TRANSCRIPTION_WORKER_MODE", "thread")
+# Seconds an idle worker sleeps before polling the queue table again
+TRANSCRIPTION_POLL_INTERVAL = 2.0
+# Jobs left "running" for longer than this are assumed dead and requeued
+TRANSCRIPTION_JOB_TIMEOUT = 300
+# Start the workers, and requeue abandoned jobs, when the app loads. Off unless
+# set: embedded_backend/wsgi.py and asgi.py turn it on for server processes, so
+# management commands, scripts and test runners never start workers. Set it to 1
+# for `runserver --noreload`, or to 0 to keep a server from starting them; they
+# then start with the first upload, or run separately with
+# `manage.py run_transcription_workers`.
+TRANSCRIPTION_AUTOSTART = os.getenv("TRANSCRIPTION_AUTOSTART", "0") == "1"
+# Entries in the in-process LRU of transcriptions keyed by PCM digest (0 disables it)
+TRANSCRIPTION_CACHE_SIZE = 1024
+
+# Streaming transcription of chunked uploads (POST /api/audio/?stream=1, see api/streaming.py)
+STREAMING_RECOGNITION_WORKERS = 4
+# Frame RMS below this fraction of full scale counts as silence
+STREAMING_SILENCE_THRESHOLD = 0.015
+# A pause this long closes a segment and sends it to the recognizer
+STREAMING_MIN_SILENCE_MS = 400
+# Segments are cut at this length even without a pause
+STREAMING_MAX_SEGMENT_MS = 15000
+
+# Cache of Gemini answers (see api/cache.py LLMResponseCache)
+LLM_CACHE_SIZE = 512
+# Seconds a cached answer stays valid, in memory and in the database (0 turns the cache off)
+LLM_CACHE_TTL = 24 * 60 * 60
+
+# Sentences synthesized in parallel while a streamed answer is still generating
+TTS_STREAM_WORKERS = 2
+
+# Start the AI response as soon as a transcription is saved, so GET
+# /api/audio/ai-process/<id>/ finds it ready or in flight (see api/services.py).
+# Uploads that are never asked for an answer still cost an LLM and TTS call.
+EAGER_RESPONSES = os.getenv("EAGER_RESPONSES", "") in ("1", "true")
+# Threads generating speculative responses per process
+EAGER_RESPONSE_WORKERS = 4
+# Seconds between checks for a response another process is generating
+EAGER_POLL_INTERVAL = 0.1
+
+# Playback formats of generated speech (see api/tts_formats.py): mp3 (gTTS
+# output as is), wav, pcm (raw 16-bit), ulaw or adpcm (IMA-ADPCM WAV).
+# Format of responses that ask for none with ?audio_format= or X-Audio-Format
+TTS_DEFAULT_FORMAT = "mp3"
+# Sample rate of the transcoded formats
+TTS_OUTPUT_SAMPLE_RATE = 16000
+# Formats made for every new clip right after synthesis, e.g. the one the
+# whole fleet plays; the rest are transcoded on first request
+TTS_PRETRANSCODE_FORMATS = []
+
+# Device commands answered locally, without the LLM (see api/intents.py).
+# Patterns are regular expressions matched against the whole transcription,
+# lowercased, without punctuation and with a leading wake word removed.
+# ``action`` is returned to the device as is.
+LOCAL_INTENTS = [
+    {
+        'name': 'ac_on',
+        'patterns': [r"(please )?turn on the (ac|air conditioner|air conditioning)", r"(ac|air conditioner) on"],
+        'response': "Okay, turning on the air conditioner.",
+        'action': {'device': 'ac', 'command': 'on'},
+    },
+    {
+        'name': 'ac_off',
+        'patterns': [r"(please )?turn off the (ac|air conditioner|air conditioning)", r"(ac|air conditioner) off"],
+        'response': "Okay, turning off the air conditioner.",
+        'action': {'device': 'ac', 'command': 'off'},
+    },
+    {
+        'name': 'lights_on',
+        'patterns': [r"(please )?turn on the lights?", r"lights? on"],
+        'response': "Okay, turning on the lights.",
+        'action': {'device': 'lights', 'command': 'on'},
+    },
+    {
+        'name': 'lights_off',
+        'patterns': [r"(please )?turn off the lights?", r"lights? off"],
+        'response': "Okay, turning off the lights.",
+        'action': {'device': 'lights', 'command': 'off'},
+    },
+]
+LOCAL_INTENT_WAKE_WORDS = ["ok google", "okay google", "hey google"]
+# Languages the canned responses are synthesized in at startup (with API_WARMUP)
+LOCAL_INTENT_LANGUAGES = ['en']
+
+# Device WebSocket sessions under ASGI (see api/websocket.py)
+WS_DEVICE_PATH = '/ws/device/'
+# Response audio is sent in binary messages of at most this many bytes
+WS_AUDIO_FRAME_BYTES = 4096
+# Largest upload of one interaction; the interaction is dropped beyond it
+WS_MAX_UPLOAD_BYTES = 10 * 1024 * 1024
+
+# Speech recognition backends tried in order (see api/recognizers.py).
+# "sphinx" runs offline and needs `pip install pocketsphinx`; "google" is remote.
+RECOGNIZER_BACKENDS = os.getenv("RECOGNIZER_BACKENDS", "google").split(",")
+RECOGNIZER_LANGUAGE = "en-US"
+# A result below this confidence (a probability, 0-1) falls through to the next
+# backend; one reported without a confidence is accepted
+RECOGNIZER_MIN_CONFIDENCE = 0.6
+# Override the Google Web Speech URL, e.g. to point at the local fake in benchmarks/
+GOOGLE_SPEECH_ENDPOINT = os.getenv("GOOGLE_SPEECH_ENDPOINT")
+
+# Pooled HTTP client of the async views (api/async_clients.py), per event loop.
+# Requests beyond the limit wait in asyncio; httpcore's own pool scan gets
+# CPU-bound with large pools, so raising this rarely helps throughput.
+ASYNC_HTTP_MAX_CONNECTIONS = 32
+ASYNC_HTTP_TIMEOUT = 30.0
+
+# Calls to Google STT, Gemini and gTTS (see api/upstream.py).
+# Seconds one request may spend on upstream calls in total
+UPSTREAM_DEADLINE = 20.0
+# Longest single attempt per upstream, capped by what is left of the deadline
+UPSTREAM_TIMEOUTS = {'stt': 10.0, 'llm': 15.0, 'tts': 10.0}
+# Send a duplicate request once the first is slower than this percentile of
+# recent calls (None disables hedging), after this many calls were observed
+UPSTREAM_HEDGE_PERCENTILE = 95
+UPSTREAM_HEDGE_MIN_SAMPLES = 20
+# At most this fraction of calls may be hedged, so an outage isn't doubled
+UPSTREAM_HEDGE_MAX_RATIO = 0.1
+# Consecutive failures that open a circuit, and seconds before it lets a trial call through
+UPSTREAM_BREAKER_FAILURES = 5
+UPSTREAM_BREAKER_RESET = 30.0
+# Threads running upstream attempts, and pooled keep-alive connections per host
+UPSTREAM_POOL_SIZE = 32
+# Local recognizers tried when every remote one is unavailable, e.g. "sphinx"
+RECOGNIZER_FALLBACK = [name for name in os.getenv("RECOGNIZER_FALLBACK", "").split(",") if name]
+
+# Admission control (see api/admission.py).
+# Calls in flight per upstream and worker process, hedges included (None for
+# no limit); further calls queue, device requests before batch work
+ADMISSION_CONCURRENCY = {'stt': 16, 'llm': 8, 'tts': 16}
+# Requests per second each device may make on average, and in a burst (0, the
+# default, disables the limit). Only requests with an X-Device-Id count: without
+# one, every device behind the same NAT or proxy would share a bucket.
+ADMISSION_DEVICE_RATE = float(os.getenv("ADMISSION_DEVICE_RATE", "0"))
+ADMISSION_DEVICE_BURST = 10
+
+# Media storage and cleanup (see api/storage.py and the sweep_media command).
+# Levels of hashed subdirectories under audio_files/ and generated_audio/;
+# each level has 256 directories, so 1 keeps a million files at ~4000 per directory
+MEDIA_SHARD_DEPTH = 1
+# Days files are kept, per media directory (None keeps them forever)
+MEDIA_RETENTION_DAYS = {'audio_files': 30, 'generated_audio': 90}
+# Bytes each directory may use; the oldest files are deleted first (None for no limit)
+MEDIA_QUOTA_BYTES = {'audio_files': 10 * 1024 ** 3, 'generated_audio': 2 * 1024 ** 3}
+# Unreferenced uploads and .part files younger than this (seconds) are left alone
+MEDIA_ORPHAN_GRACE = 60 * 60
+# Seconds between background sweeps in server processes (0 disables them)
+MEDIA_SWEEP_INTERVAL = 60 * 60
+# Files deleted per batch, and the pause between batches in seconds
+MEDIA_SWEEP_BATCH = 200
+MEDIA_SWEEP_PAUSE = 0.5
+
+# Serving media at MEDIA_URL (see api/media.py). "x-sendfile" (Apache
+# mod_xsendfile, lighttpd) or "x-accel-redirect" (nginx) leaves sending the
+# file to the front-end server; empty serves it from Django.
+MEDIA_OFFLOAD = os.getenv("MEDIA_OFFLOAD", "")
+# Internal nginx location that maps to MEDIA_ROOT, for x-accel-redirect
+MEDIA_ACCEL_REDIRECT_PREFIX = os.getenv("MEDIA_ACCEL_REDIRECT_PREFIX", "/protected-media/")
+# Cache-Control max-age of served files, per media directory
+MEDIA_CACHE_MAX_AGE = {'audio_files': 0, 'generated_audio': 7 * 24 * 60 * 60}
+
+# Load recognizer models and build the Gemini/gTTS clients in ApiConfig.ready.
+# Off by default so manage.py commands start fast; enable it for server workers.
+API_WARMUP = os.getenv("API_WARMUP", "0") == "1"
+
+# Preprocess audio before recognition (see api/preprocessing.py): downmix to
+# mono, resample, trim silence and normalize. Silent clips are rejected.
+AUDIO_PREPROCESS = True
+PREPROCESS_SAMPLE_RATE = 16000
+# Frames with RMS below this fraction of full scale count as silence
+PREPROCESS_SILENCE_THRESHOLD = 0.01
+# Silence kept around the detected speech
+PREPROCESS_PAD_MS = 150
+# RMS level speech is normalized to, and the most gain applied to get there
+PREPROCESS_TARGET_DBFS = -20.0
+PREPROCESS_MAX_GAIN_DB = 20.0
@@ -12,5 +12,7 @@ import os
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'embedded_backend.settings')
+# A server process: start the transcription workers with it (see TRANSCRIPTION_AUTOSTART)
+os.environ.setdefault('TRANSCRIPTION_AUTOSTART', '1')
 
 application = get_wsgi_application()